@@ -0,0 +1,400 @@
+"""Microbenchmarks for the bitmex package.
+
+Usage: python bench.py [name ...]   (runs every benchmark when no name is given)
+"""
+from __future__ import print_function
+
+import random
+import sys
+import time
+
+
+def timed(label, fn, n):
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    print("%-40s %10d ops %8.3f s %10.0f ops/s %8.3f us/op" % (label, n, elapsed, n / elapsed, elapsed * 1e6 / n))
+    return elapsed
+
+
+def bench_journal(n=100000):
+    """Order journal: appending an intent and its ack with group commit running, and recovering the
+    journal into an order store."""
+    import shutil
+    import tempfile
+    from bitmex.journal import ACK, INTENT, Journal
+
+    path = tempfile.mkdtemp()
+    try:
+        journal = Journal(path).start()
+        orders = [{'symbol': 'XBTUSD', 'side': 'Buy', 'orderQty': 100, 'price': 9000.5, 'ordType': 'Limit',
+                   'clOrdID': 'bench-%d' % i} for i in range(n)]
+        acks = [{'orderID': 'o-%d' % i, 'clOrdID': 'bench-%d' % i, 'symbol': 'XBTUSD', 'side': 'Buy',
+                 'ordStatus': 'New', 'orderQty': 100, 'leavesQty': 100, 'cumQty': 0, 'price': 9000.5,
+                 'timestamp': '2020-01-01T00:00:00.000Z'} for i in range(n)]
+
+        def append():
+            for i in range(n):
+                journal.append(INTENT, orders[i])
+                journal.append(ACK, acks[i])
+        timed("journal: intent + ack append", append, n)
+        journal.commit()
+        print("journal: %d commits for %d records" % (journal.commits, journal.appended))
+        timed("journal: recover", journal.recover, 2 * n)
+        journal.close()
+    finally:
+        shutil.rmtree(path)
+
+
+def bench_metrics(n=1000000):
+    """Cost of one instrumentation point: disabled (the default), and recording into a histogram."""
+    from bitmex.metrics import NULL_METRICS, Histogram, Metrics
+
+    def disabled():
+        metrics = NULL_METRICS
+        for _ in range(n):
+            started = time.perf_counter_ns() if metrics.enabled else 0
+            if started:
+                metrics.timing('request', time.perf_counter_ns() - started, endpoint='order', verb='POST')
+
+    def enabled():
+        metrics = Metrics()
+        for _ in range(n):
+            started = time.perf_counter_ns() if metrics.enabled else 0
+            if started:
+                metrics.timing('request', time.perf_counter_ns() - started, endpoint='order', verb='POST')
+
+    histogram = Histogram()
+    values = [random.randint(10 ** 5, 10 ** 9) for _ in range(n)]
+    timed("metrics: disabled", disabled, n)
+    timed("metrics: Metrics.timing", enabled, n)
+    timed("metrics: Histogram.record", lambda: [histogram.record(v) for v in values], n)
+    timed("metrics: Histogram.percentile", lambda: [histogram.percentile(99) for _ in range(n // 1000)], n // 1000)
+
+
+def bench_orderbook(n=1000000, levels=5000):
+    """Replay `n` level inserts/updates/deletes over a full-depth XBTUSD-like book."""
+    from bitmex.orderbook import OrderBook
+
+    rnd = random.Random(42)
+    tick = 0.5
+    mid = 10000.0
+    # Level ids follow the BitMEX convention of decreasing with price.
+    ids = lambda price: int(8800000000 - price * 100)
+    ops = []
+    live = {}
+    for _ in range(n):
+        price = mid + tick * rnd.randint(-levels, levels)
+        level_id = ids(price)
+        side = 'Buy' if price < mid else 'Sell'
+        if level_id in live:
+            if rnd.random() < 0.2:
+                ops.append(('delete', level_id, side, price, 0))
+                del live[level_id]
+            else:
+                ops.append(('update', level_id, side, price, rnd.randint(1, 100000)))
+        else:
+            live[level_id] = True
+            ops.append(('insert', level_id, side, price, rnd.randint(1, 100000)))
+
+    book = OrderBook('XBTUSD')
+
+    def replay():
+        insert, update, delete = book.insert, book.update, book.delete
+        for action, level_id, side, price, size in ops:
+            if action == 'update':
+                update(level_id, side, size)
+            elif action == 'insert':
+                insert(level_id, side, price, size)
+            else:
+                delete(level_id, side)
+
+    timed("orderbook replay", replay, n)
+    queries = 100000
+    timed("orderbook best bid/ask", lambda: [(book.best_bid(), book.best_ask()) for _ in range(queries)], queries)
+    timed("orderbook depth to price", lambda: [book.depth('Buy', mid - 50) for _ in range(queries)], queries)
+    timed("orderbook vwap 1M contracts", lambda: [book.vwap('Buy', 1000000) for _ in range(queries)], queries)
+    timed("orderbook imbalance top 25", lambda: [book.imbalance(25) for _ in range(queries)], queries)
+    print("levels in book: %d" % len(book))
+
+
+def bench_signing(n=100000):
+    """Per-request CPU cost of building and signing an order POST, before and after the fast path."""
+    import requests
+    from bitmex import bitmex
+    from bitmex.auth import generate_signature
+
+    class Account:
+        apiKey = 'LAqUlngMIQkIUjXMUreyu3qn'
+        apiSecret = 'chNOOS4KvNXR_Xq4k4c9qsfoKWvnDecLATCRlcBwyKDYnWgO'
+
+    client = bitmex.TradeClient(Account())
+    url = client.client.base_url + 'order'
+    postdict = {'symbol': 'XBTUSD', 'side': 'Buy', 'orderQty': 100, 'price': 10000.5, 'ordType': 'Limit',
+                'clOrdID': 'mm-000000000001'}
+
+    def legacy_auth(r):
+        expires = int(round(time.time()) + 5)
+        r.headers['api-expires'] = str(expires)
+        r.headers['api-key'] = Account.apiKey
+        r.headers['api-signature'] = generate_signature(Account.apiSecret, r.method, r.url, expires, r.body or '')
+        return r
+
+    def before():
+        session = client.client.session
+        for _ in range(n):
+            session.prepare_request(requests.Request('POST', url, json=postdict, auth=legacy_auth))
+
+    def after():
+        prepare, sign = client._prepare, client._sign
+        for _ in range(n):
+            sign(prepare('POST', url, None, postdict))
+
+    timed("signing: Request + prepare_request", before, n)
+    timed("signing: TradeClient._prepare + _sign", after, n)
+    timed("signing: generate_signature only",
+          lambda: [generate_signature(Account.apiSecret, 'POST', url, 1, '{}') for _ in range(n)], n)
+    timed("signing: Signer.sign only", lambda: [client.signer.sign('POST', url, 1, b'{}') for _ in range(n)], n)
+
+
+def bench_codecs(n=200):
+    """Decode/encode cost of each installed JSON codec on payloads shaped like the real ones."""
+    from bitmex import codec
+
+    rnd = random.Random(7)
+    trades = [{'timestamp': '2024-01-01T00:00:%02d.%03dZ' % (i % 60, i % 1000), 'symbol': 'XBTUSD',
+               'side': rnd.choice(('Buy', 'Sell')), 'size': rnd.randint(1, 50000), 'price': 10000 + i * 0.5,
+               'tickDirection': 'PlusTick', 'trdMatchID': '%032x' % rnd.getrandbits(128),
+               'grossValue': rnd.randint(1, 10 ** 9), 'homeNotional': rnd.random(), 'foreignNotional': 100}
+              for i in range(1000)]
+    book = {'table': 'orderBookL2', 'action': 'partial',
+            'data': [{'symbol': 'XBTUSD', 'id': 8800000000 - i, 'side': 'Sell' if i % 2 else 'Buy',
+                      'size': rnd.randint(1, 100000), 'price': 10000 + (i - 2500) * 0.5} for i in range(5000)]}
+    orders = [{'orderID': '%032x' % rnd.getrandbits(128), 'clOrdID': 'mm-%d' % i, 'symbol': 'XBTUSD',
+               'side': 'Buy', 'orderQty': 100, 'price': 10000.5, 'ordType': 'Limit', 'ordStatus': 'New',
+               'leavesQty': 100, 'cumQty': 0, 'avgPx': None, 'timestamp': '2024-01-01T00:00:00.000Z'}
+              for i in range(100)]
+    payloads = [('trades x1000', trades), ('L2 partial x5000', book), ('orders x100', orders)]
+
+    for label, payload in payloads:
+        raw = codec.CODECS['json'][1](payload)
+        for name in sorted(codec.CODECS):
+            loads, dumps = codec.CODECS[name]
+            timed("%s loads %s" % (name, label), lambda: [loads(raw) for _ in range(n)], n)
+            timed("%s dumps %s" % (name, label), lambda: [dumps(payload) for _ in range(n)], n)
+    print("selected codec: %s" % codec.name)
+
+
+def bench_replay(n=1000000, levels=5000):
+    """Record `n` synthetic book deltas and trades to a tick file, then replay them as fast as possible."""
+    import shutil
+    import tempfile
+    from bitmex.tickstore import ReplayWebsocket, TickRecorder, TickReplay
+
+    rnd = random.Random(11)
+    path = tempfile.mkdtemp(prefix='ticks-')
+    try:
+        recorder = TickRecorder(path, batch=65536)
+        partial = [{'symbol': 'XBTUSD', 'id': i, 'side': 'Sell' if i < levels else 'Buy',
+                    'price': 10000.0 + (levels - i) * 0.5, 'size': 100} for i in range(2 * levels)]
+        recorder.on_book('partial', partial, ts=1)
+        messages = []
+        for i in range(n):
+            level_id = rnd.randrange(2 * levels)
+            if i % 10:
+                messages.append(('update', [{'symbol': 'XBTUSD', 'id': level_id,
+                                             'side': 'Sell' if level_id < levels else 'Buy',
+                                             'size': rnd.randint(1, 100000)}]))
+            else:
+                messages.append(('insert', [{'symbol': 'XBTUSD', 'side': 'Buy', 'price': 10000.0, 'size': 10}]))
+
+        def record():
+            on_book, on_trade = recorder.on_book, recorder.on_trade
+            for ts, (action, data) in enumerate(messages, 2):
+                if action == 'update':
+                    on_book(action, data, ts)
+                else:
+                    on_trade(action, data, ts)
+            recorder.close()
+
+        timed("ticks record", record, n)
+        replay = TickReplay(path)
+        ws = ReplayWebsocket(replay)
+        timed("ticks replay into books/trades", lambda: replay.play(ws), len(replay))
+        timed("ticks scan messages", lambda: sum(1 for _ in replay.messages()), len(replay))
+        print("records: %d, file %.1f MB" % (len(replay), replay.records.nbytes / 1e6))
+    finally:
+        shutil.rmtree(path)
+
+
+def bench_positions(n=100000, symbols=500):
+    """Position engine: fills, and mark updates each revaluing `symbols` positions in one pass."""
+    from bitmex.positions import PositionEngine
+
+    engine = PositionEngine()
+    names = ['S%d' % i for i in range(symbols)]
+    for i, name in enumerate(names):
+        engine.fill(name, 100 * (1 if i % 2 else -1), 10000.0 + i)
+    timed("positions: fill", lambda: [engine.fill(names[i % symbols], 1 if i % 2 else -1, 10000.0 + i % 100)
+                                      for i in range(n)], n)
+    timed("positions: mark + revalue (%d symbols)" % symbols,
+          lambda: [engine.set_mark(names[i % symbols], 9000.0 + i % 2000) for i in range(n)], n)
+
+
+# Per-order budget of the risk gate (check + ack bookkeeping): a tenth of the 100us between orders
+# at 10k orders/s.
+RISK_RATE = 10000
+RISK_TARGET_US = 10.0
+
+
+def bench_risk(n=200000, symbols=10):
+    """Pre-trade risk gate with every limit on: the check of a new order, the check of an amend, and a
+    full order's life (check, ack, cancel ack). Fails if an order's life exceeds RISK_TARGET_US."""
+    from bitmex.positions import PositionEngine
+    from bitmex.risk import RiskGate
+
+    names = ['S%d' % i for i in range(symbols)]
+    positions = PositionEngine()
+    positions.load([{'symbol': name, 'currentQty': 100, 'avgEntryPrice': 10000.0, 'markPrice': 10000.0}
+                    for name in names])
+    gate = RiskGate(max_order_qty=10000, max_order_notional=10.0, max_open_orders=200, max_position=10 ** 9,
+                    price_band=0.05, positions=positions)
+    gate.prepare(names)
+    orders = [{'symbol': names[i % symbols], 'side': 'Buy' if i % 2 else 'Sell', 'orderQty': 100,
+               'price': 10000.0 - (i % 100) * 0.5, 'clOrdID': 'bench-%d' % i} for i in range(n)]
+    acks = [{'orderID': 'o-%d' % i, 'clOrdID': order['clOrdID'], 'symbol': order['symbol'], 'side': order['side'],
+             'ordStatus': 'New', 'leavesQty': 100} for i, order in enumerate(orders)]
+    cancels = [{'orderID': 'o-%d' % i, 'ordStatus': 'Canceled', 'leavesQty': 0} for i in range(n)]
+    amend = {'orderID': 'o-0', 'price': 10001.0, 'leavesQty': 150}
+
+    def check():
+        for order in orders:
+            gate.check(order['symbol'], 100, order['price'])
+    timed("risk: check", check, n)
+
+    def life():
+        for i in range(n):
+            gate.check_order(orders[i])
+            gate.on_ack(acks[i])
+            gate.on_ack(cancels[i])
+    elapsed = timed("risk: check + ack + cancel ack", life, n)
+    gate.check_order(orders[0])
+    gate.on_ack(acks[0])
+    timed("risk: amend check", lambda: [gate.check_amend(amend) for _ in range(n)], n)
+
+    per_order = elapsed * 1e6 / n
+    print("risk at %d orders/s: %.1f%% of one core, %.2f us/order (target %.0f us): %s" % (
+        RISK_RATE, per_order * RISK_RATE / 1e4, per_order, RISK_TARGET_US,
+        'ok' if per_order < RISK_TARGET_US else 'OVER'))
+    if per_order >= RISK_TARGET_US:
+        raise SystemExit(1)
+
+
+def bench_simulator(n=2000, threads=8):
+    """Order throughput and latency against the local simulator: `threads` workers each placing and
+    cancelling resting limit orders, `n` orders in total."""
+    from concurrent.futures import ThreadPoolExecutor
+    from bitmex import bitmex
+    from bitmex.ratelimit import RateLimiter
+    from bitmex.simulator import Simulator
+    from bitmex.transport import Transport
+
+    class Account:
+        apiKey = 'bench'
+        apiSecret = 'bench-secret'
+
+    with Simulator(accounts={Account.apiKey: Account.apiSecret}, rate_limit=10 ** 7) as sim:
+        client = bitmex.TradeClient(Account(), ratelimiter=RateLimiter(limit=10 ** 7),
+                                    transport=Transport(pool_maxsize=threads), base_url=sim.base_url)
+        latencies = []
+
+        def roundtrip(i):
+            start = time.perf_counter()
+            ack = client.buy('XBTUSD', 1, 'Limit', price=9000.0 - (i % 100) * 0.5)
+            placed = time.perf_counter()
+            client.cancel(ack['orderID'])
+            latencies.append((placed - start, time.perf_counter() - placed))
+
+        def run():
+            with ThreadPoolExecutor(max_workers=threads) as pool:
+                list(pool.map(roundtrip, range(n)))
+
+        timed("simulator place+cancel (%d threads)" % threads, run, n)
+        for k, label in enumerate(('place', 'cancel')):
+            values = sorted(l[k] for l in latencies)
+            print("%-40s p50 %7.3f ms  p99 %7.3f ms  max %7.3f ms" % (
+                "simulator %s latency" % label, values[len(values) // 2] * 1e3,
+                values[int(len(values) * 0.99)] * 1e3, values[-1] * 1e3))
+        print("responses: %s" % sim.responses)
+
+
+def bench_tracing(n=1000000):
+    """Cost of a tracing stamp, and of summarizing a full ring buffer."""
+    from bitmex.tracing import BOOK, Tracer
+
+    tracer = Tracer()
+    trace = tracer.begin()
+    timed("tracing: Tracer.record", lambda: [tracer.record(1, BOOK, 0) for _ in range(n)], n)
+    timed("tracing: Trace.stamp", lambda: [trace.stamp(BOOK) for _ in range(n)], n)
+    for _ in range(len(tracer.times)):
+        tracer.begin()
+    timed("tracing: Tracer.summary (full buffer)", tracer.summary, 1)
+
+
+STARTUP_SCRIPT = """
+import json, sys, time
+started = time.perf_counter()
+import bitmex_om
+imported = time.perf_counter()
+class Account:
+    apiKey = 'bench'
+    apiSecret = 'bench-secret'
+ex = bitmex_om.ExchangeInterface(sys.argv[1], config=Account())
+built = time.perf_counter()
+if sys.argv[2] == 'start':
+    ex.start()
+warmed = time.perf_counter()
+ex.create(bitmex_om.Order('bitmex', 'XBT', 'USD', 'Limit', 'buy', 1, 9000.0))
+acked = time.perf_counter()
+print(json.dumps({'import': imported - started, 'client': built - imported, 'start': warmed - built,
+                  'first order': acked - warmed, 'total': acked - started}))
+"""
+
+
+def bench_startup(n=10):
+    """Process startup: `import bitmex_om`, then cold-to-first-order against the local simulator, with
+    the first order sent straight away and after ExchangeInterface.start() (median of `n` processes)."""
+    import json
+    import os
+    import subprocess
+    from bitmex.simulator import Simulator
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    with Simulator(accounts={'bench': 'bench-secret'}, rate_limit=10 ** 7) as sim:
+        for mode in ('cold', 'start'):
+            runs = [json.loads(subprocess.check_output([sys.executable, '-c', STARTUP_SCRIPT, sim.base_url, mode],
+                                                       cwd=here)) for _ in range(n)]
+            for step in ('import', 'client', 'start', 'first order', 'total'):
+                values = sorted(run[step] for run in runs)
+                print("%-40s p50 %7.3f ms  max %7.3f ms" % (
+                    "startup (%s): %s" % (mode, step), values[len(values) // 2] * 1e3, values[-1] * 1e3))
+
+
+BENCHMARKS = {
+    'codecs': bench_codecs,
+    'journal': bench_journal,
+    'metrics': bench_metrics,
+    'orderbook': bench_orderbook,
+    'positions': bench_positions,
+    'replay': bench_replay,
+    'risk': bench_risk,
+    'signing': bench_signing,
+    'simulator': bench_simulator,
+    'startup': bench_startup,
+    'tracing': bench_tracing,
+}
+
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or sorted(BENCHMARKS):
+        BENCHMARKS[name]()
@@ -0,0 +1,557 @@
+"""Asyncio BitMEX API Connector.
+
+Same surface as `TradeClient`, but every call is a coroutine running on a pooled aiohttp
+connector, and retry backoff uses `asyncio.sleep`, so many requests can be in flight at once:
+
+    async with AsyncTradeClient(acc) as client:
+        await asyncio.gather(client.cancel(ids), client.balances(), client.position())
+"""
+from __future__ import absolute_import
+
+import asyncio
+import json
+import time
+
+import aiohttp
+from yarl import URL
+
+# python  3+ and 2+
+try:
+    from urllib.parse import urlencode
+except ImportError:
+    from urllib import urlencode
+
+from bitmex import codec
+from bitmex.auth import AuthenticationError, Signer, compact_json
+from bitmex.bitmex import BASE_URL, CONSTANT, SYMBOL, THROTTLE_CANCEL_ALL, THROTTLE_DEAD_MAN, THROTTLE_KEEP
+from bitmex.instruments import RELOAD_RETRY, InstrumentCache, round_order
+from bitmex.metrics import NULL_METRICS
+from bitmex.order import ClOrdIDGenerator
+from bitmex.ratelimit import RateLimiter, priority_for
+from bitmex.retry import RetryError, RetryPolicy, match_duplicates, sent_clordids
+from bitmex.risk import RiskError
+from bitmex.singleflight import AsyncSingleFlight, request_key
+
+
+class BitMEXHTTPError(Exception):
+    """Non-2xx response from BitMEX."""
+
+    def __init__(self, status, body, headers=None):
+        super(BitMEXHTTPError, self).__init__("HTTP %s: %s" % (status, body))
+        self.status = status
+        self.body = body
+        self.headers = headers or {}
+
+
+class AsyncTradeClient:
+    """BitMEX API Connector for asyncio."""
+
+    def __init__(self, acc, base_url=BASE_URL, pool_size=100, timeout=7, ratelimiter=None, metrics=None,
+                 retry_policy=None, session=None, symbol=SYMBOL, instruments=None, on_throttle=THROTTLE_KEEP):
+        self.apiKey = acc.apiKey
+        self.apiSecret = acc.apiSecret
+        self.signer = Signer.for_secret(self.apiSecret)
+        # Shared with any sync TradeClient of the same key, the budget is per account.
+        self.ratelimiter = ratelimiter or RateLimiter.for_key(self.apiKey)
+        # Seconds a request may wait for its token before failing at once; None waits as long as it takes.
+        self.ratelimit_timeout = None
+        self.public_ratelimiter = RateLimiter.for_key(None, limit=30)
+        self.metrics = metrics or NULL_METRICS
+        # May be shared with a sync TradeClient, the circuit breakers are thread-safe.
+        self.retry_policy = retry_policy or RetryPolicy()
+        # What a 429 does to our resting orders, as on `TradeClient`: THROTTLE_KEEP, THROTTLE_CANCEL_ALL
+        # or THROTTLE_DEAD_MAN (cancelAllAfter(dead_man_timeout)).
+        self.on_throttle = on_throttle
+        self.dead_man_timeout = 60
+        self._throttled_until = 0.0
+        self._armed = False
+        # The last reaction task; each one runs after the one before it.
+        self._reaction = None
+        self.base_url = base_url
+        self.symbol = symbol
+        self.pool_size = pool_size
+        self.timeout = timeout
+        # A session passed in is shared (e.g. by an AsyncExecutionEngine) and closed by its owner.
+        self.session = session
+        self.owns_session = session is None
+        self.clOrdID = ClOrdIDGenerator()
+        # Reloaded from instrument/active by `_instrument_cache`, never by the cache's own (blocking) fetch.
+        self.instruments = instruments or InstrumentCache()
+        self.round_orders = True
+        self._instruments_lock = None
+        self._instruments_reload = None
+        # A `bitmex.risk.RiskGate` checking new orders and amends; may be shared with a sync client.
+        self.risk = None
+        # A `bitmex.orderstore.OrderStore` fed with every order ack, e.g. the one an AsyncExecutionEngine
+        # keeps per account.
+        self.order_store = None
+        # Concurrent identical GETs share one request; None sends every read.
+        self.singleflight = AsyncSingleFlight()
+        # These headers are always sent
+        self.headers = {
+            'user-agent': 'liquidbot-1',
+            'content-type': 'application/json',
+            'accept': 'application/json',
+        }
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def open(self):
+        """Create the pooled session; called lazily by the first request if needed."""
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, limit_per_host=self.pool_size,
+                                             ttl_dns_cache=300, keepalive_timeout=60)
+            self.session = aiohttp.ClientSession(connector=connector, headers=self.headers)
+        return self.session
+
+    async def close(self):
+        if self._reaction is not None:
+            # A cancel-all or disarm still queued for the budget goes out first.
+            await asyncio.wait([self._reaction])
+        if self.session is not None and self.owns_session:
+            await self.session.close()
+            self.session = None
+
+    #
+    # Public methods
+    #
+    async def symbols(self):
+        cache = await self._instrument_cache()
+        return list(cache.active)
+
+    async def instrument(self, symbol):
+        """Get an instrument's details, from the instrument cache."""
+        cache = await self._instrument_cache()
+        instrument = cache.instruments.get(symbol)
+        if instrument is None:
+            data = await self._curl_bitmex(path='instrument', postdict={'symbol': symbol}, verb="GET")
+            instrument = data[0]
+            cache.put(instrument)
+        return instrument
+
+    async def ticker(self, symbol):
+        """Get ticker data."""
+        instrument = await self.instrument(symbol)
+        # If this is an index, we have to get the data from the last trade.
+        if instrument['symbol'][0] == '.':
+            ticker = {}
+            ticker['mid'] = ticker['buy'] = ticker['sell'] = ticker['last'] = instrument['markPrice']
+        # Normal instrument
+        else:
+            bid = instrument['bidPrice'] or instrument['lastPrice']
+            ask = instrument['askPrice'] or instrument['lastPrice']
+            ticker = {
+                "last": instrument['lastPrice'],
+                "buy": bid,
+                "sell": ask,
+                "mid": (bid + ask) / 2
+            }
+        return ticker
+
+    async def today(self, symbol):
+        data = await self.instrument(symbol)
+        return {
+            "low": data['lowPrice'],
+            "high": data['highPrice'],
+            "volume": data['volume']
+        }
+
+    async def order_book(self, symbol, depth=25):
+        """Get market depth / orderbook, same layout as `Client.order_book`."""
+        postdict = {
+            'symbol': symbol,
+            'depth': depth
+        }
+        return await self._curl_bitmex(path='orderBook/L2', postdict=postdict, verb="GET")
+
+    async def recent_trades(self, symbol):
+        return await self._curl_bitmex(path='trade', postdict={'symbol': symbol}, verb="GET")
+
+    #
+    # Authentication required methods
+    #
+    async def balances(self):
+        """Get your current balance: {currency: XBt, marginBalance: .., availableMargin: ..}"""
+        data = await self._curl_bitmex_private(path='user/margin', postdict={'currency': 'XBt'}, verb="GET")
+        if isinstance(data, dict):
+            return {'currency': data['currency'], 'marginBalance': data['marginBalance'],
+                    'availableMargin': data['availableMargin']}
+
+    def Xbt_to_XBT(self, xbt):
+        return xbt / float(CONSTANT)
+
+    async def position(self):
+        """Get your open positions."""
+        return await self._curl_bitmex_private(path='position', verb="GET")
+
+    async def close_position(self, symbol, price=None):
+        """close position if price is given then position close at that price otherwise close @ market price"""
+        postdict = {'symbol': symbol}
+        if price:
+            postdict.update({'price': price})
+        return await self._curl_bitmex_private(path='order/closePosition', postdict=postdict, verb="POST")
+
+    async def isolate_margin(self, symbol, leverage, rethrow_errors=False):
+        """Set the leverage on an isolated margin position"""
+        postdict = {
+            'symbol': symbol,
+            'leverage': leverage
+        }
+        return await self._curl_bitmex_private(path='position/leverage', postdict=postdict, verb="POST")
+
+    async def history(self, symbol=None):
+        """Trade history, for `symbol` if given otherwise for all symbols."""
+        postdict = {'symbol': symbol} if symbol else None
+        return await self._curl_bitmex_private(path='execution/tradeHistory', postdict=postdict, verb="GET")
+
+    async def delta(self, symbol=None):
+        symbol = symbol or self.symbol
+        for position in await self.position() or []:
+            if position['symbol'] == symbol:
+                return position['homeNotional']
+        return 0
+
+    async def buy(self, symbol, quantity, ordertpye, price=None, stopPx=None, clOrdID=None):
+        """Place a buy order. Returns order object. ID: orderID"""
+        return await self.place_order(symbol, quantity, ordertpye, price=price, stopPx=stopPx, clOrdID=clOrdID)
+
+    async def sell(self, symbol, quantity, ordertpye, price=None, stopPx=None, clOrdID=None):
+        """Place a sell order. Returns order object. ID: orderID"""
+        return await self.place_order(symbol, -quantity, ordertpye, price=price, stopPx=stopPx, clOrdID=clOrdID)
+
+    async def place_order(self, symbol, quantity, ordertpye, price=None, stopPx=None, clOrdID=None):
+        postdict = {}
+        if ordertpye != "Market":
+            if price is None or price < 0:
+                raise Exception("Price must be positive.")
+            postdict = {'price': price}
+            if ordertpye in ['StopLimit', 'LimitIfTouched']:
+                postdict.update({'stopPx': stopPx})
+        postdict.update({
+            'symbol': symbol,
+            'orderQty': quantity,
+            'ordType': ordertpye,
+            'clOrdID': clOrdID or self.clOrdID()
+        })
+        return await self._send_orders("order", [postdict], postdict, "POST")
+
+    async def amend_bulk_orders(self, orders):
+        """Amend multiple orders."""
+        return await self._send_orders('order/bulk', orders, {'orders': orders}, 'PUT', amend=True)
+
+    async def create_bulk_orders(self, orders):
+        """Create multiple orders."""
+        for order in orders:
+            order.setdefault('symbol', self.symbol)
+        return await self._send_orders('order/bulk', orders, {'orders': orders}, 'POST')
+
+    async def active_orders(self, symbol=None):
+        """Get open orders."""
+        query = {
+            'filter': json.dumps({"open": True, 'symbol': symbol or self.symbol}),
+            'count': 500
+        }
+        orders = await self._curl_bitmex_private(path="order", query=query, verb="GET")
+        if isinstance(orders, list):
+            return orders
+
+    async def orders(self, orderIDs=None, clOrdIDs=None):
+        """Get orders, open or not, by orderID and/or clOrdID."""
+        filter = {}
+        if orderIDs:
+            filter['orderID'] = orderIDs
+        if clOrdIDs:
+            filter['clOrdID'] = clOrdIDs
+        return await self._curl_bitmex_private(path="order", query={'filter': json.dumps(filter), 'count': 500},
+                                               verb="GET")
+
+    async def cancel(self, orderID):
+        """Cancel an existing order, or a list of them."""
+        return self._track(await self._curl_bitmex_private(path="order", postdict={'orderID': orderID}, verb="DELETE"))
+
+    async def cancel_all(self, symbol=None, text=None):
+        """Cancel all open orders, or those of `symbol`, in one DELETE order/all."""
+        postdict = {}
+        if symbol:
+            postdict['symbol'] = symbol
+        if text:
+            postdict['text'] = text
+        return self._track(await self._curl_bitmex_private(path='order/all', postdict=postdict or None, verb='DELETE'))
+
+    async def cancel_all_after(self, timeout):
+        """Arm the exchange-side dead man's switch for `timeout` seconds; 0 disarms it."""
+        return await self._curl_bitmex_private(path='order/cancelAllAfter', postdict={'timeout': int(timeout * 1000)},
+                                               verb='POST')
+
+    async def withdraw(self, amount, fee, address):
+        postdict = {
+            'amount': amount,
+            'fee': fee,
+            'currency': 'XBt',
+            'address': address
+        }
+        return await self._curl_bitmex_private(path="user/requestWithdrawal", postdict=postdict, verb="POST",
+                                               max_retries=0)
+
+    def _reload_instruments(self):
+        """Reload a stale instrument cache in a task, unless one is running or the last failed within
+        RELOAD_RETRY seconds."""
+        cache = self.instruments
+        if self._instruments_reload is not None and not self._instruments_reload.done():
+            return
+        if cache.failed is not None and time.monotonic() - cache.failed <= RELOAD_RETRY:
+            return
+
+        async def reload():
+            try:
+                await self._instrument_cache()
+            except Exception as e:
+                # The stale entries stay.
+                cache.failed = time.monotonic()
+                cache.last_error = e
+                cache.errors += 1
+        self._instruments_reload = asyncio.ensure_future(reload())
+
+    async def _instrument_cache(self):
+        """The instrument cache, reloaded first when stale; concurrent callers share one reload."""
+        cache = self.instruments
+        if cache.stale():
+            if self._instruments_lock is None:
+                self._instruments_lock = asyncio.Lock()
+            async with self._instruments_lock:
+                if cache.stale():
+                    cache.load(await self._curl_bitmex(path='instrument/active', verb="GET"))
+        return cache
+
+    async def _round(self, orders, amend=False):
+        """Round orders in place to their instrument's tick and lot size; amends without a symbol
+        are left alone. A stale cache is used as it is while a task reloads it."""
+        if not self.round_orders:
+            return
+        cache = self.instruments
+        if cache.loaded is None:
+            cache = await self._instrument_cache()
+        elif cache.stale():
+            self._reload_instruments()
+        for order in orders:
+            instrument = cache.instruments.get(order.get('symbol'))
+            if instrument is not None:
+                round_order(instrument, order, amend=amend)
+
+    async def _send_orders(self, path, orders, postdict, verb, amend=False):
+        """Round `orders` and put them through the risk gate (which refuses them with a RiskError), then
+        send `postdict` carrying them."""
+        await self._round(orders, amend)
+        risk = self.risk
+        if risk is None:
+            return self._track(await self._curl_bitmex_private(path=path, postdict=postdict, verb=verb))
+        try:
+            for order in orders:
+                risk.check_order(order, amend)
+        except RiskError as e:
+            self.metrics.incr('risk_rejected', check=e.check)
+            if not amend:
+                risk.release(orders)
+            raise
+        try:
+            acks = await self._curl_bitmex_private(path=path, postdict=postdict, verb=verb)
+        except BaseException:
+            if not amend:
+                risk.release(orders)
+            raise
+        return self._track(acks)
+
+    def _throttled(self, reset):
+        """Apply `on_throttle` once per throttle window, as on `TradeClient`: the reaction is a task sent
+        at once past the throttle, so the request that hit the 429 does not wait for it."""
+        if self.on_throttle == THROTTLE_KEEP or reset <= self._throttled_until:
+            return
+        self._throttled_until = reset
+        self._react(self._throttle_reaction)
+
+    def _react(self, reaction):
+        """Run the coroutine function `reaction` as a task, after the reaction before it."""
+        previous = self._reaction
+
+        async def run():
+            if previous is not None:
+                await asyncio.wait([previous])
+            await reaction()
+        self._reaction = asyncio.ensure_future(run())
+
+    async def _throttle_reaction(self):
+        try:
+            if self.on_throttle == THROTTLE_CANCEL_ALL:
+                self._track(await self._curl_bitmex_private(path='order/all', verb='DELETE', urgent=True))
+            elif self.on_throttle == THROTTLE_DEAD_MAN:
+                await self._curl_bitmex_private(path='order/cancelAllAfter', verb='POST', urgent=True,
+                                                postdict={'timeout': int(self.dead_man_timeout * 1000)})
+                self._armed = True
+        except Exception:
+            # Never let the reaction to a 429 fail anything else.
+            self.metrics.incr('errors', endpoint='throttle', kind=self.on_throttle)
+
+    def _recovered(self):
+        """Requests succeed again after a 429 armed the dead man's switch: disarm it."""
+        if time.time() < self._throttled_until:
+            return
+        self._armed = False
+        self._react(self._disarm)
+
+    async def _disarm(self):
+        try:
+            await self.cancel_all_after(0)
+        except Exception:
+            self.metrics.incr('errors', endpoint='throttle', kind='disarm')
+
+    def _track(self, acks):
+        """Feed order acks into the order store and the risk gate, so they do not wait for the stream
+        to catch up."""
+        if self.order_store is not None and acks:
+            for ack in acks if isinstance(acks, list) else [acks]:
+                if isinstance(ack, dict):
+                    self.order_store.update(ack)
+        if self.risk is not None and acks:
+            self.risk.on_ack(acks)
+        return acks
+
+    #
+    # Transport
+    #
+    async def _curl_bitmex(self, path, query=None, postdict=None, timeout=None, verb=None, max_retries=None):
+        return await self._curl_bitmex_private(path, query, postdict, timeout, verb, max_retries, private=False)
+
+    async def _curl_bitmex_private(self, path, query=None, postdict=None, timeout=None, verb=None,
+                                   max_retries=None, private=True, urgent=False):
+        """Send a request to BitMEX Servers.
+
+        Retries follow `retry_policy` with per-call state, so concurrent requests never share a retry
+        budget, and every wait is an `asyncio.sleep` that leaves the event loop free for other requests.
+        Identical GETs in flight at the same time are sent once and share the result (`singleflight`).
+        `urgent` sends the first attempt past the rate limiter's queue and any 429 block (see `_throttled`).
+        """
+        # Default to POST if data is attached, GET otherwise
+        if not verb:
+            verb = 'POST' if postdict else 'GET'
+
+        singleflight = self.singleflight
+        if singleflight is None:
+            return await self._request(path, query, postdict, timeout, verb, max_retries, private)
+        if verb == 'GET':
+            return await singleflight.do(request_key(verb, path, query, postdict, private), lambda: self._request(
+                path, query, postdict, timeout, verb, max_retries, private))
+        try:
+            return await self._request(path, query, postdict, timeout, verb, max_retries, private, urgent)
+        finally:
+            singleflight.invalidate()
+
+    async def _request(self, path, query, postdict, timeout, verb, max_retries, private, urgent=False):
+        session = await self.open()
+        url = self.base_url + path
+        if query:
+            url = url + '?' + urlencode(query)
+
+        # GET/DELETE are always retried, POST/PUT only when they carry clOrdIDs.
+        policy = self.retry_policy
+        state = policy.begin(verb, postdict, max_retries, path=path)
+        # Sent as encoded here: left to aiohttp, the query is requoted and no longer matches the signature.
+        request_url = URL(url, encoded=True)
+        timeout = aiohttp.ClientTimeout(total=timeout or self.timeout)
+        body = compact_json(postdict) if postdict is not None else b''
+
+        metrics = self.metrics
+        while True:
+            breaker = policy.check(path)
+            if private and not self.apiKey:
+                raise Exception("You must be authenticated to use this method")
+
+            wait = None
+            reason = None
+            ratelimiter = self.ratelimiter if private else self.public_ratelimiter
+            if urgent and state.attempt == 0:
+                ratelimiter.take(priority_for(verb, path))
+                waited = 0.0
+            else:
+                waited = await ratelimiter.acquire_async(priority_for(verb, path), self.ratelimit_timeout)
+            if waited:
+                metrics.timing('ratelimit_wait', int(waited * 1e9), endpoint=path)
+            # Signed once the token is ours, and on every attempt, so no wait can expire the signature.
+            headers = {}
+            if private:
+                started = time.perf_counter_ns() if metrics.enabled else 0
+                headers = self.signer.headers(self.apiKey, verb, url, body)
+                if started:
+                    metrics.timing('sign', time.perf_counter_ns() - started)
+            started = time.perf_counter_ns() if metrics.enabled else 0
+            try:
+                async with session.request(verb, request_url, data=body or None, headers=headers,
+                                           timeout=timeout) as response:
+                    ratelimiter.update(response.headers)
+                    status = response.status
+                    content = await response.read()
+                    if started:
+                        metrics.timing('request', time.perf_counter_ns() - started, endpoint=path, verb=verb)
+                        metrics.incr('responses', endpoint=path, status=status)
+                    # Anything but a server error shows the endpoint is up.
+                    if status >= 500:
+                        breaker.failure()
+                    else:
+                        breaker.success()
+                    if status < 300:
+                        if self._armed and private and not urgent:
+                            self._recovered()
+                        if not started:
+                            return codec.loads(content)
+                        started = time.perf_counter_ns()
+                        data = codec.loads(content)
+                        metrics.timing('decode', time.perf_counter_ns() - started, endpoint=path)
+                        return data
+                    text = content.decode('utf8', 'replace')
+
+                    # 401 - Auth error. This is fatal.
+                    if status == 401:
+                        raise AuthenticationError(path, text)
+                    # 404, can be thrown if order canceled or does not exist.
+                    elif status == 404 and verb == 'DELETE':
+                        return
+                    # 429, ratelimit; hold this budget until it resets. The retry waits in the rate limiter,
+                    # behind any cancels, and is signed once it leaves; `on_throttle` sees to our resting orders.
+                    elif status == 429:
+                        wait = ratelimiter.throttle(response.headers) - time.time()
+                        reason = '429'
+                        # A reaction answered 429 waits for the budget like any request; it does not react again.
+                        if private and not urgent:
+                            self._throttled(time.time() + wait)
+                    # 503 - BitMEX temporary downtime, likely due to a deploy. Try again
+                    elif status == 503:
+                        reason = '503'
+                    # Duplicate clOrdID: an earlier attempt landed, go get the order(s) and return it
+                    elif status == 400 and postdict and 'duplicate clordid' in text.lower():
+                        found = await self._curl_bitmex_private(
+                            'order', query={'filter': json.dumps({'clOrdID': sent_clordids(postdict)}), 'count': 500},
+                            verb='GET')
+                        return match_duplicates(postdict, found)
+                    else:
+                        raise BitMEXHTTPError(status, text, dict(response.headers))
+                    error = BitMEXHTTPError(status, text, dict(response.headers))
+
+            except asyncio.TimeoutError as e:
+                breaker.failure()
+                error, reason = e, 'timeout'
+            except aiohttp.ClientConnectionError as e:
+                breaker.failure()
+                error, reason = e, 'connection'
+            metrics.incr('errors', endpoint=path, kind=reason)
+
+            delay = state.next_delay(wait)
+            if delay is None:
+                raise RetryError("Max retries on %s (%s) hit, raising." % (path, body.decode('utf8')), error)
+            metrics.incr('retries', endpoint=path)
+            if delay and reason != '429':
+                metrics.timing('backoff', int(delay * 1e9), endpoint=path, reason=reason)
+                await asyncio.sleep(delay)
@@ -0,0 +1,154 @@
+"""BitMEX request signing."""
+from __future__ import absolute_import
+
+import hashlib
+import hmac
+import threading
+import time
+import weakref
+
+# python  3+ and 2+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+from requests.auth import AuthBase
+
+from bitmex import codec
+
+# Parsed request paths are cached per url; cleared wholesale when it grows past this.
+PATH_CACHE_SIZE = 4096
+_path_cache = {}
+
+
+class AuthenticationError(Exception):
+    """BitMEX answered 401: the key or secret is wrong, or the signature had expired. Not retried."""
+
+    def __init__(self, path, message):
+        super(AuthenticationError, self).__init__("Authentication failed on %s: %s" % (path, message))
+        self.path = path
+        self.message = message
+
+
+def generate_signature(secret, verb, url, nonce, data):
+    """Generate a request signature compatible with BitMEX.
+
+    Generates an API signature.
+    A signature is HMAC_SHA256(secret, verb + path + nonce + data), hex encoded.
+    Verb must be uppercased, url is relative, nonce must be an increasing 64-bit integer
+    and the data, if present, must be JSON without whitespace between keys.
+
+    For example, in psuedocode (and in real code below):
+
+    verb=POST
+    url=/api/v1/order
+    nonce=1416993995705
+    data={"symbol":"XBTZ14","quantity":1,"price":395.01}
+    signature = HEX(HMAC_SHA256(secret, 'POST/api/v1/order1416993995705{"symbol":"XBTZ14","quantity":1,"price":395.01}'))
+"""
+    # Parse the url so we can remove the base and extract just the path.
+    parsedURL = urlparse(url)
+    path = parsedURL.path
+    if parsedURL.query:
+        path = path + '?' + parsedURL.query
+
+    if isinstance(data, (bytes, bytearray)):
+        data = data.decode('utf8')
+
+    # print "Computing HMAC: %s" % verb + path + str(nonce) + data
+    message = verb + path + str(nonce) + data
+
+    signature = hmac.new(bytearray(secret, 'utf8'), bytearray(message, 'utf8'), digestmod=hashlib.sha256).hexdigest()
+    return signature
+
+
+def request_path(url):
+    """Path plus query of `url`, the part of the url that is signed. Cached per url."""
+    path = _path_cache.get(url)
+    if path is None:
+        parsedURL = urlparse(url)
+        path = parsedURL.path
+        if parsedURL.query:
+            path = path + '?' + parsedURL.query
+        if len(_path_cache) >= PATH_CACHE_SIZE:
+            _path_cache.clear()
+        _path_cache[url] = path
+    return path
+
+
+def compact_json(data):
+    """Serialize a request body once, without whitespace, so the signed bytes are the sent bytes."""
+    return codec.dumps(data)
+
+
+class Signer:
+    """HMAC-SHA256 signer with the key schedule done once.
+
+    The keyed HMAC state is built once per secret and `copy()`-ed for each request, and the
+    verb + path prefix of the message is cached per url. Signers are shared per secret while some
+    client still holds one; the registry is keyed by a digest, so it never holds the secret itself.
+    """
+    _signers = weakref.WeakValueDictionary()
+    _lock = threading.Lock()
+
+    def __init__(self, secret):
+        self._mac = hmac.new(secret.encode('utf8'), digestmod=hashlib.sha256)
+        self._prefixes = {}
+
+    @classmethod
+    def for_secret(cls, secret):
+        key = hashlib.sha256(secret.encode('utf8')).digest()
+        with cls._lock:
+            signer = cls._signers.get(key)
+            if signer is None:
+                signer = cls._signers[key] = cls(secret)
+        return signer
+
+    def sign(self, verb, url, expires, body=b''):
+        """Same result as generate_signature(secret, verb, url, expires, body); `body` is bytes."""
+        prefix = self._prefixes.get((verb, url))
+        if prefix is None:
+            if len(self._prefixes) >= PATH_CACHE_SIZE:
+                self._prefixes.clear()
+            prefix = self._prefixes[(verb, url)] = (verb + request_path(url)).encode('utf8')
+        mac = self._mac.copy()
+        mac.update(prefix)
+        mac.update(str(expires).encode('ascii'))
+        if body:
+            mac.update(body)
+        return mac.hexdigest()
+
+    def headers(self, apiKey, verb, url, body=b''):
+        """The api-expires/api-key/api-signature headers for one request."""
+        expires = int(round(time.time()) + 5)  # 5s grace period in case of clock skew
+        return {
+            'api-expires': str(expires),
+            'api-key': apiKey,
+            'api-signature': self.sign(verb, url, expires, body),
+        }
+
+
+class APIKeyAuthWithExpires(AuthBase):
+    """Attaches API Key Authentication to the given Request object. This implementation uses `expires`."""
+
+    def __init__(self, apiKey, apiSecret):
+        """Init with Key & Secret."""
+        self.apiKey = apiKey
+        self.apiSecret = apiSecret
+        self.signer = Signer.for_secret(apiSecret)
+
+    def __call__(self, r):
+        """
+        Called when forming a request - generates api key headers. This call uses `expires` instead of nonce.
+
+        This way it will not collide with other processes using the same API Key if requests arrive out of order.
+        For more details, see https://www.bitmex.com/app/apiKeys
+        """
+        # modify and return the request
+        body = r.body or b''
+        if not isinstance(body, bytes):
+            body = body.encode('utf8')
+        r.headers.update(self.signer.headers(self.apiKey, r.method, r.url, body))
+
+        return r
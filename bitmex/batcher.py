@@ -0,0 +1,252 @@
+"""Coalesce individual order requests into BitMEX bulk calls.
+
+New orders and amends submitted within a short window are sent as one POST/PUT order/bulk and
+cancels as one multi-ID DELETE order, so requoting a ladder costs one request and one rate-limit
+token. Every submission gets a `concurrent.futures.Future` resolved with its own ack
+(use `asyncio.wrap_future` from async code). A submission's `bitmex.tracing.Trace`, if any, is
+stamped as the bulk request carrying it is signed, sent and acked.
+
+Queued amends are superseded rather than stacked. A second amend of the same order is merged into the
+queued one, and each caller's future resolves with the one ack; the merged amend is withdrawn only
+if every one of them is cancelled. A cancel drops the queued amends of its orders, whether they name
+the order by orderID or by origClOrdID, and their futures are cancelled. While the account is throttled (429) the queues keep
+absorbing requotes, so when the budget returns only the latest price of each order goes out.
+
+Creates and amends are rounded to tick and lot size, and checked by the client's risk gate if it
+has one, as they are queued. A refused one is never queued, and only its own future fails, with the
+ValueError of an order below the lot size or the `bitmex.risk.RiskError`.
+
+Cancelling a submission's future before its batch goes out withdraws it from the batch; once the
+batch is on its way the future can no longer be cancelled.
+"""
+from __future__ import absolute_import
+
+import threading
+import time
+from concurrent.futures import Future
+
+CREATE = 'create'
+AMEND = 'amend'
+CANCEL = 'cancel'
+# Cancels go out first when several batches are due at once.
+FLUSH_ORDER = (CANCEL, AMEND, CREATE)
+
+
+def amend_key(order):
+    return order.get('orderID') or order.get('origClOrdID')
+
+
+def order_ids(item):
+    """The orderIDs of a queued cancel, which names one order or a list of them."""
+    return item if isinstance(item, list) else [item]
+
+
+class OrderBatcher:
+    """Collects creates, amends and cancels and flushes each kind when its window elapses or it
+    reaches `max_batch` entries."""
+
+    def __init__(self, client, window=0.002, max_batch=50):
+        self.client = client
+        self.window = window
+        self.max_batch = max_batch
+        self.cond = threading.Condition()
+        self.pending = dict((kind, []) for kind in FLUSH_ORDER)
+        self.deadlines = dict((kind, None) for kind in FLUSH_ORDER)
+        self.running = True
+        # Metrics
+        self.requests = 0
+        self.submitted = 0
+        self.merged = 0
+        self.dropped = 0
+        self.thread = threading.Thread(target=self._run, name='OrderBatcher')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, order, trace=None):
+        """Queue a new order (an order/bulk dict: symbol, side, orderQty, price, ordType, ...)."""
+        return self._checked(CREATE, order, trace)
+
+    def amend(self, order, trace=None):
+        """Queue an amend; `order` carries orderID or origClOrdID plus the fields to change."""
+        return self._checked(AMEND, order, trace)
+
+    def cancel(self, orderID, trace=None):
+        """Queue a cancel of an orderID, or of a list of them; the future resolves with the ack, or a
+        list of acks."""
+        return self._enqueue(CANCEL, list(orderID) if isinstance(orderID, (list, tuple)) else orderID, trace)
+
+    def _checked(self, kind, item, trace=None):
+        """Round and check `item` on its own before queuing it, so it cannot fail the bulk call."""
+        try:
+            self.client._pretrade([item], amend=kind == AMEND)
+        except Exception as e:
+            future = Future()
+            future.set_exception(e)
+            return future
+        try:
+            return self._enqueue(kind, item, trace)
+        except Exception:
+            risk = self.client.risk
+            if kind == CREATE and risk is not None:
+                risk.release([item])
+            raise
+
+    def _enqueue(self, kind, item, trace=None):
+        future = Future()
+        with self.cond:
+            if not self.running:
+                raise Exception("OrderBatcher is closed")
+            queue = self.pending[kind]
+            self.submitted += 1
+            if kind == AMEND and self._merge_amend(item, future):
+                return future
+            if kind == CANCEL:
+                self._drop_amends(item)
+            if not queue:
+                self.deadlines[kind] = time.monotonic() + self.window
+            # Every caller of a merged amend has a future of its own in the entry.
+            queue.append((item, [future], trace))
+            self.cond.notify()
+        return future
+
+    def _merge_amend(self, item, future):
+        """Fold `item` into a queued amend of the same order that a caller still waits for; `future`
+        joins that amend's futures."""
+        key = amend_key(item)
+        if key is None:
+            return False
+        for queued, futures, _ in self.pending[AMEND]:
+            if amend_key(queued) == key and not all(f.cancelled() for f in futures):
+                queued.update(item)
+                futures.append(future)
+                self.merged += 1
+                return True
+        return False
+
+    def _drop_amends(self, orderIDs):
+        keys = set(order_ids(orderIDs))
+        # Amends may name the order by the clOrdID it was placed with.
+        store = getattr(self.client, 'order_store', None)
+        if store is not None:
+            for orderID in list(keys):
+                state = store.get(orderID)
+                if state is not None and state.clOrdID:
+                    keys.add(state.clOrdID)
+        kept = []
+        for entry in self.pending[AMEND]:
+            if entry[0].get('orderID') in keys or entry[0].get('origClOrdID') in keys:
+                for future in entry[1]:
+                    future.cancel()
+                self.dropped += 1
+            else:
+                kept.append(entry)
+        self.pending[AMEND] = kept
+        if not kept:
+            self.deadlines[AMEND] = None
+
+    def flush(self):
+        """Send everything queued right now."""
+        with self.cond:
+            for kind in FLUSH_ORDER:
+                self.deadlines[kind] = 0 if self.pending[kind] else None
+            self.cond.notify()
+
+    def close(self, flush=True):
+        if flush:
+            self.flush()
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        self.thread.join()
+
+    def _due(self, now):
+        due = []
+        for kind in FLUSH_ORDER:
+            queue = self.pending[kind]
+            if queue and (len(queue) >= self.max_batch or now >= self.deadlines[kind] or not self.running):
+                due.append((kind, queue[:self.max_batch]))
+                self.pending[kind] = queue[self.max_batch:]
+                self.deadlines[kind] = now + self.window if self.pending[kind] else None
+        return due
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while True:
+                    now = time.monotonic()
+                    due = self._due(now)
+                    if due or (not self.running and not any(self.pending.values())):
+                        break
+                    deadlines = [d for d in self.deadlines.values() if d is not None]
+                    self.cond.wait(min(deadlines) - now if deadlines else None)
+            if not due:
+                return
+            for kind, batch in due:
+                self._send(kind, batch)
+
+    def _send(self, kind, batch):
+        # Futures still pending are marked running, so no caller can cancel them under us. An entry
+        # whose futures were all cancelled is withdrawn.
+        live = []
+        withdrawn = []
+        for item, futures, trace in batch:
+            futures = [future for future in futures if future.set_running_or_notify_cancel()]
+            if futures:
+                live.append((item, futures, trace))
+            else:
+                withdrawn.append(item)
+        if withdrawn:
+            risk = getattr(self.client, 'risk', None)
+            if kind == CREATE and risk is not None:
+                risk.release(withdrawn)
+            if not live:
+                return
+        items = [item for item, _, _ in live]
+        traces = [trace for _, _, trace in live if trace is not None] or None
+        try:
+            self.requests += 1
+            if kind == CREATE:
+                acks = self.client.create_bulk_orders(items, trace=traces)
+            elif kind == AMEND:
+                acks = self.client.amend_bulk_orders(items, trace=traces)
+            else:
+                acks = self.client.cancel([orderID for item in items for orderID in order_ids(item)], trace=traces)
+        except BaseException as e:
+            for _, futures, _ in live:
+                for future in futures:
+                    future.set_exception(e)
+            return
+        for (_, futures, _), ack in zip(live, self._match(kind, items, acks)):
+            for future in futures:
+                future.set_result(ack)
+
+    @staticmethod
+    def _match(kind, items, acks):
+        """Line up the acks of a bulk call with the submissions, by id where there is one. A cancel of a
+        list of orders gets the list of their acks."""
+        if not isinstance(acks, list):
+            return [acks] * len(items)
+        by_id = {}
+        for ack in acks:
+            if isinstance(ack, dict):
+                for key in ('orderID', 'clOrdID'):
+                    if ack.get(key):
+                        by_id[ack[key]] = ack
+        if kind == CANCEL:
+            keys = [order_ids(item) for item in items]
+        else:
+            keys = [[item.get('orderID') or item.get('clOrdID') or item.get('origClOrdID')] for item in items]
+        # Without ids, acks are taken to come back in the order they were sent.
+        in_order = len(acks) == sum(len(k) for k in keys)
+        matched = []
+        i = 0
+        for item, item_keys in zip(items, keys):
+            found = []
+            for key in item_keys:
+                ack = by_id.get(key) if key else None
+                if ack is None and in_order:
+                    ack = acks[i]
+                found.append(ack)
+                i += 1
+            matched.append(found if isinstance(item, list) else found[0])
+        return matched
@@ -1,20 +1,30 @@
 """BitMEX API Connector."""
 from __future__ import absolute_import
 
-import hashlib
-import hmac
-# python  3+ and 2+
-try:
-    from urllib.parse import urlparse
-except ImportError:
-    from urlparse2 import urlparse
-
 import requests
 import time
-import datetime
 import json
 
-from requests.auth import AuthBase
+from requests.structures import CaseInsensitiveDict
+
+from bitmex import codec
+from bitmex.auth import APIKeyAuthWithExpires, AuthenticationError, Signer, compact_json, generate_signature
+from bitmex.instruments import InstrumentCache
+from bitmex.journal import AMEND, INTENT
+from bitmex.metrics import NULL_METRICS
+from bitmex.order import ClOrdIDGenerator
+from bitmex.orderstore import OrderStore
+from bitmex.ratelimit import RateLimiter, priority_for
+from bitmex.retry import RetryError, RetryPolicy, match_duplicates, sent_clordids
+from bitmex.risk import RiskError, RiskGate
+from bitmex.singleflight import SingleFlight, request_key
+from bitmex.tracing import ACKED, SENT, SIGNED, stamp
+from bitmex.transport import Transport
+
+__all__ = ['APIKeyAuthWithExpires', 'BASE_URL', 'CONSTANT', 'Client', 'HOST', 'PROTOCOL', 'SYMBOL',
+           'THROTTLE_CANCEL_ALL', 'THROTTLE_DEAD_MAN', 'THROTTLE_KEEP', 'TradeClient', 'VERSION',
+           'generate_nonce', 'generate_signature', 'page_params']
+# APIKeyAuthWithExpires and generate_signature were defined here before bitmex.auth; still importable from here.
 
 PROTOCOL = "https"
 HOST = "www.bitmex.com/api"
@@ -23,76 +33,43 @@ CONSTANT = 100000000
 BASE_URL = 'https://www.bitmex.com/api/v1/'
 SYMBOL = 'XBTUSD'
 
+# What to do with our resting orders when the account budget is exhausted (429), see TradeClient.
+THROTTLE_KEEP = 'keep'  # leave them resting
+THROTTLE_CANCEL_ALL = 'cancel_all'  # one DELETE order/all, sent at once past the throttle
+THROTTLE_DEAD_MAN = 'dead_man'  # arm cancelAllAfter(dead_man_timeout) at once, disarmed once requests succeed
+
 
 def generate_nonce():
     return int(round(time.time() * 10000))
 
 
-def generate_signature(secret, verb, url, nonce, data):
-    """Generate a request signature compatible with BitMEX.
-
-    Generates an API signature.
-    A signature is HMAC_SHA256(secret, verb + path + nonce + data), hex encoded.
-    Verb must be uppercased, url is relative, nonce must be an increasing 64-bit integer
-    and the data, if present, must be JSON without whitespace between keys.
-
-    For example, in psuedocode (and in real code below):
-
-    verb=POST
-    url=/api/v1/order
-    nonce=1416993995705
-    data={"symbol":"XBTZ14","quantity":1,"price":395.01}
-    signature = HEX(HMAC_SHA256(secret, 'POST/api/v1/order1416993995705{"symbol":"XBTZ14","quantity":1,"price":395.01}'))
-"""
-    # Parse the url so we can remove the base and extract just the path.
-    parsedURL = urlparse(url)
-    path = parsedURL.path
-    if parsedURL.query:
-        path = path + '?' + parsedURL.query
-
-    if isinstance(data, (bytes, bytearray)):
-        data = data.decode('utf8')
-
-    # print "Computing HMAC: %s" % verb + path + str(nonce) + data
-    message = verb + path + str(nonce) + data
-
-    signature = hmac.new(bytearray(secret, 'utf8'), bytearray(message, 'utf8'), digestmod=hashlib.sha256).hexdigest()
-    return signature
-
-
-class APIKeyAuthWithExpires(AuthBase):
-    """Attaches API Key Authentication to the given Request object. This implementation uses `expires`."""
-
-    def __init__(self, apiKey, apiSecret):
-        """Init with Key & Secret."""
-        self.apiKey = apiKey
-        self.apiSecret = apiSecret
-
-    def __call__(self, r):
-        """
-        Called when forming a request - generates api key headers. This call uses `expires` instead of nonce.
-
-        This way it will not collide with other processes using the same API Key if requests arrive out of order.
-        For more details, see https://www.bitmex.com/app/apiKeys
-        """
-        # modify and return the request
-        expires = int(round(time.time()) + 5)  # 5s grace period in case of clock skew
-        r.headers['api-expires'] = str(expires)
-        r.headers['api-key'] = self.apiKey
-        r.headers['api-signature'] = generate_signature(self.apiSecret, r.method, r.url, expires, r.body or '')
-
-        return r
+def page_params(count=None, start=None, startTime=None, endTime=None, reverse=None):
+    """The paging/time-range filters that were given, as request params."""
+    params = {}
+    for name, value in (('count', count), ('start', start), ('startTime', startTime), ('endTime', endTime),
+                        ('reverse', reverse)):
+        if value is not None:
+            params[name] = value
+    return params
 
 
 class Client:
-    def __init__(self):
+    def __init__(self, transport=None, base_url=BASE_URL, symbol=SYMBOL, instruments=None):
+        """Public market data. Instrument details are cached in `instruments` (a
+        `bitmex.instruments.InstrumentCache`), by default one loaded through instrument/active."""
         # self.logger = logging.getLogger('root')
-        self.base_url = BASE_URL
-        self.symbol = SYMBOL
-        self.retries = 0  # initialize counter
+        self.base_url = base_url
+        self.symbol = symbol
+        self.ws = None
+        # Unauthenticated requests are limited per IP, separately from the account.
+        self.public_ratelimiter = RateLimiter.for_key(None, limit=30)
+        self.instruments = instruments or InstrumentCache()
+        if self.instruments.fetch is None:
+            self.instruments.fetch = self._active_instruments
 
         # Prepare HTTPS session
-        self.session = requests.Session()
+        self.transport = transport or Transport()
+        self.session = self.transport.session
         # These headers are always sent
         self.session.headers.update({'user-agent': 'liquidbot-1'})
         self.session.headers.update({'content-type': 'application/json'})
@@ -101,6 +78,24 @@ class Client:
     def server(self):
         return u"{0:s}://{1:s}/{2:s}".format(PROTOCOL, HOST, VERSION)
 
+    def _active_instruments(self):
+        return self._curl_bitmex(path='instrument/active', verb="GET")
+
+    def _curl_bitmex(self, path, query=None, postdict=None, timeout=7, verb=None, rethrow_errors=False,
+                     max_retries=None):
+        """Send an unauthenticated request to BitMEX Servers, paced by the public rate limiter. Errors
+        are raised; `TradeClient` adds retries, circuit breakers and metrics."""
+        if not verb:
+            verb = 'POST' if postdict else 'GET'
+        self.public_ratelimiter.acquire(priority_for(verb, path))
+        response = self.session.request(verb, self.base_url + path, params=query, timeout=timeout,
+                                        data=compact_json(postdict) if postdict is not None else None)
+        self.public_ratelimiter.update(response.headers)
+        if response.status_code == 429:
+            self.public_ratelimiter.throttle(response.headers)
+        response.raise_for_status()
+        return codec.loads(response.content)
+
     #
     # Public methods
     #
@@ -109,16 +104,11 @@ class Client:
         curl -X GET --header 'Accept: application/json' 'https://www.bitmex.com/api/v1/instrument/active'
         :return:[XBTUSD,..] list of symbols
         """
-        endpoint = 'instrument/active'
-        data = self._curl_bitmex(path=endpoint, verb="GET")
-        symbols = list(map(lambda i: i['symbol'], data))
-        return symbols
+        return self.instruments.symbols()
 
     def ticker(self, symbol):
-        """Get ticker data."""
-        endpoint = 'instrument'
-        postdict = {'symbol': symbol}
-        instrument = self._curl_bitmex(path=endpoint, postdict=postdict, verb="GET")[0]
+        """Get ticker data; without a websocket the prices are as old as the instrument cache."""
+        instrument = self.instrument(symbol)
         # If this is an index, we have to get the data from the last trade.
         if instrument['symbol'][0] == '.':
             ticker = {}
@@ -137,19 +127,24 @@ class Client:
 
     def instrument(self, symbol):
         """Get an instrument's details."""
-
-        endpoint = 'instrument'
-        postdict = {'symbol': symbol}
-        return self._curl_bitmex(path=endpoint, postdict=postdict, verb="GET")[0]
+        if self.ws is not None:
+            instrument = self.ws.live_instrument(symbol)
+            if instrument is not None:
+                return instrument
+
+        instrument = self.instruments.get(symbol)
+        if instrument is None:
+            endpoint = 'instrument'
+            postdict = {'symbol': symbol}
+            instrument = self._curl_bitmex(path=endpoint, postdict=postdict, verb="GET")[0]
+            self.instruments.put(instrument)
+        return instrument
 
     def today(self, symbol):
         """
         {"low":"550.09","high":"572.2398","volume":"7305.33119836"}
         """
-        endpoint = 'instrument'
-        postdict = {'symbol': symbol}
-
-        data = self._curl_bitmex(path=endpoint, postdict=postdict, verb="GET")[0]
+        data = self.instrument(symbol)
 
         return {
             "low": data['lowPrice'],
@@ -168,7 +163,13 @@ class Client:
                 "price": 0
               },....
         ]
+        Served from the websocket book when one is connected and deep enough.
         """
+        if self.ws is not None:
+            book = self.ws.live_order_book(symbol, depth)
+            if book is not None:
+                return book
+
         endpoint = 'orderBook/L2'
         postdict = {
             'symbol': symbol,
@@ -176,9 +177,23 @@ class Client:
         }
         return self._curl_bitmex(path=endpoint, postdict=postdict, verb="GET")
 
-    def recent_trades(self, symbol):
+    def book(self, symbol, depth=25):
+        """Get the order book as an array-backed `OrderBook` for vectorized depth queries.
+
+        Returns the live websocket book when connected, otherwise a snapshot built from orderBook/L2.
+        """
+        if self.ws is not None:
+            book = self.ws.live_book(symbol, depth)
+            if book is not None:
+                return book
+        from bitmex.orderbook import OrderBook
+        return OrderBook.from_list(symbol, self.order_book(symbol, depth))
+
+    def recent_trades(self, symbol, count=None, start=None, startTime=None, endTime=None, reverse=None):
         """Get recent trades.
 
+        count/start page through the result, startTime/endTime (ISO 8601) restrict it to a time range.
+
         Returns
         -------
         A list of dicts:
@@ -195,11 +210,19 @@ class Client:
                 "foreignNotional": 25
               },
 
+        Served from the websocket trade table when one is connected and no page was asked for.
         """
+        paged = page_params(count, start, startTime, endTime, reverse)
+        if not paged and self.ws is not None:
+            trades = self.ws.live_trades(symbol)
+            if trades is not None:
+                return trades
+
         endpoint = 'trade'
         postdict = {
             'symbol': symbol
         }
+        postdict.update(paged)
 
         return self._curl_bitmex(path=endpoint, postdict=postdict, verb="GET")
 
@@ -208,16 +231,135 @@ class Client:
 class TradeClient(Client):
     """BitMEX API Connector."""
 
-    def __init__(self, acc):
-        """Init connector."""
+    def __init__(self, acc, ratelimiter=None, transport=None, base_url=BASE_URL, metrics=None, retry_policy=None,
+                 on_throttle=THROTTLE_KEEP, symbol=SYMBOL, instruments=None):
+        """Init connector.
+
+        Every request first takes a token from `ratelimiter`, which is shared by all clients of the
+        same API key unless one is passed in. `transport` configures pooling, keep-alive and HTTP/2
+        and may be shared between clients. `base_url` points the client somewhere other than the
+        live exchange, e.g. testnet or a local `bitmex.simulator`. `metrics` (a `bitmex.metrics.Metrics`)
+        receives per-endpoint latency, signing and decode time, backoff and error counts.
+        `retry_policy` (a `bitmex.retry.RetryPolicy`) sets retries, backoff, deadlines and the
+        circuit breakers; share one between clients to share the breakers.
+
+        On a 429 the rate limiter holds every request on the account until the limit resets; queued
+        requests then go out cancels first. `on_throttle` (THROTTLE_KEEP, THROTTLE_CANCEL_ALL or
+        THROTTLE_DEAD_MAN) decides what happens to our resting orders meanwhile; its request is sent at
+        once from a background thread, and a switch it armed is disarmed (or left to a running
+        heartbeat) once requests succeed again. `symbol` is the default for calls that take no symbol
+        (active_orders, create_bulk_orders). Instrument details come from `instruments` (a
+        `bitmex.instruments.InstrumentCache`, shareable between clients).
+
+        Set these attributes after construction to change the defaults:
+
+            ratelimit_timeout  seconds a request may wait for its token before failing at once;
+                               None (the default) waits as long as it takes
+            round_orders       round outgoing orders to the instrument's tick and lot size (True)
+            singleflight       a `bitmex.singleflight.SingleFlight` through which concurrent identical
+                               GETs share one request; set its `ttl` to also serve results that
+                               recent, or set it to None to send every read
+            risk               a `bitmex.risk.RiskGate` checking every new order and amend before it
+                               is sent (see `enable_risk`); None (the default) sends them unchecked
+            journal            a `bitmex.journal.Journal` recording every order intent before it is
+                               sent, and every ack and order stream row, for recovery after a restart
+                               (see `open_journal`); None (the default) keeps no journal
+        """
 
         self.apiKey = acc.apiKey
         self.apiSecret = acc.apiSecret
-        self.client = Client()
-
-        # Create websocket for streaming data
-        # self.ws = BitMEXWebsocket()
-        # self.ws.connect(base_url, symbol, shouldAuth=shouldWSAuth)
+        self.instruments = instruments or InstrumentCache()
+        if self.instruments.fetch is None:
+            self.instruments.fetch = self._active_instruments
+        self.client = Client(transport, base_url, symbol, self.instruments)
+        self.ws = None
+        self.order_store = None
+        self.positions = None
+        self.recorder = None
+        self.clOrdID = ClOrdIDGenerator()
+        self.ratelimiter = ratelimiter or RateLimiter.for_key(self.apiKey)
+        self.ratelimit_timeout = None
+        # Unauthenticated requests are limited per IP, separately from the account.
+        self.public_ratelimiter = RateLimiter.for_key(None, limit=30)
+        self.signer = Signer.for_secret(self.apiSecret)
+        self.round_orders = True
+        self.risk = None
+        self.journal = None
+        self.singleflight = SingleFlight()
+        self.metrics = metrics or NULL_METRICS
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.on_throttle = on_throttle
+        self.dead_man_timeout = 60
+        self.heartbeat = None
+        self._throttled_until = 0.0
+        self._armed = False  # by a THROTTLE_DEAD_MAN reaction, until requests succeed again
+        self._reactions = None
+        self._headers = None
+        self._urls = {}
+
+    def connect_websocket(self, symbol=SYMBOL, depth=25, shouldAuth=False, reconcile=30, record=None, tracer=None):
+        """Create websocket for streaming data; order_book, ticker and recent_trades are then served locally.
+
+        With shouldAuth the order/execution streams feed `order_store`, which is reconciled against
+        REST every `reconcile` seconds, and the execution/position/margin streams and instrument marks
+        feed `positions`, a `bitmex.positions.PositionEngine`. With `record` (a directory) every market data message is
+        appended to a tick recording there, see `replay`. With `tracer` (a `bitmex.tracing.Tracer`)
+        every message starts a trace, available to listeners as `ws.trace`.
+        """
+        # The websocket client and numpy are only loaded by clients that stream.
+        from bitmex.tickstore import TickRecorder
+        from bitmex.ws import BitMEXWebsocket
+        self.ws = BitMEXWebsocket(depth=depth, tracer=tracer)
+        if record:
+            self.recorder = TickRecorder(record)
+            self.recorder.attach(self.ws)
+        if shouldAuth:
+            from bitmex.positions import PositionEngine
+            # A store recovered from the journal carries on from there.
+            if self.order_store is None:
+                self.order_store = OrderStore()
+            self.order_store.attach(self.ws)
+            if self.journal is not None:
+                self.journal.attach(self.ws)
+            self.positions = PositionEngine(self.instruments)
+            self.positions.attach(self.ws)
+            if self.risk is not None:
+                self.risk.positions = self.positions
+                self.risk.attach(self.ws)
+        self.ws.connect(self.client.base_url, symbol, shouldAuth=shouldAuth, apiKey=self.apiKey,
+                        apiSecret=self.apiSecret)
+        if shouldAuth and reconcile:
+            self.order_store.start_reconciler(self, self.ws.symbols, reconcile)
+        return self.ws
+
+    def replay(self, path, symbol=None, depth=25, speed=None, timeout=10, tracer=None):
+        """Serve market data from a recording made with connect_websocket(record=path) instead of the
+        live feed. `speed` None plays as fast as possible, 1.0 at the recorded pace."""
+        from bitmex.tickstore import ReplayWebsocket, TickReplay
+        self.ws = ReplayWebsocket(TickReplay(path), depth=depth, tracer=tracer)
+        self.ws.connect(symbol=symbol, speed=speed, timeout=timeout)
+        return self.ws
+
+    def preconnect(self, connections=1, keepalive=None):
+        """Open pooled connections ahead of the first order; with `keepalive` (seconds) keep them hot."""
+        timings = self.client.transport.preconnect(self.client.base_url, connections)
+        if keepalive:
+            self.client.transport.start_keepalive(self.client.base_url, keepalive, connections)
+        return timings
+
+    def close_websocket(self):
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+        if self.order_store is not None:
+            self.order_store.stop()
+            self.order_store = None
+        self.positions = None
+        if self.risk is not None:
+            self.risk.positions = None
+        if self.ws is not None:
+            self.ws.exit()
+            self.ws = None
 
     #
     # Authentication required methods
@@ -251,7 +393,7 @@ class TradeClient(Client):
                     'availableMargin': data['availableMargin']}
 
     def Xbt_to_XBT(self, xbt):
-        return xbt / CONSTANT
+        return xbt / float(CONSTANT)
 
     @authentication_required
     def position(self):
@@ -282,42 +424,55 @@ class TradeClient(Client):
         return self._curl_bitmex_private(path=path, postdict=postdict, verb="POST", rethrow_errors=rethrow_errors, private=True)
 
     @authentication_required
-    def history(self, symbol=None):
+    def history(self, symbol=None, count=None, start=None, startTime=None, endTime=None, reverse=None):
         """
 
         :param symbol:
+        :param count, start, startTime, endTime, reverse: paging, as for recent_trades
         :return:
         order history list if currency provided then for that currency otherwise for show all orders
         """
         endpoint = 'execution/tradeHistory'
+        postdict = page_params(count, start, startTime, endTime, reverse)
         if symbol:
-            postdict = {'symbol': symbol}
+            postdict['symbol'] = symbol
+        if postdict:
             return self._curl_bitmex_private(path=endpoint, postdict=postdict, verb="GET", private=True)
         return self._curl_bitmex_private(path=endpoint, verb="GET", private=True)
 
     @authentication_required
-    def delta(self):
-        return self.position(self.symbol)['homeNotional']
+    def delta(self, symbol=None):
+        """homeNotional of the position in `symbol` (the client's symbol by default), 0 when flat.
+        Read from `positions` while the websocket is live, otherwise from GET /position."""
+        symbol = symbol or self.client.symbol
+        if self.positions is not None and self.positions.live:
+            return self.positions.delta(symbol)
+        for position in self.position() or []:
+            if position['symbol'] == symbol:
+                return position['homeNotional']
+        return 0
 
     @authentication_required
-    def buy(self, symbol, quantity, ordertpye, price=None, stopPx=None):
+    def buy(self, symbol, quantity, ordertpye, price=None, stopPx=None, clOrdID=None, trace=None):
         """Place a buy order.
 
         Returns order object. ID: orderID
         """
-        return self.place_order(symbol, quantity, ordertpye, price=None, stopPx=None)
+        return self.place_order(symbol, quantity, ordertpye, price=price, stopPx=stopPx, clOrdID=clOrdID,
+                                trace=trace)
 
     @authentication_required
-    def sell(self, symbol, quantity, ordertpye, price=None, stopPx=None):
+    def sell(self, symbol, quantity, ordertpye, price=None, stopPx=None, clOrdID=None, trace=None):
         """Place a sell order.
 
         Returns order object. ID: orderID
         """
         quantity = - quantity
-        return self.place_order(symbol, quantity, ordertpye, price=None, stopPx=None)
+        return self.place_order(symbol, quantity, ordertpye, price=price, stopPx=stopPx, clOrdID=clOrdID,
+                                trace=trace)
 
     @authentication_required
-    def place_order(self, symbol, quantity, ordertpye, price=None, stopPx=None):
+    def place_order(self, symbol, quantity, ordertpye, price=None, stopPx=None, clOrdID=None, trace=None):
         """
 
         :param symbol:
@@ -325,11 +480,13 @@ class TradeClient(Client):
         :param ordertpye:
         :param price: optional when place market order no need to give price
         :param stopPx: when place stop order need to give this value also
+        :param clOrdID: our id for the order; generated when not given
+        :param trace: a `bitmex.tracing.Trace` to stamp as the request is signed, sent and acked
         :return:
         """
         postdict = {}
         if ordertpye != "Market":
-            if price < 0:
+            if price is None or price < 0:
                 raise Exception("Price must be positive.")
             else:
                 postdict = {'price': price}
@@ -341,34 +498,35 @@ class TradeClient(Client):
         postdict.update({
             'symbol': symbol,
             'orderQty': quantity,
-            'orderType': ordertpye
+            'ordType': ordertpye,
+            'clOrdID': clOrdID or self.clOrdID()
         })
-        return self._curl_bitmex_private(path=endpoint, postdict=postdict, verb="POST", private=True)
+        return self._send_orders(endpoint, [postdict], postdict, "POST", trace=trace)
 
 
     @authentication_required
-    def amend_bulk_orders(self, orders):
+    def amend_bulk_orders(self, orders, trace=None):
         """Amend multiple orders."""
         # Note rethrow; if this fails, we want to catch it and re-tick
-        return self._curl_bitmex_private(path='order/bulk', postdict={'orders': orders}, verb='PUT', rethrow_errors=True,
-                                         private=True)
+        return self._send_orders('order/bulk', orders, {'orders': orders}, 'PUT', trace=trace, amend=True,
+                                 rethrow_errors=True)
 
 
     @authentication_required
-    def create_bulk_orders(self, orders):
-        """Create multiple orders."""
+    def create_bulk_orders(self, orders, trace=None):
+        """Create multiple orders. Orders without a symbol default to the client's symbol."""
         for order in orders:
-            order['symbol'] = self.symbol
-        return self._curl_bitmex_private(path='order/bulk', postdict={'orders': orders}, verb='POST', private=True)
+            order.setdefault('symbol', self.client.symbol)
+        return self._send_orders('order/bulk', orders, {'orders': orders}, 'POST', trace=trace)
 
     @authentication_required
-    def active_orders(self):
+    def active_orders(self, symbol=None):
         """Get open orders via HTTP. Used on close to ensure we catch them all."""
         path = "order"
         orders = self._curl_bitmex_private(
             path=path,
             query={
-                'filter': json.dumps({"open": True, 'symbol': self.client.symbol}),
+                'filter': json.dumps({"open": True, 'symbol': symbol or self.client.symbol}),
                 'count': 500
             },
             verb="GET",
@@ -379,13 +537,148 @@ class TradeClient(Client):
             return [o for o in orders]
 
     @authentication_required
-    def cancel(self, orderID):
+    def orders(self, orderIDs=None, clOrdIDs=None):
+        """Get orders, open or not, by orderID and/or clOrdID."""
+        filter = {}
+        if orderIDs:
+            filter['orderID'] = orderIDs
+        if clOrdIDs:
+            filter['clOrdID'] = clOrdIDs
+        return self._curl_bitmex_private(path="order", query={'filter': json.dumps(filter), 'count': 500},
+                                         verb="GET", private=True)
+
+    @authentication_required
+    def cancel(self, orderID, trace=None):
         """Cancel an existing order."""
         path = "order"
         postdict = {
             'orderID': orderID,
         }
-        return self._curl_bitmex_private(path=path, postdict=postdict, verb="DELETE", private=True)
+        if self.journal is not None:
+            self.journal.cancel(orderID)
+        return self._track(self._curl_bitmex_private(path=path, postdict=postdict, verb="DELETE", private=True,
+                                                     trace=trace))
+
+    @authentication_required
+    def cancel_all(self, symbol=None, text=None):
+        """Cancel all open orders, or those of `symbol`, in one DELETE order/all."""
+        postdict = {}
+        if symbol:
+            postdict['symbol'] = symbol
+        if text:
+            postdict['text'] = text
+        if self.journal is not None:
+            self.journal.cancel(**postdict)
+        return self._track(self._curl_bitmex_private(path='order/all', postdict=postdict or None, verb='DELETE',
+                                                     private=True))
+
+    @authentication_required
+    def cancel_all_after(self, timeout):
+        """Arm the exchange-side dead man's switch: all orders are cancelled unless this is called
+        again within `timeout` seconds. 0 disarms it."""
+        return self._curl_bitmex_private(path='order/cancelAllAfter', postdict={'timeout': int(timeout * 1000)},
+                                         verb='POST', private=True)
+
+    def start_heartbeat(self, timeout=60, interval=15, **kwargs):
+        """Keep cancelAllAfter(`timeout`) renewed every `interval` seconds from a background thread on
+        its own connection (see `bitmex.heartbeat`). Returns the `DeadMansSwitch`; its `on_degraded`
+        callback hears of slow, missed and late renewals."""
+        from bitmex.heartbeat import DeadMansSwitch
+        self.stop_heartbeat(disarm=False)
+        self.heartbeat = DeadMansSwitch(self, timeout, interval, **kwargs).start()
+        return self.heartbeat
+
+    def stop_heartbeat(self, disarm=True):
+        """Stop the renewals; with `disarm` the switch is turned off rather than left to fire."""
+        if self.heartbeat is not None:
+            self.heartbeat.stop(disarm)
+            self.heartbeat = None
+
+    def _round(self, orders, amend=False):
+        """Round orders in place to their instrument's tick and lot size. Amends carry no symbol or
+        side; those of orders in the order store are rounded by the stored ones."""
+        if not self.round_orders:
+            return
+        for order in orders:
+            symbol = order.get('symbol')
+            side = None
+            if amend and self.order_store is not None:
+                state = (self.order_store.get(order['orderID']) if order.get('orderID') else
+                         self.order_store.by_clordid(order.get('origClOrdID')))
+                if state is not None:
+                    symbol, side = state.symbol, state.side
+            if symbol:
+                self.instruments.round_order(order, symbol, side, amend)
+
+    def enable_risk(self, **limits):
+        """Check orders against a `bitmex.risk.RiskGate` with `limits` (max_order_qty, max_order_notional,
+        max_open_orders, max_position, price_band, symbols) fed by this client's acks, order stream and
+        positions. Returns the gate."""
+        gate = RiskGate(instruments=self.instruments, positions=self.positions, **limits)
+        if self.ws is not None and self.order_store is not None:
+            gate.attach(self.ws)
+        self.risk = gate
+        return gate
+
+    def _pretrade(self, orders, amend=False):
+        """Round `orders` and put them through the risk gate, which refuses them with a RiskError."""
+        self._round(orders, amend)
+        if self.risk is not None:
+            try:
+                for order in orders:
+                    self.risk.check_order(order, amend)
+            except RiskError as e:
+                self.metrics.incr('risk_rejected', check=e.check)
+                if not amend:
+                    self.risk.release(orders)
+                raise
+
+    def _send_orders(self, path, orders, postdict, verb, trace=None, amend=False, **kwargs):
+        """`_pretrade` the `orders` carried by `postdict`, send it and track the acks."""
+        self._pretrade(orders, amend)
+        if self.journal is not None:
+            self.journal.intent(AMEND if amend else INTENT, orders)
+        try:
+            acks = self._curl_bitmex_private(path=path, postdict=postdict, verb=verb, private=True, trace=trace,
+                                             **kwargs)
+        except BaseException:
+            if self.risk is not None and not amend:
+                self.risk.release(orders)
+            raise
+        return self._track(acks)
+
+    def _track(self, acks):
+        """Feed order acks into the order store and the risk gate, so they do not wait for the stream
+        to catch up."""
+        if self.order_store is not None and acks:
+            for ack in acks if isinstance(acks, list) else [acks]:
+                if isinstance(ack, dict):
+                    self.order_store.update(ack)
+        if self.risk is not None and acks:
+            self.risk.on_ack(acks)
+        if self.journal is not None and acks:
+            self.journal.acks(acks)
+        return acks
+
+    def open_journal(self, path, symbols=None, reconcile=True, **kwargs):
+        """Journal orders to `path` (see `bitmex.journal`), first recovering what an earlier run left
+        there. The recovered orders become `order_store` (which a later authenticated websocket keeps
+        current), brought up to date with one REST delta unless `reconcile` is off. The journal is
+        then compacted to the open orders. Returns the `bitmex.journal.Recovery`."""
+        from bitmex.journal import Journal
+        journal = Journal(path, **kwargs)
+        recovery = journal.recover(self.order_store)
+        if reconcile:
+            recovery.reconcile(self, symbols or sorted(set(recovery.symbols()) | {self.client.symbol}), journal)
+        journal.compact(recovery)
+        self.order_store = recovery.store
+        self.journal = journal.start()
+        return recovery
+
+    def close_journal(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
 
     @authentication_required
     def withdraw(self, amount, fee, address):
@@ -398,200 +691,266 @@ class TradeClient(Client):
         }
         return self._curl_bitmex_private(path=path, postdict=postdict, verb="POST", max_retries=0, private=True)
 
-    def _curl_bitmex_private(self, path, query=None, postdict=None, timeout=7, verb=None, rethrow_errors=False,
-                     max_retries=None, private=None):
-        """Send a request to BitMEX Servers."""
-        # Handle URL
-        url = self.client.base_url + path
+    def _prepare(self, verb, url, query=None, postdict=None):
+        """Build the PreparedRequest directly instead of going through Session.prepare_request.
 
-        # Default to POST if data is attached, GET otherwise
-        if not verb:
-            verb = 'POST' if postdict else 'GET'
-
-        # By default don't retry POST or PUT. Retrying GET/DELETE is okay because they are idempotent.
-        # In the future we could allow retrying PUT, so long as 'leavesQty' is not used (not idempotent),
-        # or you could change the clOrdID (set {"clOrdID": "new", "origClOrdID": "old"}) so that an amend
-        # can't erroneously be applied twice.
-        if max_retries is None:
-            max_retries = 0 if verb in ['POST', 'PUT'] else 3
-
-        # Auth: API Key/Secret
-
-        def exit_or_throw(e):
-            if rethrow_errors:
-                raise e
-            else:
-                exit(1)
-
-        def retry():
-            self.retries += 1
-            if self.retries > max_retries:
-                raise Exception("Max retries on %s (%s) hit, raising." % (path, json.dumps(postdict or '')))
-            return self._curl_bitmex_private(path, query, postdict, timeout, verb, rethrow_errors, max_retries, private)
-
-        # Make the request
-        response = None
-        try:
+        Headers are copied from a template of the session headers, urls without a query are
+        prepared once, and the body is serialized once so the signed bytes are the sent bytes.
+        The request is left unsigned: `_send` signs it once it holds a rate-limit token.
+        """
+        if self._headers is None:
+            self._headers = CaseInsensitiveDict(self.client.session.headers)
+        prepped = requests.PreparedRequest()
+        prepped.method = verb
+        if query:
+            prepped.prepare_url(url, query)
+        else:
+            prepared_url = self._urls.get(url)
+            if prepared_url is None:
+                prepped.prepare_url(url, None)
+                prepared_url = self._urls[url] = prepped.url
+            prepped.url = prepared_url
+        headers = self._headers.copy()
+        if postdict is not None:
+            body = compact_json(postdict)
+            prepped.body = body
+            headers['Content-Length'] = str(len(body))
+        elif verb in ('POST', 'PUT', 'PATCH'):
+            headers['Content-Length'] = '0'
+        prepped.headers = headers
+        prepped.hooks = self.client.session.hooks
+        return prepped
+
+    def _sign(self, prepped, trace=None):
+        """Sign `prepped`; its api-expires starts counting now."""
+        started = time.perf_counter_ns() if self.metrics.enabled else 0
+        prepped.headers.update(self.signer.headers(self.apiKey, prepped.method, prepped.url, prepped.body or b''))
+        if started:
+            self.metrics.timing('sign', time.perf_counter_ns() - started)
+        if trace is not None:
+            stamp(trace, SIGNED)
+        return prepped
+
+    def _send(self, prepped, path, verb, timeout, ratelimiter, trace=None, private=False, urgent=False):
+        """Take a rate-limit token, sign, send, and resync the limiter; records wait and request latency.
+
+        Signing after the wait keeps a long queue in the limiter from expiring the signature. With
+        `urgent` the token is taken at once, past any queue or 429 block."""
+        metrics = self.metrics
+        if urgent:
+            ratelimiter.take(priority_for(verb, path))
+        elif not metrics.enabled and trace is None:
+            ratelimiter.acquire(priority_for(verb, path), self.ratelimit_timeout)
             if private:
-                auth = APIKeyAuthWithExpires(self.apiKey, self.apiSecret)
-                req = requests.Request(verb, url, json=postdict, auth=auth, params=query)
-            else:
-                req = requests.Request(verb, url, json=postdict, params=query)
-            prepped = self.client.session.prepare_request(req)
+                self._sign(prepped)
             response = self.client.session.send(prepped, timeout=timeout)
-            # Make non-200s throw
-            response.raise_for_status()
-
-        except requests.exceptions.HTTPError as e:
-            if response is None:
-                raise e
-
-            # 401 - Auth error. This is fatal.
-            if response.status_code == 401:
-                return
-
-            # 404, can be thrown if order canceled or does not exist.
-            elif response.status_code == 404:
-                if verb == 'DELETE':
-
-                    return
-                exit_or_throw(e)
-
-            # 429, ratelimit; cancel orders & wait until X-Ratelimit-Reset
-            elif response.status_code == 429:
-                # Figure out how long we need to wait.
-                ratelimit_reset = response.headers['X-Ratelimit-Reset']
-                to_sleep = int(ratelimit_reset) - int(time.time())
-                reset_str = datetime.datetime.fromtimestamp(int(ratelimit_reset)).strftime('%X')
-
-                # We're ratelimited, and we may be waiting for a long time. Cancel orders.
-                self.cancel([o['orderID'] for o in self.active_orders()])
-
-                time.sleep(to_sleep)
-
-                # Retry the request.
-                return retry()
-
-            # 503 - BitMEX temporary downtime, likely due to a deploy. Try again
-            elif response.status_code == 503:
-                time.sleep(3)
-                return retry()
-
-            elif response.status_code == 400:
-                error = response.json()['error']
-                message = error['message'].lower() if error else ''
-
-                # Duplicate clOrdID: that's fine, probably a deploy, go get the order(s) and return it
-                if 'duplicate clordid' in message:
-                    orders = postdict['orders'] if 'orders' in postdict else postdict
-
-                    IDs = json.dumps({'clOrdID': [order['clOrdID'] for order in orders]})
-                    orderResults = self._curl_bitmex('/order', query={'filter': IDs}, verb='GET')
-
-                    for i, order in enumerate(orderResults):
-                        if (
-                                order['orderQty'] != abs(postdict['orderQty']) or
-                                order['side'] != ('Buy' if postdict['orderQty'] > 0 else 'Sell') or
-                                order['price'] != postdict['price'] or
-                                order['symbol'] != postdict['symbol']):
-                            raise Exception(
-                                'Attempted to recover from duplicate clOrdID, but order returned from API ' +
-                                'did not match POST.\nPOST data: %s\nReturned order: %s' % (
-                                    json.dumps(orders[i]), json.dumps(order)))
-                    # All good
-                    return orderResults
-
-                elif 'insufficient available balance' in message:
-                    exit_or_throw(Exception('Insufficient Funds'))
-
-            # If we haven't returned or re-raised yet, we get here.
-            exit_or_throw(e)
+            ratelimiter.update(response.headers)
+            return response
+        waited = 0.0 if urgent else ratelimiter.acquire(priority_for(verb, path), self.ratelimit_timeout)
+        if waited:
+            metrics.timing('ratelimit_wait', int(waited * 1e9), endpoint=path)
+        if private:
+            self._sign(prepped, trace)
+        stamp(trace, SENT)
+        started = time.perf_counter_ns()
+        response = self.client.session.send(prepped, timeout=timeout)
+        stamp(trace, ACKED)
+        metrics.timing('request', time.perf_counter_ns() - started, endpoint=path, verb=verb)
+        metrics.incr('responses', endpoint=path, status=response.status_code)
+        if response.status_code in (429, 503):
+            metrics.incr('errors', endpoint=path, kind=str(response.status_code))
+        ratelimiter.update(response.headers)
+        return response
+
+    def _decode(self, response, path):
+        if not self.metrics.enabled:
+            return codec.loads(response.content)
+        started = time.perf_counter_ns()
+        data = codec.loads(response.content)
+        self.metrics.timing('decode', time.perf_counter_ns() - started, endpoint=path)
+        return data
+
+    def _backoff(self, seconds, path, reason):
+        """Sleep before a retry, recording the time spent."""
+        if seconds <= 0:
+            return
+        self.metrics.timing('backoff', int(seconds * 1e9), endpoint=path, reason=reason)
+        time.sleep(seconds)
 
-        except requests.exceptions.Timeout as e:
-            # Timeout, re-run this request
-            return retry()
-
-        except requests.exceptions.ConnectionError as e:
-            time.sleep(1)
-            return retry()
-
-        # Reset retry counter on success
-        self.retries = 0
-
-        return response.json()
+    def _curl_bitmex_private(self, path, query=None, postdict=None, timeout=7, verb=None, rethrow_errors=False,
+                     max_retries=None, private=None, trace=None, urgent=False):
+        """Send a request to BitMEX Servers.
 
-    def _curl_bitmex(self, path, query=None, postdict=None, timeout=7, verb=None, rethrow_errors=False,
-                     max_retries=None):
-        """Send a request to BitMEX Servers."""
-        # Handle URL
-        url = self.client.base_url + path
+        Failed requests are retried under `retry_policy` (see `bitmex.retry`). Only idempotent requests
+        are retried, with jittered exponential backoff and within the policy's deadline, and each
+        endpoint's circuit breaker fails fast while BitMEX is down. Errors are always raised, a 401 as
+        `bitmex.auth.AuthenticationError`; only a DELETE of an order already gone (404) returns None.
+        `rethrow_errors` is kept for compatibility.
 
+        Identical GETs in flight at the same time are sent once and share the result (`singleflight`).
+        `urgent` sends the first attempt past the rate limiter's queue and any 429 block (see `_throttled`).
+        """
         # Default to POST if data is attached, GET otherwise
         if not verb:
             verb = 'POST' if postdict else 'GET'
 
-        # By default don't retry POST or PUT. Retrying GET/DELETE is okay because they are idempotent.
-        # In the future we could allow retrying PUT, so long as 'leavesQty' is not used (not idempotent),
-        # or you could change the clOrdID (set {"clOrdID": "new", "origClOrdID": "old"}) so that an amend
-        # can't erroneously be applied twice.
-        if max_retries is None:
-            max_retries = 0 if verb in ['POST', 'PUT'] else 3
+        singleflight = self.singleflight
+        if singleflight is None:
+            return self._request(path, query, postdict, timeout, verb, max_retries, private, trace)
+        if verb == 'GET':
+            return singleflight.do(request_key(verb, path, query, postdict, private), lambda: self._request(
+                path, query, postdict, timeout, verb, max_retries, private, trace))
+        try:
+            return self._request(path, query, postdict, timeout, verb, max_retries, private, trace, urgent)
+        finally:
+            # Reads kept fresh from before this write may no longer hold.
+            singleflight.invalidate()
 
-        # Auth: API Key/Secret
+    def _request(self, path, query, postdict, timeout, verb, max_retries, private, trace, urgent=False):
+        url = self.client.base_url + path
 
-        def exit_or_throw(e):
-            if rethrow_errors:
-                raise e
+        # GET/DELETE are idempotent and always retried. POST/PUT only when they carry clOrdIDs, so that a
+        # request which did land on an earlier attempt comes back as a duplicate clOrdID (recovered below)
+        # instead of being applied twice.
+        ratelimiter = self.ratelimiter if private else self.public_ratelimiter
+        policy = self.retry_policy
+        state = policy.begin(verb, postdict, max_retries, path=path)
+
+        while True:
+            breaker = policy.check(path)
+            wait = None
+            try:
+                # Prepared and signed afresh on every attempt, so a retry never carries an expired signature.
+                prepped = self._prepare(verb, url, query, postdict)
+                response = self._send(prepped, path, verb, timeout, ratelimiter, trace, private,
+                                      urgent and state.attempt == 0)
+                status = response.status_code
+                if status < 300:
+                    data = self._decode(response, path)
+            except requests.exceptions.Timeout as e:
+                breaker.failure()
+                self.metrics.incr('errors', endpoint=path, kind='timeout')
+                error, reason = e, 'timeout'
+            except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+                # A body cut short fails here too, and is retried like a dropped connection.
+                breaker.failure()
+                self.metrics.incr('errors', endpoint=path, kind='connection')
+                error, reason = e, 'connection'
             else:
-                exit(1)
-
-        def retry():
-            self.retries += 1
-            if self.retries > max_retries:
-                raise Exception("Max retries on %s (%s) hit, raising." % (path, json.dumps(postdict or '')))
-            return self._curl_bitmex(path, query, postdict, timeout, verb, rethrow_errors, max_retries)
-
-        # Make the request
-        response = None
+                if status < 300:
+                    breaker.success()
+                    if self._armed and private and not urgent:
+                        self._recovered()
+                    return data
+                # Anything but a server error shows the endpoint is up.
+                if status >= 500:
+                    breaker.failure()
+                else:
+                    breaker.success()
+                try:
+                    response.raise_for_status()
+                except requests.exceptions.HTTPError as e:
+                    error = e
+                reason = str(status)
+
+                # 401 - Auth error. This is fatal.
+                if status == 401:
+                    raise AuthenticationError(path, response.text)
+
+                # 404, can be thrown if order canceled or does not exist.
+                elif status == 404:
+                    if verb == 'DELETE':
+                        return
+                    raise error
+
+                # 429, ratelimit; hold this budget until it resets. The retry then queues in the rate
+                # limiter, behind any cancels, instead of sleeping here, and is signed once it leaves.
+                elif status == 429:
+                    wait = ratelimiter.throttle(response.headers) - time.time()
+                    # A reaction answered 429 waits for the budget like any request; it does not react again.
+                    if private and not urgent:
+                        self._throttled(time.time() + wait)
+
+                # 503 - BitMEX temporary downtime, likely due to a deploy. Try again
+                elif status == 503:
+                    pass
+
+                elif status == 400:
+                    error_body = response.json()['error']
+                    message = error_body['message'].lower() if error_body else ''
+
+                    # Duplicate clOrdID: that's fine, an earlier attempt landed; go get the order(s) and return it
+                    if 'duplicate clordid' in message:
+                        return self._recover_duplicate(postdict)
+
+                    elif 'insufficient available balance' in message:
+                        raise Exception('Insufficient Funds')
+                    raise error
+
+                else:
+                    raise error
+
+            delay = state.next_delay(wait)
+            if delay is None:
+                raise RetryError("Max retries on %s (%s) hit, raising." % (path, json.dumps(postdict or '')), error)
+            self.metrics.incr('retries', endpoint=path)
+            if reason != '429':
+                self._backoff(delay, path, reason)
+
+    def _throttled(self, reset):
+        """Apply `on_throttle` once per throttle window.
+
+        The reaction runs on a background thread, so the request that hit the 429 goes straight back to
+        queue in the rate limiter, and it is sent at once past the throttle that blocks everything else.
+        If the exchange answers it 429 too, its retry is the first request out when the budget returns.
+        """
+        if self.on_throttle == THROTTLE_KEEP or reset <= self._throttled_until:
+            return
+        self._throttled_until = reset
+        self._react(self._throttle_reaction)
+
+    def _react(self, reaction):
+        """Run `reaction` on the reaction thread; reactions run one at a time, in order."""
+        if self._reactions is None:
+            from concurrent.futures import ThreadPoolExecutor
+            self._reactions = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ThrottleReaction')
+        return self._reactions.submit(reaction)
+
+    def _throttle_reaction(self):
         try:
-            req = requests.Request(verb, url, json=postdict, params=query)
-            prepped = self.client.session.prepare_request(req)
-            response = self.client.session.send(prepped, timeout=timeout)
-            # Make non-200s throw
-            response.raise_for_status()
-
-        except requests.exceptions.HTTPError as e:
-            if response is None:
-                raise e
-
-
-            # 429, ratelimit; cancel orders & wait until X-Ratelimit-Reset
-            if response.status_code == 429:
-                # Figure out how long we need to wait.
-                ratelimit_reset = response.headers['X-Ratelimit-Reset']
-                to_sleep = int(ratelimit_reset) - int(time.time())
-                reset_str = datetime.datetime.fromtimestamp(int(ratelimit_reset)).strftime('%X')
-                time.sleep(to_sleep)
-
-                # Retry the request.
-                return retry()
-
-            # 503 - BitMEX temporary downtime, likely due to a deploy. Try again
-            elif response.status_code == 503:
-                time.sleep(3)
-                return retry()
-
-            # If we haven't returned or re-raised yet, we get here.
-            exit_or_throw(e)
-
-        except requests.exceptions.Timeout as e:
-            return retry()
-
-        except requests.exceptions.ConnectionError as e:
-            time.sleep(1)
-            return retry()
+            if self.on_throttle == THROTTLE_CANCEL_ALL:
+                if self.journal is not None:
+                    self.journal.cancel()
+                self._track(self._curl_bitmex_private(path='order/all', verb='DELETE', private=True, urgent=True))
+            elif self.on_throttle == THROTTLE_DEAD_MAN:
+                self._curl_bitmex_private(path='order/cancelAllAfter', verb='POST', private=True, urgent=True,
+                                          postdict={'timeout': int(self.dead_man_timeout * 1000)})
+                self._armed = True
+        except Exception:
+            # Never let the reaction to a 429 fail anything else.
+            self.metrics.incr('errors', endpoint='throttle', kind=self.on_throttle)
+
+    def _recovered(self):
+        """Requests succeed again after a 429 armed the dead man's switch: disarm it, or leave it to a
+        running heartbeat, whose next renewal takes it over."""
+        if time.time() < self._throttled_until:
+            return
+        self._armed = False
+        if self.heartbeat is None or not self.heartbeat.running():
+            self._react(self._disarm)
+
+    def _disarm(self):
+        try:
+            self.cancel_all_after(0)
+        except Exception:
+            self.metrics.incr('errors', endpoint='throttle', kind='disarm')
 
-        # Reset retry counter on success
-        self.retries = 0
+    def _recover_duplicate(self, postdict):
+        """The orders of a POST rejected for a duplicate clOrdID, i.e. one an earlier attempt placed."""
+        return match_duplicates(postdict, self.orders(clOrdIDs=sent_clordids(postdict)))
 
-        return response.json()
+    def _curl_bitmex(self, path, query=None, postdict=None, timeout=7, verb=None, rethrow_errors=False,
+                     max_retries=None):
+        """Send an unauthenticated request to BitMEX Servers, paced by the public rate limiter."""
+        return self._curl_bitmex_private(path, query, postdict, timeout, verb, rethrow_errors, max_retries,
+                                         private=False)
@@ -0,0 +1,55 @@
+"""Pluggable JSON codec for REST and websocket payloads.
+
+Uses orjson or ujson when installed and falls back to the standard library. `loads` takes the raw
+response bytes directly and `dumps` returns compact bytes ready to sign and send.
+"""
+from __future__ import absolute_import
+
+import json
+
+
+def _stdlib_dumps(obj):
+    return json.dumps(obj, separators=(',', ':')).encode('utf8')
+
+
+CODECS = {
+    'json': (json.loads, _stdlib_dumps),
+}
+
+try:
+    import orjson
+    CODECS['orjson'] = (orjson.loads, orjson.dumps)
+except ImportError:
+    pass
+
+try:
+    import ujson
+    CODECS['ujson'] = (ujson.loads, lambda obj: ujson.dumps(obj, escape_forward_slashes=False).encode('utf8'))
+except ImportError:
+    pass
+
+PREFERENCE = ('orjson', 'ujson', 'json')
+
+name = None
+loads = None
+dumps = None
+
+
+def use(codec=None):
+    """Select the codec by name, or the fastest one installed when `codec` is None."""
+    global name, loads, dumps
+    if codec is None:
+        codec = next(c for c in PREFERENCE if c in CODECS)
+    if codec not in CODECS:
+        raise ValueError("JSON codec %s is not available (have: %s)" % (codec, ', '.join(sorted(CODECS))))
+    name = codec
+    loads, dumps = CODECS[codec]
+    return name
+
+
+def register(codec, loads_fn, dumps_fn):
+    """Add a codec: `loads_fn` takes bytes, `dumps_fn` returns compact bytes."""
+    CODECS[codec] = (loads_fn, dumps_fn)
+
+
+use()
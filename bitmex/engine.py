@@ -0,0 +1,371 @@
+"""Execution engine for many accounts and symbols.
+
+Each account (sub-account, API key) gets its own `TradeClient`, which brings its own signer, rate
+budget (`RateLimiter.for_key`), clOrdID sequence and, with websockets, order store. All accounts
+send through one shared `Transport`, so they share a single connection pool.
+
+Work is dispatched on a small thread pool per account. A slow or throttled account only ever
+occupies its own workers, so it cannot hold up the others. Every call returns a
+`concurrent.futures.Future`:
+
+    engine = ExecutionEngine({'mm1': acc1, 'mm2': acc2}, symbols=['XBTUSD', 'ETHUSD'])
+    futures = [engine.place(name, 'XBTUSD', 'Buy', 100, 9000.5) for name in engine.accounts]
+    acks = [f.result() for f in futures]
+
+`AsyncExecutionEngine` is the asyncio counterpart: `AsyncTradeClient`s sharing one aiohttp session.
+It runs concurrent coroutines instead of threads, and a semaphore per account caps how many
+requests each account has in flight. Each account has an order store too, fed by its acks and,
+once `connect_websockets` has run, by its websocket.
+"""
+from __future__ import absolute_import
+
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from bitmex.bitmex import BASE_URL, SYMBOL, TradeClient
+from bitmex.instruments import InstrumentCache
+from bitmex.orderstore import OrderStore
+from bitmex.transport import Transport
+
+
+def _accounts(accounts):
+    """{name: account} from a dict, or from a list of accounts named by their apiKey."""
+    if isinstance(accounts, dict):
+        return dict(accounts)
+    return dict((acc.apiKey, acc) for acc in accounts)
+
+
+def order_dict(symbol, side, quantity, price=None, ordType='Limit', clOrdID=None, **extra):
+    """order/bulk representation of one order."""
+    order = {'symbol': symbol, 'side': side, 'orderQty': quantity, 'ordType': ordType}
+    if price is not None:
+        order['price'] = price
+    if clOrdID:
+        order['clOrdID'] = clOrdID
+    order.update(extra)
+    return order
+
+
+class ExecutionEngine:
+    """N accounts x M symbols on one connection pool, with per-account worker threads.
+
+    accounts: {name: account} or a list of accounts (objects with apiKey/apiSecret, named by key).
+    symbols: the contracts traded; the first is each client's default symbol.
+    workers: threads per account, i.e. how many of its requests can be in flight at once.
+    Further keyword arguments (metrics, retry_policy, on_throttle, ...) go to every TradeClient.
+    The clients share one `InstrumentCache`, so instrument data is fetched once for all of them.
+    """
+
+    def __init__(self, accounts, symbols=(SYMBOL,), base_url=BASE_URL, workers=4, transport=None, **client_kwargs):
+        self.accounts = _accounts(accounts)
+        self.symbols = list(symbols)
+        self.base_url = base_url
+        self.workers = workers
+        self.transport = transport or Transport(pool_maxsize=max(16, workers * len(self.accounts)))
+        self.instruments = client_kwargs.pop('instruments', None) or InstrumentCache()
+        self.clients = {}
+        self.executors = {}
+        for name, acc in self.accounts.items():
+            self.clients[name] = TradeClient(acc, transport=self.transport, base_url=base_url,
+                                             symbol=self.symbols[0], instruments=self.instruments, **client_kwargs)
+            self.executors[name] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='engine-%s' % name)
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def client(self, account):
+        return self.clients[account]
+
+    def interface(self, account):
+        """An `ExchangeInterface` (bitmex_om) over this account's client."""
+        from bitmex_om import ExchangeInterface
+        return ExchangeInterface(client=self.clients[account])
+
+    #
+    # Dispatch
+    #
+    def submit(self, account, method, *args, **kwargs):
+        """Call `method` (a TradeClient method name, or a callable taking the client) on `account`'s
+        workers. Returns a Future."""
+        client = self.clients[account]
+        fn = getattr(client, method) if isinstance(method, str) else (lambda *a, **k: method(client, *a, **k))
+        return self.executors[account].submit(fn, *args, **kwargs)
+
+    def map(self, method, *args, **kwargs):
+        """`submit` on every account at once. Returns {account: Future}."""
+        return dict((name, self.submit(name, method, *args, **kwargs)) for name in self.clients)
+
+    @staticmethod
+    def gather(futures, timeout=None):
+        """{account: result} of a {account: Future} dict; a failed call maps to its exception."""
+        results = {}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result(timeout)
+            except Exception as e:
+                results[name] = e
+        return results
+
+    #
+    # Orders
+    #
+    def place(self, account, symbol, side, quantity, price=None, ordType='Limit', clOrdID=None, **extra):
+        """Place one order. `side` is 'Buy' or 'Sell'; the clOrdID comes from the account's sequence."""
+        order = order_dict(symbol, side, quantity, price, ordType,
+                           clOrdID or self.clients[account].clOrdID(), **extra)
+
+        def place(client):
+            return client._send_orders('order', [order], order, 'POST')
+        return self.submit(account, place)
+
+    def place_bulk(self, account, orders):
+        """Place many orders (order/bulk dicts) of one account in one request."""
+        client = self.clients[account]
+        for order in orders:
+            order.setdefault('clOrdID', client.clOrdID())
+        return self.submit(account, 'create_bulk_orders', orders)
+
+    def amend(self, account, orders):
+        """Amend orders of one account in one request; each dict carries orderID or origClOrdID."""
+        return self.submit(account, 'amend_bulk_orders', orders if isinstance(orders, list) else [orders])
+
+    def cancel(self, account, orderIDs):
+        return self.submit(account, 'cancel', orderIDs)
+
+    def cancel_all(self, account=None, symbol=None):
+        """DELETE order/all on one account, or on every account ({account: Future})."""
+        if account is None:
+            return self.map('cancel_all', symbol)
+        return self.submit(account, 'cancel_all', symbol)
+
+    #
+    # State
+    #
+    def active_orders(self, account, symbol=None):
+        """Open orders of `account` for `symbol`, or for all the engine's symbols. Served from the order
+        store when the account's websocket is live."""
+        store = self.order_store(account)
+        if store is not None:
+            return [o for o in store.open_orders(symbol) if symbol is not None or o['symbol'] in self.symbols]
+        symbols = [symbol] if symbol is not None else self.symbols
+        orders = []
+        for s in symbols:
+            orders.extend(self.clients[account].active_orders(s) or [])
+        return orders
+
+    def order_store(self, account):
+        store = self.clients[account].order_store
+        return store if store is not None and store.live else None
+
+    def positions(self):
+        return self.map('position')
+
+    def balances(self):
+        return self.map('balances')
+
+    def connect_websockets(self, depth=25, reconcile=30):
+        """Open an authenticated websocket per account, for all symbols, feeding its order store.
+        Connects run in parallel; returns once every account has its partials."""
+        threads = []
+        errors = {}
+
+        def connect(name):
+            try:
+                self.clients[name].connect_websocket(self.symbols, depth=depth, shouldAuth=True, reconcile=reconcile)
+            except Exception as e:
+                errors[name] = e
+        for name in self.clients:
+            thread = threading.Thread(target=connect, args=(name,), name='engine-connect-%s' % name)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise Exception("Websocket connect failed for %s" % ', '.join(
+                '%s (%s)' % (name, e) for name, e in sorted(errors.items())))
+
+    def close(self, cancel=False):
+        """Stop the workers (finishing queued work) and websockets; with `cancel` pull every account's
+        orders first."""
+        if self.closed:
+            return
+        if cancel:
+            self.gather(self.cancel_all())
+        for executor in self.executors.values():
+            executor.shutdown(wait=True)
+        for client in self.clients.values():
+            client.close_websocket()
+        self.closed = True
+
+
+class AsyncExecutionEngine:
+    """asyncio version of `ExecutionEngine`: one `AsyncTradeClient` per account on a shared aiohttp
+    session, with at most `concurrency` requests in flight per account.
+
+        async with AsyncExecutionEngine(accounts) as engine:
+            acks = await asyncio.gather(*[engine.place(n, 'XBTUSD', 'Buy', 1, 9000) for n in engine.accounts])
+    """
+
+    def __init__(self, accounts, symbols=(SYMBOL,), base_url=BASE_URL, concurrency=4, pool_size=100, **client_kwargs):
+        self.accounts = _accounts(accounts)
+        self.symbols = list(symbols)
+        self.base_url = base_url
+        self.concurrency = concurrency
+        self.pool_size = pool_size
+        self.instruments = client_kwargs.pop('instruments', None) or InstrumentCache()
+        self.client_kwargs = client_kwargs
+        self.session = None
+        self.clients = {}
+        self.semaphores = {}
+        self.websockets = {}
+        self.reconcilers = {}
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def open(self):
+        import aiohttp
+        from bitmex.async_bitmex import AsyncTradeClient
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, limit_per_host=self.pool_size,
+                                             ttl_dns_cache=300, keepalive_timeout=60)
+            self.session = aiohttp.ClientSession(connector=connector)
+            for name, acc in self.accounts.items():
+                self.clients[name] = AsyncTradeClient(acc, base_url=self.base_url, session=self.session,
+                                                      symbol=self.symbols[0], instruments=self.instruments,
+                                                      **self.client_kwargs)
+                self.clients[name].order_store = OrderStore()
+                self.semaphores[name] = asyncio.Semaphore(self.concurrency)
+                # The clients' fixed headers are the same for every account; the signature is per request.
+                self.session.headers.update(self.clients[name].headers)
+        return self
+
+    async def close(self):
+        for task in self.reconcilers.values():
+            task.cancel()
+        self.reconcilers = {}
+        for ws in self.websockets.values():
+            ws.exit()
+        self.websockets = {}
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def submit(self, account, method, *args, **kwargs):
+        """Await `method` (an AsyncTradeClient method name, or a coroutine function taking the client)
+        on `account`, within its concurrency limit."""
+        client = self.clients[account]
+        async with self.semaphores[account]:
+            if isinstance(method, str):
+                return await getattr(client, method)(*args, **kwargs)
+            return await method(client, *args, **kwargs)
+
+    async def map(self, method, *args, **kwargs):
+        """`submit` on every account concurrently. Returns {account: result or exception}."""
+        names = list(self.clients)
+        results = await asyncio.gather(*[self.submit(name, method, *args, **kwargs) for name in names],
+                                       return_exceptions=True)
+        return dict(zip(names, results))
+
+    async def place(self, account, symbol, side, quantity, price=None, ordType='Limit', clOrdID=None, **extra):
+        order = order_dict(symbol, side, quantity, price, ordType, clOrdID or self.clients[account].clOrdID(), **extra)
+
+        async def place(client):
+            return await client._send_orders('order', [order], order, 'POST')
+        return await self.submit(account, place)
+
+    async def place_bulk(self, account, orders):
+        client = self.clients[account]
+        for order in orders:
+            order.setdefault('clOrdID', client.clOrdID())
+        return await self.submit(account, 'create_bulk_orders', orders)
+
+    async def amend(self, account, orders):
+        return await self.submit(account, 'amend_bulk_orders', orders if isinstance(orders, list) else [orders])
+
+    async def cancel(self, account, orderIDs):
+        return await self.submit(account, 'cancel', orderIDs)
+
+    async def cancel_all(self, account=None, symbol=None):
+        if account is None:
+            return await self.map('cancel_all', symbol)
+        return await self.submit(account, 'cancel_all', symbol)
+
+    async def active_orders(self, account, symbol=None):
+        """Open orders of `account` for `symbol`, or for all the engine's symbols. Served from the order
+        store when the account's websocket is live."""
+        store = self.order_store(account)
+        if store is not None:
+            return [o for o in store.open_orders(symbol) if symbol is not None or o['symbol'] in self.symbols]
+        symbols = [symbol] if symbol is not None else self.symbols
+        results = await asyncio.gather(*[self.submit(account, 'active_orders', s) for s in symbols])
+        return [order for orders in results for order in orders or ()]
+
+    def order_store(self, account):
+        store = self.clients[account].order_store
+        return store if store is not None and store.live else None
+
+    async def connect_websockets(self, depth=25, reconcile=30):
+        """Open an authenticated websocket per account, for all symbols, feeding its order store, which
+        is then reconciled against REST every `reconcile` seconds. The blocking connects run in
+        parallel on the loop's executor; returns once every account has its partials."""
+        from bitmex.ws import BitMEXWebsocket
+        await self.open()
+        loop = asyncio.get_event_loop()
+
+        def connect(name):
+            client = self.clients[name]
+            ws = BitMEXWebsocket(depth=depth)
+            client.order_store.attach(ws)
+            ws.connect(self.base_url, self.symbols, shouldAuth=True, apiKey=client.apiKey, apiSecret=client.apiSecret)
+            return ws
+        names = [name for name in self.clients if name not in self.websockets]
+        results = await asyncio.gather(*[loop.run_in_executor(None, connect, name) for name in names],
+                                       return_exceptions=True)
+        errors = {}
+        for name, result in zip(names, results):
+            if isinstance(result, Exception):
+                errors[name] = result
+                continue
+            self.websockets[name] = result
+            if reconcile:
+                self.reconcilers[name] = asyncio.ensure_future(self._reconcile_every(name, reconcile))
+        if errors:
+            raise Exception("Websocket connect failed for %s" % ', '.join(
+                '%s (%s)' % (name, e) for name, e in sorted(errors.items())))
+
+    async def reconcile(self, account):
+        """`OrderStore.reconcile` for `account`, through its async client. Returns the number of orders
+        repaired."""
+        store = self.clients[account].order_store
+        repaired = 0
+        for symbol in self.symbols:
+            rest_open = await self.submit(account, 'active_orders', symbol)
+            if not isinstance(rest_open, list):
+                continue
+            merged, missing = store.merge_open(symbol, rest_open)
+            repaired += merged
+            if missing:
+                for row in await self.submit(account, 'orders', orderIDs=missing) or []:
+                    store.update(row)
+                    repaired += 1
+        return repaired
+
+    async def _reconcile_every(self, account, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.reconcile(account)
+            except Exception:
+                # The stream keeps the store current; a failed repair is retried next round.
+                pass
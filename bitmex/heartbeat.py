@@ -0,0 +1,185 @@
+"""Dead man's switch kept armed from a background thread.
+
+`DeadMansSwitch` calls order/cancelAllAfter(timeout) every `interval` seconds. If the process hangs
+or dies the renewals stop, and the exchange cancels every order of the account once `timeout` runs
+out. Strategy threads never wait on it:
+
+    own thread       renewals run on a daemon thread; starting and stopping return at once
+    own connection   a client with its own single-connection transport, retry policy and circuit
+                     breaker, so a busy pool or an open breaker on the strategy's client cannot delay it
+    priority         it shares the account's rate limiter (the budget is per account) at the
+                     cancel priority, so it goes ahead of queued orders and queries; a renewal
+                     that would wait longer than `request_timeout` for its token (e.g. during a
+                     429 throttle) fails at once instead of letting the switch run out unnoticed
+
+A renewal that fails, or that the exchange does not acknowledge, is counted as missed and tried
+again after `retry` seconds. One that takes longer than `max_latency`, one that is missed, one that
+starts late because the thread was held up, and the switch coming within `interval` of firing each
+call `on_degraded(switch, reason, latency)` on the heartbeat thread. The counts also go to the
+client's metrics (heartbeat latency, heartbeat_missed, heartbeat_degraded).
+"""
+from __future__ import absolute_import
+
+import threading
+import time
+
+from bitmex.bitmex import TradeClient
+from bitmex.retry import RetryPolicy
+from bitmex.transport import Transport
+
+SLOW = 'slow'
+MISSED = 'missed'
+LATE = 'late'
+EXPIRING = 'expiring'
+
+
+class DeadMansSwitch:
+    """Renew cancelAllAfter(`timeout`) on `client`'s account every `interval` seconds.
+
+    max_latency: seconds a renewal may take before it counts as degraded.
+    on_degraded: callback(switch, reason, latency), reason one of SLOW, MISSED, LATE, EXPIRING.
+    retry: seconds before a missed renewal is tried again (default interval / 4).
+    request_timeout: seconds a renewal may wait for a rate-limit token, and then take, before it is
+        abandoned as missed.
+    """
+
+    def __init__(self, client, timeout=60.0, interval=15.0, max_latency=1.0, on_degraded=None, retry=None,
+                 request_timeout=5.0, transport=None):
+        if interval >= timeout:
+            raise ValueError("Heartbeat interval %ss must be shorter than the timeout %ss" % (interval, timeout))
+        self.timeout = timeout
+        self.interval = interval
+        self.max_latency = max_latency
+        self.on_degraded = on_degraded
+        self.retry = interval / 4.0 if retry is None else retry
+        self.request_timeout = min(request_timeout, interval)
+        self.metrics = client.metrics
+        # The client stands in for the account: it carries the apiKey and apiSecret.
+        self.client = TradeClient(client, ratelimiter=client.ratelimiter,
+                                  transport=transport or Transport(pool_connections=1, pool_maxsize=1),
+                                  base_url=client.client.base_url, metrics=client.metrics,
+                                  retry_policy=RetryPolicy(max_retries=0, deadline=self.request_timeout),
+                                  symbol=client.client.symbol, instruments=client.instruments)
+        self.client.ratelimit_timeout = self.request_timeout
+        self.stopping = threading.Event()  # a new one per start, so a restart never revives a stopped loop
+        self.disarm = True
+        self.thread = None
+        self.stopped = None  # the last stopped thread, perhaps still sending its disarm
+        self.armed_at = None  # monotonic time of the last renewal that landed
+        self.finished_at = None  # monotonic end of the last renewal, landed or not
+        self.last_error = None
+        # Metrics
+        self.renewals = 0
+        self.missed = 0
+        self.consecutive_missed = 0
+        self.slow = 0
+        self.late = 0
+        self.latency = None
+        self.worst_latency = 0.0
+
+    def start(self):
+        """Start renewing. After a `stop` the new thread first waits for the old one to finish, so its
+        disarm can never land after the new thread's first renewal."""
+        if self.thread is None:
+            self.stopping = threading.Event()
+            self.thread = threading.Thread(target=self._run, args=(self.stopping, self.stopped),
+                                           name='DeadMansSwitch')
+            self.thread.daemon = True
+            self.thread.start()
+        return self
+
+    def stop(self, disarm=True, wait=None):
+        """Stop renewing; with `disarm` the heartbeat thread's last act is cancelAllAfter(0). Waits up
+        to `wait` seconds for the thread (default: not at all)."""
+        self.disarm = disarm
+        self.stopping.set()
+        if self.thread is not None:
+            self.stopped = self.thread
+            if wait:
+                self.thread.join(wait)
+        self.thread = None
+
+    def _run(self, stopping, previous=None):
+        if previous is not None:
+            previous.join()
+        delay = 0.0
+        while not stopping.wait(delay):
+            delay = self.interval if self.beat() else self.retry
+        if self.disarm and self.armed_at is not None:
+            try:
+                self._send(0)
+            except Exception:
+                # The switch fires on its own once `timeout` runs out.
+                pass
+
+    def _send(self, timeout):
+        return self.client._curl_bitmex_private(path='order/cancelAllAfter', postdict={'timeout': int(timeout * 1000)},
+                                                verb='POST', private=True, timeout=self.request_timeout,
+                                                max_retries=0)
+
+    def beat(self):
+        """Renew the switch once. Returns True when the renewal landed."""
+        started = time.monotonic()
+        # After a landed renewal the thread sleeps `interval`; sleeping much longer means it was held up.
+        if self.finished_at is not None and self.consecutive_missed == 0 and \
+                started - self.finished_at > self.interval + self.max_latency:
+            self.late += 1
+            self._degraded(LATE, started - self.finished_at - self.interval)
+        try:
+            # Only an acknowledgement ({now, cancelTime}) shows the exchange took the renewal.
+            ack = self._send(self.timeout)
+            if not isinstance(ack, dict):
+                raise Exception("cancelAllAfter was not acknowledged: %r" % (ack,))
+        except Exception as e:
+            self.finished_at = time.monotonic()
+            latency = self.finished_at - started
+            self.last_error = e
+            self.missed += 1
+            self.consecutive_missed += 1
+            self.metrics.incr('heartbeat_missed')
+            self._degraded(MISSED, latency)
+            if self.armed_at is not None and self.remaining() < self.interval:
+                self._degraded(EXPIRING, latency)
+            return False
+        self.finished_at = time.monotonic()
+        latency = self.finished_at - started
+        self.armed_at = started
+        self.renewals += 1
+        self.consecutive_missed = 0
+        self.latency = latency
+        self.worst_latency = max(self.worst_latency, latency)
+        self.metrics.timing('heartbeat', int(latency * 1e9))
+        if latency > self.max_latency:
+            self.slow += 1
+            self._degraded(SLOW, latency)
+        return True
+
+    def _degraded(self, reason, latency):
+        self.metrics.incr('heartbeat_degraded', reason=reason)
+        if self.on_degraded is not None:
+            try:
+                self.on_degraded(self, reason, latency)
+            except Exception:
+                # A failing callback must not stop the renewals.
+                pass
+
+    def remaining(self):
+        """Seconds until the exchange cancels everything unless renewed; None before the first renewal."""
+        if self.armed_at is None:
+            return None
+        return self.armed_at + self.timeout - time.monotonic()
+
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def stats(self):
+        return {
+            'renewals': self.renewals,
+            'missed': self.missed,
+            'consecutive_missed': self.consecutive_missed,
+            'slow': self.slow,
+            'late': self.late,
+            'latency': self.latency,
+            'worst_latency': self.worst_latency,
+            'remaining': self.remaining(),
+        }
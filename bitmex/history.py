@@ -0,0 +1,241 @@
+"""Bulk download of public trades and own executions into an append-only columnar store.
+
+A time range is split into windows that are fetched concurrently (each window paged with
+count/start) and appended in time order. Every REST call goes through the client's rate limiter
+at query priority, so a download never starves orders or cancels. Rows are de-duplicated on
+trdMatchID / execID, also where pages or windows overlap, and a download into a non-empty store
+resumes from its last timestamp.
+
+The store is a directory holding one raw little-endian file per column. Appends go to the end of
+each file, and reads are `np.memmap` views, so loading a dataset copies nothing.
+"""
+from __future__ import absolute_import
+
+import datetime
+import json
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+PAGE_SIZE = 1000  # The most BitMEX returns per request.
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# (column, dtype, row field). Timestamps are epoch milliseconds, side is +1 buy / -1 sell, ids are
+# the 16 raw bytes of the UUID.
+TRADE_SCHEMA = (
+    ('timestamp', '<i8', 'timestamp'),
+    ('price', '<f8', 'price'),
+    ('size', '<i8', 'size'),
+    ('side', 'i1', 'side'),
+    ('trdMatchID', 'S16', 'trdMatchID'),
+)
+EXECUTION_SCHEMA = (
+    ('timestamp', '<i8', 'timestamp'),
+    ('price', '<f8', 'lastPx'),
+    ('size', '<i8', 'lastQty'),
+    ('side', 'i1', 'side'),
+    ('execID', 'S16', 'execID'),
+    ('orderID', 'S16', 'orderID'),
+    ('execCost', '<i8', 'execCost'),
+    ('execComm', '<i8', 'execComm'),
+)
+
+
+def to_ms(t):
+    """Epoch milliseconds from a datetime (naive = UTC), an ISO 8601 string or a number of ms."""
+    if isinstance(t, datetime.datetime):
+        if t.tzinfo is not None:
+            t = t.replace(tzinfo=None) - t.utcoffset()
+        return int((t - EPOCH).total_seconds() * 1000)
+    if isinstance(t, str):
+        return int(np.datetime64(t.rstrip('Z'), 'ms').astype(np.int64))
+    return int(t)
+
+
+def iso(ms):
+    """The ISO 8601 form BitMEX expects for startTime/endTime."""
+    return str(np.datetime64(int(ms), 'ms')) + 'Z'
+
+
+def uuid_bytes(value):
+    return bytes.fromhex(value.replace('-', '')) if value else b''
+
+
+def _stored_id(value):
+    # 'S16' columns drop trailing NUL bytes on read; pad back to compare with uuid_bytes().
+    return bytes(value).ljust(16, b'\0')
+
+
+def to_columns(rows, schema):
+    """Convert decoded rows to one NumPy array per column."""
+    columns = {}
+    for name, dtype, field in schema:
+        values = [row.get(field) for row in rows]
+        if name == 'timestamp':
+            column = np.array([v.rstrip('Z') for v in values], dtype='datetime64[ms]').astype(np.int64)
+        elif name == 'side':
+            column = np.array([1 if v == 'Buy' else -1 for v in values], dtype=dtype)
+        elif dtype == 'S16':
+            column = np.array([uuid_bytes(v) for v in values], dtype=dtype)
+        else:
+            column = np.array([0 if v is None else v for v in values], dtype=dtype)
+        columns[name] = column
+    return columns
+
+
+class ColumnStore:
+    """Append-only column files in `path`, described by `schema` ((name, dtype, ...) tuples).
+
+    `column(name)` returns a read-only memmap over the rows written so far. A torn append (a crash
+    between columns) is repaired on open by truncating every column to the shortest one.
+    """
+
+    def __init__(self, path, schema):
+        self.path = path
+        self.schema = [(c[0], np.dtype(c[1])) for c in schema]
+        self.lock = threading.Lock()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        meta = os.path.join(path, 'schema.json')
+        described = [[name, dtype.str] for name, dtype in self.schema]
+        if os.path.exists(meta):
+            with open(meta) as f:
+                if json.load(f) != described:
+                    raise ValueError("%s holds a different schema" % path)
+        else:
+            with open(meta, 'w') as f:
+                json.dump(described, f)
+        self.rows = min(self._file_rows(name, dtype) for name, dtype in self.schema)
+        for name, dtype in self.schema:
+            if self._file_rows(name, dtype) != self.rows:
+                with open(self._file(name), 'r+b') as f:
+                    f.truncate(self.rows * dtype.itemsize)
+
+    def _file(self, name):
+        return os.path.join(self.path, name + '.col')
+
+    def _file_rows(self, name, dtype):
+        try:
+            return os.path.getsize(self._file(name)) // dtype.itemsize
+        except OSError:
+            return 0
+
+    def __len__(self):
+        return self.rows
+
+    @property
+    def names(self):
+        return [name for name, _ in self.schema]
+
+    def append(self, columns):
+        """Append equal-length arrays, one per column. Returns the new row count."""
+        n = len(columns[self.schema[0][0]])
+        if not n:
+            return self.rows
+        with self.lock:
+            for name, dtype in self.schema:
+                data = np.ascontiguousarray(columns[name], dtype=dtype)
+                if len(data) != n:
+                    raise ValueError("column %s has %d rows, expected %d" % (name, len(data), n))
+                with open(self._file(name), 'ab') as f:
+                    f.write(data.tobytes())
+            self.rows += n
+        return self.rows
+
+    def column(self, name):
+        dtype = dict(self.schema)[name]
+        if not self.rows:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(self._file(name), dtype=dtype, mode='r', shape=(self.rows,))
+
+    def columns(self):
+        return dict((name, self.column(name)) for name in self.names)
+
+    def tail(self, name, n):
+        return self.column(name)[max(0, self.rows - n):]
+
+
+class HistoryDownloader:
+    """Fetch a time range of trades or executions into a `ColumnStore`.
+
+    window: seconds of history per concurrently fetched window.
+    workers: windows in flight at once; the client's rate limiter still paces the requests.
+    """
+
+    def __init__(self, client, workers=4, window=3600, page=PAGE_SIZE):
+        self.client = client
+        self.workers = workers
+        self.window = int(window * 1000)
+        self.page = page
+
+    def trades(self, symbol, start, end, store):
+        """Public trades of `symbol` between `start` and `end` into `store` (see TRADE_SCHEMA)."""
+        return self._download(self.client.recent_trades, symbol, start, end, store, TRADE_SCHEMA, 'trdMatchID')
+
+    def executions(self, symbol, start, end, store):
+        """Our own executions (execution/tradeHistory) into `store` (see EXECUTION_SCHEMA)."""
+        return self._download(self.client.history, symbol, start, end, store, EXECUTION_SCHEMA, 'execID')
+
+    def _fetch_window(self, fetch, symbol, start, end):
+        rows = []
+        offset = 0
+        while True:
+            page = fetch(symbol, count=self.page, start=offset, startTime=iso(start), endTime=iso(end - 1))
+            if not isinstance(page, list):
+                raise ValueError("Unexpected history response for %s %s-%s: %r" % (symbol, iso(start), iso(end), page))
+            rows.extend(page)
+            if len(page) < self.page:
+                return rows
+            offset += len(page)
+
+    def _download(self, fetch, symbol, start, end, store, schema, key):
+        """Fetch [start, end) in windows and append the new rows in time order. Returns rows added."""
+        start, end = to_ms(start), to_ms(end)
+        # Rows before `floor` are stored already, and so are the ones at `floor` whose ids are in `seen`.
+        floor = None
+        seen = set()
+        if len(store):
+            # Resume: rows at the last stored millisecond may have been cut off by the previous run,
+            # so refetch from there and drop the ones already stored.
+            last = int(store.tail('timestamp', 1)[0])
+            if last >= start:
+                start = last
+                floor = iso(last)
+                stamps = store.column('timestamp')
+                first = int(np.searchsorted(stamps, last))
+                seen = set(_stored_id(v) for v in store.column(key)[first:])
+        if start >= end:
+            return 0
+
+        windows = deque((t, min(t + self.window, end)) for t in range(start, end, self.window))
+        added = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            pending = deque()
+            while windows or pending:
+                # Keep a bounded number of windows in flight and consume them in time order.
+                while windows and len(pending) < self.workers * 2:
+                    pending.append(pool.submit(self._fetch_window, fetch, symbol, *windows.popleft()))
+                rows = pending.popleft().result()
+                rows.sort(key=lambda r: r['timestamp'])
+                fresh = []
+                for row in rows:
+                    if floor is not None and row['timestamp'] < floor:
+                        continue
+                    rid = uuid_bytes(row.get(key))
+                    if rid and rid not in seen:
+                        seen.add(rid)
+                        fresh.append(row)
+                if not fresh:
+                    continue
+                rows = fresh
+                columns = to_columns(rows, schema)
+                store.append(columns)
+                added += len(rows)
+                # Only rows from the window's last millisecond on can show up again in the next window.
+                last = columns['timestamp'][-1]
+                floor = iso(last)
+                seen = set(_stored_id(v) for v in columns[key][columns['timestamp'] == last])
+        return added
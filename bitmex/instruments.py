@@ -0,0 +1,176 @@
+"""Instrument metadata cache and tick/lot size rounding.
+
+`InstrumentCache` holds every active instrument, loaded in one `instrument/active` request and
+reloaded once it is `ttl` seconds old (or on `refresh`). `ticker`, `instrument`, `today` and
+`symbols` answer from it instead of each issuing their own request. Concurrent readers of a stale
+cache wait for a single reload rather than each fetching. The order path does not wait: it rounds
+against the stale entries while a background thread reloads them, and a reload that fails leaves
+them in place and is tried again `RELOAD_RETRY` seconds later.
+
+Orders are rounded against the cached `tickSize` and `lotSize` before they are sent, since the
+exchange rejects anything off the grid:
+
+    price      buys round down, sells up, so rounding never makes an order more aggressive
+    stopPx     nearest tick
+    orderQty   towards zero to a multiple of lotSize; an order that rounds to nothing is refused
+"""
+from __future__ import absolute_import
+
+import math
+import threading
+import time
+from decimal import Decimal
+
+# Seconds before a failed background reload is tried again.
+RELOAD_RETRY = 5.0
+
+
+def _decimals(step):
+    exponent = Decimal(repr(step)).normalize().as_tuple().exponent
+    return max(0, -exponent)
+
+
+def round_step(value, step, mode='nearest'):
+    """Round `value` to a multiple of `step`: mode 'down', 'up' or 'nearest'."""
+    if not step:
+        return value
+    steps = value / step
+    # Absorb float noise so 9000.5 / 0.5 never lands a hair below 18001.
+    if mode == 'down':
+        steps = math.floor(steps + 1e-9)
+    elif mode == 'up':
+        steps = math.ceil(steps - 1e-9)
+    else:
+        steps = math.floor(steps + 0.5)
+    return round(steps * step, _decimals(step))
+
+
+def round_price(instrument, price, side=None):
+    """`price` on `instrument`'s tick grid; see the module docstring for the direction."""
+    mode = 'down' if side == 'Buy' else 'up' if side == 'Sell' else 'nearest'
+    return round_step(price, instrument.get('tickSize'), mode)
+
+
+def round_quantity(instrument, quantity):
+    """`quantity` (signed) towards zero to a multiple of `instrument`'s lotSize."""
+    lot = instrument.get('lotSize')
+    if not lot:
+        return quantity
+    rounded = round_step(abs(quantity), lot, 'down')
+    if float(rounded).is_integer():
+        rounded = int(rounded)
+    return -rounded if quantity < 0 else rounded
+
+
+def round_order(instrument, order, side=None, amend=False):
+    """Round `order` in place to `instrument`'s tick and lot sizes.
+
+    A new order's side comes from its `side` or the sign of its orderQty. An amend's orderQty is
+    unsigned, so pass the side of the order amended, if known, or its price rounds to the nearest tick.
+    """
+    side = side or order.get('side')
+    qty = order.get('orderQty')
+    if side is None and qty and not amend:
+        side = 'Buy' if qty > 0 else 'Sell'
+    if order.get('price') is not None:
+        order['price'] = round_price(instrument, order['price'], side)
+    if order.get('stopPx') is not None:
+        order['stopPx'] = round_price(instrument, order['stopPx'])
+    if qty:
+        order['orderQty'] = round_quantity(instrument, qty)
+        if not order['orderQty']:
+            raise ValueError("Order quantity %s of %s is below the lot size %s" % (
+                qty, instrument['symbol'], instrument.get('lotSize')))
+    return order
+
+
+class InstrumentCache:
+    """Instruments by symbol, reloaded through `fetch` (returning instrument/active) when older than
+    `ttl` seconds. `ttl` None never expires; `fetch` None leaves loading to the owner (`load`)."""
+
+    def __init__(self, fetch=None, ttl=60.0):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.instruments = {}
+        self.active = []
+        self.loaded = None
+        self.lock = threading.Lock()
+        self.reloading = False
+        self.failed = None  # monotonic time of the last failed background reload
+        self.last_error = None
+        # Metrics
+        self.hits = 0
+        self.loads = 0
+        self.errors = 0
+
+    def stale(self):
+        return self.loaded is None or (self.ttl is not None and time.monotonic() - self.loaded > self.ttl)
+
+    def load(self, instruments):
+        """Replace the cache with `instruments` (an instrument/active response)."""
+        self.instruments = dict((i['symbol'], i) for i in instruments)
+        self.active = [i['symbol'] for i in instruments]
+        self.loaded = time.monotonic()
+        self.failed = None
+        self.loads += 1
+
+    def put(self, instrument):
+        """Add one instrument fetched on its own (e.g. an index, which instrument/active leaves out)."""
+        self.instruments[instrument['symbol']] = instrument
+
+    def refresh(self):
+        with self.lock:
+            self.load(self.fetch())
+
+    def invalidate(self):
+        self.loaded = None
+
+    def _fresh(self, wait=True):
+        """Reload a stale cache. Without `wait` a cache that holds anything is reloaded in the background
+        and served as it is meanwhile."""
+        if self.fetch is None or not self.stale():
+            return
+        if wait or self.loaded is None:
+            with self.lock:
+                # Whoever waited on the lock finds the cache already reloaded.
+                if self.stale():
+                    self.load(self.fetch())
+        elif not self.reloading and (self.failed is None or time.monotonic() - self.failed > RELOAD_RETRY):
+            self.reloading = True
+            thread = threading.Thread(target=self._reload, name='InstrumentCache')
+            thread.daemon = True
+            thread.start()
+
+    def _reload(self):
+        try:
+            with self.lock:
+                if self.stale():
+                    self.load(self.fetch())
+        except Exception as e:
+            # The stale entries stay; the order path tries again after RELOAD_RETRY.
+            self.failed = time.monotonic()
+            self.last_error = e
+            self.errors += 1
+        finally:
+            self.reloading = False
+
+    def get(self, symbol, wait=True):
+        """The cached instrument, or None if `symbol` is not among them. Without `wait` a stale cache is
+        served while it reloads in the background."""
+        self._fresh(wait)
+        instrument = self.instruments.get(symbol)
+        if instrument is not None:
+            self.hits += 1
+        return instrument
+
+    def symbols(self):
+        self._fresh()
+        return list(self.active)
+
+    def round_order(self, order, symbol=None, side=None, amend=False):
+        """Round `order` in place when its instrument is known; unknown symbols pass through. A stale
+        cache is not waited for."""
+        instrument = self.get(order.get('symbol') or symbol, wait=False)
+        if instrument is None:
+            return order
+        return round_order(instrument, order, side, amend)
@@ -0,0 +1,389 @@
+"""Write-ahead order journal.
+
+Every order intent is appended before its request goes out, and so is every amend, cancel, ack and
+order or execution stream row. On restart `recover` replays the journal into an `OrderStore` and
+`Recovery.reconcile` fetches the one REST delta needed to catch up. That delta is the open orders of
+the journaled symbols plus the fate of intents that never saw an ack. No cold reload of every
+order follows.
+
+The journal is one memory-mapped file of length-prefixed records:
+
+    length  u4   payload bytes; 0 marks the end of the journal
+    crc     u4   crc32 of ts, kind and payload
+    ts      i8   ns since the epoch
+    kind    u1   INTENT, AMEND, CANCEL, ACK, ORDER, EXECUTION or SNAPSHOT
+    payload      the row as compact JSON (`bitmex.codec`)
+
+An append is a copy into the map, so it costs no system call. Once it returns, the record survives
+the process being killed. A flusher thread msyncs whatever was appended every `interval` seconds,
+one msync for all the records since the last (group commit), for durability against the machine
+going down. `commit` waits for that flush, and with `durable` every intent waits before its order
+is sent. A record cut short by a crash fails its crc; recovery stops there and appends resume over it.
+
+`compact` rewrites the journal as a snapshot of the open orders and pending intents, so it only
+grows with one session's traffic.
+"""
+from __future__ import absolute_import
+
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+from bitmex import codec
+from bitmex.orderstore import EXECUTION_FIELDS, OrderStore
+
+MAGIC = b'BMXJRNL1'
+HEADER = struct.Struct('<IIqB')
+TS_KIND = struct.Struct('<qB')
+
+INTENT = 1
+AMEND = 2
+CANCEL = 3
+ACK = 4
+ORDER = 5
+EXECUTION = 6
+SNAPSHOT = 7
+
+FILENAME = 'orders.journal'
+
+
+def _crc(ts, kind, payload):
+    return zlib.crc32(payload, zlib.crc32(TS_KIND.pack(ts, kind)))
+
+
+class Recovery:
+    """What a journal replay rebuilt.
+
+    store: an `OrderStore` with every journaled order.
+    intents: {clOrdID: (ts, order)} of orders sent (or about to be) without an ack in the journal.
+    opened: {orderID: ts} of when each order was sent, in ns.
+    """
+
+    def __init__(self, store, intents, opened, records, elapsed):
+        self.store = store
+        self.intents = intents
+        self.opened = opened
+        self.records = records
+        self.elapsed = elapsed
+
+    def symbols(self):
+        symbols = set(order.symbol for order in self.store.orders.values() if order.is_open() and order.symbol)
+        symbols.update(order.get('symbol') for _, order in self.intents.values() if order.get('symbol'))
+        return sorted(symbols)
+
+    def reconcile(self, client, symbols=None, journal=None):
+        """Catch up with the exchange: open orders of `symbols` (default: those with open orders or
+        intents) and the intents nobody acked, looked up by clOrdID. What REST returns is appended to
+        `journal`. Returns the number of orders repaired."""
+        symbols = symbols or self.symbols()
+        before = dict((o.orderID, (o.ordStatus, o.leavesQty)) for o in self.store.orders.values())
+        rows = []
+        for symbol in symbols:
+            rows.extend(client.active_orders(symbol) or [])
+        if self.intents:
+            rows.extend(client.orders(clOrdIDs=list(self.intents)) or [])
+        seen = set(row['orderID'] for row in rows)
+        missing = [o.orderID for o in self.store.orders.values()
+                   if o.is_open() and o.orderID not in seen and (not symbols or o.symbol in symbols)]
+        if missing:
+            rows.extend(client.orders(orderIDs=missing) or [])
+        for row in rows:
+            self.store.update(row)
+            intent = self.intents.get(row.get('clOrdID'))
+            self.opened.setdefault(row['orderID'], intent[0] if intent else time.time_ns())
+        if journal is not None:
+            journal.acks(rows)
+        # Whatever the exchange does not know by clOrdID never landed.
+        self.intents.clear()
+        return sum(1 for o in self.store.orders.values() if before.get(o.orderID) != (o.ordStatus, o.leavesQty))
+
+
+class Journal:
+    """Append-only memory-mapped order journal in `<path>/orders.journal`. See the module docstring.
+
+    capacity: initial size of the file in bytes; it doubles when full.
+    interval: seconds between group commits (msync).
+    durable: make `intent` wait for its commit, so an order is never sent before its intent is on disk.
+    """
+
+    def __init__(self, path, capacity=1 << 24, interval=0.005, durable=False):
+        self.path = path
+        self.interval = interval
+        self.durable = durable
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.filename = os.path.join(path, FILENAME)
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        # Held while the map is msynced or replaced, which appends (holding `lock`) need not wait for.
+        self.sync_lock = threading.Lock()
+        self.file = None
+        self.mm = None
+        self._open(capacity)
+        self.synced = self.offset
+        self.running = False
+        self.thread = None
+        # Metrics
+        self.appended = 0
+        self.commits = 0
+
+    #
+    # File
+    #
+    def _open(self, capacity):
+        new = not os.path.exists(self.filename) or os.path.getsize(self.filename) < len(MAGIC)
+        self.file = open(self.filename, 'w+b' if new else 'r+b')
+        if new:
+            self.file.write(MAGIC)
+        size = max(capacity, os.fstat(self.file.fileno()).st_size)
+        self.file.truncate(size)
+        self.capacity = size
+        self.mm = mmap.mmap(self.file.fileno(), size)
+        if self.mm[:len(MAGIC)] != MAGIC:
+            raise ValueError("%s is not an order journal" % self.filename)
+        self.offset = len(MAGIC)
+        for _ in self._scan():
+            pass
+        self._scrub()
+
+    def _scan(self):
+        """Yield (ts, kind, payload) of the valid records, leaving `offset` past the last one."""
+        mm = self.mm
+        offset = len(MAGIC)
+        size = self.capacity
+        while offset + HEADER.size <= size:
+            length, crc, ts, kind = HEADER.unpack_from(mm, offset)
+            end = offset + HEADER.size + length
+            if not length or end > size:
+                break
+            payload = mm[offset + HEADER.size:end]
+            if _crc(ts, kind, payload) != crc:
+                break
+            offset = end
+            self.offset = offset
+            yield ts, kind, payload
+
+    def _scrub(self):
+        """Zero what a crash left past the last valid record, so it cannot be mistaken for one."""
+        page = mmap.PAGESIZE
+        offset = self.offset
+        while offset < self.capacity:
+            end = min(self.capacity, offset + page - offset % page)
+            if not self.mm[offset:end].strip(b'\0'):
+                break
+            self.mm[offset:end] = b'\0' * (end - offset)
+            offset = end
+
+    def _grow(self, needed):
+        """Double the file until `needed` bytes fit. Holds `lock`."""
+        size = self.capacity
+        while size < needed:
+            size *= 2
+        with self.sync_lock:
+            self.mm.flush()
+            self.mm.close()
+            self.file.truncate(size)
+            self.mm = mmap.mmap(self.file.fileno(), size)
+            self.capacity = size
+
+    #
+    # Appends
+    #
+    def append(self, kind, row, ts=None):
+        """Append one record; returns the offset it ends at (see `commit`)."""
+        payload = codec.dumps(row)
+        ts = ts or time.time_ns()
+        crc = _crc(ts, kind, payload)
+        with self.lock:
+            start = self.offset
+            end = start + HEADER.size + len(payload)
+            # Room for the record and the zero length after it.
+            if end + HEADER.size > self.capacity:
+                self._grow(end + HEADER.size)
+            mm = self.mm
+            # The payload first: a header with a length is what makes the record exist.
+            mm[start + HEADER.size:end] = payload
+            HEADER.pack_into(mm, start, len(payload), crc, ts, kind)
+            self.offset = end
+            self.appended += 1
+        return end
+
+    def intent(self, kind, orders):
+        """Journal new orders (INTENT) or amends (AMEND) before they are sent."""
+        end = 0
+        for order in orders:
+            end = self.append(kind, order)
+        if self.durable:
+            self.commit(end)
+
+    def cancel(self, orderIDs=None, **fields):
+        """Journal a cancel before it is sent: orderIDs, or the filter of a cancel-all."""
+        if orderIDs is not None:
+            fields['orderID'] = orderIDs
+        self.append(CANCEL, fields)
+
+    def acks(self, acks):
+        """Journal a REST ack, or each of a list of them."""
+        if isinstance(acks, dict):
+            self.append(ACK, acks)
+        elif isinstance(acks, list):
+            for ack in acks:
+                if isinstance(ack, dict):
+                    self.append(ACK, ack)
+        return acks
+
+    #
+    # Websocket
+    #
+    def attach(self, ws):
+        """Journal the order and execution streams of an authenticated BitMEXWebsocket."""
+        ws.add_listener('order', self.on_order)
+        ws.add_listener('execution', self.on_execution)
+
+    def on_order(self, action, data):
+        for row in data:
+            self.append(ORDER, row)
+
+    def on_execution(self, action, data):
+        # The partial is history the order rows already reflect.
+        if action == 'insert':
+            for row in data:
+                self.append(EXECUTION, row)
+
+    #
+    # Group commit
+    #
+    def start(self):
+        """Start the flusher thread."""
+        if self.running:
+            return self
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name='Journal-commit')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def _run(self):
+        while self.running:
+            with self.cond:
+                self.cond.wait(self.interval)
+            self._flush()
+
+    def _flush(self):
+        """msync everything appended since the last commit and wake its waiters. The msync runs
+        outside `lock`, so appends carry on meanwhile."""
+        with self.lock:
+            offset = self.offset
+            synced = self.synced
+        if offset <= synced:
+            return
+        with self.sync_lock:
+            start = synced - synced % mmap.PAGESIZE
+            self.mm.flush(start, offset - start)
+        with self.cond:
+            if offset > self.synced:
+                self.synced = offset
+                self.commits += 1
+            self.cond.notify_all()
+
+    def commit(self, offset=None, timeout=None):
+        """Wait until the journal is on disk up to `offset` (default: all appended so far). Waiters
+        share the flusher's msync; without a flusher the caller syncs. False on timeout."""
+        if offset is None:
+            offset = self.offset
+        if not self.running:
+            self._flush()
+            return True
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.cond:
+            while self.synced < offset:
+                # Wake the flusher instead of waiting out its interval.
+                self.cond.notify_all()
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.cond.wait(self.interval if remaining is None else min(self.interval, remaining))
+        return True
+
+    def close(self):
+        self.running = False
+        with self.cond:
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.mm is not None:
+            self._flush()
+            with self.lock:
+                self.mm.close()
+                self.file.close()
+                self.mm = None
+
+    #
+    # Recovery
+    #
+    def records(self):
+        """Yield (ts, kind, row) of every record."""
+        with self.lock:
+            offset = self.offset
+            items = list(self._scan())
+            self.offset = offset
+        for ts, kind, payload in items:
+            yield ts, kind, codec.loads(payload)
+
+    def recover(self, store=None):
+        """Replay the journal into `store` (a new `OrderStore` by default). Returns a `Recovery`."""
+        started = time.perf_counter()
+        store = store if store is not None else OrderStore()
+        intents = {}
+        opened = {}
+        count = 0
+        for ts, kind, row in self.records():
+            count += 1
+            if kind == INTENT:
+                if row.get('clOrdID'):
+                    intents[row['clOrdID']] = (ts, row)
+            elif kind in (ACK, ORDER, SNAPSHOT, EXECUTION):
+                orderID = row.get('orderID')
+                if not orderID:
+                    continue
+                if kind == EXECUTION:
+                    store.executions.append(row)
+                    store.update(row, fields=EXECUTION_FIELDS)
+                else:
+                    store.update(row)
+                intent = intents.pop(row.get('clOrdID'), None) if row.get('clOrdID') else None
+                if orderID not in opened:
+                    # A snapshot carries the order's original send time.
+                    opened[orderID] = intent[0] if intent is not None else ts
+        return Recovery(store, intents, opened, count, time.perf_counter() - started)
+
+    def compact(self, recovery):
+        """Replace the journal with a snapshot of `recovery`: its open orders and pending intents."""
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(MAGIC)
+            for order in recovery.store.orders.values():
+                if order.is_open():
+                    self._write_record(f, SNAPSHOT, order.to_dict(), recovery.opened.get(order.orderID))
+            for clOrdID, (ts, order) in recovery.intents.items():
+                self._write_record(f, INTENT, order, ts)
+            f.flush()
+            os.fsync(f.fileno())
+        with self.lock, self.sync_lock:
+            capacity = self.capacity
+            self.mm.close()
+            self.file.close()
+            os.replace(tmp, self.filename)
+            self._open(capacity)
+            self.synced = self.offset
+
+    @staticmethod
+    def _write_record(f, kind, row, ts=None):
+        payload = codec.dumps(row)
+        ts = ts or time.time_ns()
+        f.write(HEADER.pack(len(payload), _crc(ts, kind, payload), ts, kind))
+        f.write(payload)
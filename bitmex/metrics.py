@@ -0,0 +1,282 @@
+"""Latency histograms and counters for API calls.
+
+Clients report to a metrics object through three calls: `timing(name, ns, **labels)`,
+`incr(name, n=1, **labels)` and the `enabled` flag. `NULL_METRICS` is the default; it records
+nothing, and callers check `enabled` before reading the clock, so instrumentation costs one
+attribute check when it is off.
+
+`Metrics` aggregates in memory into log-linear (HDR-style) histograms. It can also forward every
+sample to sinks such as `StatsdSink`. `PrometheusExporter` renders a `Metrics` in the Prometheus
+text format and can serve it over HTTP.
+
+    metrics = Metrics()
+    client = TradeClient(acc, metrics=metrics)
+    ...
+    metrics.snapshot()['request{endpoint=order,verb=POST}']['p99']
+"""
+from __future__ import absolute_import
+
+import socket
+import threading
+
+
+class Histogram:
+    """Log-linear histogram of non-negative integer values (nanoseconds here).
+
+    Values below 2**precision are counted exactly; above that every power of two is split into
+    2**(precision - 1) buckets, so a percentile is within 2**-(precision - 1) of the true value
+    (under 2% with the default precision of 7). Values too large for `max_bits` share the last
+    bucket, whose percentile is the largest value recorded. Recording is a bit_length, a shift and
+    a list increment. It takes no lock, so two threads recording into the same bucket at the same
+    moment can lose one count.
+    """
+
+    def __init__(self, precision=7, max_bits=44):
+        self.precision = precision
+        self.sub = 1 << precision
+        self.half = self.sub >> 1
+        self.counts = [0] * (self.sub + (max_bits - precision + 1) * self.half)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def _index(self, value):
+        if value < self.sub:
+            return value
+        shift = value.bit_length() - self.precision
+        return self.sub + (shift - 1) * self.half + ((value >> shift) - self.half)
+
+    def _value(self, index):
+        """Upper edge of bucket `index`, the value percentiles report."""
+        if index < self.sub:
+            return index
+        shift, offset = divmod(index - self.sub, self.half)
+        shift += 1
+        return ((self.half + offset + 1) << shift) - 1
+
+    def record(self, value):
+        value = int(value) if value > 0 else 0
+        index = self._index(value)
+        if index >= len(self.counts):
+            index = len(self.counts) - 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        if self.min is None or value < self.min:
+            self.min = value
+
+    def percentile(self, q):
+        """Value at or below which `q` percent of the samples fall."""
+        if not self.count:
+            return None
+        rank = max(1, int(round(q / 100.0 * self.count)))
+        last = len(self.counts) - 1
+        seen = 0
+        for index, n in enumerate(self.counts):
+            if n:
+                seen += n
+                if seen >= rank:
+                    # The last bucket also holds everything past max_bits; only `max` bounds it.
+                    return self.max if index == last else min(self._value(index), self.max)
+        return self.max
+
+    def mean(self):
+        return self.total / float(self.count) if self.count else None
+
+    def reset(self):
+        self.counts = [0] * len(self.counts)
+        self.count = self.total = self.max = 0
+        self.min = None
+
+
+def series_name(name, labels):
+    if not labels:
+        return name
+    return '%s{%s}' % (name, ','.join('%s=%s' % kv for kv in labels))
+
+
+class NullMetrics:
+    """Metrics that record nothing."""
+    enabled = False
+
+    def timing(self, name, ns, **labels):
+        pass
+
+    def incr(self, name, n=1, **labels):
+        pass
+
+
+NULL_METRICS = NullMetrics()
+
+
+class Metrics:
+    """In-memory histograms (`timing`) and counters (`incr`), keyed by name and labels.
+
+    Timings are in nanoseconds; `snapshot` and the exporters report seconds.
+    """
+    enabled = True
+
+    def __init__(self, sinks=(), precision=7):
+        self.precision = precision
+        self.histograms = {}
+        self.counters = {}
+        self.sinks = list(sinks)
+        self.lock = threading.Lock()
+
+    def _histogram(self, key):
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(key, Histogram(self.precision))
+        return histogram
+
+    def timing(self, name, ns, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self._histogram(key).record(ns)
+        for sink in self.sinks:
+            sink.timing(name, ns, **labels)
+
+    def incr(self, name, n=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+        for sink in self.sinks:
+            sink.incr(name, n, **labels)
+
+    def histogram(self, name, **labels):
+        return self.histograms.get((name, tuple(sorted(labels.items()))))
+
+    def counter(self, name, **labels):
+        return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def snapshot(self):
+        """{series: {'count', 'mean', 'min', 'p50', 'p90', 'p99', 'p99.9', 'max'}} for timings (seconds)
+        and {series: value} for counters."""
+        result = {}
+        for (name, labels), h in list(self.histograms.items()):
+            if not h.count:
+                continue
+            result[series_name(name, labels)] = {
+                'count': h.count,
+                'mean': h.mean() / 1e9,
+                'min': h.min / 1e9,
+                'p50': h.percentile(50) / 1e9,
+                'p90': h.percentile(90) / 1e9,
+                'p99': h.percentile(99) / 1e9,
+                'p99.9': h.percentile(99.9) / 1e9,
+                'max': h.max / 1e9,
+            }
+        for (name, labels), value in list(self.counters.items()):
+            result[series_name(name, labels)] = value
+        return result
+
+    def reset(self):
+        with self.lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+
+class StatsdSink:
+    """Forward every sample to a StatsD daemon over UDP (`<prefix>.<name>.<label values>`).
+
+    Sends are fire-and-forget; a dead daemon costs a failed sendto, not an exception.
+    """
+
+    def __init__(self, host='127.0.0.1', port=8125, prefix='bitmex'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+
+    def _name(self, name, labels):
+        parts = [self.prefix, name] + [str(v).replace('/', '_').replace('.', '_') for _, v in sorted(labels.items())]
+        return '.'.join(p for p in parts if p)
+
+    def _send(self, line):
+        try:
+            self.sock.sendto(line.encode('utf8'), self.address)
+        except (OSError, socket.error):
+            pass
+
+    def timing(self, name, ns, **labels):
+        self._send('%s:%.3f|ms' % (self._name(name, labels), ns / 1e6))
+
+    def incr(self, name, n=1, **labels):
+        self._send('%s:%d|c' % (self._name(name, labels), n))
+
+
+class PrometheusExporter:
+    """Prometheus text exposition of a `Metrics`: timings as summaries (seconds), counters as `_total`."""
+
+    QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+    def __init__(self, metrics, namespace='bitmex'):
+        self.metrics = metrics
+        self.namespace = namespace
+        self.server = None
+
+    def _labels(self, labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs)
+
+    def render(self):
+        lines = []
+        typed = set()
+        for (name, labels), h in sorted(self.metrics.histograms.items()):
+            metric = '%s_%s_seconds' % (self.namespace, name)
+            if metric not in typed:
+                typed.add(metric)
+                lines.append('# TYPE %s summary' % metric)
+            for q in self.QUANTILES:
+                value = h.percentile(q * 100)
+                lines.append('%s%s %.9f' % (metric, self._labels(labels, [('quantile', q)]),
+                                            (value or 0) / 1e9))
+            lines.append('%s_sum%s %.9f' % (metric, self._labels(labels), h.total / 1e9))
+            lines.append('%s_count%s %d' % (metric, self._labels(labels), h.count))
+        for (name, labels), value in sorted(self.metrics.counters.items()):
+            metric = '%s_%s_total' % (self.namespace, name)
+            if metric not in typed:
+                typed.add(metric)
+                lines.append('# TYPE %s counter' % metric)
+            lines.append('%s%s %d' % (metric, self._labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port=9108, host='127.0.0.1'):
+        """Serve /metrics from a daemon thread. Returns the bound port.
+
+        Only local scrapers can reach it by default; pass host='0.0.0.0' to expose it on every interface.
+        """
+        try:
+            from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        except ImportError:
+            from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer as ThreadingHTTPServer
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = exporter.render().encode('utf8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        thread = threading.Thread(target=self.server.serve_forever, name='PrometheusExporter')
+        thread.daemon = True
+        thread.start()
+        return self.server.server_address[1]
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
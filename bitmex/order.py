@@ -0,0 +1,109 @@
+"""Compact order state and client-assigned order ids."""
+from __future__ import absolute_import
+
+import itertools
+import time
+
+from bitmex import codec
+
+# The fields of an ack we act on; everything else in the ack is dropped.
+ACK_FIELDS = ('orderID', 'ordStatus', 'cumQty', 'leavesQty', 'price', 'avgPx')
+OPEN_STATUSES = ('New', 'PartiallyFilled')
+CLORDID_MAX_LEN = 36
+_DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+_MISSING = object()
+
+
+def base36(n):
+    s = ''
+    while True:
+        n, r = divmod(n, 36)
+        s = _DIGITS[r] + s
+        if not n:
+            return s
+
+
+class ClOrdIDGenerator:
+    """Deterministic clOrdIDs: <prefix>-<session>-<counter>.
+
+    The session defaults to the start time in base 36, so ids do not repeat across restarts; with an
+    explicit session the sequence is fully reproducible. Thread-safe (itertools.count is atomic).
+    """
+
+    def __init__(self, prefix='mm', session=None, start=1):
+        self.session = session if session is not None else base36(int(time.time() * 1000))
+        self.prefix = '%s-%s-' % (prefix, self.session)
+        self.counter = itertools.count(start)
+        if len(self.prefix) > CLORDID_MAX_LEN - 8:
+            raise ValueError("clOrdID prefix too long: %s" % self.prefix)
+
+    def __call__(self):
+        return self.prefix + base36(next(self.counter))
+
+    def owns(self, clOrdID):
+        return bool(clOrdID) and clOrdID.startswith(self.prefix)
+
+
+class OrderState(object):
+    """One order's exchange state in a fixed set of slots instead of the full ack dict.
+
+    Supports read-only dict-style access (`state['ordStatus']`, `state.get('price')`) so code written
+    against raw acks keeps working.
+    """
+    __slots__ = ('orderID', 'clOrdID', 'symbol', 'side', 'ordType', 'ordStatus', 'orderQty', 'price', 'stopPx',
+                 'cumQty', 'leavesQty', 'avgPx', 'workingIndicator', 'timestamp', 'text')
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name))
+
+    def merge(self, row, fields=None):
+        """Copy `fields` (default: every slot) present in `row` onto this state."""
+        for name in fields or self.__slots__:
+            value = row.get(name, _MISSING)
+            if value is not _MISSING:
+                setattr(self, name, value)
+        return self
+
+    def is_open(self):
+        return self.ordStatus in OPEN_STATUSES
+
+    def __getitem__(self, name):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name)
+
+    def get(self, name, default=None):
+        value = getattr(self, name, None)
+        return default if value is None else value
+
+    def __contains__(self, name):
+        return getattr(self, name, None) is not None
+
+    def to_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__ if getattr(self, name) is not None)
+
+    def __repr__(self):
+        return 'OrderState(%s)' % ', '.join('%s=%r' % kv for kv in sorted(self.to_dict().items()))
+
+
+def decode_ack(ack, into=None, fields=ACK_FIELDS):
+    """Pull `fields` out of an ack into an OrderState (or any object with those attributes).
+
+    `ack` may be the decoded dict or the raw JSON body; a bulk ack (a list) decodes its first element.
+    Returns None when the ack is not an order (e.g. an error body).
+    """
+    if isinstance(ack, (bytes, bytearray, str)):
+        ack = codec.loads(ack)
+    if isinstance(ack, list):
+        ack = ack[0] if ack else None
+    if not isinstance(ack, dict) or 'orderID' not in ack:
+        return None
+    if into is None:
+        into = OrderState()
+    for name in fields:
+        value = ack.get(name, _MISSING)
+        if value is not _MISSING:
+            setattr(into, name, value)
+    return into
@@ -0,0 +1,238 @@
+"""Array-backed L2 order book.
+
+Each side keeps its levels in parallel NumPy arrays sorted best-first, so locating a level is a
+binary search and depth/VWAP/imbalance queries are vectorized over contiguous memory instead of
+scanning a list of dicts.
+
+Size updates, most of the L2 feed, are O(log n). Inserting or deleting a level is the same search
+plus a shift of the levels behind it, O(n) but one contiguous memmove per array: a tree or skip
+list would make it O(log n) at the cost of the contiguous layout the vectorized queries rely on.
+"""
+from __future__ import absolute_import
+
+import numpy as np
+
+BUY = 'Buy'
+SELL = 'Sell'
+
+
+class BookSide:
+    """One side of the book. Levels are sorted by `key`, which is price for asks and -price for bids,
+    so index 0 is always the best level. `set` of a new price and `remove` shift the levels behind it."""
+
+    def __init__(self, side, capacity=64):
+        self.side = side
+        self.sign = -1.0 if side == BUY else 1.0
+        self.n = 0
+        self._keys = np.empty(capacity, dtype=np.float64)
+        self._prices = np.empty(capacity, dtype=np.float64)
+        self._sizes = np.empty(capacity, dtype=np.int64)
+        self._ids = np.empty(capacity, dtype=np.int64)
+
+    def __len__(self):
+        return self.n
+
+    @property
+    def prices(self):
+        return self._prices[:self.n]
+
+    @property
+    def sizes(self):
+        return self._sizes[:self.n]
+
+    @property
+    def ids(self):
+        return self._ids[:self.n]
+
+    def _grow(self):
+        capacity = len(self._keys) * 2
+        for name in ('_keys', '_prices', '_sizes', '_ids'):
+            old = getattr(self, name)
+            new = np.empty(capacity, dtype=old.dtype)
+            new[:self.n] = old[:self.n]
+            setattr(self, name, new)
+
+    def _find(self, price):
+        key = self.sign * price
+        i = int(np.searchsorted(self._keys[:self.n], key))
+        return i, key, (i < self.n and self._keys[i] == key)
+
+    def set(self, level_id, price, size):
+        """Insert a level or overwrite the one already resting at `price`. Returns the id of a different
+        level overwritten, else None."""
+        i, key, found = self._find(price)
+        displaced = None
+        if found:
+            if self._ids[i] != level_id:
+                displaced = int(self._ids[i])
+        else:
+            n = self.n
+            if n == len(self._keys):
+                self._grow()
+            if i < n:
+                for arr in (self._keys, self._prices, self._sizes, self._ids):
+                    arr[i + 1:n + 1] = arr[i:n]
+            self._keys[i] = key
+            self._prices[i] = price
+            self.n = n + 1
+        self._sizes[i] = size
+        self._ids[i] = level_id
+        return displaced
+
+    def update(self, price, size):
+        i, _, found = self._find(price)
+        if found:
+            self._sizes[i] = size
+        return found
+
+    def remove(self, price):
+        i, _, found = self._find(price)
+        if found:
+            n = self.n
+            for arr in (self._keys, self._prices, self._sizes, self._ids):
+                arr[i:n - 1] = arr[i + 1:n]
+            self.n = n - 1
+        return found
+
+    def clear(self):
+        self.n = 0
+
+    def best(self):
+        if not self.n:
+            return None
+        return float(self._prices[0]), int(self._sizes[0])
+
+    def depth_to(self, price):
+        """Cumulative size of every level at `price` or better."""
+        i = int(np.searchsorted(self._keys[:self.n], self.sign * price, side='right'))
+        return int(self._sizes[:i].sum())
+
+    def vwap(self, size):
+        """Average price to fill `size` by sweeping this side, or None if the side is too thin."""
+        if size <= 0 or not self.n:
+            return None
+        cum = np.cumsum(self._sizes[:self.n])
+        i = int(np.searchsorted(cum, size))
+        if i >= self.n:
+            return None
+        prices = self._prices[:i + 1]
+        filled = self._sizes[:i + 1].astype(np.float64)
+        filled[i] = size - (cum[i - 1] if i else 0)
+        return float(np.dot(prices, filled) / size)
+
+    def volume(self, levels=None):
+        return int(self._sizes[:self.n if levels is None else min(levels, self.n)].sum())
+
+
+class OrderBook:
+    """L2 book for one symbol, fed with orderBookL2 rows and addressed by BitMEX level id.
+
+    Level ids map to their (side, price) through a single dict; the levels themselves live in the
+    side arrays. A level that moves is taken off the side it was on, and a level overwritten at its
+    price by another id is forgotten.
+    """
+
+    def __init__(self, symbol, capacity=64):
+        self.symbol = symbol
+        self.bids = BookSide(BUY, capacity)
+        self.asks = BookSide(SELL, capacity)
+        self._levels = {}
+
+    def __len__(self):
+        return len(self.bids) + len(self.asks)
+
+    def side(self, side):
+        return self.bids if side == BUY else self.asks
+
+    def clear(self):
+        self.bids.clear()
+        self.asks.clear()
+        self._levels.clear()
+
+    def insert(self, level_id, side, price, size):
+        old = self._levels.get(level_id)
+        if old is not None and old != (side, price):
+            self.side(old[0]).remove(old[1])
+        self._levels[level_id] = (side, price)
+        displaced = self.side(side).set(level_id, price, size)
+        if displaced is not None:
+            self._levels.pop(displaced, None)
+
+    def update(self, level_id, side, size, price=None):
+        old = self._levels.get(level_id)
+        if old is None:
+            if price is not None:
+                self.insert(level_id, side, price, size)
+            return
+        if price is not None and price != old[1]:
+            self.insert(level_id, side, price, size)
+        else:
+            self.side(old[0]).update(old[1], size)
+
+    def delete(self, level_id, side):
+        level = self._levels.pop(level_id, None)
+        if level is not None:
+            self.side(level[0]).remove(level[1])
+
+    def apply(self, action, rows):
+        """Apply the data of one orderBookL2 message."""
+        if action == 'partial':
+            self.clear()
+            action = 'insert'
+        if action == 'insert':
+            for row in rows:
+                self.insert(row['id'], row['side'], row['price'], row['size'])
+        elif action == 'update':
+            for row in rows:
+                self.update(row['id'], row['side'], row['size'], row.get('price'))
+        elif action == 'delete':
+            for row in rows:
+                self.delete(row['id'], row['side'])
+
+    #
+    # Queries
+    #
+    def best_bid(self):
+        """(price, size) of the best bid, or None."""
+        return self.bids.best()
+
+    def best_ask(self):
+        return self.asks.best()
+
+    def mid(self):
+        bid, ask = self.bids.best(), self.asks.best()
+        if bid is None or ask is None:
+            return None
+        return (bid[0] + ask[0]) / 2
+
+    def depth(self, side, price):
+        """Cumulative size resting on `side` at `price` or better."""
+        return self.side(side).depth_to(price)
+
+    def vwap(self, side, size):
+        """Average fill price for a market order of `size` on `side` ('Buy' sweeps the asks)."""
+        return (self.asks if side == BUY else self.bids).vwap(size)
+
+    def imbalance(self, levels=None):
+        """(bid volume - ask volume) / total volume over the top `levels` of each side."""
+        bid, ask = self.bids.volume(levels), self.asks.volume(levels)
+        total = bid + ask
+        return (bid - ask) / float(total) if total else 0.0
+
+    def to_list(self, depth=None):
+        """Same layout as GET orderBook/L2: sells by descending price, then buys by descending price."""
+        rows = []
+        for book_side in (self.asks, self.bids):
+            n = book_side.n if not depth else min(depth, book_side.n)
+            levels = zip(book_side.ids[:n].tolist(), book_side.prices[:n].tolist(), book_side.sizes[:n].tolist())
+            side_rows = [{'symbol': self.symbol, 'id': i, 'side': book_side.side, 'size': s, 'price': p}
+                         for i, p, s in levels]
+            rows += reversed(side_rows) if book_side is self.asks else side_rows
+        return rows
+
+    @classmethod
+    def from_list(cls, symbol, rows):
+        """Build a book from a REST orderBook/L2 snapshot."""
+        book = cls(symbol, capacity=max(64, len(rows)))
+        book.apply('partial', rows)
+        return book
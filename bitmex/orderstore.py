@@ -0,0 +1,188 @@
+"""In-process order state kept current from the private order/execution streams.
+
+Lookups by orderID or clOrdID are dict reads instead of a GET /order round-trip. A reconciler
+periodically compares the store with REST and repairs whatever the stream missed.
+
+REST acks and stream rows race each other, so a row is only merged if it is not older than what the
+store holds: a closed order is never reopened, and a row with an earlier timestamp or a lower cumQty
+than the order's is dropped. The store stops being `live` when its websocket drops, until the next
+order partial.
+"""
+from __future__ import absolute_import
+
+import threading
+from collections import deque
+
+from bitmex.order import OPEN_STATUSES, OrderState
+
+# Fields an execution row carries about the state of its order.
+EXECUTION_FIELDS = ('orderID', 'clOrdID', 'symbol', 'ordStatus', 'cumQty', 'leavesQty', 'avgPx', 'price', 'orderQty',
+                    'workingIndicator', 'timestamp', 'text')
+
+
+class OrderStore:
+    """Orders, as compact `OrderState`s, indexed by orderID and clOrdID.
+
+    Feed it with `on_order` / `on_execution` (websocket listeners) or `update` (REST acks). Closed
+    orders are kept, up to `max_closed` of them, so late status checks still resolve locally.
+    """
+
+    def __init__(self, max_closed=10000, max_executions=10000):
+        self.lock = threading.RLock()
+        self.orders = {}
+        self.clOrdIDs = {}
+        self.closed = deque()
+        self.max_closed = max_closed
+        self.executions = deque(maxlen=max_executions)
+        self.live = False
+        self._reconciler = None
+        self._stop = threading.Event()
+
+    def __len__(self):
+        return len(self.orders)
+
+    def __contains__(self, orderID):
+        return orderID in self.orders
+
+    #
+    # Updates
+    #
+    def attach(self, ws):
+        """Subscribe to the order and execution tables of an authenticated BitMEXWebsocket."""
+        ws.add_listener('order', self.on_order)
+        ws.add_listener('execution', self.on_execution)
+        ws.add_disconnect_listener(self.on_disconnect)
+
+    def on_disconnect(self):
+        # Whatever happened while disconnected is unknown until the next partial.
+        self.live = False
+
+    def on_order(self, action, data):
+        with self.lock:
+            if action == 'partial':
+                self.live = True
+            for row in data:
+                self.update(row)
+
+    def on_execution(self, action, data):
+        with self.lock:
+            for row in data:
+                if action in ('partial', 'insert'):
+                    self.executions.append(row)
+                if row.get('orderID'):
+                    self.update(row, fields=EXECUTION_FIELDS)
+
+    def update(self, row, fields=None):
+        """Merge one order row (a REST ack, a stream row or a partial update) into the store, unless
+        it is stale (see `stale`)."""
+        orderID = row.get('orderID')
+        if not orderID:
+            return None
+        with self.lock:
+            order = self.orders.get(orderID)
+            new = order is None
+            if new:
+                order = self.orders[orderID] = OrderState(orderID=orderID)
+            elif self.stale(order, row):
+                return order
+            was_open = order.is_open()
+            order.merge(row, fields)
+            if order.clOrdID:
+                self.clOrdIDs[order.clOrdID] = orderID
+            if (was_open or new) and not order.is_open():
+                self._retire(orderID)
+            return order
+
+    @staticmethod
+    def stale(order, row):
+        """Whether `row` is older than `order`: it would reopen a closed order, or it has an earlier
+        timestamp or fewer contracts filled (e.g. a REST ack overtaken by the stream)."""
+        if order.ordStatus is not None and not order.is_open():
+            status = row.get('ordStatus')
+            if status is None or status in OPEN_STATUSES:
+                return True
+        timestamp = row.get('timestamp')
+        if timestamp and order.timestamp and timestamp < order.timestamp:
+            return True
+        cumQty = row.get('cumQty')
+        return cumQty is not None and order.cumQty is not None and cumQty < order.cumQty
+
+    def _retire(self, orderID):
+        self.closed.append(orderID)
+        while len(self.closed) > self.max_closed:
+            old = self.orders.pop(self.closed.popleft(), None)
+            if old is not None and old.clOrdID:
+                self.clOrdIDs.pop(old.clOrdID, None)
+
+    #
+    # Lookups
+    #
+    def get(self, orderID):
+        return self.orders.get(orderID)
+
+    def by_clordid(self, clOrdID):
+        orderID = self.clOrdIDs.get(clOrdID)
+        return self.orders.get(orderID) if orderID else None
+
+    def status(self, orderID):
+        order = self.orders.get(orderID)
+        return order.ordStatus if order else None
+
+    def open_orders(self, symbol=None):
+        """Open orders as plain dicts, like GET /order returns them."""
+        with self.lock:
+            return [o.to_dict() for o in self.orders.values()
+                    if o.is_open() and (symbol is None or o.symbol == symbol)]
+
+    #
+    # Reconciliation
+    #
+    def reconcile(self, client, symbols):
+        """Repair the store against REST: take every open order the exchange reports for `symbols`,
+        then look up the ones we still think are open but the exchange does not. Returns the number
+        of orders repaired."""
+        repaired = 0
+        for symbol in symbols:
+            rest_open = client.active_orders(symbol)
+            if not isinstance(rest_open, list):
+                continue
+            merged, missing = self.merge_open(symbol, rest_open)
+            repaired += merged
+            if missing:
+                for row in client.orders(orderIDs=missing) or []:
+                    self.update(row)
+                    repaired += 1
+        return repaired
+
+    def merge_open(self, symbol, rest_open):
+        """Merge the open orders REST reports for `symbol`. Returns the number of them we had wrong, and
+        the orderIDs we still think are open but REST did not report."""
+        merged = 0
+        with self.lock:
+            for row in rest_open:
+                local = self.orders.get(row['orderID'])
+                if local is None or local.ordStatus != row.get('ordStatus') or \
+                        local.leavesQty != row.get('leavesQty'):
+                    merged += 1
+                self.update(row)
+            seen = set(row['orderID'] for row in rest_open)
+            missing = [o.orderID for o in self.orders.values()
+                       if o.is_open() and o.symbol == symbol and o.orderID not in seen]
+        return merged, missing
+
+    def start_reconciler(self, client, symbols, interval=30):
+        """Run `reconcile` every `interval` seconds on a daemon thread."""
+        def loop():
+            while not self._stop.wait(interval):
+                try:
+                    self.reconcile(client, symbols)
+                except Exception:
+                    # The stream keeps the store current; a failed repair is retried next round.
+                    pass
+        self._stop.clear()
+        self._reconciler = threading.Thread(target=loop, name='OrderStore-reconcile')
+        self._reconciler.daemon = True
+        self._reconciler.start()
+
+    def stop(self):
+        self._stop.set()
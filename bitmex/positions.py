@@ -0,0 +1,336 @@
+"""Local position and PnL engine.
+
+Positions are kept from our own executions instead of polling GET /position and user/margin. Each
+fill updates its symbol's quantity, entry cost and realised PnL. Each mark update (instrument
+markPrice, or the book mid) revalues every symbol at once: unrealised PnL, notional and margin are
+numpy arrays indexed by symbol, recomputed in one vectorized pass.
+
+Amounts are in the settlement currency's smallest unit (XBt), as BitMEX reports them. A contract's
+value at price p is `qty * multiplier / p` for inverse contracts (XBTUSD: multiplier -100000000) and
+`qty * multiplier * p` for linear and quanto ones. The entry cost is the sum of that value over the
+fills that opened the position, so unrealised PnL is value at mark minus entry cost.
+
+Seed it from the websocket's position and margin partials (`attach`) or from REST (`load`); from
+then on it needs no requests. It stops being `live` when the websocket drops, until the next
+position partial reseeds it. Reads (`position`, `delta`, `balances`, `snapshot`) take the lock and
+copy, so risk checks on other threads see a consistent state.
+"""
+from __future__ import absolute_import
+
+import threading
+
+import numpy as np
+
+# XBTUSD, for instruments the cache does not describe.
+DEFAULT_MULTIPLIER = -100000000
+SATOSHI = 100000000.0
+MARK_PRICE = 'markPrice'
+MID = 'mid'
+
+
+class PositionEngine:
+    """Per-symbol position, entry cost, realised/unrealised PnL and margin in numpy arrays.
+
+    instruments: a `bitmex.instruments.InstrumentCache` (or anything with `get(symbol)`) giving each
+    symbol's multiplier, isInverse and initMargin.
+    """
+
+    FIELDS = ('qty', 'cost', 'realised', 'comm', 'mark', 'multiplier', 'inverse', 'leverage',
+              'notional', 'unrealised', 'margin')
+
+    def __init__(self, instruments=None, capacity=16):
+        self.instruments = instruments
+        self.lock = threading.RLock()
+        self.index = {}
+        self.symbols = []
+        self.qty = np.zeros(capacity)
+        self.cost = np.zeros(capacity)  # Entry value of the open quantity
+        self.realised = np.zeros(capacity)
+        self.comm = np.zeros(capacity)  # Fees and funding paid
+        self.mark = np.zeros(capacity)
+        self.multiplier = np.zeros(capacity)
+        self.inverse = np.zeros(capacity, dtype=bool)
+        self.leverage = np.ones(capacity)
+        self.notional = np.zeros(capacity)  # Signed, positive long
+        self.unrealised = np.zeros(capacity)
+        self.margin = np.zeros(capacity)
+        # Wallet as last reported, plus what was realised since.
+        self.wallet = 0.0
+        self.wallet_since = 0.0
+        self.live = False
+        self.marks_from = MARK_PRICE
+        self.ws = None
+        # Metrics
+        self.fills = 0
+        self.revalues = 0
+
+    #
+    # Symbols
+    #
+    def _slot(self, symbol):
+        """Index of `symbol`, adding it (and growing the arrays) on first sight. Holds `lock`."""
+        i = self.index.get(symbol)
+        if i is not None:
+            return i
+        i = len(self.symbols)
+        if i == len(self.qty):
+            for name in self.FIELDS:
+                array = getattr(self, name)
+                grown = np.ones(2 * i, dtype=array.dtype) if name == 'leverage' else np.zeros(2 * i, dtype=array.dtype)
+                grown[:i] = array
+                setattr(self, name, grown)
+        instrument = self.instruments.get(symbol) if self.instruments is not None else None
+        instrument = instrument or {}
+        multiplier = instrument.get('multiplier') or DEFAULT_MULTIPLIER
+        self.multiplier[i] = multiplier
+        self.inverse[i] = instrument.get('isInverse', multiplier < 0)
+        if instrument.get('initMargin'):
+            self.leverage[i] = 1.0 / instrument['initMargin']
+        if instrument.get('markPrice'):
+            self.mark[i] = instrument['markPrice']
+        self.index[symbol] = i
+        self.symbols.append(symbol)
+        return i
+
+    def _value(self, i, qty, price):
+        """Value of `qty` contracts of slot `i` at `price`, signed so value(mark) - cost is the PnL."""
+        if self.inverse[i]:
+            return qty * float(self.multiplier[i]) / price
+        return qty * float(self.multiplier[i]) * price
+
+    #
+    # Updates
+    #
+    def fill(self, symbol, qty, price, comm=0.0):
+        """Apply a fill of signed `qty` at `price`. Returns the PnL it realised."""
+        with self.lock:
+            i = self._slot(symbol)
+            position = float(self.qty[i])
+            cost = float(self.cost[i])
+            realised = 0.0
+            if position and (position > 0) != (qty > 0):
+                # The part of the position this fill closes, in the position's sign.
+                closed = -qty if abs(qty) <= abs(position) else position
+                entry = cost * closed / position
+                realised = self._value(i, closed, price) - entry
+                cost -= entry
+                position -= closed
+                qty += closed
+            if qty:
+                cost += self._value(i, qty, price)
+                position += qty
+            self.qty[i] = position
+            self.cost[i] = cost if position else 0.0
+            self.realised[i] += realised
+            self.comm[i] += comm
+            self.wallet_since += realised - comm
+            self.fills += 1
+            # Only this symbol changed; marks revalue all of them.
+            self._revalue_one(i)
+            return realised
+
+    def set_mark(self, symbol, price):
+        """Mark `symbol` at `price` and revalue everything."""
+        if not price:
+            return
+        with self.lock:
+            i = self._slot(symbol)
+            self.mark[i] = price
+            self._revalue()
+
+    def set_marks(self, marks):
+        """Mark several symbols ({symbol: price}) and revalue once."""
+        with self.lock:
+            for symbol, price in marks.items():
+                if price:
+                    i = self._slot(symbol)
+                    self.mark[i] = price
+            self._revalue()
+
+    def set_leverage(self, symbol, leverage):
+        with self.lock:
+            i = self._slot(symbol)
+            self.leverage[i] = leverage
+            self._revalue()
+
+    def _revalue(self):
+        """Unrealised PnL, notional and margin of every symbol, in one pass. Holds `lock`."""
+        n = len(self.symbols)
+        qty = self.qty[:n]
+        mark = self.mark[:n]
+        marked = mark > 0
+        safe = np.where(marked, mark, 1.0)
+        # Value of one contract at the mark, and its magnitude for notional.
+        unit = np.where(self.inverse[:n], self.multiplier[:n] / safe, self.multiplier[:n] * safe)
+        self.notional[:n] = np.where(marked, qty * np.abs(unit), 0.0)
+        self.unrealised[:n] = np.where(marked & (qty != 0), qty * unit - self.cost[:n], 0.0)
+        self.margin[:n] = np.abs(self.notional[:n]) / self.leverage[:n]
+        self.revalues += 1
+
+    def _revalue_one(self, i):
+        """`_revalue` for slot `i` alone. Holds `lock`."""
+        mark = float(self.mark[i])
+        qty = float(self.qty[i])
+        if mark > 0:
+            unit = self._value(i, 1.0, mark)
+            self.notional[i] = qty * abs(unit)
+            self.unrealised[i] = qty * unit - float(self.cost[i]) if qty else 0.0
+        else:
+            self.notional[i] = self.unrealised[i] = 0.0
+        self.margin[i] = abs(float(self.notional[i])) / float(self.leverage[i])
+
+    def load(self, positions, margin=None):
+        """Seed from GET /position rows (and a user/margin row), replacing what is held."""
+        with self.lock:
+            self.qty[:] = self.cost[:] = self.realised[:] = self.comm[:] = 0.0
+            for row in positions or ():
+                i = self._slot(row['symbol'])
+                qty = row.get('currentQty') or 0
+                self.qty[i] = qty
+                entry = row.get('avgEntryPrice')
+                self.cost[i] = self._value(i, qty, entry) if qty and entry else 0.0
+                self.realised[i] = row.get('realisedPnl') or 0.0
+                self.comm[i] = row.get('execComm') or 0.0
+                if row.get('markPrice'):
+                    self.mark[i] = row['markPrice']
+                if row.get('leverage'):
+                    self.leverage[i] = row['leverage']
+            if margin:
+                self.wallet = margin['walletBalance']
+                self.wallet_since = 0.0
+            self._revalue()
+            self.live = True
+
+    #
+    # Websocket
+    #
+    def attach(self, ws, marks=MARK_PRICE):
+        """Follow an authenticated BitMEXWebsocket: executions, the position and margin tables, and
+        marks from the instrument table (`marks` 'markPrice') or the book mid ('mid')."""
+        self.ws = ws
+        self.marks_from = marks
+        ws.add_listener('execution', self.on_execution)
+        ws.add_listener('position', self.on_position)
+        ws.add_listener('margin', self.on_margin)
+        if marks == MID:
+            ws.add_listener(ws.book_table, self.on_book)
+        else:
+            ws.add_listener('instrument', self.on_instrument)
+        ws.add_disconnect_listener(self.on_disconnect)
+
+    def on_disconnect(self):
+        # Fills and funding while disconnected are missed; the next partials reseed the engine.
+        self.live = False
+
+    def on_execution(self, action, data):
+        # The partial is history, already in the position partial.
+        if action != 'insert':
+            return
+        for row in data:
+            comm = row.get('execComm') or 0.0
+            if row.get('execType') == 'Trade' and row.get('lastQty'):
+                qty = row['lastQty'] if row['side'] == 'Buy' else -row['lastQty']
+                self.fill(row['symbol'], qty, row['lastPx'], comm)
+            elif comm:
+                # Funding and other charges without a fill.
+                with self.lock:
+                    i = self._slot(row['symbol'])
+                    self.comm[i] += comm
+                    self.wallet_since -= comm
+
+    def on_position(self, action, data):
+        if action == 'partial':
+            self.load(data)
+        else:
+            with self.lock:
+                for row in data:
+                    if row.get('leverage'):
+                        i = self._slot(row['symbol'])
+                        self.leverage[i] = row['leverage']
+
+    def on_margin(self, action, data):
+        for row in data:
+            if row.get('walletBalance') is not None:
+                with self.lock:
+                    self.wallet = row['walletBalance']
+                    self.wallet_since = 0.0
+
+    def on_instrument(self, action, data):
+        marks = dict((row['symbol'], row['markPrice']) for row in data if row.get('markPrice'))
+        if marks:
+            self.set_marks(marks)
+
+    def on_book(self, action, data):
+        symbols = set(row['symbol'] for row in data)
+        marks = {}
+        for symbol in symbols:
+            book = self.ws.book(symbol)
+            if book is not None:
+                marks[symbol] = book.mid()
+        if marks:
+            self.set_marks(marks)
+
+    #
+    # Reads
+    #
+    def position(self, symbol):
+        """{'symbol', 'currentQty', 'avgEntryPrice', 'markPrice', 'homeNotional', 'realisedPnl',
+        'unrealisedPnl', 'execComm', 'margin'}, in the shape of a GET /position row; None if unseen."""
+        with self.lock:
+            i = self.index.get(symbol)
+            if i is None:
+                return None
+            qty = float(self.qty[i])
+            entry = None
+            if qty and self.cost[i]:
+                per = self.cost[i] / qty
+                entry = float(self.multiplier[i] / per if self.inverse[i] else per / self.multiplier[i])
+            return {
+                'symbol': symbol,
+                'currentQty': qty,
+                'avgEntryPrice': entry,
+                'markPrice': float(self.mark[i]) or None,
+                'homeNotional': float(self.notional[i]) / SATOSHI,
+                'realisedPnl': float(self.realised[i]),
+                'unrealisedPnl': float(self.unrealised[i]),
+                'execComm': float(self.comm[i]),
+                'margin': float(self.margin[i]),
+            }
+
+    def positions(self):
+        with self.lock:
+            return [self.position(symbol) for symbol in self.symbols]
+
+    def delta(self, symbol=None):
+        """XBT value of the position in `symbol`, signed (homeNotional for XBTUSD); of all symbols
+        when None."""
+        with self.lock:
+            if symbol is None:
+                return float(self.notional[:len(self.symbols)].sum()) / SATOSHI
+            i = self.index.get(symbol)
+            return float(self.notional[i]) / SATOSHI if i is not None else 0.0
+
+    def balances(self):
+        """The user/margin figures we act on, in XBt: walletBalance, unrealisedPnl, marginBalance,
+        initMargin (position margin) and availableMargin."""
+        with self.lock:
+            n = len(self.symbols)
+            wallet = float(self.wallet + self.wallet_since)
+            unrealised = float(self.unrealised[:n].sum())
+            used = float(self.margin[:n].sum())
+            return {
+                'currency': 'XBt',
+                'walletBalance': wallet,
+                'unrealisedPnl': unrealised,
+                'marginBalance': wallet + unrealised,
+                'initMargin': used,
+                'availableMargin': wallet + unrealised - used,
+            }
+
+    def snapshot(self):
+        """Copies of the arrays, by field name, with the `symbols` they are indexed by."""
+        with self.lock:
+            n = len(self.symbols)
+            result = dict((name, getattr(self, name)[:n].copy()) for name in self.FIELDS)
+            result['symbols'] = list(self.symbols)
+            return result
@@ -0,0 +1,205 @@
+"""Client-side rate limiting driven by the BitMEX X-RateLimit-* headers.
+
+BitMEX gives every account a request budget that refills continuously over a one minute window and
+reports what is left on every response. `RateLimiter` mirrors that budget as a token bucket so we pace
+ourselves below the limit instead of discovering it through a 429. Tokens are handed out by priority:
+cancels may spend the bucket down to zero, new orders and amends keep a small reserve for cancels, and
+queries keep a larger one.
+"""
+from __future__ import absolute_import
+
+import asyncio
+import threading
+import time
+
+CANCEL = 0
+ORDER = 1
+QUERY = 2
+PRIORITY_NAMES = ('cancel', 'order', 'query')
+
+
+def priority_for(verb, path):
+    """Scheduling priority of a request."""
+    if verb == 'DELETE' or path.startswith('order/cancelAll'):
+        return CANCEL
+    if verb in ('POST', 'PUT') and path.startswith('order'):
+        return ORDER
+    return QUERY
+
+
+class RateLimiter:
+    """Thread-safe, priority-aware token bucket.
+
+    One limiter should be shared by everything that spends the same account's budget; `for_key`
+    returns a process-wide instance per API key.
+    """
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, limit=60, period=60.0, reserve=(0, 2, 5)):
+        self.limit = limit
+        self.period = float(period)
+        self.rate = limit / self.period
+        self.reserve = reserve
+        self.tokens = float(limit)
+        self.blocked_until = 0.0
+        self.updated = time.monotonic()
+        self.cond = threading.Condition()
+        self.waiting = [0, 0, 0]
+        # Metrics
+        self.acquired = [0, 0, 0]
+        self.delayed = [0, 0, 0]
+        self.wait_time = [0.0, 0.0, 0.0]
+        self.remaining = None
+        self.throttled = 0
+
+    @classmethod
+    def for_key(cls, apiKey, **kwargs):
+        with cls._shared_lock:
+            limiter = cls._shared.get(apiKey)
+            if limiter is None:
+                limiter = cls._shared[apiKey] = cls(**kwargs)
+            return limiter
+
+    def _refill(self, now):
+        self.tokens = min(float(self.limit), self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _delay(self, priority, now):
+        """Seconds until a token is available to `priority`; takes the token when that is 0."""
+        self._refill(now)
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        # Lower priorities yield to anybody of higher priority already queued.
+        if any(self.waiting[:priority]):
+            return 1.0 / self.rate
+        needed = 1.0 + self.reserve[priority]
+        if self.tokens >= needed:
+            self.tokens -= 1.0
+            self.acquired[priority] += 1
+            return 0.0
+        return (needed - self.tokens) / self.rate
+
+    def try_acquire(self, priority=QUERY):
+        """Take a token without waiting. Returns 0 on success, otherwise the suggested wait in seconds."""
+        with self.cond:
+            return self._delay(priority, time.monotonic())
+
+    def take(self, priority=CANCEL):
+        """Take a token at once, ahead of any queue and of a 429 block; the bucket may go into debt, which
+        later requests wait off. For the reaction to a 429, which cannot wait for the block it reacts to."""
+        with self.cond:
+            self._refill(time.monotonic())
+            self.tokens -= 1.0
+            self.acquired[priority] += 1
+
+    def acquire(self, priority=QUERY, timeout=None):
+        """Block until a token is available. Returns the time spent waiting."""
+        start = time.monotonic()
+        with self.cond:
+            delay = self._delay(priority, start)
+            if not delay:
+                return 0.0
+            self.waiting[priority] += 1
+            self.delayed[priority] += 1
+            try:
+                while delay:
+                    if timeout is not None and time.monotonic() - start + delay > timeout:
+                        raise Exception("Rate limit: no %s token within %.3fs" % (PRIORITY_NAMES[priority], timeout))
+                    self.cond.wait(delay)
+                    delay = self._delay(priority, time.monotonic())
+            finally:
+                self.waiting[priority] -= 1
+                self.cond.notify_all()
+        waited = time.monotonic() - start
+        self.wait_time[priority] += waited
+        return waited
+
+    async def acquire_async(self, priority=QUERY, timeout=None):
+        """Coroutine version of `acquire`; waits with asyncio.sleep instead of blocking the thread.
+        A waiting coroutine is queued like a waiting thread, so lower priorities yield to it."""
+        start = time.monotonic()
+        with self.cond:
+            delay = self._delay(priority, start)
+            if not delay:
+                return 0.0
+            self.waiting[priority] += 1
+            self.delayed[priority] += 1
+        try:
+            while delay:
+                if timeout is not None and time.monotonic() - start + delay > timeout:
+                    raise Exception("Rate limit: no %s token within %.3fs" % (PRIORITY_NAMES[priority], timeout))
+                await asyncio.sleep(delay)
+                with self.cond:
+                    delay = self._delay(priority, time.monotonic())
+        finally:
+            with self.cond:
+                self.waiting[priority] -= 1
+                self.cond.notify_all()
+        waited = time.monotonic() - start
+        self.wait_time[priority] += waited
+        return waited
+
+    def update(self, headers):
+        """Resync the bucket with the X-RateLimit-* headers of a response."""
+        remaining = headers.get('X-RateLimit-Remaining')
+        if remaining is None:
+            return
+        limit = headers.get('X-RateLimit-Limit')
+        reset = headers.get('X-RateLimit-Reset')
+        with self.cond:
+            now = time.monotonic()
+            self._refill(now)
+            if limit is not None and int(limit) != self.limit:
+                self.limit = int(limit)
+                self.rate = self.limit / self.period
+            self.remaining = int(remaining)
+            # The server is authoritative; never believe we have more than it says.
+            self.tokens = min(self.tokens, float(self.remaining))
+            if self.remaining <= 0 and reset is not None:
+                self.block_until(float(reset), now)
+            self.cond.notify_all()
+
+    def throttle(self, headers):
+        """Hand out no tokens until a 429 lifts: Retry-After seconds from now, or else X-RateLimit-Reset.
+        Requests on this budget then queue in `acquire` and go out by priority. Returns the epoch time."""
+        retry_after = headers.get('Retry-After')
+        if retry_after is not None:
+            reset = time.time() + float(retry_after)
+        else:
+            reset = float(headers.get('X-RateLimit-Reset') or time.time() + 1)
+        with self.cond:
+            self.tokens = 0.0
+            self.throttled += 1
+            self.block_until(reset)
+        return reset
+
+    def block_until(self, reset, now=None):
+        """Hand out no tokens until the epoch time `reset`, e.g. after a 429."""
+        now = time.monotonic() if now is None else now
+        self.blocked_until = max(self.blocked_until, now + max(0.0, reset - time.time()))
+
+    def budget(self):
+        """Tokens currently available."""
+        with self.cond:
+            self._refill(time.monotonic())
+            return self.tokens
+
+    def snapshot(self):
+        """Current budget and per-priority counters as a flat dict of metrics."""
+        with self.cond:
+            now = time.monotonic()
+            self._refill(now)
+            metrics = {
+                'tokens': self.tokens,
+                'limit': self.limit,
+                'remaining': self.remaining,
+                'blocked_for': max(0.0, self.blocked_until - now),
+                'throttled': self.throttled,
+            }
+            for p, name in enumerate(PRIORITY_NAMES):
+                metrics['acquired_' + name] = self.acquired[p]
+                metrics['delayed_' + name] = self.delayed[p]
+                metrics['wait_time_' + name] = self.wait_time[p]
+                metrics['waiting_' + name] = self.waiting[p]
+            return metrics
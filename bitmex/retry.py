@@ -0,0 +1,212 @@
+"""Retry policy and per-endpoint circuit breakers for REST calls.
+
+A `RetryPolicy` decides whether and when a failed request is tried again. The policy itself holds
+no per-call state: each call gets a `RetryState` from `begin`, so concurrent calls never share a
+retry count. Backoff is exponential with full jitter, and every call has a deadline. A wait that
+would run past the deadline gives up at once rather than sleeping first. The wait a 429 asks for is
+the exception: the server said when the request will go through, so it is always waited out.
+
+Only idempotent requests are retried. GET and DELETE always are, as are POSTs that only set state
+(cancelAllAfter, leverage). Other POSTs and PUTs are retried only when every order they carry has a
+clOrdID, so a request that did land is rejected as a duplicate instead of being applied twice; an
+amend that only names its order by origClOrdID does not count.
+
+The policy also keeps a `CircuitBreaker` per endpoint. After `threshold` consecutive failures that
+look like an outage (503s, timeouts, connection errors) the breaker opens. Calls to that endpoint
+then fail fast with `CircuitOpenError` for `cooldown` seconds, and one probe request decides
+whether it closes again.
+
+The policy only computes delays, so the sync client sleeps with `time.sleep` and the async one with
+`asyncio.sleep`.
+"""
+from __future__ import absolute_import
+
+import json
+import random
+import threading
+import time
+
+IDEMPOTENT_VERBS = ('GET', 'HEAD', 'DELETE')
+# POSTs that set state rather than create it, safe to repeat.
+IDEMPOTENT_PATHS = ('order/cancelAllAfter', 'position/leverage')
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class RetryError(Exception):
+    """A call failed and its retries or deadline are used up. `last` is the final failure."""
+
+    def __init__(self, message, last=None):
+        super(RetryError, self).__init__(message)
+        self.last = last
+
+
+class CircuitOpenError(Exception):
+    """The endpoint's circuit breaker is open; the request was not sent."""
+
+    def __init__(self, endpoint, retry_in):
+        super(CircuitOpenError, self).__init__("Circuit open for %s, retry in %.1fs" % (endpoint, retry_in))
+        self.endpoint = endpoint
+        self.retry_in = retry_in
+
+
+def has_clordid(postdict):
+    """True when `postdict`, a single order or an order/bulk body, gives every order a new clOrdID."""
+    if not postdict:
+        return False
+    orders = postdict.get('orders', [postdict])
+    return bool(orders) and all(order.get('clOrdID') for order in orders)
+
+
+def sent_clordids(postdict):
+    return [order['clOrdID'] for order in postdict.get('orders', [postdict])]
+
+
+def match_duplicates(postdict, found):
+    """Recover a POST rejected for a duplicate clOrdID: check that the orders `found` under its clOrdIDs
+    are the ones it sent and return them in the shape of its ack (a list for order/bulk)."""
+    orders = postdict.get('orders', [postdict])
+    found = dict((order['clOrdID'], order) for order in found or ())
+    results = []
+    for sent in orders:
+        order = found.get(sent['clOrdID'])
+        # An amend may leave the quantity, and so the side, as they were.
+        qty = sent.get('orderQty')
+        side = sent.get('side') or (None if qty is None else 'Buy' if qty > 0 else 'Sell')
+        if (order is None or
+                (qty is not None and order['orderQty'] != abs(qty)) or
+                (side is not None and order['side'] != side) or
+                ('price' in sent and order['price'] != sent['price']) or
+                order['symbol'] != sent.get('symbol', order['symbol'])):
+            raise Exception(
+                'Attempted to recover from duplicate clOrdID, but order returned from API ' +
+                'did not match POST.\nPOST data: %s\nReturned order: %s' % (json.dumps(sent), json.dumps(order)))
+        results.append(order)
+    return results if 'orders' in postdict else results[0]
+
+
+class CircuitBreaker:
+    """Closed -> open after `threshold` consecutive failures -> half-open after `cooldown` seconds,
+    when a single probe is let through; its outcome closes or re-opens the circuit."""
+
+    def __init__(self, threshold=5, cooldown=10.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.state = CLOSED
+        self.failures = 0
+        self.opened = 0.0
+        # Metrics
+        self.trips = 0
+        self.rejected = 0
+
+    def retry_in(self):
+        """Seconds until the next probe is allowed; 0 when a request would go through now."""
+        with self.lock:
+            if self.state == CLOSED:
+                return 0.0
+            return max(0.0, self.opened + self.cooldown - time.monotonic())
+
+    def allow(self):
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+            now = time.monotonic()
+            # A probe that never reported back (the caller died) is replaced after another cooldown.
+            if now >= self.opened + self.cooldown:
+                self.state = HALF_OPEN
+                self.opened = now
+                return True
+            self.rejected += 1
+            return False
+
+    def success(self):
+        with self.lock:
+            self.state = CLOSED
+            self.failures = 0
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.threshold:
+                if self.state != OPEN:
+                    self.trips += 1
+                self.state = OPEN
+                self.opened = time.monotonic()
+
+
+class RetryState:
+    """The retry bookkeeping of one call."""
+    __slots__ = ('policy', 'max_retries', 'attempt', 'deadline')
+
+    def __init__(self, policy, max_retries, deadline):
+        self.policy = policy
+        self.max_retries = max_retries
+        self.attempt = 0
+        self.deadline = deadline
+
+    def next_delay(self, wait=None):
+        """Seconds to wait before the next attempt, or None when the call should give up.
+
+        `wait` overrides the computed backoff when the server said how long to wait (429); it is not held
+        to the deadline.
+        """
+        self.attempt += 1
+        if self.attempt > self.max_retries:
+            return None
+        if wait is not None:
+            return max(0.0, wait)
+        delay = self.policy.backoff(self.attempt)
+        if self.deadline is not None and time.monotonic() + delay > self.deadline:
+            return None
+        return delay
+
+
+class RetryPolicy:
+    """max_retries: retries after the first attempt, for requests that may be retried at all.
+    base, cap: the n-th retry waits uniformly in [0, min(cap, base * 2**n)] seconds.
+    deadline: seconds a call may take in total, waits included (other than a 429's).
+    threshold, cooldown: circuit breaker settings, see `CircuitBreaker`.
+    """
+
+    def __init__(self, max_retries=3, base=0.25, cap=10.0, deadline=30.0, threshold=5, cooldown=10.0):
+        self.max_retries = max_retries
+        self.base = base
+        self.cap = cap
+        self.deadline = deadline
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.breakers = {}
+        self.lock = threading.Lock()
+
+    def retryable(self, verb, postdict=None, path=None):
+        return verb in IDEMPOTENT_VERBS or path in IDEMPOTENT_PATHS or has_clordid(postdict)
+
+    def begin(self, verb, postdict=None, max_retries=None, deadline=None, path=None):
+        """Start the retry state of one call. `max_retries` and `deadline` override the policy's;
+        requests that are not idempotent get no retries regardless."""
+        if not self.retryable(verb, postdict, path):
+            max_retries = 0
+        elif max_retries is None:
+            max_retries = self.max_retries
+        deadline = self.deadline if deadline is None else deadline
+        return RetryState(self, max_retries, time.monotonic() + deadline if deadline else None)
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.cap, self.base * (1 << attempt)))
+
+    def breaker(self, endpoint):
+        breaker = self.breakers.get(endpoint)
+        if breaker is None:
+            with self.lock:
+                breaker = self.breakers.setdefault(endpoint, CircuitBreaker(self.threshold, self.cooldown))
+        return breaker
+
+    def check(self, endpoint):
+        """Raise CircuitOpenError if `endpoint` is failing fast; returns its breaker otherwise."""
+        breaker = self.breaker(endpoint)
+        if not breaker.allow():
+            raise CircuitOpenError(endpoint, breaker.retry_in())
+        return breaker
@@ -0,0 +1,368 @@
+"""Pre-trade risk checks on the order path.
+
+A `RiskGate` sits between the client's order methods and the transport. It refuses, with a
+`RiskError`, any order that would breach one of its limits:
+
+    max_order_qty        contracts in one order
+    max_order_notional   XBT value of one order, at its price (market orders: at the mark)
+    max_open_orders      orders of a symbol resting or in flight
+    max_position         contracts, in the worst case: position + same-side open orders + the order
+    price_band           fraction a price may stray from the mark (or last price)
+
+The defaults apply to every symbol and `symbols` overrides them per symbol. Each symbol's limits and
+contract value are resolved once, on first sight or in `prepare`. The counters the checks read are
+kept locally, so no check makes a request: open orders come from our own acks and the websocket
+order stream, positions and marks from the client's `PositionEngine`. A check is a dict lookup and
+a few comparisons.
+
+A passing order is booked under its clOrdID until its ack arrives, so concurrent orders cannot
+together overshoot a limit, and released if its request fails. Checking an order already booked is
+a no-op, so an order checked when queued on the batcher is not counted again by the bulk call that
+carries it. Booking slots are recycled, so the steady state allocates no containers. The keys of
+recently closed orders are remembered, so a REST ack that arrives after the order stream closed its
+order does not book it again.
+
+Position limits need live positions (an authenticated websocket); without them the position
+counts as flat. Orders reducing the position are never refused for it.
+"""
+from __future__ import absolute_import
+
+import threading
+from collections import deque
+
+# Closed orders remembered, so a late ack of one is not booked again.
+REMEMBER_CLOSED = 10000
+
+INF = float('inf')
+SATOSHI = 100000000.0
+# XBTUSD, for instruments the cache does not describe.
+DEFAULT_MULTIPLIER = -100000000
+
+LIMITS = ('max_order_qty', 'max_order_notional', 'max_open_orders', 'max_position', 'price_band')
+CLOSED = ('Filled', 'Canceled', 'Rejected', 'Expired', 'Stopped', 'DoneForDay')
+
+
+class RiskError(Exception):
+    """An order was refused before it was sent. `check` names the limit it breached."""
+
+    def __init__(self, check, symbol, value=None, limit=None):
+        if check == 'halted':
+            message = "Trading halted: %s" % limit
+        else:
+            message = "%s on %s: %s exceeds %s" % (check, symbol, value, limit)
+        super(RiskError, self).__init__(message)
+        self.check = check
+        self.symbol = symbol
+        self.value = value
+        self.limit = limit
+
+
+class SymbolRisk:
+    """A symbol's resolved limits (inf when unset) and its open order counters."""
+    __slots__ = ('symbol', 'max_qty', 'max_notional', 'max_open', 'max_position', 'band', 'unit', 'inverse',
+                 'orders', 'bought', 'sold')
+
+    def __init__(self, symbol, limits, multiplier, inverse):
+        self.symbol = symbol
+        self.max_qty, self.max_notional, self.max_open, self.max_position, self.band = limits
+        # XBT value of one contract is unit / price (inverse) or unit * price.
+        self.unit = abs(multiplier) / SATOSHI
+        self.inverse = inverse
+        self.orders = 0
+        self.bought = 0.0  # Open buy quantity
+        self.sold = 0.0  # Open sell quantity, positive
+
+
+class _Booked:
+    __slots__ = ('state', 'buy', 'leaves', 'filled', 'orderID', 'clOrdID')
+
+
+class RiskGate:
+    """Per-order limits checked against local state. See the module docstring.
+
+    symbols: {symbol: {limit: value}} overriding the defaults; a limit set to None is off.
+    instruments: a `bitmex.instruments.InstrumentCache`, for contract values and reference prices.
+    positions: a `bitmex.positions.PositionEngine`, for positions and marks.
+    """
+
+    def __init__(self, max_order_qty=None, max_order_notional=None, max_open_orders=None, max_position=None,
+                 price_band=None, symbols=None, instruments=None, positions=None):
+        self.defaults = {
+            'max_order_qty': max_order_qty,
+            'max_order_notional': max_order_notional,
+            'max_open_orders': max_open_orders,
+            'max_position': max_position,
+            'price_band': price_band,
+        }
+        self.overrides = symbols or {}
+        self.instruments = instruments
+        self.positions = positions
+        self.lock = threading.Lock()
+        self.states = {}
+        # Booked orders by clOrdID and by orderID.
+        self.booked = {}
+        self.free = []
+        # orderIDs and clOrdIDs of recently closed orders, and the same keys oldest first.
+        self.closed = set()
+        self.closing = deque(maxlen=REMEMBER_CLOSED)
+        self.halted = None
+        # Metrics
+        self.checks = 0
+        self.rejected = {}
+
+    #
+    # Limits
+    #
+    def _limit(self, symbol, name):
+        value = self.overrides.get(symbol, {}).get(name, self.defaults[name])
+        return INF if value is None else value
+
+    def _resolve(self, symbol):
+        instrument = self.instruments.get(symbol, wait=False) if self.instruments is not None else None
+        instrument = instrument or {}
+        multiplier = instrument.get('multiplier') or DEFAULT_MULTIPLIER
+        return SymbolRisk(symbol, [self._limit(symbol, name) for name in LIMITS], multiplier,
+                          instrument.get('isInverse', multiplier < 0))
+
+    def _state(self, symbol):
+        """`symbol`'s SymbolRisk, resolved on first sight. Holds `lock`."""
+        state = self.states.get(symbol)
+        if state is None:
+            state = self.states[symbol] = self._resolve(symbol)
+        return state
+
+    def prepare(self, symbols):
+        """Resolve `symbols` ahead of their first order, so it does not load the instrument cache."""
+        with self.lock:
+            for symbol in symbols:
+                self._state(symbol)
+
+    def set_limits(self, symbol=None, **limits):
+        """Change limits, of one symbol or the defaults; the counters are kept."""
+        with self.lock:
+            if symbol is None:
+                self.defaults.update(limits)
+            else:
+                self.overrides.setdefault(symbol, {}).update(limits)
+            for state in self.states.values():
+                state.max_qty, state.max_notional, state.max_open, state.max_position, state.band = [
+                    self._limit(state.symbol, name) for name in LIMITS]
+
+    def halt(self, reason='halted'):
+        """Refuse every new order and amend until `resume`; cancels still go through."""
+        self.halted = reason
+
+    def resume(self):
+        self.halted = None
+
+    #
+    # Checks
+    #
+    def _reference(self, state, i):
+        """The mark (or last price) to check prices against; None when there is none yet."""
+        if i is not None:
+            mark = self.positions.mark.item(i)
+            if mark > 0:
+                return mark
+        if self.instruments is not None:
+            # The cached dict as it is: a reload on the order path would cost a request.
+            instrument = self.instruments.instruments.get(state.symbol)
+            if instrument is not None:
+                return instrument.get('markPrice') or instrument.get('lastPrice')
+        return None
+
+    def _reject(self, check, state, value, limit):
+        self.rejected[check] = self.rejected.get(check, 0) + 1
+        raise RiskError(check, state.symbol, value, limit)
+
+    def _check(self, state, qty, price, exposure):
+        """Refuse an order of signed `qty` at `price` (None: market) that changes the open quantity of
+        its side by `exposure`. Holds `lock`."""
+        self.checks += 1
+        if self.halted is not None:
+            self._reject('halted', state, None, self.halted)
+        size = qty if qty > 0 else -qty
+        if size > state.max_qty:
+            self._reject('max_order_qty', state, size, state.max_qty)
+        positions = self.positions
+        # The symbol's slot in the position engine, for its mark and position.
+        i = positions.index.get(state.symbol) if positions is not None else None
+        if state.band != INF or state.max_notional != INF:
+            reference = self._reference(state, i)
+            if price is not None and reference and state.band != INF:
+                deviation = abs(price - reference) / reference
+                if deviation > state.band:
+                    self._reject('price_band', state, price, reference)
+            at = price or reference
+            if at and state.max_notional != INF:
+                notional = size * state.unit / at if state.inverse else size * state.unit * at
+                if notional > state.max_notional:
+                    self._reject('max_order_notional', state, notional, state.max_notional)
+        if state.max_position != INF and exposure and (exposure > 0) == (qty > 0):
+            position = positions.qty.item(i) if i is not None and positions.live else 0.0
+            if exposure > 0:
+                worst = position + state.bought + exposure
+            else:
+                worst = state.sold - exposure - position
+            if worst > state.max_position:
+                self._reject('max_position', state, worst, state.max_position)
+
+    def check(self, symbol, qty, price=None, clOrdID=None):
+        """Check a new order of signed `qty` and book it under `clOrdID`. Raises RiskError."""
+        with self.lock:
+            if clOrdID is not None and clOrdID in self.booked:
+                return
+            state = self.states.get(symbol) or self._state(symbol)
+            if state.orders >= state.max_open:
+                self.checks += 1
+                self._reject('max_open_orders', state, state.orders + 1, state.max_open)
+            self._check(state, qty, price, qty)
+            # Without a clOrdID the ack could not be matched to the booking; the ack books it.
+            if clOrdID is not None:
+                self._book(state, qty > 0, abs(qty), None, clOrdID)
+
+    def check_amend(self, order):
+        """Check an amend (order/bulk PUT dict) of an order we know; others are left to the exchange."""
+        with self.lock:
+            entry = self.booked.get(order.get('orderID') or order.get('origClOrdID'))
+            if entry is None:
+                return
+            # orderQty is the new total, of which `filled` is done; leavesQty is what rests.
+            if order.get('leavesQty') is not None:
+                leaves = abs(order['leavesQty'])
+            elif order.get('orderQty') is not None:
+                leaves = max(0, abs(order['orderQty']) - entry.filled)
+            else:
+                leaves = entry.leaves
+            qty = leaves if entry.buy else -leaves
+            self._check(entry.state, qty, order.get('price'), qty - (entry.leaves if entry.buy else -entry.leaves))
+
+    def check_order(self, order, amend=False):
+        """`check` (or `check_amend`) of an order/bulk dict."""
+        if amend:
+            return self.check_amend(order)
+        qty = order.get('orderQty') or 0
+        side = order.get('side')
+        if side is not None:
+            qty = abs(qty) if side == 'Buy' else -abs(qty)
+        self.check(order.get('symbol'), qty, order.get('price'), order.get('clOrdID'))
+
+    #
+    # Bookkeeping
+    #
+    def _book(self, state, buy, leaves, orderID, clOrdID, filled=0):
+        entry = self.free.pop() if self.free else _Booked()
+        entry.state = state
+        entry.buy = buy
+        entry.leaves = leaves
+        entry.filled = filled
+        entry.orderID = orderID
+        entry.clOrdID = clOrdID
+        if clOrdID:
+            self.booked[clOrdID] = entry
+        if orderID:
+            self.booked[orderID] = entry
+        state.orders += 1
+        if buy:
+            state.bought += leaves
+        else:
+            state.sold += leaves
+        return entry
+
+    def _unbook(self, entry):
+        state = entry.state
+        state.orders -= 1
+        if entry.buy:
+            state.bought -= entry.leaves
+        else:
+            state.sold -= entry.leaves
+        for key in (entry.clOrdID, entry.orderID):
+            if key and self.booked.get(key) is entry:
+                del self.booked[key]
+        entry.state = None
+        self.free.append(entry)
+
+    def _forget(self, orderID, clOrdID):
+        """Remember a closed order's keys; the oldest are dropped past REMEMBER_CLOSED. Holds `lock`."""
+        closed, closing = self.closed, self.closing
+        for key in (orderID, clOrdID):
+            if key and key not in closed:
+                if len(closing) == REMEMBER_CLOSED:
+                    closed.discard(closing[0])
+                closing.append(key)
+                closed.add(key)
+
+    def release(self, orders):
+        """Unbook orders whose request failed before the exchange acked them."""
+        with self.lock:
+            for order in orders:
+                entry = self.booked.get(order.get('clOrdID'))
+                if entry is not None and entry.orderID is None:
+                    self._unbook(entry)
+
+    def _update(self, row):
+        """Apply an order ack or order stream row. Holds `lock`."""
+        orderID = row.get('orderID')
+        clOrdID = row.get('clOrdID')
+        entry = self.booked.get(orderID) if orderID else None
+        if entry is None and clOrdID:
+            entry = self.booked.get(clOrdID)
+        status = row.get('ordStatus')
+        leaves = row.get('leavesQty')
+        closed = status in CLOSED or leaves == 0
+        if entry is None:
+            if closed:
+                self._forget(orderID, clOrdID)
+                return
+            # A REST ack arriving after the stream closed the order.
+            if orderID in self.closed or clOrdID in self.closed:
+                return
+            # Someone else's order on the account, or one from before we started.
+            if status is None or not row.get('symbol') or not row.get('side'):
+                return
+            leaves = row.get('orderQty') if leaves is None else leaves
+            if leaves:
+                self._book(self._state(row['symbol']), row['side'] == 'Buy', leaves, orderID, clOrdID or None,
+                           row.get('cumQty') or 0)
+            return
+        if orderID and entry.orderID is None:
+            entry.orderID = orderID
+            self.booked[orderID] = entry
+        if row.get('cumQty') is not None:
+            entry.filled = row['cumQty']
+        if closed:
+            self._forget(entry.orderID, entry.clOrdID)
+            self._unbook(entry)
+        elif leaves is not None:
+            if entry.buy:
+                entry.state.bought += leaves - entry.leaves
+            else:
+                entry.state.sold += leaves - entry.leaves
+            entry.leaves = leaves
+
+    def on_ack(self, acks):
+        """Feed REST acks (a dict or a list of them) into the counters."""
+        with self.lock:
+            if isinstance(acks, dict):
+                self._update(acks)
+            else:
+                for ack in acks:
+                    if isinstance(ack, dict):
+                        self._update(ack)
+        return acks
+
+    def on_order(self, action, data):
+        with self.lock:
+            for row in data:
+                self._update(row)
+
+    def attach(self, ws):
+        """Follow an authenticated BitMEXWebsocket's order stream, so fills and cancels by the exchange
+        (or by another client on the account) free their limits."""
+        ws.add_listener('order', self.on_order)
+
+    def open_orders(self, symbol):
+        """(count, open buy quantity, open sell quantity) of `symbol` as the gate counts them."""
+        with self.lock:
+            state = self.states.get(symbol)
+            return (state.orders, state.bought, state.sold) if state is not None else (0, 0.0, 0.0)
@@ -0,0 +1,1379 @@
+"""Local stand-in for the BitMEX REST and websocket API, for offline and load testing.
+
+`Simulator` serves the endpoints `TradeClient` uses and the /realtime feed from one local port.
+A price-time priority `MatchingEngine` stands behind them, seeded with a liquidity provider that
+re-quotes whatever is taken. Responses carry X-RateLimit-* headers from a per-key budget,
+answer 429 once that budget runs out, and can inject 429/503s and latency on purpose:
+
+    with Simulator(accounts={'key': 'secret'}, faults={503: 0.01}) as sim:
+        client = TradeClient(account, base_url=sim.base_url)
+
+or, standalone: python -m bitmex.simulator --port 8080 --key key --secret secret
+"""
+from __future__ import absolute_import
+
+import base64
+import bisect
+import datetime
+import hashlib
+import itertools
+import random
+import socket
+import ssl
+import struct
+import threading
+import time
+import uuid
+from collections import deque
+
+try:
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import parse_qsl, urlparse
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer as ThreadingHTTPServer
+    from urlparse import parse_qsl, urlparse
+
+from bitmex import codec
+from bitmex.auth import generate_signature
+
+API_PREFIX = '/api/v1/'
+SATOSHI = 100000000
+LIQUIDITY = '__liquidity__'
+MAKER_FEE = -0.00025
+TAKER_FEE = 0.00075
+STOP_TYPES = ('Stop', 'StopLimit', 'MarketIfTouched', 'LimitIfTouched')
+ORDER_TYPES = ('Limit', 'Market') + STOP_TYPES
+PRICED_TYPES = ('Limit', 'StopLimit', 'LimitIfTouched')
+OPEN_STATUSES = ('New', 'PartiallyFilled')
+WS_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+DEFAULT_INSTRUMENTS = {
+    'XBTUSD': {'tickSize': 0.5, 'lotSize': 1, 'price': 10000.0},
+}
+
+
+def now_iso():
+    return datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+
+class SimError(Exception):
+    """A request the exchange rejects; rendered as BitMEX's {"error": {...}} body."""
+
+    def __init__(self, status, message, name='HTTPError'):
+        Exception.__init__(self, message)
+        self.status = status
+        self.message = message
+        self.name = name
+
+
+class SimOrder(object):
+    __slots__ = ('orderID', 'clOrdID', 'account', 'symbol', 'side', 'ordType', 'ordStatus', 'orderQty', 'price',
+                 'stopPx', 'leavesQty', 'cumQty', 'avgPx', 'execInst', 'triggered', 'text', 'timestamp',
+                 'transactTime')
+
+    FIELDS = ('orderID', 'clOrdID', 'symbol', 'side', 'ordType', 'ordStatus', 'orderQty', 'price', 'stopPx',
+              'leavesQty', 'cumQty', 'avgPx', 'execInst', 'triggered', 'text', 'timestamp', 'transactTime')
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name))
+
+    def is_open(self):
+        return self.ordStatus in OPEN_STATUSES
+
+    def to_dict(self):
+        row = dict((name, getattr(self, name)) for name in self.FIELDS)
+        row['workingIndicator'] = self.is_open() and (self.ordType not in STOP_TYPES or bool(self.triggered))
+        return row
+
+
+class PriceLevels:
+    """One side of the simulated book: FIFO queues of orders per price, prices kept sorted best-first."""
+
+    def __init__(self, side):
+        self.side = side
+        self.sign = -1 if side == 'Buy' else 1
+        self.keys = []
+        self.levels = {}
+        self.sizes = {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def best(self):
+        return self.sign * self.keys[0] if self.keys else None
+
+    def prices(self, depth=None):
+        keys = self.keys if depth is None else self.keys[:depth]
+        return [self.sign * k for k in keys]
+
+    def add(self, order):
+        level = self.levels.get(order.price)
+        if level is None:
+            level = self.levels[order.price] = deque()
+            bisect.insort(self.keys, self.sign * order.price)
+            self.sizes[order.price] = 0
+        level.append(order)
+        self.sizes[order.price] += order.leavesQty
+
+    def remove(self, order):
+        level = self.levels[order.price]
+        level.remove(order)
+        self.sizes[order.price] -= order.leavesQty
+        if not level:
+            self._drop(order.price)
+
+    def reduce(self, order, qty):
+        """Take `qty` off the head order of its level (after a fill or a size-down amend)."""
+        self.sizes[order.price] -= qty
+
+    def pop_head(self, price):
+        level = self.levels[price]
+        level.popleft()
+        if not level:
+            self._drop(price)
+
+    def _drop(self, price):
+        del self.levels[price]
+        del self.sizes[price]
+        i = bisect.bisect_left(self.keys, self.sign * price)
+        del self.keys[i]
+
+
+class Position(object):
+    __slots__ = ('symbol', 'currentQty', 'cost', 'realisedPnl', 'leverage', 'execComm')
+
+    def __init__(self, symbol):
+        self.symbol = symbol
+        self.currentQty = 0
+        self.cost = 0.0  # Signed XBt paid for the open quantity (inverse contract: qty / price).
+        self.realisedPnl = 0.0
+        self.leverage = 100.0
+        self.execComm = 0.0
+
+    def fill(self, qty, price):
+        """Apply a signed fill; returns the XBt realised by it."""
+        realised = 0.0
+        if self.currentQty and (self.currentQty > 0) != (qty > 0):
+            # The part of the position this fill closes, in the position's own sign.
+            closed = -qty if abs(qty) <= abs(self.currentQty) else self.currentQty
+            removed = self.cost * closed / self.currentQty
+            realised = removed - closed * SATOSHI / price
+            self.cost -= removed
+            self.currentQty -= closed
+            qty += closed
+        if qty:
+            self.cost += qty * SATOSHI / price
+            self.currentQty += qty
+        if not self.currentQty:
+            self.cost = 0.0
+        self.realisedPnl += realised
+        return realised
+
+    def avg_entry(self):
+        return self.currentQty * SATOSHI / self.cost if self.cost else None
+
+    def unrealised(self, mark):
+        if not self.currentQty or not mark:
+            return 0.0
+        return self.cost - self.currentQty * SATOSHI / mark
+
+    def to_dict(self, account, mark):
+        unrealised = self.unrealised(mark)
+        return {
+            'account': account,
+            'symbol': self.symbol,
+            'currency': 'XBt',
+            'currentQty': self.currentQty,
+            'avgEntryPrice': self.avg_entry(),
+            'markPrice': mark,
+            'leverage': self.leverage,
+            'crossMargin': self.leverage == 0,
+            'isOpen': self.currentQty != 0,
+            'homeNotional': self.currentQty / mark if mark else 0.0,
+            'foreignNotional': -self.currentQty,
+            'posCost': int(self.cost),
+            'realisedPnl': int(self.realisedPnl),
+            'unrealisedPnl': int(unrealised),
+            'execComm': int(self.execComm),
+            'timestamp': now_iso(),
+        }
+
+
+class Account(object):
+    __slots__ = ('name', 'wallet', 'positions', 'open', 'executions', 'unlimited', 'cancel_at')
+
+    def __init__(self, name, wallet, unlimited=False, max_executions=10000):
+        self.name = name
+        self.wallet = float(wallet)
+        self.positions = {}
+        self.open = {}
+        self.executions = deque(maxlen=max_executions)
+        self.unlimited = unlimited
+        self.cancel_at = None
+
+    def position(self, symbol):
+        position = self.positions.get(symbol)
+        if position is None:
+            position = self.positions[symbol] = Position(symbol)
+        return position
+
+
+class MatchingEngine:
+    """Price-time priority matching for every configured symbol, with positions and margin per account.
+
+    Every public method is one atomic step under `lock`. The table changes it makes (orderBookL2
+    deltas, trades, instrument, order and execution rows) go to `listeners` as
+    `(table, action, data, account)` once the step is done.
+    """
+
+    def __init__(self, instruments=None, balance=SATOSHI, liquidity=True, liquidity_depth=50, liquidity_size=10000,
+                 max_trades=10000):
+        self.lock = threading.RLock()
+        self.balance = balance
+        self.instruments = {}
+        self.books = {}
+        self.stops = {}
+        self.trades = {}
+        self.orders = {}
+        self.clOrdIDs = {}
+        self.accounts = {}
+        self.listeners = []
+        self.liquidity = liquidity
+        self._events = []
+        self._touched = {}
+        self._replenish = []
+        self._exec_ids = itertools.count(1)
+        for symbol, spec in (instruments or DEFAULT_INSTRUMENTS).items():
+            self.add_instrument(symbol, max_trades=max_trades, **spec)
+            if liquidity:
+                self.seed(symbol, liquidity_depth, liquidity_size)
+        self._events = []
+        self._touched = {}
+
+    #
+    # Setup
+    #
+    def add_instrument(self, symbol, tickSize=0.5, lotSize=1, price=10000.0, max_trades=10000):
+        self.instruments[symbol] = {
+            'symbol': symbol, 'state': 'Open', 'typ': 'FFWCSX', 'isInverse': True, 'multiplier': -SATOSHI,
+            'tickSize': tickSize, 'lotSize': lotSize, 'lastPrice': price, 'markPrice': price,
+            'indexPrice': price, 'fairPrice': price, 'bidPrice': None, 'askPrice': None, 'midPrice': None,
+            'lowPrice': price, 'highPrice': price, 'volume': 0, 'volume24h': 0, 'openInterest': 0,
+            'timestamp': now_iso(),
+        }
+        self.books[symbol] = {'Buy': PriceLevels('Buy'), 'Sell': PriceLevels('Sell')}
+        self.stops[symbol] = []
+        self.trades[symbol] = deque(maxlen=max_trades)
+
+    def account(self, name):
+        account = self.accounts.get(name)
+        if account is None:
+            account = self.accounts[name] = Account(name, self.balance, unlimited=(name == LIQUIDITY))
+        return account
+
+    def seed(self, symbol, depth=50, size=10000):
+        """Rest `depth` levels of `size` on each side of the instrument's price for the liquidity account."""
+        with self.lock:
+            inst = self.instruments[symbol]
+            tick = inst['tickSize']
+            mid = round(inst['lastPrice'] / tick) * tick
+            for i in range(1, depth + 1):
+                self.place(LIQUIDITY, {'symbol': symbol, 'side': 'Buy', 'orderQty': size, 'price': mid - i * tick})
+                self.place(LIQUIDITY, {'symbol': symbol, 'side': 'Sell', 'orderQty': size, 'price': mid + (i - 1) * tick})
+
+    #
+    # Orders
+    #
+    def place(self, account, params):
+        with self.lock:
+            try:
+                return self._place(account, params).to_dict()
+            finally:
+                self._publish()
+
+    def place_bulk(self, account, orders):
+        """Place `orders` in one step. Like BitMEX, an invalid order rejects the whole request: every order is
+        checked, margin included, before any is placed."""
+        with self.lock:
+            try:
+                checked = []
+                clOrdIDs = set()
+                reserved = 0.0
+                for params in orders:
+                    fields = self._check_place(account, params, reserved)
+                    clOrdID, required = fields[-2], fields[-1]
+                    if clOrdID and clOrdID in clOrdIDs:
+                        raise SimError(400, 'Duplicate clOrdID')
+                    clOrdIDs.add(clOrdID)
+                    reserved += required
+                    checked.append(fields)
+                return [self._place(account, params, fields).to_dict() for params, fields in zip(orders, checked)]
+            finally:
+                self._publish()
+
+    def amend(self, account, params):
+        with self.lock:
+            try:
+                return self._amend(account, params).to_dict()
+            finally:
+                self._publish()
+
+    def amend_bulk(self, account, orders):
+        """Amend `orders` in one step; an invalid amend rejects the whole request before any is applied."""
+        with self.lock:
+            try:
+                checked = []
+                clOrdIDs = set()
+                for params in orders:
+                    checked.append(self._check_amend(account, params))
+                    clOrdID = params.get('clOrdID')
+                    if clOrdID and clOrdID in clOrdIDs:
+                        raise SimError(400, 'Duplicate clOrdID')
+                    clOrdIDs.add(clOrdID)
+                return [self._amend(account, params, fields).to_dict() for params, fields in zip(orders, checked)]
+            finally:
+                self._publish()
+
+    def cancel(self, account, orderIDs=None, clOrdIDs=None, text=None):
+        with self.lock:
+            try:
+                results = []
+                for key, ids in (('orderID', orderIDs), ('clOrdID', clOrdIDs)):
+                    for value in _as_list(ids):
+                        order = self._lookup(account, key, value)
+                        if order is None:
+                            results.append({key: value, 'error': 'Not Found'})
+                        elif not order.is_open():
+                            row = order.to_dict()
+                            row['error'] = 'Unable to cancel order due to existing state: %s' % order.ordStatus
+                            results.append(row)
+                        else:
+                            self._cancel(order, text or 'Canceled: Canceled via API.')
+                            results.append(order.to_dict())
+                if not results:
+                    raise SimError(400, 'Missing orderID or clOrdID')
+                return results
+            finally:
+                self._publish()
+
+    def cancel_all(self, account, symbol=None, filter=None, text=None):
+        with self.lock:
+            try:
+                filter = filter or {}
+                cancelled = []
+                for order in list(self.account(account).open.values()):
+                    if symbol and order.symbol != symbol:
+                        continue
+                    if any(getattr(order, k, None) != v for k, v in filter.items() if k in SimOrder.FIELDS):
+                        continue
+                    self._cancel(order, text or 'Canceled: Cancel all via API.')
+                    cancelled.append(order.to_dict())
+                return cancelled
+            finally:
+                self._publish()
+
+    def cancel_all_after(self, account, timeout):
+        """Arm (timeout ms > 0) or disarm (0) the dead man's switch of `account`."""
+        with self.lock:
+            acct = self.account(account)
+            now = time.time()
+            acct.cancel_at = now + timeout / 1000.0 if timeout else None
+            result = {'now': now_iso()}
+            if acct.cancel_at:
+                result['cancelTime'] = datetime.datetime.utcfromtimestamp(acct.cancel_at).strftime(
+                    '%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+            return result
+
+    def expire(self, now=None):
+        """Fire the cancel-all-after timers that are due."""
+        now = now or time.time()
+        with self.lock:
+            for acct in list(self.accounts.values()):
+                if acct.cancel_at and acct.cancel_at <= now:
+                    acct.cancel_at = None
+                    self.cancel_all(acct.name, text='Canceled: Cancel all after timer expired')
+
+    def close_position(self, account, symbol, price=None):
+        with self.lock:
+            try:
+                position = self.account(account).position(symbol)
+                if not position.currentQty:
+                    raise SimError(400, 'No position to close')
+                params = {'symbol': symbol, 'orderQty': -position.currentQty, 'execInst': 'Close'}
+                if price is not None:
+                    params['price'] = price
+                return self._place(account, params).to_dict()
+            finally:
+                self._publish()
+
+    def set_leverage(self, account, symbol, leverage):
+        with self.lock:
+            self._instrument(symbol)
+            leverage = float(leverage)
+            if leverage < 0 or leverage > 100:
+                raise SimError(400, 'Invalid leverage')
+            position = self.account(account).position(symbol)
+            position.leverage = leverage
+            return position.to_dict(account, self.instruments[symbol]['markPrice'])
+
+    #
+    # Queries
+    #
+    def open_orders(self, account, symbol=None):
+        with self.lock:
+            return [o.to_dict() for o in self.account(account).open.values()
+                    if symbol is None or o.symbol == symbol]
+
+    def get_orders(self, account, symbol=None, filter=None, count=100, start=0, reverse=False):
+        with self.lock:
+            filter = dict(filter or {})
+            open_only = filter.pop('open', False)
+            rows = []
+            for order in self.orders.values():
+                if order.account != account or (symbol and order.symbol != symbol):
+                    continue
+                if open_only and not order.is_open():
+                    continue
+                if not _matches(order, filter):
+                    continue
+                rows.append(order)
+            return _page([o.to_dict() for o in rows], count, start, reverse)
+
+    def positions(self, account):
+        with self.lock:
+            acct = self.account(account)
+            return [p.to_dict(account, self.instruments[p.symbol]['markPrice']) for p in acct.positions.values()]
+
+    def margin(self, account):
+        with self.lock:
+            acct = self.account(account)
+            unrealised = sum(p.unrealised(self.instruments[p.symbol]['markPrice']) for p in acct.positions.values())
+            used = self._used_margin(acct)
+            margin_balance = acct.wallet + unrealised
+            return {
+                'account': account,
+                'currency': 'XBt',
+                'walletBalance': int(acct.wallet),
+                'unrealisedPnl': int(unrealised),
+                'realisedPnl': int(sum(p.realisedPnl for p in acct.positions.values())),
+                'marginBalance': int(margin_balance),
+                'availableMargin': int(margin_balance - used),
+                'initMargin': int(used),
+                'timestamp': now_iso(),
+            }
+
+    def instrument(self, symbol=None):
+        with self.lock:
+            if symbol is None:
+                return [dict(inst) for inst in self.instruments.values()]
+            if symbol not in self.instruments:
+                return []
+            return [dict(self.instruments[symbol])]
+
+    def l2(self, symbol, depth=25):
+        """orderBook/L2 rows: sells by descending price, then buys by descending price."""
+        with self.lock:
+            book = self.books[self._instrument(symbol)['symbol']]
+            depth = int(depth) or None
+            sells = book['Sell'].prices(depth)[::-1]
+            buys = book['Buy'].prices(depth)
+            return [self._level(symbol, 'Sell', p) for p in sells] + [self._level(symbol, 'Buy', p) for p in buys]
+
+    def recent_trades(self, symbol=None, count=100, start=0, reverse=False, startTime=None, endTime=None):
+        with self.lock:
+            symbols = [symbol] if symbol else list(self.trades)
+            rows = [t for s in symbols for t in self.trades.get(s, ())]
+            if len(symbols) > 1:
+                rows.sort(key=lambda t: t['timestamp'])
+            return _page(_between(rows, startTime, endTime), count, start, reverse)
+
+    def executions(self, account, symbol=None, count=100, start=0, reverse=False, startTime=None, endTime=None):
+        with self.lock:
+            rows = [e for e in self.account(account).executions
+                    if e['execType'] == 'Trade' and (symbol is None or e['symbol'] == symbol)]
+            return _page(_between(rows, startTime, endTime), count, start, reverse)
+
+    def snapshot(self, table, symbol=None, account=None, depth=None):
+        """The rows of a websocket partial for `table`."""
+        with self.lock:
+            if table in ('orderBookL2', 'orderBookL2_25'):
+                return self.l2(symbol, 25 if table == 'orderBookL2_25' else 0)
+            if table == 'trade':
+                return list(self.trades[symbol])[-100:]
+            if table == 'instrument':
+                return self.instrument(symbol)
+            if table == 'order':
+                return self.open_orders(account)
+            if table == 'execution':
+                return list(self.account(account).executions)[-100:]
+            if table == 'position':
+                return self.positions(account)
+            if table == 'margin':
+                return [self.margin(account)]
+            raise SimError(400, 'Unknown table: %s' % table)
+
+    #
+    # Internals
+    #
+    def _instrument(self, symbol):
+        inst = self.instruments.get(symbol)
+        if inst is None:
+            raise SimError(400, 'Invalid symbol: %s' % symbol)
+        return inst
+
+    def _lookup(self, account, key, value):
+        if key == 'orderID':
+            order = self.orders.get(value)
+        else:
+            order = self.orders.get(self.clOrdIDs.get((account, value)))
+        return order if order is not None and order.account == account else None
+
+    def _level(self, symbol, side, price):
+        tick = self.instruments[symbol]['tickSize']
+        return {'symbol': symbol, 'id': 8800000000 - int(round(price / tick)), 'side': side,
+                'size': self.books[symbol][side].sizes.get(price, 0), 'price': price}
+
+    def _check_price(self, inst, price, name='price'):
+        if price is None:
+            raise SimError(400, '%s is required for this order type' % name)
+        if price <= 0:
+            raise SimError(400, 'Invalid %s' % name)
+        ticks = price / inst['tickSize']
+        if abs(ticks - round(ticks)) > 1e-9:
+            raise SimError(400, 'Invalid %s tickSize' % name)
+
+    def _used_margin(self, acct):
+        used = 0.0
+        for p in acct.positions.values():
+            leverage = p.leverage or 100.0
+            used += abs(p.cost) / leverage
+        for order in acct.open.values():
+            if order.price:
+                leverage = acct.position(order.symbol).leverage or 100.0
+                used += order.leavesQty * SATOSHI / order.price / leverage
+        return used
+
+    def _check_place(self, account, params, reserved=0.0):
+        """Validate a new order without changing anything. `reserved` is margin already claimed by orders
+        placed along with it. Returns (symbol, side, qty, price, stopPx, ordType, execInst, clOrdID,
+        required margin)."""
+        inst = self._instrument(params.get('symbol'))
+        symbol = inst['symbol']
+        acct = self.account(account)
+        qty = params.get('orderQty')
+        if qty is None:
+            raise SimError(400, "'orderQty' is required")
+        qty = int(qty)
+        side = params.get('side') or ('Buy' if qty > 0 else 'Sell')
+        if side not in ('Buy', 'Sell'):
+            raise SimError(400, 'Invalid side')
+        qty = abs(qty)
+        if not qty:
+            raise SimError(400, 'Invalid orderQty')
+        if qty % inst['lotSize']:
+            raise SimError(400, 'Order quantity must be a multiple of lot size: %s' % inst['lotSize'])
+        price = params.get('price')
+        stopPx = params.get('stopPx')
+        ordType = params.get('ordType') or ('Stop' if stopPx is not None and price is None else
+                                            'StopLimit' if stopPx is not None else
+                                            'Limit' if price is not None else 'Market')
+        if ordType not in ORDER_TYPES:
+            raise SimError(400, 'Invalid ordType')
+        if ordType in PRICED_TYPES:
+            self._check_price(inst, price)
+        elif ordType == 'Market':
+            price = None
+        if ordType in STOP_TYPES:
+            self._check_price(inst, stopPx, 'stopPx')
+        clOrdID = params.get('clOrdID') or ''
+        if clOrdID and (account, clOrdID) in self.clOrdIDs:
+            raise SimError(400, 'Duplicate clOrdID')
+        execInst = params.get('execInst') or ''
+        if 'Close' in execInst or 'ReduceOnly' in execInst:
+            current = acct.position(symbol).currentQty
+            if not current or (current > 0) == (side == 'Buy') or qty > abs(current):
+                raise SimError(400, 'Order with execInst of %s would increase the position' % execInst)
+        required = 0.0
+        if not acct.unlimited and 'Close' not in execInst and 'ReduceOnly' not in execInst:
+            ref = price or inst['lastPrice']
+            leverage = acct.position(symbol).leverage or 100.0
+            required = qty * SATOSHI / ref / leverage
+            available = self.margin(account)['availableMargin'] - reserved
+            if required > available:
+                raise SimError(400, 'Account has insufficient Available Balance, %d XBt required' % required)
+        return symbol, side, qty, price, stopPx, ordType, execInst, clOrdID, required
+
+    def _place(self, account, params, checked=None):
+        symbol, side, qty, price, stopPx, ordType, execInst, clOrdID, _ = \
+            checked or self._check_place(account, params)
+        acct = self.account(account)
+        stamp = now_iso()
+        order = SimOrder(orderID=str(uuid.uuid4()), clOrdID=clOrdID, account=account, symbol=symbol, side=side,
+                         ordType=ordType, ordStatus='New', orderQty=qty, price=price, stopPx=stopPx, leavesQty=qty,
+                         cumQty=0, avgPx=None, execInst=execInst, triggered='', text=params.get('text') or '',
+                         timestamp=stamp, transactTime=stamp)
+        self.orders[order.orderID] = order
+        acct.open[order.orderID] = order
+        if clOrdID:
+            self.clOrdIDs[(account, clOrdID)] = order.orderID
+        self._emit('order', 'insert', [order.to_dict()], account)
+        self._execution(order, 'New')
+        if ordType in STOP_TYPES:
+            self.stops[symbol].append(order)
+            self._trigger_stops(symbol)
+        else:
+            self._execute(order)
+        self._requote()
+        return order
+
+    def _check_amend(self, account, params):
+        """Validate an amend without changing anything. Returns (order, price, leavesQty)."""
+        if params.get('orderID'):
+            order = self._lookup(account, 'orderID', params['orderID'])
+        else:
+            order = self._lookup(account, 'clOrdID', params.get('origClOrdID'))
+        if order is None:
+            raise SimError(404, 'Not Found')
+        if not order.is_open():
+            raise SimError(400, 'Invalid ordStatus: %s' % order.ordStatus)
+        inst = self.instruments[order.symbol]
+        price = params.get('price', order.price)
+        if price != order.price:
+            self._check_price(inst, price)
+        if params.get('stopPx') is not None:
+            self._check_price(inst, params['stopPx'], 'stopPx')
+        leaves = order.leavesQty
+        if params.get('orderQty') is not None:
+            leaves = abs(int(params['orderQty'])) - order.cumQty
+        if params.get('leavesQty') is not None:
+            leaves = abs(int(params['leavesQty']))
+        if leaves <= 0:
+            raise SimError(400, 'Invalid leavesQty')
+        if params.get('clOrdID') and (account, params['clOrdID']) in self.clOrdIDs:
+            raise SimError(400, 'Duplicate clOrdID')
+        return order, price, leaves
+
+    def _amend(self, account, params, checked=None):
+        order, price, leaves = checked or self._check_amend(account, params)
+        if params.get('clOrdID'):
+            self.clOrdIDs[(account, params['clOrdID'])] = order.orderID
+            order.clOrdID = params['clOrdID']
+
+        resting = order.ordType not in STOP_TYPES or order.triggered
+        book = self.books[order.symbol][order.side]
+        requeue = resting and order.price is not None and (price != order.price or leaves > order.leavesQty)
+        if requeue:
+            self._touch(order.symbol, order.side, order.price)
+            book.remove(order)
+        elif resting and order.price is not None and leaves < order.leavesQty:
+            self._touch(order.symbol, order.side, order.price)
+            book.reduce(order, order.leavesQty - leaves)
+        order.price = price
+        order.stopPx = params.get('stopPx', order.stopPx)
+        order.leavesQty = leaves
+        order.orderQty = order.cumQty + leaves
+        order.transactTime = now_iso()
+        self._emit('order', 'update', [order.to_dict()], account)
+        self._execution(order, 'Replaced')
+        if requeue:
+            self._execute(order)
+        elif not resting:
+            self._trigger_stops(order.symbol)
+        self._requote()
+        return order
+
+    def _cancel(self, order, text):
+        if order.ordType in STOP_TYPES and not order.triggered:
+            self.stops[order.symbol].remove(order)
+        elif order.price is not None and order.price in self.books[order.symbol][order.side].levels:
+            book = self.books[order.symbol][order.side]
+            if order in book.levels[order.price]:
+                self._touch(order.symbol, order.side, order.price)
+                book.remove(order)
+        order.ordStatus = 'Canceled'
+        order.leavesQty = 0
+        order.text = text
+        order.transactTime = now_iso()
+        self._close(order)
+        self._emit('order', 'update', [order.to_dict()], order.account)
+        self._execution(order, 'Canceled')
+
+    def _execute(self, order):
+        """Match `order` against the opposite side, then rest (Limit) or cancel (Market) what is left."""
+        symbol = order.symbol
+        opposite = self.books[symbol]['Sell' if order.side == 'Buy' else 'Buy']
+        limit = order.price if order.ordType in PRICED_TYPES else None
+        crosses = (lambda p: limit is None or p <= limit) if order.side == 'Buy' else \
+            (lambda p: limit is None or p >= limit)
+        best = opposite.best()
+        if 'ParticipateDoNotInitiate' in order.execInst and best is not None and crosses(best):
+            self._cancel(order, 'Canceled: Order had execInst of ParticipateDoNotInitiate')
+            return
+        last = None
+        while order.leavesQty and len(opposite):
+            price = opposite.best()
+            if not crosses(price):
+                break
+            maker = opposite.levels[price][0]
+            qty = min(order.leavesQty, maker.leavesQty)
+            self._touch(symbol, maker.side, price)
+            opposite.reduce(maker, qty)
+            self._fill(maker, qty, price, 'AddedLiquidity')
+            self._fill(order, qty, price, 'RemovedLiquidity')
+            if not maker.leavesQty:
+                opposite.pop_head(price)
+                if maker.account == LIQUIDITY and self.liquidity:
+                    self._replenish.append((symbol, maker.side, maker.orderQty, price))
+            self._trade(symbol, order.side, qty, price, last)
+            last = price
+        if order.leavesQty:
+            if limit is None:
+                self._cancel(order, 'Canceled: Market order had no more liquidity to match against')
+            else:
+                self._touch(symbol, order.side, order.price)
+                self.books[symbol][order.side].add(order)
+        if last is not None:
+            self._trigger_stops(symbol)
+
+    def _requote(self):
+        """Put back what was taken from the liquidity account, at the same prices."""
+        while self._replenish:
+            symbol, side, qty, price = self._replenish.pop(0)
+            self._place(LIQUIDITY, {'symbol': symbol, 'side': side, 'orderQty': qty, 'price': price})
+
+    def _trigger_stops(self, symbol):
+        last = self.instruments[symbol]['lastPrice']
+        fired = True
+        while fired:
+            fired = False
+            for order in list(self.stops[symbol]):
+                rising = (order.side == 'Buy') == (order.ordType in ('Stop', 'StopLimit'))
+                if (rising and last >= order.stopPx) or (not rising and last <= order.stopPx):
+                    self.stops[symbol].remove(order)
+                    order.triggered = 'StopOrderTriggered'
+                    order.transactTime = now_iso()
+                    self._emit('order', 'update', [order.to_dict()], order.account)
+                    self._execute(order)
+                    last = self.instruments[symbol]['lastPrice']
+                    fired = True
+                    break
+
+    def _fill(self, order, qty, price, liquidity):
+        order.avgPx = price if not order.cumQty else \
+            (order.avgPx * order.cumQty + price * qty) / (order.cumQty + qty)
+        order.cumQty += qty
+        order.leavesQty -= qty
+        order.ordStatus = 'Filled' if not order.leavesQty else 'PartiallyFilled'
+        order.transactTime = now_iso()
+        if not order.leavesQty:
+            self._close(order)
+        acct = self.account(order.account)
+        signed = qty if order.side == 'Buy' else -qty
+        position = acct.position(order.symbol)
+        realised = position.fill(signed, price)
+        value = qty * SATOSHI / price
+        fee = value * (MAKER_FEE if liquidity == 'AddedLiquidity' else TAKER_FEE)
+        position.execComm += fee
+        acct.wallet += realised - fee
+        self._emit('order', 'update', [order.to_dict()], order.account)
+        self._execution(order, 'Trade', lastQty=qty, lastPx=price, lastLiquidityInd=liquidity,
+                        execCost=int(-signed * SATOSHI / price), execComm=int(fee), commission=fee / value)
+
+    def _close(self, order):
+        self.account(order.account).open.pop(order.orderID, None)
+        if order.account == LIQUIDITY:
+            # Nobody looks the liquidity provider's orders up once they are done.
+            self.orders.pop(order.orderID, None)
+
+    def _execution(self, order, execType, **extra):
+        if order.account == LIQUIDITY:
+            return
+        row = order.to_dict()
+        row.update({
+            'execID': str(uuid.UUID(int=next(self._exec_ids))),
+            'account': order.account,
+            'execType': execType,
+            'lastQty': 0,
+            'lastPx': None,
+            'timestamp': order.transactTime,
+        })
+        row.update(extra)
+        self.account(order.account).executions.append(row)
+        self._emit('execution', 'insert', [row], order.account)
+
+    def _trade(self, symbol, side, qty, price, previous):
+        inst = self.instruments[symbol]
+        tick = 'ZeroPlusTick' if price == inst['lastPrice'] and side == 'Buy' else \
+            'ZeroMinusTick' if price == inst['lastPrice'] else \
+            'PlusTick' if price > inst['lastPrice'] else 'MinusTick'
+        trade = {
+            'timestamp': now_iso(), 'symbol': symbol, 'side': side, 'size': qty, 'price': price,
+            'tickDirection': tick, 'trdMatchID': str(uuid.uuid4()), 'grossValue': int(qty * SATOSHI / price),
+            'homeNotional': qty / price, 'foreignNotional': qty,
+        }
+        self.trades[symbol].append(trade)
+        inst['lastPrice'] = inst['markPrice'] = inst['fairPrice'] = price
+        inst['lowPrice'] = min(inst['lowPrice'], price)
+        inst['highPrice'] = max(inst['highPrice'], price)
+        inst['volume'] += qty
+        inst['volume24h'] += qty
+        self._emit('trade', 'insert', [trade])
+
+    def _touch(self, symbol, side, price):
+        key = (symbol, side, price)
+        if key not in self._touched:
+            self._touched[key] = self.books[symbol][side].sizes.get(price, 0)
+
+    def _emit(self, table, action, data, account=None):
+        self._events.append((table, action, data, account))
+
+    def _publish(self):
+        """Turn the touched levels into L2 deltas, refresh the instruments and hand everything to listeners."""
+        events, self._events = self._events, []
+        touched, self._touched = self._touched, {}
+        deltas = {}
+        for (symbol, side, price), before in touched.items():
+            after = self.books[symbol][side].sizes.get(price, 0)
+            if before == after:
+                continue
+            action = 'insert' if not before else 'delete' if not after else 'update'
+            row = self._level(symbol, side, price)
+            if action == 'delete':
+                del row['size']
+            deltas.setdefault((symbol, action), []).append(row)
+        book_events = []
+        for action in ('delete', 'update', 'insert'):
+            for (symbol, a), rows in deltas.items():
+                if a == action:
+                    book_events.append(('orderBookL2', action, rows, None))
+        symbols = set(s for s, _, _ in touched) | set(e[2][0]['symbol'] for e in events if e[0] == 'trade')
+        for symbol in symbols:
+            inst = self.instruments[symbol]
+            changes = {}
+            bid, ask = self.books[symbol]['Buy'].best(), self.books[symbol]['Sell'].best()
+            for name, value in (('bidPrice', bid), ('askPrice', ask),
+                                ('midPrice', (bid + ask) / 2 if bid is not None and ask is not None else None)):
+                if inst[name] != value:
+                    inst[name] = changes[name] = value
+            if changes or any(e[0] == 'trade' and e[2][0]['symbol'] == symbol for e in events):
+                inst['timestamp'] = now_iso()
+                for name in ('lastPrice', 'markPrice', 'fairPrice', 'volume', 'volume24h', 'timestamp'):
+                    changes[name] = inst[name]
+                changes['symbol'] = symbol
+                events.append(('instrument', 'update', [changes], None))
+        events = book_events + events
+        if events:
+            for listener in self.listeners:
+                listener(events)
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    if isinstance(value, str) and value.startswith('['):
+        return codec.loads(value)
+    return [value]
+
+
+def _matches(order, filter):
+    for key, value in filter.items():
+        actual = getattr(order, key, None) if key in SimOrder.FIELDS else None
+        if isinstance(value, list):
+            if actual not in value:
+                return False
+        elif actual != value:
+            return False
+    return True
+
+
+def _between(rows, startTime, endTime):
+    if startTime:
+        rows = [r for r in rows if r['timestamp'] >= _normal_time(startTime)]
+    if endTime:
+        rows = [r for r in rows if r['timestamp'] <= _normal_time(endTime)]
+    return rows
+
+
+def _normal_time(value):
+    """ISO timestamps compare as strings once they share our millisecond 'Z' form."""
+    value = value.rstrip('Z')
+    if '.' not in value:
+        value += '.000'
+    return value[:23] + 'Z'
+
+
+def _page(rows, count=100, start=0, reverse=False):
+    count = min(int(count or 100), 1000)
+    start = int(start or 0)
+    if reverse in (True, 'true'):
+        rows = rows[::-1]
+    return rows[start:start + count]
+
+
+class KeyBudget:
+    """The per-key request budget behind the X-RateLimit-* headers: `limit` requests refilling evenly
+    over `period` seconds."""
+
+    def __init__(self, limit, period):
+        self.limit = limit
+        self.period = float(period)
+        self.tokens = float(limit)
+        self.updated = time.time()
+
+    def take(self):
+        """Returns (allowed, remaining, reset epoch). Reset is when the budget is full again, as on
+        BitMEX; `retry_after` is when the next request would be allowed."""
+        now = time.time()
+        self.tokens = min(float(self.limit), self.tokens + (now - self.updated) * self.limit / self.period)
+        self.updated = now
+        allowed = self.tokens >= 1.0
+        if allowed:
+            self.tokens -= 1.0
+        reset = int(now + (self.limit - self.tokens) * self.period / self.limit) + 1
+        return allowed, int(self.tokens), reset
+
+    def retry_after(self):
+        return int(max(0.0, 1.0 - self.tokens) * self.period / self.limit) + 1
+
+
+class Subscriber:
+    """One websocket connection: its topics, its account and its outgoing message queue."""
+
+    def __init__(self, topics, account):
+        self.topics = topics
+        self.account = account
+        self.queue = deque()
+        self.cond = threading.Condition()
+        self.closed = False
+
+    def wants(self, table, data, account):
+        if table in ('order', 'execution', 'position', 'margin'):
+            return account is not None and account == self.account and table in self.topics
+        if table == 'orderBookL2':
+            symbol = data[0]['symbol']
+            return ('orderBookL2', symbol) in self.topics or ('orderBookL2_25', symbol) in self.topics
+        return (table, data[0]['symbol']) in self.topics or table in self.topics
+
+    def send(self, message):
+        with self.cond:
+            self.queue.append(message)
+            self.cond.notify()
+
+
+class SimulatorHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes; without this Nagle + delayed ACK add ~40ms each.
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        if self.server.simulator.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def do_GET(self):
+        if urlparse(self.path).path == '/realtime' and self.headers.get('Upgrade', '').lower() == 'websocket':
+            return self.server.simulator.serve_websocket(self)
+        self.server.simulator.serve_rest(self, 'GET')
+
+    def do_POST(self):
+        self.server.simulator.serve_rest(self, 'POST')
+
+    def do_PUT(self):
+        self.server.simulator.serve_rest(self, 'PUT')
+
+    def do_DELETE(self):
+        self.server.simulator.serve_rest(self, 'DELETE')
+
+
+class Simulator:
+    """HTTP + websocket front end of a `MatchingEngine`.
+
+    accounts: {apiKey: apiSecret}; requests signed with any other key get a 401.
+    rate_limit / rate_period: the per-key budget reported in X-RateLimit-* (BitMEX: 60 per minute).
+    faults: {429: p, 503: p} probability of answering a request with that status regardless.
+    latency: seconds added to every REST response, or a callable returning them.
+    certfile / keyfile: serve HTTPS (and wss) with this certificate, e.g. a self-signed one.
+    """
+
+    ROUTES = {
+        ('GET', 'order'): 'get_order',
+        ('POST', 'order'): 'post_order',
+        ('PUT', 'order'): 'put_order',
+        ('DELETE', 'order'): 'delete_order',
+        ('POST', 'order/bulk'): 'post_order_bulk',
+        ('PUT', 'order/bulk'): 'put_order_bulk',
+        ('DELETE', 'order/all'): 'delete_order_all',
+        ('POST', 'order/cancelAllAfter'): 'post_cancel_all_after',
+        ('POST', 'order/closePosition'): 'post_close_position',
+        ('GET', 'position'): 'get_position',
+        ('POST', 'position/leverage'): 'post_leverage',
+        ('GET', 'user/margin'): 'get_margin',
+        ('GET', 'instrument'): 'get_instrument',
+        ('GET', 'instrument/active'): 'get_instrument_active',
+        ('GET', 'orderBook/L2'): 'get_l2',
+        ('GET', 'trade'): 'get_trade',
+        ('GET', 'execution/tradeHistory'): 'get_trade_history',
+    }
+    PUBLIC = ('instrument', 'instrument/active', 'orderBook/L2', 'trade')
+
+    def __init__(self, host='127.0.0.1', port=0, accounts=None, instruments=None, rate_limit=60, rate_period=60,
+                 faults=None, latency=0, balance=SATOSHI, liquidity=True, seed=None, verbose=False, certfile=None,
+                 keyfile=None):
+        self.engine = MatchingEngine(instruments, balance=balance, liquidity=liquidity)
+        self.engine.listeners.append(self._broadcast)
+        self.accounts = dict(accounts or {})
+        self.rate_limit = rate_limit
+        self.rate_period = rate_period
+        self.budgets = {}
+        self.budget_lock = threading.Lock()
+        self.faults = dict((int(k), v) for k, v in (faults or {}).items())
+        self.latency = latency
+        self.random = random.Random(seed)
+        self.verbose = verbose
+        self.subscribers = []
+        # Counted on the handler threads, under stats_lock.
+        self.stats_lock = threading.Lock()
+        self.requests = 0
+        self.responses = {}
+        self.server = ThreadingHTTPServer((host, port), SimulatorHandler)
+        self.server.daemon_threads = True
+        self.server.simulator = self
+        self.tls = certfile is not None
+        if self.tls:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(certfile, keyfile)
+            # The handshake runs on the request thread, not in accept() on the server's.
+            self.server.socket = context.wrap_socket(self.server.socket, server_side=True,
+                                                     do_handshake_on_connect=False)
+        self.thread = None
+        self._stop = threading.Event()
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return '%s://%s:%d/api/v1/' % ('https' if self.tls else 'http', host, port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name='Simulator')
+        self.thread.daemon = True
+        self.thread.start()
+        timer = threading.Thread(target=self._timers, name='Simulator-timers')
+        timer.daemon = True
+        timer.start()
+        return self
+
+    def drop_websockets(self):
+        """Close every realtime connection, as a network drop would; clients may connect again."""
+        for subscriber in list(self.subscribers):
+            subscriber.closed = True
+            subscriber.send(None)
+
+    def stop(self):
+        self._stop.set()
+        self.drop_websockets()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _timers(self):
+        while not self._stop.wait(0.05):
+            self.engine.expire()
+
+    #
+    # REST
+    #
+    def _budget(self, key):
+        with self.budget_lock:
+            budget = self.budgets.get(key)
+            if budget is None:
+                budget = self.budgets[key] = KeyBudget(self.rate_limit, self.rate_period)
+            return budget.take() + (budget.retry_after(),)
+
+    def serve_rest(self, handler, verb):
+        url = urlparse(handler.path)
+        length = int(handler.headers.get('Content-Length') or 0)
+        body = handler.rfile.read(length) if length else b''
+        path = url.path[len(API_PREFIX):] if url.path.startswith(API_PREFIX) else None
+        with self.stats_lock:
+            self.requests += 1
+        headers = {}
+        try:
+            method = self.ROUTES.get((verb, path))
+            if method is None:
+                raise SimError(404, 'Not Found')
+            params = dict(parse_qsl(url.query))
+            if body:
+                try:
+                    params.update(codec.loads(body))
+                except ValueError:
+                    raise SimError(400, 'Invalid JSON body')
+            for name in ('filter', 'columns'):
+                if isinstance(params.get(name), str):
+                    params[name] = codec.loads(params[name])
+            account = None
+            if path not in self.PUBLIC or handler.headers.get('api-key'):
+                account = self._authenticate(handler, verb, body)
+            allowed, remaining, reset, retry_after = self._budget(account or handler.client_address[0])
+            headers = {'X-RateLimit-Limit': str(self.rate_limit), 'X-RateLimit-Remaining': str(remaining),
+                       'X-RateLimit-Reset': str(reset)}
+            if not allowed:
+                headers['Retry-After'] = str(retry_after)
+                raise SimError(429, 'Rate limit exceeded, retry in %d seconds.' % retry_after, 'RateLimitError')
+            for status in (429, 503):
+                if self.faults.get(status) and self.random.random() < self.faults[status]:
+                    if status == 429:
+                        headers['X-RateLimit-Remaining'] = '0'
+                        headers['Retry-After'] = '1'
+                        raise SimError(429, 'Rate limit exceeded, retry in 1 seconds.', 'RateLimitError')
+                    raise SimError(503, 'The system is currently overloaded. Please try again later.')
+            latency = self.latency() if callable(self.latency) else self.latency
+            if latency:
+                time.sleep(latency)
+            status, payload = 200, getattr(self, method)(account, params)
+        except SimError as e:
+            status, payload = e.status, {'error': {'message': e.message, 'name': e.name}}
+        except (KeyError, TypeError, ValueError) as e:
+            status, payload = 400, {'error': {'message': 'Invalid request: %s' % e, 'name': 'ValidationError'}}
+        with self.stats_lock:
+            self.responses[status] = self.responses.get(status, 0) + 1
+        data = codec.dumps(payload)
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(data)))
+        for name, value in headers.items():
+            handler.send_header(name, value)
+        handler.end_headers()
+        handler.wfile.write(data)
+
+    def _authenticate(self, handler, verb, body, path=None):
+        key = handler.headers.get('api-key')
+        expires = handler.headers.get('api-expires')
+        signature = handler.headers.get('api-signature')
+        if not key or not expires or not signature:
+            raise SimError(401, 'Signature not valid.')
+        secret = self.accounts.get(key)
+        if secret is None:
+            raise SimError(401, 'Invalid API Key.')
+        if int(expires) < time.time():
+            raise SimError(401, 'This request has expired - `expires` is in the past.')
+        if generate_signature(secret, verb, path or handler.path, expires, body) != signature:
+            raise SimError(401, 'Signature not valid.')
+        return key
+
+    def get_order(self, account, params):
+        return self.engine.get_orders(account, params.get('symbol'), params.get('filter'), params.get('count', 100),
+                                      params.get('start', 0), params.get('reverse', False))
+
+    def post_order(self, account, params):
+        return self.engine.place(account, params)
+
+    def put_order(self, account, params):
+        return self.engine.amend(account, params)
+
+    def delete_order(self, account, params):
+        return self.engine.cancel(account, params.get('orderID'), params.get('clOrdID'), params.get('text'))
+
+    def post_order_bulk(self, account, params):
+        return self.engine.place_bulk(account, _as_list(params.get('orders')))
+
+    def put_order_bulk(self, account, params):
+        return self.engine.amend_bulk(account, _as_list(params.get('orders')))
+
+    def delete_order_all(self, account, params):
+        return self.engine.cancel_all(account, params.get('symbol'), params.get('filter'), params.get('text'))
+
+    def post_cancel_all_after(self, account, params):
+        return self.engine.cancel_all_after(account, int(params.get('timeout', 0)))
+
+    def post_close_position(self, account, params):
+        return self.engine.close_position(account, params['symbol'], params.get('price'))
+
+    def get_position(self, account, params):
+        return self.engine.positions(account)
+
+    def post_leverage(self, account, params):
+        return self.engine.set_leverage(account, params['symbol'], params['leverage'])
+
+    def get_margin(self, account, params):
+        return self.engine.margin(account)
+
+    def get_instrument(self, account, params):
+        return self.engine.instrument(params.get('symbol'))
+
+    def get_instrument_active(self, account, params):
+        return self.engine.instrument()
+
+    def get_l2(self, account, params):
+        return self.engine.l2(params['symbol'], params.get('depth', 25))
+
+    def get_trade(self, account, params):
+        return self.engine.recent_trades(params.get('symbol'), params.get('count', 100), params.get('start', 0),
+                                         params.get('reverse', False), params.get('startTime'), params.get('endTime'))
+
+    def get_trade_history(self, account, params):
+        return self.engine.executions(account, params.get('symbol'), params.get('count', 100), params.get('start', 0),
+                                      params.get('reverse', False), params.get('startTime'), params.get('endTime'))
+
+    #
+    # Websocket
+    #
+    def serve_websocket(self, handler):
+        """Minimal RFC 6455 server: the handshake, unfragmented text frames out, close/ping in."""
+        url = urlparse(handler.path)
+        account = None
+        if handler.headers.get('api-key'):
+            try:
+                # The realtime handshake signs GET/realtime without the subscribe query.
+                account = self._authenticate(handler, 'GET', b'', '/realtime')
+            except SimError as e:
+                handler.send_error(401, e.message)
+                return
+        accept = base64.b64encode(hashlib.sha1((handler.headers['Sec-WebSocket-Key'] + WS_GUID).encode()).digest())
+        handler.send_response(101, 'Switching Protocols')
+        handler.send_header('Upgrade', 'websocket')
+        handler.send_header('Connection', 'Upgrade')
+        handler.send_header('Sec-WebSocket-Accept', accept.decode())
+        handler.end_headers()
+        handler.wfile.flush()
+        handler.close_connection = True
+
+        topics = set()
+        for topic in dict(parse_qsl(url.query)).get('subscribe', '').split(','):
+            if topic:
+                table, _, symbol = topic.partition(':')
+                topics.add((table, symbol) if symbol else table)
+        subscriber = Subscriber(topics, account)
+        _send_frame(handler.wfile, codec.dumps({'info': 'Welcome to the BitMEX Realtime API.', 'version': 'sim'}))
+        # Register and take the partials under the engine lock so no delta falls between them.
+        with self.engine.lock:
+            for topic in sorted(topics, key=str):
+                table, symbol = topic if isinstance(topic, tuple) else (topic, None)
+                if table in ('order', 'execution', 'position', 'margin') and account is None:
+                    subscriber.send({'status': 401, 'error': 'Not authenticated', 'request': {'op': 'subscribe'}})
+                    continue
+                data = self.engine.snapshot(table, symbol, account)
+                subscriber.send({'table': table, 'action': 'partial', 'keys': [], 'data': data})
+            self.subscribers.append(subscriber)
+
+        reader = threading.Thread(target=self._read_frames, args=(handler, subscriber), name='Simulator-ws-reader')
+        reader.daemon = True
+        reader.start()
+        try:
+            while not subscriber.closed:
+                with subscriber.cond:
+                    while not subscriber.queue and not subscriber.closed:
+                        subscriber.cond.wait(1.0)
+                    messages = list(subscriber.queue)
+                    subscriber.queue.clear()
+                for message in messages:
+                    if message is None:
+                        break
+                    _send_frame(handler.wfile, codec.dumps(message))
+                handler.wfile.flush()
+        except (OSError, socket.error):
+            pass
+        finally:
+            subscriber.closed = True
+            if subscriber in self.subscribers:
+                self.subscribers.remove(subscriber)
+            try:
+                _send_frame(handler.wfile, b'', 0x8)
+            except (OSError, socket.error):
+                pass
+
+    def _read_frames(self, handler, subscriber):
+        try:
+            while not subscriber.closed:
+                opcode, payload = _read_frame(handler.rfile)
+                if opcode is None or opcode == 0x8:
+                    break
+                if opcode == 0x9:
+                    subscriber.send({'pong': True})
+                elif opcode == 0x1 and payload == b'ping':
+                    subscriber.send('pong')
+        except (OSError, socket.error, ValueError):
+            pass
+        with subscriber.cond:
+            subscriber.closed = True
+            subscriber.cond.notify()
+
+    def _broadcast(self, events):
+        for table, action, data, account in events:
+            if not data:
+                continue
+            for subscriber in self.subscribers:
+                if subscriber.wants(table, data, account):
+                    tables = [table]
+                    if table == 'orderBookL2':
+                        # Deltas go to both book tables; the client trims to the depth it asked for.
+                        symbol = data[0]['symbol']
+                        tables = [t for t in ('orderBookL2', 'orderBookL2_25') if (t, symbol) in subscriber.topics]
+                    for name in tables:
+                        subscriber.send({'table': name, 'action': action, 'data': data})
+
+
+def _send_frame(wfile, payload, opcode=0x1):
+    n = len(payload)
+    if n < 126:
+        header = struct.pack('!BB', 0x80 | opcode, n)
+    elif n < 65536:
+        header = struct.pack('!BBH', 0x80 | opcode, 126, n)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 127, n)
+    wfile.write(header + payload)
+
+
+def _read_frame(rfile):
+    head = rfile.read(2)
+    if len(head) < 2:
+        return None, None
+    opcode = head[0] & 0x0f
+    masked = head[1] & 0x80
+    n = head[1] & 0x7f
+    if n == 126:
+        n = struct.unpack('!H', rfile.read(2))[0]
+    elif n == 127:
+        n = struct.unpack('!Q', rfile.read(8))[0]
+    mask = rfile.read(4) if masked else None
+    payload = rfile.read(n)
+    if mask:
+        payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+    return opcode, payload
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Local BitMEX simulator')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--key', default='key')
+    parser.add_argument('--secret', default='secret')
+    parser.add_argument('--rate-limit', type=int, default=60)
+    parser.add_argument('--fault-503', type=float, default=0.0)
+    parser.add_argument('--fault-429', type=float, default=0.0)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--verbose', action='store_true')
+    parser.add_argument('--certfile')
+    parser.add_argument('--keyfile')
+    args = parser.parse_args(argv)
+    sim = Simulator(args.host, args.port, accounts={args.key: args.secret}, rate_limit=args.rate_limit,
+                    faults={503: args.fault_503, 429: args.fault_429}, latency=args.latency, verbose=args.verbose,
+                    certfile=args.certfile, keyfile=args.keyfile)
+    print("BitMEX simulator on %s (key %s)" % (sim.base_url, args.key))
+    sim.start()
+    try:
+        while sim.thread.is_alive():
+            sim.thread.join(1)
+    except KeyboardInterrupt:
+        sim.stop()
+
+
+if __name__ == '__main__':
+    main()
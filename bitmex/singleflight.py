@@ -0,0 +1,127 @@
+"""Single-flight coalescing of identical concurrent reads.
+
+When several threads ask for the same GET (same path, query and body) while one is already in
+flight, they wait for that request and share its decoded result instead of each sending their own
+and spending their own rate-limit token. A failure is shared the same way, raised in every caller.
+
+With `ttl` a finished result also stays fresh for that many seconds, so reads arriving just after
+it are served without a request. Writes call `invalidate`, so a read issued after one of our own
+orders never joins a request that started before it, nor gets a result kept from before it. Shared
+results are the same objects for every caller; treat them as read-only.
+
+`AsyncSingleFlight` does the same for coroutines on one event loop. The shared request runs as a
+task of its own that every caller awaits through `asyncio.shield`, so a caller that is cancelled
+(e.g. by its timeout) leaves the request running for the others.
+"""
+from __future__ import absolute_import
+
+import asyncio
+import json
+import threading
+import time
+
+# Finished results kept beyond this many are pruned of the expired ones.
+MAX_KEPT = 256
+
+
+def request_key(verb, path, query=None, postdict=None, private=True):
+    return (verb, path, private,
+            json.dumps(query, sort_keys=True) if query else None,
+            json.dumps(postdict, sort_keys=True) if postdict else None)
+
+
+class _Call:
+    __slots__ = ('event', 'result', 'error', 'finished', 'task')
+
+    def __init__(self, event):
+        self.event = event
+        self.result = None
+        self.error = None
+        self.finished = None
+        self.task = None
+
+
+class SingleFlight:
+    """Run `fn` once per `key` among concurrent callers of `do`; `ttl` seconds of freshness after."""
+
+    def __init__(self, ttl=0.0):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.calls = {}
+        # Metrics
+        self.requests = 0
+        self.shared = 0
+
+    def _join(self, key, now):
+        """The call to wait for under `key`, or None when the caller has to make it. Holds `lock`."""
+        call = self.calls.get(key)
+        if call is not None and (call.finished is None or now - call.finished <= self.ttl):
+            return call
+        if len(self.calls) > MAX_KEPT:
+            for k in [k for k, c in self.calls.items() if c.finished is not None and now - c.finished > self.ttl]:
+                del self.calls[k]
+        return None
+
+    def _finish(self, key, call):
+        """Keep a successful result for `ttl`, otherwise forget the call. Holds `lock`."""
+        if self.ttl and call.error is None:
+            call.finished = time.monotonic()
+        elif self.calls.get(key) is call:
+            del self.calls[key]
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self._join(key, time.monotonic())
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call(threading.Event())
+                self.requests += 1
+            else:
+                self.shared += 1
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                self._finish(key, call)
+            call.event.set()
+        return call.result
+
+    def invalidate(self):
+        """Forget every call: fresh results are dropped, and requests in flight still complete for the
+        callers already waiting on them while later callers send their own."""
+        with self.lock:
+            self.calls.clear()
+
+
+class AsyncSingleFlight(SingleFlight):
+    """`SingleFlight` for coroutines: `await do(key, coroutine_function)`. Use from one event loop."""
+
+    async def do(self, key, fn):
+        call = self._join(key, time.monotonic())
+        if call is not None:
+            self.shared += 1
+        else:
+            call = self.calls[key] = _Call(None)
+            self.requests += 1
+            call.task = asyncio.ensure_future(self._run(key, call, fn))
+            # Retrieved here, so a failure nobody is left to await is not reported as lost.
+            call.task.add_done_callback(lambda task: task.cancelled() or task.exception())
+        return await asyncio.shield(call.task)
+
+    async def _run(self, key, call, fn):
+        try:
+            call.result = await fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            self._finish(key, call)
+        return call.result
@@ -0,0 +1,427 @@
+"""Tick recorder and replay engine for market data.
+
+`TickRecorder` listens on a `BitMEXWebsocket` and appends every book delta, trade and instrument
+change to one file of fixed-width records, and the rest of each trade row (trdMatchID,
+tickDirection, exchange timestamp, notionals) to a second one. `TickReplay` memory-maps that file and plays it back
+into a `ReplayWebsocket`. The replay websocket can stand in for the live one on a `TradeClient`,
+so order_book(), book(), recent_trades(), ticker() and instrument() answer from the recording.
+Replay runs at wall-clock speed (or a multiple of it), or as fast as possible.
+"""
+from __future__ import absolute_import
+
+import json
+import math
+import os
+import threading
+import time
+import uuid
+
+import numpy as np
+
+from bitmex import tracing
+from bitmex.orderbook import OrderBook
+from bitmex.ws import BitMEXWebsocket
+
+BOOK = 0
+TRADE = 1
+INSTRUMENT = 2
+TABLES = ('book', 'trade', 'instrument')
+
+ACTIONS = ('partial', 'insert', 'update', 'delete')
+ACTION_CODES = dict((action, code) for code, action in enumerate(ACTIONS))
+SIDES = {'Buy': 1, 'Sell': -1}
+SIDE_NAMES = {1: 'Buy', -1: 'Sell', 0: None}
+
+# Numeric instrument fields that are recorded, one record per field and change. `id` holds the
+# field's index here and `price` its value.
+INSTRUMENT_FIELDS = ('lastPrice', 'bidPrice', 'askPrice', 'markPrice', 'indexPrice', 'fairPrice', 'lowPrice',
+                     'highPrice', 'volume', 'volume24h', 'openInterest', 'fundingRate', 'tickSize', 'lotSize')
+
+# One record. `ts` is the receive time in ns and is shared by every record of one message; the
+# first record of a message has FIRST set in `action`. A record with size -1 marks a message
+# without rows (e.g. an empty partial). A trade's `id` is its 1-based row in trades.bin (0: none).
+FIRST = 0x80
+RECORD = np.dtype([
+    ('ts', '<i8'),
+    ('kind', 'u1'),
+    ('action', 'u1'),
+    ('side', 'i1'),
+    ('symbol', '<u2'),
+    ('id', '<i8'),
+    ('price', '<f8'),
+    ('size', '<i8'),
+])
+
+# The rest of a trade row, in trades.bin. `fields` has bit i set when TRADE_FIELDS[i] was in the row,
+# and bit 6 when foreignNotional was an int.
+TRADE_FIELDS = ('timestamp', 'tickDirection', 'trdMatchID', 'grossValue', 'homeNotional', 'foreignNotional')
+TICK_DIRECTIONS = (None, 'PlusTick', 'ZeroPlusTick', 'MinusTick', 'ZeroMinusTick')
+TICK_CODES = dict((name, code) for code, name in enumerate(TICK_DIRECTIONS) if name)
+TRADE_RECORD = np.dtype([
+    ('fields', 'u1'),
+    ('timestamp', '<i8'),  # exchange time, ms since the epoch
+    ('tickDirection', 'u1'),
+    ('trdMatchID', 'V16'),
+    ('grossValue', '<i8'),
+    ('homeNotional', '<f8'),
+    ('foreignNotional', '<f8'),
+])
+
+
+def trade_record(row):
+    """The trades.bin record of a live trade row."""
+    fields = 0
+    timestamp = tick = gross = home = foreign = 0
+    match = bytes(16)
+    if row.get('timestamp'):
+        timestamp = int(np.datetime64(row['timestamp'].rstrip('Z'), 'ms').astype(np.int64))
+        fields |= 1
+    if row.get('tickDirection') in TICK_CODES:
+        tick = TICK_CODES[row['tickDirection']]
+        fields |= 2
+    try:
+        match = uuid.UUID(row['trdMatchID']).bytes
+        fields |= 4
+    except (KeyError, TypeError, ValueError):
+        pass
+    for bit, name in ((8, 'grossValue'), (16, 'homeNotional'), (32, 'foreignNotional')):
+        if row.get(name) is not None:
+            fields |= bit
+    if fields & 8:
+        gross = row['grossValue']
+    if fields & 16:
+        home = row['homeNotional']
+    if fields & 32:
+        foreign = row['foreignNotional']
+        if isinstance(foreign, int):
+            fields |= 64
+    return fields, timestamp, tick, match, gross, home, foreign
+
+
+def trade_fields(record):
+    """The fields of a trade row kept in a trades.bin record."""
+    fields, timestamp, tick, match, gross, home, foreign = record.tolist()
+    row = {}
+    if fields & 1:
+        row['timestamp'] = str(np.datetime64(timestamp, 'ms')) + 'Z'
+    if fields & 2:
+        row['tickDirection'] = TICK_DIRECTIONS[tick]
+    if fields & 4:
+        row['trdMatchID'] = str(uuid.UUID(bytes=bytes(match)))
+    if fields & 8:
+        row['grossValue'] = gross
+    if fields & 16:
+        row['homeNotional'] = home
+    if fields & 32:
+        # Contracts of an inverse instrument: an int, as the feed sends it.
+        row['foreignNotional'] = int(foreign) if fields & 64 else foreign
+    return row
+
+
+class TickRecorder:
+    """Append-only writer. Records are buffered and written `batch` at a time; `flush` forces a write.
+
+    The files are `<path>/ticks.bin` and `<path>/trades.bin`. Symbols are numbered in the order they
+    first appear, and the numbering is kept in `<path>/symbols.json`.
+    """
+
+    def __init__(self, path, batch=4096):
+        self.path = path
+        self.batch = batch
+        self.lock = threading.RLock()
+        self.pending = []
+        self.pending_trades = []
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.symbols = load_symbols(path)
+        self.symbol_ids = dict((symbol, i) for i, symbol in enumerate(self.symbols))
+        ticks = os.path.join(path, 'ticks.bin')
+        trades = os.path.join(path, 'trades.bin')
+        # Drop a partially written trailing record left by a crash.
+        for name, dtype in ((ticks, RECORD), (trades, TRADE_RECORD)):
+            if os.path.exists(name):
+                size = os.path.getsize(name)
+                if size % dtype.itemsize:
+                    with open(name, 'r+b') as f:
+                        f.truncate(size - size % dtype.itemsize)
+        self.file = open(ticks, 'ab')
+        self.trades_file = open(trades, 'ab')
+        self.count = os.path.getsize(ticks) // RECORD.itemsize
+        self.trades = os.path.getsize(trades) // TRADE_RECORD.itemsize
+
+    def attach(self, ws):
+        """Record every book, trade and instrument message of a `BitMEXWebsocket`."""
+        ws.add_listener(ws.book_table, self.on_book)
+        ws.add_listener('trade', self.on_trade)
+        ws.add_listener('instrument', self.on_instrument)
+
+    def _symbol(self, symbol):
+        sid = self.symbol_ids.get(symbol)
+        if sid is None:
+            sid = self.symbol_ids[symbol] = len(self.symbols)
+            self.symbols.append(symbol)
+            with open(os.path.join(self.path, 'symbols.json'), 'w') as f:
+                json.dump(self.symbols, f)
+        return sid
+
+    def _add(self, records):
+        """Append one message's records; the first is flagged as the start of the message."""
+        first = records[0]
+        records[0] = first[:2] + (first[2] | FIRST,) + first[3:]
+        with self.lock:
+            self.pending.extend(records)
+            if len(self.pending) >= self.batch:
+                self._write()
+
+    def _write(self):
+        # Trades first: a crash between the two leaves a trade row unreferenced, never a dangling id.
+        if self.pending_trades:
+            self.trades_file.write(np.array(self.pending_trades, dtype=TRADE_RECORD).tobytes())
+            self.trades += len(self.pending_trades)
+            self.pending_trades = []
+        if self.pending:
+            self.file.write(np.array(self.pending, dtype=RECORD).tobytes())
+            self.count += len(self.pending)
+            self.pending = []
+
+    def on_book(self, action, data, ts=None):
+        ts = ts or time.time_ns()
+        code = ACTION_CODES[action]
+        if not data:
+            return self._add([(ts, BOOK, code, 0, 0, 0, math.nan, -1)])
+        symbol = self._symbol
+        self._add([(ts, BOOK, code, SIDES.get(row.get('side'), 0), symbol(row['symbol']), row['id'],
+                    row.get('price') or math.nan, row.get('size') or 0) for row in data])
+
+    def on_trade(self, action, data, ts=None):
+        ts = ts or time.time_ns()
+        code = ACTION_CODES[action]
+        if not data:
+            return self._add([(ts, TRADE, code, 0, 0, 0, math.nan, -1)])
+        symbol = self._symbol
+        extras = [trade_record(row) for row in data]
+        with self.lock:
+            # Numbered under the lock, so the ids follow the order the trade rows are written in.
+            base = self.trades + len(self.pending_trades)
+            self.pending_trades.extend(extras)
+            self._add([(ts, TRADE, code, SIDES.get(row.get('side'), 0), symbol(row['symbol']), base + i,
+                        row['price'], row['size']) for i, row in enumerate(data, 1)])
+
+    def on_instrument(self, action, data, ts=None):
+        ts = ts or time.time_ns()
+        code = ACTION_CODES[action]
+        records = []
+        for row in data:
+            sid = self._symbol(row['symbol'])
+            fields = [(i, row[name]) for i, name in enumerate(INSTRUMENT_FIELDS) if name in row]
+            # A row with none of the recorded fields still has to create/delete the instrument.
+            for i, value in fields or [(-1, None)]:
+                records.append((ts, INSTRUMENT, code, 0, sid, i, math.nan if value is None else value, 0))
+        self._add(records or [(ts, INSTRUMENT, code, 0, 0, 0, math.nan, -1)])
+
+    def flush(self):
+        with self.lock:
+            self._write()
+            self.trades_file.flush()
+            self.file.flush()
+
+    def close(self):
+        self.flush()
+        self.trades_file.close()
+        self.file.close()
+
+    def __len__(self):
+        return self.count + len(self.pending)
+
+
+def load_symbols(path):
+    try:
+        with open(os.path.join(path, 'symbols.json')) as f:
+            return json.load(f)
+    except (IOError, OSError):
+        return []
+
+
+class TickReplay:
+    """Read-only view of a recording; `records` is a memmap of RECORD rows and `trades` one of
+    TRADE_RECORD rows."""
+
+    def __init__(self, path):
+        self.path = path
+        self.symbols = load_symbols(path)
+        self.records = self._map(os.path.join(path, 'ticks.bin'), RECORD)
+        self.trades = self._map(os.path.join(path, 'trades.bin'), TRADE_RECORD)
+
+    @staticmethod
+    def _map(name, dtype):
+        n = os.path.getsize(name) // dtype.itemsize if os.path.exists(name) else 0
+        if n:
+            return np.memmap(name, dtype=dtype, mode='r', shape=(n,))
+        return np.empty(0, dtype=dtype)
+
+    def __len__(self):
+        return len(self.records)
+
+    def trade(self, ref):
+        """The trade row fields kept for a trade record's `id`; {} when there are none."""
+        if 0 < ref <= len(self.trades):
+            return trade_fields(self.trades[ref - 1])
+        return {}
+
+    def messages(self, start=0, stop=None, chunk=1 << 16):
+        """Yield (ts, kind, action, symbol, rows) per recorded message, where rows is a list of
+        (side, id, price, size) tuples. A message covering several symbols comes back as one
+        message per symbol."""
+        records = self.records[start:stop]
+        symbols = self.symbols
+        current = None
+        rows = []
+        for offset in range(0, len(records), chunk):
+            block = records[offset:offset + chunk]
+            columns = [block[name].tolist() for name in RECORD.names]
+            for ts, kind, action, side, sid, level_id, price, size in zip(*columns):
+                first = action & FIRST
+                action &= ~FIRST
+                key = (ts, kind, action, sid)
+                # Recordings made before FIRST was written only split where the key changes.
+                if first or key != current:
+                    if current is not None:
+                        yield current[0], current[1], current[2], symbols[current[3]] if rows else None, rows
+                    current = key
+                    rows = []
+                if size != -1:
+                    rows.append((side, level_id, price, size))
+        if current is not None:
+            yield current[0], current[1], current[2], symbols[current[3]] if rows else None, rows
+
+    def play(self, ws, speed=None, start=0, stop=None):
+        """Apply the recording to `ws`. `speed` None replays as fast as possible, 1.0 at recorded
+        wall-clock pace, 10.0 ten times faster. Returns the number of messages applied."""
+        first_ts = None
+        began = time.time()
+        count = 0
+        for ts, kind, action, symbol, rows in self.messages(start, stop):
+            if speed:
+                if first_ts is None:
+                    first_ts = ts
+                delay = (ts - first_ts) / 1e9 / speed - (time.time() - began)
+                if delay > 0:
+                    time.sleep(delay)
+            ws.apply_recorded(kind, ACTIONS[action], symbol, rows, ts)
+            count += 1
+            if ws.exited:
+                break
+        return count
+
+
+class ReplayWebsocket(BitMEXWebsocket):
+    """A `BitMEXWebsocket` fed from a `TickReplay` instead of the network.
+
+    Book messages are applied straight to the array books without building row dicts, unless
+    something is listening on the book table. With a tracer each replayed message starts a trace,
+    as a live frame would.
+    """
+
+    def __init__(self, replay, depth=25, max_trades=100, tracer=None):
+        BitMEXWebsocket.__init__(self, depth=depth, max_trades=max_trades, tracer=tracer)
+        self.replay = replay
+        self.symbols = list(replay.symbols)
+        self.thread = None
+
+    def connect(self, endpoint=None, symbol=None, shouldAuth=False, timeout=10, apiKey=None, apiSecret=None,
+                speed=None):
+        """Start playing in the background and wait, like the live connect, for the partials."""
+        self.exited = False
+        self.error = None
+        self._reset()
+        if symbol is not None:
+            self.symbols = [symbol] if isinstance(symbol, str) else list(symbol)
+        self.start(speed)
+        self.wait_for_partials(timeout)
+
+    def start(self, speed=None):
+        def run():
+            try:
+                self.replay.play(self, speed)
+            finally:
+                self.exited = True
+        self.thread = threading.Thread(target=run, name='ReplayWebsocket')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def wait_for_partials(self, timeout=10):
+        deadline = time.time() + timeout
+        expected = set((table, symbol) for symbol in self.symbols
+                       for table in (self.book_table, 'trade', 'instrument'))
+        while not expected <= self.partials:
+            if self.exited:
+                # A recording need not contain every table; what it has is applied by now.
+                return
+            if time.time() > deadline:
+                raise Exception("Timed out waiting for partials in %s" % self.replay.path)
+            time.sleep(0.001)
+
+    def exit(self):
+        self.exited = True
+
+    def is_connected(self):
+        return not self.exited
+
+    def apply_recorded(self, kind, action, symbol, rows, ts):
+        if not self.tracer.enabled:
+            return self._apply_recorded(kind, action, symbol, rows, ts)
+        self.trace = self.tracer.begin()
+        try:
+            self._apply_recorded(kind, action, symbol, rows, ts)
+        finally:
+            self.trace = None
+
+    def _apply_recorded(self, kind, action, symbol, rows, ts):
+        with self.lock:
+            if not rows:
+                table = self.book_table if kind == BOOK else TABLES[kind]
+                self.apply({'table': table, 'action': action, 'data': []})
+            elif kind == BOOK:
+                if self.listeners.get(self.book_table):
+                    data = [{'symbol': symbol, 'id': level_id, 'side': SIDE_NAMES[side],
+                             'price': None if price != price else price, 'size': size}
+                            for side, level_id, price, size in rows]
+                    self.apply({'table': self.book_table, 'action': action, 'data': data})
+                else:
+                    self._apply_book_rows(action, symbol, rows)
+                    if self.trace is not None:
+                        self.trace.stamp(tracing.BOOK)
+            elif kind == TRADE:
+                received = str(np.datetime64(ts // 1000000, 'ms')) + 'Z'
+                trade = self.replay.trade
+                data = []
+                for side, ref, price, size in rows:
+                    row = {'timestamp': received, 'symbol': symbol, 'side': SIDE_NAMES[side], 'size': size,
+                           'price': price}
+                    row.update(trade(ref))
+                    data.append(row)
+                self.apply({'table': 'trade', 'action': action, 'data': data})
+            else:
+                row = {'symbol': symbol}
+                for _, field, value, _ in rows:
+                    if field >= 0:
+                        row[INSTRUMENT_FIELDS[field]] = None if value != value else value
+                self.apply({'table': 'instrument', 'action': action, 'data': [row]})
+
+    def _apply_book_rows(self, action, symbol, rows):
+        if action == 'partial':
+            self.books[symbol] = OrderBook(symbol)
+            self.partials.add((self.book_table, symbol))
+            action = 'insert'
+        book = self.books.get(symbol)
+        if book is None:
+            book = self.books[symbol] = OrderBook(symbol)
+        if action == 'insert':
+            for side, level_id, price, size in rows:
+                book.insert(level_id, SIDE_NAMES[side], price, size)
+        elif action == 'update':
+            for side, level_id, price, size in rows:
+                book.update(level_id, SIDE_NAMES[side], size, None if price != price else price)
+        elif action == 'delete':
+            for side, level_id, _, _ in rows:
+                book.delete(level_id, SIDE_NAMES[side])
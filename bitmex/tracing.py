@@ -0,0 +1,190 @@
+"""Tick-to-order latency tracing.
+
+A trace follows one market data message through to the order it caused. It is stamped with a
+monotonic nanosecond clock at each stage:
+
+    received  frame read off the websocket (or replayed)
+    book      tables / order book updated
+    strategy  listeners (the strategy) invoked
+    built     order handed to ExchangeInterface.create
+    signed    request signed, once it holds a rate-limit token
+    sent      request handed to the connection
+    acked     response received
+
+Each stamp goes into a fixed-size ring buffer on the `Tracer`, and into the `Trace` itself. The
+Trace rides along on the websocket (`ws.trace` while listeners run), on the `Order`, and through
+the client's request path. Stamping takes no lock. It writes three preallocated arrays at a slot
+from `itertools.count`, so a busy tracer overwrites its oldest stamps and never grows.
+
+    tracer = Tracer()
+    client.connect_websocket(tracer=tracer)
+    ...                                    # in a listener: Order(..., trace=client.ws.trace)
+    tracer.dump('trace.npy')
+    python -m bitmex.tracing trace.npy     # per-stage latency summary
+"""
+from __future__ import absolute_import, print_function
+
+import itertools
+import sys
+import time
+from array import array
+
+STAGES = ('received', 'book', 'strategy', 'built', 'signed', 'sent', 'acked')
+RECEIVED, BOOK, STRATEGY, BUILT, SIGNED, SENT, ACKED = range(len(STAGES))
+
+# One dumped stamp, as a numpy dtype spec. numpy is only imported to dump and analyse traces.
+RECORD = [('trace', '<i8'), ('stage', 'i1'), ('ts', '<i8')]
+
+
+class Trace(object):
+    """The stamps of one trace, indexed by stage (0 = not reached)."""
+    __slots__ = ('id', 'stamps', 'tracer')
+
+    def __init__(self, tracer, id):
+        self.tracer = tracer
+        self.id = id
+        self.stamps = [0] * len(STAGES)
+
+    def stamp(self, stage, ts=None):
+        if ts is None:
+            ts = time.perf_counter_ns()
+        self.stamps[stage] = ts
+        self.tracer.record(self.id, stage, ts)
+        return ts
+
+    def elapsed(self, start=RECEIVED, end=ACKED):
+        """Nanoseconds from `start` to `end`, None unless both were stamped."""
+        if self.stamps[start] and self.stamps[end]:
+            return self.stamps[end] - self.stamps[start]
+        return None
+
+    def __repr__(self):
+        first = next((ts for ts in self.stamps if ts), 0)
+        return 'Trace(%d, %s)' % (self.id, ', '.join('%s=+%dus' % (STAGES[i], (ts - first) // 1000)
+                                                     for i, ts in enumerate(self.stamps) if ts))
+
+
+def stamp(trace, stage):
+    """Stamp `stage` on a Trace, on each of a list of them (a bulk request), or on nothing (None)."""
+    if trace is None:
+        return
+    ts = time.perf_counter_ns()
+    if isinstance(trace, list):
+        for t in trace:
+            t.stamp(stage, ts)
+    else:
+        trace.stamp(stage, ts)
+
+
+class Tracer:
+    """Ring buffer of the last `size` stamps (a power of two) of all traces."""
+    enabled = True
+
+    def __init__(self, size=1 << 16):
+        if size & (size - 1):
+            raise ValueError("Tracer size must be a power of two, not %d" % size)
+        self.mask = size - 1
+        self.ids = itertools.count(1)
+        self.slots = itertools.count()
+        self.traces = array('q', bytes(8 * size))
+        self.stages = array('b', [-1]) * size
+        self.times = array('q', bytes(8 * size))
+
+    def begin(self, stage=RECEIVED):
+        """Start a trace, stamping its first stage."""
+        trace = Trace(self, next(self.ids))
+        trace.stamp(stage)
+        return trace
+
+    def record(self, trace_id, stage, ts):
+        slot = next(self.slots) & self.mask
+        # Stage last: a slot being overwritten reads as its old stage only until its new one lands.
+        self.traces[slot] = trace_id
+        self.times[slot] = ts
+        self.stages[slot] = stage
+
+    def records(self):
+        """A copy of the buffered stamps as RECORD rows, in time order."""
+        import numpy as np
+        stages = np.frombuffer(self.stages, dtype='i1')
+        used = stages >= 0
+        records = np.empty(int(used.sum()), dtype=RECORD)
+        records['trace'] = np.frombuffer(self.traces, dtype='<i8')[used]
+        records['stage'] = stages[used]
+        records['ts'] = np.frombuffer(self.times, dtype='<i8')[used]
+        return records[np.argsort(records['ts'], kind='stable')]
+
+    def dump(self, path):
+        import numpy as np
+        np.save(path, self.records())
+
+    def summary(self):
+        return summary(self.records())
+
+
+class NullTracer:
+    """Tracer that traces nothing."""
+    enabled = False
+
+    def begin(self, stage=RECEIVED):
+        return None
+
+    def record(self, trace_id, stage, ts):
+        pass
+
+
+NULL_TRACER = NullTracer()
+
+
+def load(path):
+    import numpy as np
+    return np.load(path)
+
+
+def spans(records, start=RECEIVED, end=ACKED):
+    """Nanoseconds from the first `start` to the last `end` stamp of every trace that has both."""
+    import numpy as np
+    first = records[records['stage'] == start]
+    first = first[np.argsort(first['ts'], kind='stable')]
+    last = records[records['stage'] == end]
+    last = last[np.argsort(-last['ts'], kind='stable')]
+    first_ids, first_index = np.unique(first['trace'], return_index=True)
+    last_ids, last_index = np.unique(last['trace'], return_index=True)
+    _, a, b = np.intersect1d(first_ids, last_ids, assume_unique=True, return_indices=True)
+    return last['ts'][last_index[b]] - first['ts'][first_index[a]]
+
+
+def summary(records):
+    """{'<from>-><to>': {'count', 'p50', 'p90', 'p99', 'max'}} in microseconds, for each pair of
+    consecutive stages seen and for the whole trace (received->acked)."""
+    import numpy as np
+    present = sorted(set(records['stage'].tolist()))
+    pairs = list(zip(present, present[1:]))
+    if RECEIVED in present and ACKED in present:
+        pairs.append((RECEIVED, ACKED))
+    result = {}
+    for start, end in pairs:
+        elapsed = spans(records, start, end) / 1e3
+        if len(elapsed):
+            p50, p90, p99 = np.percentile(elapsed, [50, 90, 99])
+            result['%s->%s' % (STAGES[start], STAGES[end])] = {
+                'count': len(elapsed), 'p50': p50, 'p90': p90, 'p99': p99, 'max': elapsed.max()}
+    return result
+
+
+def main(argv=None):
+    import numpy as np
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 1:
+        print("usage: python -m bitmex.tracing <trace.npy>")
+        return 2
+    records = load(argv[0])
+    print("%d stamps, %d traces" % (len(records), len(np.unique(records['trace']))))
+    for span, s in summary(records).items():
+        print("%-20s %8d  p50 %10.1f us  p90 %10.1f us  p99 %10.1f us  max %10.1f us" % (
+            span, s['count'], s['p50'], s['p90'], s['p99'], s['max']))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
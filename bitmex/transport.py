@@ -0,0 +1,202 @@
+"""REST transport: pooled requests session with warmup, keep-alive and per-request timings.
+
+Every response sent through a `Transport` carries a `timing` attribute (a `RequestTiming`) splitting
+the request into TCP connect, TLS handshake, time to first byte and total. Connect and TLS are
+zero when the request reused a pooled connection.
+"""
+from __future__ import absolute_import
+
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+# requests vendors urllib3 in older releases; requests.packages resolves to the right one either way.
+from requests.packages.urllib3.connection import HTTPConnection, HTTPSConnection
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+_local = threading.local()
+
+
+class RequestTiming:
+    __slots__ = ('connect', 'tls', 'ttfb', 'total')
+
+    def __init__(self, connect=0.0, tls=0.0, ttfb=0.0, total=0.0):
+        self.connect = connect
+        self.tls = tls
+        self.ttfb = ttfb
+        self.total = total
+
+    def __repr__(self):
+        return 'RequestTiming(connect=%.6f, tls=%.6f, ttfb=%.6f, total=%.6f)' % (
+            self.connect, self.tls, self.ttfb, self.total)
+
+
+class _TimedConnectionMixin(object):
+    """Records TCP connect time and the TLS handshake that follows it in thread-local state."""
+
+    def _new_conn(self):
+        start = time.perf_counter()
+        conn = super(_TimedConnectionMixin, self)._new_conn()
+        _local.tcp = time.perf_counter() - start
+        return conn
+
+    def connect(self):
+        _local.tcp = 0.0
+        start = time.perf_counter()
+        super(_TimedConnectionMixin, self).connect()
+        total = time.perf_counter() - start
+        _local.connect = _local.tcp or total
+        _local.tls = max(0.0, total - _local.connect)
+
+
+class TimedHTTPConnection(_TimedConnectionMixin, HTTPConnection):
+    pass
+
+
+class TimedHTTPSConnection(_TimedConnectionMixin, HTTPSConnection):
+    pass
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter whose connections record connect/TLS time, and which stamps TTFB and total
+    time on every response."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': TimedHTTPConnectionPool,
+            'https': TimedHTTPSConnectionPool,
+        }
+
+    def send(self, request, stream=False, **kwargs):
+        _local.connect = _local.tls = 0.0
+        start = time.perf_counter()
+        response = HTTPAdapter.send(self, request, stream=stream, **kwargs)
+        ttfb = time.perf_counter() - start
+        if not stream:
+            response.content
+        response.timing = RequestTiming(_local.connect, _local.tls, ttfb, time.perf_counter() - start)
+        return response
+
+
+class HTTP2Adapter(BaseAdapter):
+    """Send requests over one multiplexed HTTP/2 connection per host using httpx (optional
+    dependency: pip install httpx[http2]). Responses are converted back to requests.Response so
+    the rest of the client is unchanged."""
+
+    def __init__(self, verify=True, max_connections=10):
+        super(HTTP2Adapter, self).__init__()
+        import httpx
+        self.httpx = httpx
+        self.client = httpx.Client(http2=True, verify=verify,
+                                   limits=httpx.Limits(max_connections=max_connections))
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        httpx = self.httpx
+        start = time.perf_counter()
+        try:
+            r = self.client.request(request.method, request.url, headers=dict(request.headers),
+                                    content=request.body, timeout=timeout)
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.Timeout(e, request=request)
+        except httpx.TransportError as e:
+            raise requests.exceptions.ConnectionError(e, request=request)
+        response = requests.Response()
+        response.status_code = r.status_code
+        response.headers = CaseInsensitiveDict(r.headers)
+        response.reason = r.reason_phrase
+        response.url = request.url
+        response.request = request
+        response.encoding = r.encoding
+        response._content = r.content
+        response.connection = self
+        total = time.perf_counter() - start
+        response.timing = RequestTiming(0.0, 0.0, r.elapsed.total_seconds(), total)
+        return response
+
+    def close(self):
+        self.client.close()
+
+
+class Transport:
+    """Owns the requests session used by `Client` and makes it tunable and observable.
+
+    pool_maxsize: connections kept per host.
+    keepalive: seconds between keep-alive pings on idle pooled connections (None disables).
+    http2: use `HTTP2Adapter` instead of the pooled HTTP/1.1 adapter.
+    """
+
+    def __init__(self, pool_connections=4, pool_maxsize=16, keepalive=None, http2=False, verify=True,
+                 history=1000):
+        self.session = requests.Session()
+        self.session.verify = verify
+        self.pool_maxsize = pool_maxsize
+        if http2:
+            self.adapter = HTTP2Adapter(verify=verify, max_connections=pool_maxsize)
+        else:
+            self.adapter = TimedHTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+                                            max_retries=0)
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+        self.keepalive = keepalive
+        self.keepalive_url = None
+        self.keepalive_connections = 1
+        self.timings = deque(maxlen=history)
+        self.session.hooks['response'].append(self._record)
+        self._stop = threading.Event()
+        self._keepalive_thread = None
+
+    def _record(self, response, *args, **kwargs):
+        timing = getattr(response, 'timing', None)
+        if timing is not None:
+            self.timings.append(timing)
+
+    def ping(self, url, timeout=5):
+        """Cheap request that keeps (or opens) a pooled connection; errors are ignored."""
+        try:
+            return self.session.get(url, timeout=timeout, verify=self.session.verify)
+        except requests.exceptions.RequestException:
+            return None
+
+    def preconnect(self, url, connections=None):
+        """Open `connections` pooled connections to the host of `url` in parallel, so the first real
+        request does not pay TCP+TLS setup. Returns the timings of the warmup requests."""
+        connections = connections or 1
+        with ThreadPoolExecutor(max_workers=connections) as pool:
+            responses = list(pool.map(lambda _: self.ping(url), range(connections)))
+        return [getattr(r, 'timing', None) for r in responses if r is not None]
+
+    def start_keepalive(self, url, interval=None, connections=1):
+        """Ping `url` on `connections` pooled connections every `interval` seconds from a daemon thread
+        so idle connections stay hot. Pings are unauthenticated and count against the IP limit."""
+        self.keepalive = interval or self.keepalive or 30
+        self.keepalive_url = url
+        self.keepalive_connections = connections
+        if self._keepalive_thread is None or not self._keepalive_thread.is_alive():
+            self._stop.clear()
+            self._keepalive_thread = threading.Thread(target=self._keepalive_loop, name='Transport-keepalive')
+            self._keepalive_thread.daemon = True
+            self._keepalive_thread.start()
+
+    def _keepalive_loop(self):
+        while not self._stop.wait(self.keepalive):
+            self.preconnect(self.keepalive_url, self.keepalive_connections)
+
+    def close(self):
+        self._stop.set()
+        self.session.close()
+
+    def last_timing(self):
+        return self.timings[-1] if self.timings else None
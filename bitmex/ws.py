@@ -0,0 +1,349 @@
+"""BitMEX WebSocket Connector.
+
+Keeps a local copy of the market data tables (L2 order book, trades, instrument) in sync with the
+realtime feed so that reads are served from memory instead of a REST round-trip. Books are kept
+in array-backed `OrderBook`s.
+"""
+from __future__ import absolute_import
+
+import threading
+import time
+from collections import deque
+
+import websocket
+
+from bitmex import codec
+from bitmex.auth import Signer
+from bitmex.orderbook import OrderBook
+from bitmex.tracing import BOOK, NULL_TRACER, STRATEGY
+
+# python  3+ and 2+
+try:
+    from urllib.parse import urlparse, urlunparse
+except ImportError:
+    from urlparse import urlparse, urlunparse
+
+# Number of trades kept in memory per symbol, roughly what a default GET /trade returns.
+MAX_TRADES = 100
+BOOK_TABLES = ('orderBookL2_25', 'orderBookL2')
+# Account tables, subscribed for all symbols when the connection is authenticated.
+PRIVATE_TABLES = ('order', 'execution', 'position', 'margin')
+
+
+def realtime_url(base_url):
+    """Turn a REST base url (https://www.bitmex.com/api/v1/) into the realtime endpoint."""
+    parsed = urlparse(base_url)
+    scheme = 'ws' if parsed.scheme == 'http' else 'wss'
+    return urlunparse((scheme, parsed.netloc, '/realtime', '', '', ''))
+
+
+class BitMEXWebsocket:
+    """Streaming market data client.
+
+    Subscribes to orderBookL2(_25), trade and instrument for one or more symbols and applies
+    partial/insert/update/delete messages to in-memory tables. Book levels are addressed by level id.
+    With shouldAuth the private order, execution, position and margin tables are subscribed too; they
+    are not stored here but handed to the listeners registered with `add_listener`.
+
+    With a `bitmex.tracing.Tracer` every frame starts a trace, stamped on receipt, once applied and
+    before the listeners run; listeners find it in `trace`.
+
+    When the connection drops the tables stop counting as live (`has_book` and friends turn False,
+    so the client falls back to REST) and, with `reconnect`, it is opened again after
+    `reconnect_delay` seconds, doubling up to `max_reconnect_delay`. The new partials make the
+    tables live again. The disconnect listeners hear of each drop once. The `live_*` reads check
+    that a table is live and read it under one hold of `lock`, so a drop cannot come in between.
+    """
+
+    def __init__(self, depth=25, max_trades=MAX_TRADES, tracer=None, reconnect=True, reconnect_delay=0.5,
+                 max_reconnect_delay=30.0):
+        self.depth = depth
+        self.book_table = 'orderBookL2_25' if depth == 25 else 'orderBookL2'
+        self.max_trades = max_trades
+        self.lock = threading.RLock()
+        self.ws = None
+        self.wst = None
+        self.url = None
+        self.symbols = []
+        self.exited = False
+        self.error = None
+        self.opened = False
+        self.dropped = False  # the current connection's drop has been reported
+        self.shouldAuth = False
+        self.apiKey = None
+        self.apiSecret = None
+        self.reconnect = reconnect
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.reconnects = 0
+        self.listeners = {}
+        self.disconnect_listeners = []
+        self.tracer = tracer or NULL_TRACER
+        self.trace = None
+        self._reset()
+
+    def add_listener(self, table, callback):
+        """Call `callback(action, data)` for every message of `table`, after it has been applied."""
+        self.listeners.setdefault(table, []).append(callback)
+
+    def add_disconnect_listener(self, callback):
+        """Call `callback()` whenever the connection drops, e.g. to stop trusting state kept from the
+        private streams until their next partial."""
+        self.disconnect_listeners.append(callback)
+
+    def _reset(self):
+        self.books = {}
+        self.trades = {}
+        self.instruments = {}
+        self.partials = set()
+
+    def connect(self, endpoint, symbol, shouldAuth=False, timeout=10, apiKey=None, apiSecret=None):
+        """Connect to the websocket and wait until the initial partials have arrived.
+
+        `endpoint` is the REST base url, the realtime url is derived from it so a local stub server
+        at http://127.0.0.1:<port>/api/v1/ is reached at ws://127.0.0.1:<port>/realtime.
+        """
+        if shouldAuth and not (apiKey and apiSecret):
+            raise Exception("An API key and secret are needed for an authenticated websocket.")
+        self.shouldAuth = shouldAuth
+        self.apiKey = apiKey
+        self.apiSecret = apiSecret
+        self.symbols = [symbol] if isinstance(symbol, str) else list(symbol)
+        self.url = realtime_url(endpoint) + '?subscribe=' + ','.join(self.subscriptions())
+        self.exited = False
+        self.error = None
+        self._reset()
+        self.wst = threading.Thread(target=self._run, name='BitMEXWebsocket')
+        self.wst.daemon = True
+        self.wst.start()
+        try:
+            self.wait_for_partials(timeout)
+        except Exception:
+            self.exit()
+            raise
+
+    def _open(self):
+        self.dropped = False
+        header = []
+        if self.shouldAuth:
+            # Same scheme as REST: sign GET/realtime with an expiry, afresh for every connection.
+            expires = int(round(time.time()) + 5)
+            header = ['api-expires: %d' % expires, 'api-key: %s' % self.apiKey,
+                      'api-signature: %s' % Signer.for_secret(self.apiSecret).sign('GET', '/realtime', expires)]
+        self.ws = websocket.WebSocketApp(self.url, header=header,
+                                         on_open=lambda ws: self._on_open(),
+                                         on_message=lambda ws, message: self.on_message(message),
+                                         on_error=lambda ws, error: self._on_error(error),
+                                         on_close=lambda ws, *args: self._on_close())
+        return self.ws
+
+    def _run(self):
+        delay = self.reconnect_delay
+        while True:
+            opened = time.time()
+            self._open().run_forever()
+            self._on_close()
+            # A failed first connect is the caller's to see: `connect` gives up and exits.
+            if self.exited or not self.reconnect:
+                self.exited = True
+                return
+            if time.time() - opened > self.max_reconnect_delay:
+                delay = self.reconnect_delay
+            time.sleep(delay)
+            delay = min(delay * 2, self.max_reconnect_delay)
+            if self.exited:
+                return
+            self.reconnects += 1
+            self.error = None
+
+    def subscriptions(self):
+        topics = []
+        for symbol in self.symbols:
+            topics += [self.book_table + ':' + symbol, 'trade:' + symbol, 'instrument:' + symbol]
+        if self.shouldAuth:
+            topics += list(PRIVATE_TABLES)
+        return topics
+
+    def wait_for_partials(self, timeout=10):
+        expected = set((table, symbol) for symbol in self.symbols
+                       for table in (self.book_table, 'trade', 'instrument'))
+        if self.shouldAuth:
+            expected |= set((table, None) for table in PRIVATE_TABLES)
+        deadline = time.time() + timeout
+        while not expected <= self.partials:
+            if self.exited or self.error:
+                raise Exception("Websocket closed before receiving partials: %s" % self.error)
+            if time.time() > deadline:
+                raise Exception("Timed out waiting for websocket partials on %s" % self.url)
+            time.sleep(0.01)
+
+    def exit(self):
+        self.exited = True
+        # Nothing is live from here on, whenever the close handshake completes.
+        self._on_close()
+        if self.ws:
+            self.ws.close()
+
+    def is_connected(self):
+        return self.ws is not None and self.opened and not self.exited and self.error is None
+
+    #
+    # Message handling
+    #
+    def on_message(self, message):
+        """Apply one raw frame. Safe to call directly, e.g. when replaying recorded frames."""
+        if not self.tracer.enabled:
+            return self.apply(codec.loads(message))
+        self.trace = self.tracer.begin()
+        try:
+            self.apply(codec.loads(message))
+        finally:
+            self.trace = None
+
+    def apply(self, message):
+        """Apply one decoded message."""
+        table = message.get('table')
+        action = message.get('action')
+        if not table or not action:
+            if 'error' in message:
+                self.error = message['error']
+            return
+        with self.lock:
+            if table in BOOK_TABLES:
+                self._apply_book(action, message['data'])
+            elif table == 'trade':
+                self._apply_trades(action, message['data'])
+            elif table == 'instrument':
+                self._apply_instrument(action, message['data'])
+            elif table in PRIVATE_TABLES and action == 'partial':
+                self.partials.add((table, None))
+            self._notify(table, action, message['data'])
+
+    def _notify(self, table, action, data):
+        trace = self.trace
+        callbacks = self.listeners.get(table, ())
+        if trace is not None:
+            trace.stamp(BOOK)
+            if callbacks:
+                trace.stamp(STRATEGY)
+        for callback in callbacks:
+            callback(action, data)
+
+    def _mark_partial(self, table, data, symbols=None):
+        for symbol in symbols or set(row['symbol'] for row in data) or self.symbols:
+            self.partials.add((table, symbol))
+
+    def _apply_book(self, action, data):
+        if action == 'partial':
+            # A partial replaces the book for every symbol it covers, even an empty one.
+            symbols = set(row['symbol'] for row in data) or set(self.symbols)
+            for symbol in symbols:
+                self.books[symbol] = OrderBook(symbol)
+            self._mark_partial(self.book_table, data, symbols)
+        rows_by_symbol = {}
+        for row in data:
+            rows_by_symbol.setdefault(row['symbol'], []).append(row)
+        for symbol, rows in rows_by_symbol.items():
+            book = self.books.get(symbol)
+            if book is None:
+                book = self.books[symbol] = OrderBook(symbol)
+            book.apply(action, rows)
+
+    def _apply_trades(self, action, data):
+        if action == 'partial':
+            # As for the book: an empty partial still clears the trades of every subscribed symbol.
+            symbols = set(row['symbol'] for row in data) or set(self.symbols)
+            for symbol in symbols:
+                self.trades[symbol] = deque(maxlen=self.max_trades)
+            self._mark_partial('trade', data, symbols)
+        if action in ('partial', 'insert'):
+            for row in data:
+                trades = self.trades.get(row['symbol'])
+                if trades is None:
+                    trades = self.trades[row['symbol']] = deque(maxlen=self.max_trades)
+                trades.append(row)
+
+    def _apply_instrument(self, action, data):
+        if action == 'partial':
+            self._mark_partial('instrument', data)
+        for row in data:
+            if action in ('partial', 'insert'):
+                self.instruments[row['symbol']] = dict(row)
+            elif action == 'update':
+                self.instruments.setdefault(row['symbol'], {}).update(row)
+            elif action == 'delete':
+                self.instruments.pop(row['symbol'], None)
+
+    def _on_error(self, error):
+        if not self.exited:
+            self.error = error
+
+    def _on_open(self):
+        self.opened = True
+
+    def _on_close(self):
+        """The connection is gone: nothing read from the tables is live until the next partials. Called
+        by the websocket, after `run_forever` returns and by `exit`; only the first call of a
+        connection tells the disconnect listeners."""
+        self.opened = False
+        with self.lock:
+            self.partials.clear()
+            if self.dropped:
+                return
+            self.dropped = True
+        for callback in self.disconnect_listeners:
+            callback()
+
+    #
+    # Local reads
+    #
+    def has_book(self, symbol, depth=25):
+        return ((self.book_table, symbol) in self.partials and
+                (self.depth is None or depth is None or 0 < depth <= self.depth))
+
+    def has_trades(self, symbol):
+        return ('trade', symbol) in self.partials
+
+    def has_instrument(self, symbol):
+        return ('instrument', symbol) in self.partials and symbol in self.instruments
+
+    def book(self, symbol):
+        """The live `OrderBook`; it keeps changing under the caller, take `lock` for consistent reads."""
+        return self.books.get(symbol)
+
+    def order_book(self, symbol, depth=25):
+        """Same layout as GET orderBook/L2: sells by descending price, then buys by descending price."""
+        with self.lock:
+            book = self.books.get(symbol)
+            return book.to_list(depth) if book is not None else []
+
+    def instrument(self, symbol):
+        with self.lock:
+            return dict(self.instruments[symbol])
+
+    def recent_trades(self, symbol):
+        with self.lock:
+            return list(self.trades.get(symbol, ()))
+
+    def live_order_book(self, symbol, depth=25):
+        """`order_book` while the book is live (`has_book`), otherwise None."""
+        with self.lock:
+            if not self.has_book(symbol, depth):
+                return None
+            return self.order_book(symbol, depth)
+
+    def live_book(self, symbol, depth=25):
+        """`book` while it is live, otherwise None. Only the check is atomic: the book returned stops
+        changing if the connection drops later."""
+        with self.lock:
+            return self.books.get(symbol) if self.has_book(symbol, depth) else None
+
+    def live_trades(self, symbol):
+        """`recent_trades` while the trade table is live, otherwise None."""
+        with self.lock:
+            return self.recent_trades(symbol) if self.has_trades(symbol) else None
+
+    def live_instrument(self, symbol):
+        """`instrument` while the instrument table is live, otherwise None."""
+        with self.lock:
+            return self.instrument(symbol) if self.has_instrument(symbol) else None
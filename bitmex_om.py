@@ -1,9 +1,12 @@
 import sys
 
 import datetime
+from concurrent.futures import ThreadPoolExecutor
 
-from bitmex import bitmex
-from time import sleep
+from bitmex.batcher import OrderBatcher
+from bitmex.order import OrderState, decode_ack
+from bitmex.tracing import BUILT, NULL_TRACER
+from time import perf_counter
 
 '''
 Error_code:
@@ -30,8 +33,23 @@ def todayStr():
     return datetime.datetime.today().strftime("%Y-%m-%d")
 
 
+def _timed(fn):
+    started = perf_counter()
+    fn()
+    return perf_counter() - started
+
+
 class Order(object):
-    def __init__(self, exchCode, sym_, _sym, orderType, side, qty, price='', stopPrice=''):
+    """An order we manage. Slotted to keep tens of thousands of them cheap, and carrying only the
+    ack fields we act on (see applyAck).
+
+    `trace` is the `bitmex.tracing.Trace` of the market data message that caused the order (pass
+    `ws.trace` from a listener); create() stamps it from built through acked."""
+    __slots__ = ('odid', 'status', 'tempOdid', 'sym_', '_sym', 'symbol', 'exchCode', 'orderType', 'price', 'fair',
+                 'side', 'quantity', 'stopPx', 'activeTs', 'clOrdID', 'ordStatus', 'cumQty', 'leavesQty', 'avgPx',
+                 'trace')
+
+    def __init__(self, exchCode, sym_, _sym, orderType, side, qty, price='', stopPrice='', clOrdID=None, trace=None):
         """in case of Market orders prices not given
            other order type also works perfectly fine
         """
@@ -48,22 +66,166 @@ class Order(object):
         self.side = side
         self.quantity = qty
         self.stopPx = stopPrice
+        # Assigned by ExchangeInterface.create() when not given, before the order is sent.
+        self.clOrdID = clOrdID
+        self.ordStatus = None
+        self.cumQty = None
+        self.leavesQty = None
+        self.avgPx = None
+        self.trace = trace
 
         self.activeTs = -1.0
 
+    @property
+    def orderID(self):
+        return self.odid
+
+    @orderID.setter
+    def orderID(self, value):
+        self.odid = value
+
+    @property
+    def stamps(self):
+        """Nanosecond stamps per tracing stage (0 = not reached), None when the order is not traced."""
+        return self.trace.stamps if self.trace is not None else None
+
+    def applyAck(self, ackMsg):
+        """Copy orderID, ordStatus, cumQty, leavesQty, price and avgPx out of an ack; the ack itself
+        is not kept. Returns None if ackMsg is not an order."""
+        return decode_ack(ackMsg, into=self)
+
 
 class ExchangeInterface:
-    def __init__(self):
+    def __init__(self, base_url=None, config=None, ratelimiter=None, tracer=None, client=None):
+        # Imported here so that importing this module stays cheap: requests and the client load with the
+        # first interface. Nothing touches the network until start() or the first call.
+        from bitmex import bitmex
         self.exchCode = 'Bitmex'
-        self.btmx_config = MyBMEX()
-        self.bitmex = bitmex.TradeClient(self.btmx_config)
+        # With a tracer, orders created without a trace start one when they are built.
+        self.tracer = tracer or NULL_TRACER
+        # An existing TradeClient (e.g. one account of an ExecutionEngine) is used as is.
+        self.btmx_config = config or MyBMEX()
+        self.bitmex = client or bitmex.TradeClient(self.btmx_config, ratelimiter=ratelimiter,
+                                                   base_url=base_url or bitmex.BASE_URL)
         self.cxlNb = 0
         self.retryNum = 5
+        self.batcher = None
+        self.recovery = None
+        self.clOrdID = self.bitmex.clOrdID
+
+    def _start_tasks(self, connections, keepalive, websocket, symbols):
+        tasks = {
+            'connections': lambda: self.bitmex.preconnect(connections, keepalive),
+            'instruments': self.bitmex.instruments.refresh,
+        }
+        if websocket:
+            tasks['websocket'] = lambda: self.bitmex.connect_websocket(
+                symbols or self.bitmex.client.symbol, shouldAuth=bool(self.bitmex.apiKey))
+        return tasks
+
+    def start(self, connections=2, keepalive=None, websocket=False, symbols=None):
+        """Warm up before the first order, all in parallel: open `connections` pooled connections (kept
+        hot every `keepalive` seconds), load the instrument cache and, with `websocket`, subscribe the
+        market data and order streams of `symbols`. Returns {step: seconds taken}."""
+        tasks = self._start_tasks(connections, keepalive, websocket, symbols)
+        with ThreadPoolExecutor(max_workers=len(tasks)) as pool:
+            futures = [(name, pool.submit(_timed, fn)) for name, fn in tasks.items()]
+        return dict((name, future.result()) for name, future in futures)
+
+    async def startAsync(self, connections=2, keepalive=None, websocket=False, symbols=None):
+        """start() for asyncio code: the steps run on the loop's executor, so the loop is not blocked."""
+        import asyncio
+        loop = asyncio.get_event_loop()
+        tasks = self._start_tasks(connections, keepalive, websocket, symbols)
+        timings = await asyncio.gather(*[loop.run_in_executor(None, _timed, fn) for fn in tasks.values()])
+        return dict(zip(tasks, timings))
+
+    def openJournal(self, path, symbols=None, **kwargs):
+        """Journal every order to `path` and recover what an earlier run journaled there, so
+        getInitActiveOrders() answers from the journal and one REST delta (see `bitmex.journal`).
+        Returns the `bitmex.journal.Recovery`."""
+        self.recovery = self.bitmex.open_journal(path, symbols, **kwargs)
+        return self.recovery
+
+    def closeJournal(self):
+        self.bitmex.close_journal()
+
+    def startHeartbeat(self, timeout=60, interval=15, maxLatency=1.0, onDegraded=None):
+        """Keep the exchange-side dead man's switch armed: unless renewed within `timeout` seconds,
+        every order is cancelled. Renewals run every `interval` seconds on a background thread and
+        connection of their own; `onDegraded(switch, reason, latency)` is called there when one is
+        slower than `maxLatency`, fails, is late, or the switch is about to fire."""
+        return self.bitmex.start_heartbeat(timeout, interval, max_latency=maxLatency, on_degraded=onDegraded)
+
+    def stopHeartbeat(self, disarm=True):
+        self.bitmex.stop_heartbeat(disarm)
+
+    def enableRisk(self, **limits):
+        """Check every order before it is sent against pre-trade limits (see `bitmex.risk`); a refused
+        create or amend raises `bitmex.risk.RiskError` without a request. Returns the RiskGate."""
+        gate = self.bitmex.enable_risk(**limits)
+        gate.prepare([self.bitmex.client.symbol])
+        return gate
+
+    def enableBatching(self, window=0.002, maxBatch=50):
+        """Coalesce creates, amends and cancels issued within `window` seconds (or `maxBatch` of them)
+        into single order/bulk and multi-ID DELETE requests."""
+        self.batcher = OrderBatcher(self.bitmex, window=window, max_batch=maxBatch)
+        return self.batcher
+
+    def disableBatching(self):
+        if self.batcher is not None:
+            self.batcher.close()
+            self.batcher = None
+
+    def _built(self, o):
+        if o.trace is not None:
+            o.trace.stamp(BUILT)
+        elif self.tracer.enabled:
+            o.trace = self.tracer.begin(BUILT)
 
     def create(self, o):
-        ackMsg = self.place_order(**o.__dict__)
+        if o.clOrdID is None:
+            o.clOrdID = self.clOrdID()
+        if self.batcher is not None:
+            ackMsg = self.createAsync(o).result()
+        else:
+            self._built(o)
+            ackMsg = self.place_order(o.side.lower(), o.symbol, o.quantity, o.orderType, price=o.price,
+                                      stopPx=o.stopPx, clOrdID=o.clOrdID, trace=o.trace)
+        o.applyAck(ackMsg)
         return ackMsg
 
+    def orderDict(self, o):
+        """order/bulk representation of an Order."""
+        order = {
+            'symbol': o.symbol,
+            'side': 'Buy' if o.side.lower() == 'buy' else 'Sell',
+            'orderQty': o.quantity,
+            'ordType': o.orderType,
+        }
+        if o.orderType != 'Market':
+            order['price'] = o.price
+        if o.orderType in ['Stop', 'StopLimit', 'MarketIfTouched', 'LimitIfTouched']:
+            order['stopPx'] = o.stopPx
+        if o.clOrdID:
+            order['clOrdID'] = o.clOrdID
+        return order
+
+    def createAsync(self, o):
+        """Queue an order on the batcher; returns a future resolved with its ack."""
+        if o.clOrdID is None:
+            o.clOrdID = self.clOrdID()
+        self._built(o)
+        return self.batcher.submit(self.orderDict(o), trace=o.trace)
+
+    def amendAsync(self, odid, **changes):
+        changes['orderID'] = odid
+        return self.batcher.amend(changes)
+
+    def cxlAsync(self, odid):
+        return self.batcher.cancel(odid)
+
     def isActive(self, ackMsg):
         odid, timestamp = None, None
         if isinstance(ackMsg, dict) and ackMsg['ordStatus'] != 'Filled':
@@ -104,18 +266,22 @@ class ExchangeInterface:
             return ackMsg
 
     def checkOrderStatus(self, o):
+        store = self._order_store()
+        if store is not None:
+            ackMsg = store.get(o.odid)
+            return self.readOrderStatus(ackMsg) if ackMsg is not None else []
         a_orders = self._active_orders()
-        if not len(a_orders):
+        if not a_orders:
             return []
-        for i in range(a_orders):
-            if a_orders[i]['orderID'] == o.odid:
-                return self.readOrderStatus(a_orders[i])
+        for a_order in a_orders:
+            if a_order['orderID'] == o.odid:
+                return self.readOrderStatus(a_order)
         # return self.readOrderStatus(ackMsg)
 
     def readOrderStatus(self, ackMsg):
         orderStatus = None
         tradedPrice, tradedQty, remainQty = None, None, None
-        if type(ackMsg) is dict:
+        if type(ackMsg) is dict or isinstance(ackMsg, OrderState):
             # it means order place
             isTraded = True if ackMsg['ordStatus'] == 'Filled' else False and not ackMsg['workingIndicator']
             isCancelled = True if ackMsg['ordStatus'] == 'Canceled' else False
@@ -149,8 +315,19 @@ class ExchangeInterface:
             intAckMsg = self.handleUnknownMsg(ackMsg)
             return intAckMsg
 
+    def _activeTs(self, odid):
+        """When the order was sent, as journaled; now if it was not."""
+        opened = self.recovery.opened.get(odid) if self.recovery is not None else None
+        if opened is None:
+            return nowStr()
+        return datetime.datetime.fromtimestamp(opened / 1e9).strftime('%H:%M:%S.%f')[:-3]
+
     def getInitActiveOrders(self):
-        ackMsg = self._active_orders()
+        if self.recovery is not None:
+            # Recovered from the journal and already reconciled with REST.
+            ackMsg = self.bitmex.order_store.open_orders(self.bitmex.client.symbol)
+        else:
+            ackMsg = self._active_orders()
         if type(ackMsg) == list:
             if not len(ackMsg):
                 return ackMsg
@@ -165,12 +342,12 @@ class ExchangeInterface:
                     orderType = obj['ordType']
                     price = float(obj['price'])
                     side = obj['side'].upper()
-                    print(obj)
                     qty = float(obj['leavesQty'])
-                    o = Order(self.exchCode, sym_, _sym, orderType, side, qty, price)
+                    o = Order(self.exchCode, sym_, _sym, orderType, side, qty, price, clOrdID=obj.get('clOrdID'))
+                    o.applyAck(obj)
                     o.odid = odid
                     o.status = 'ACTIVE'
-                    o.activeTs = nowStr()
+                    o.activeTs = self._activeTs(odid)
                     tmpActiveOrderList.append(o)
                 return tmpActiveOrderList
         else:
@@ -184,8 +361,8 @@ class ExchangeInterface:
         n += 1
         ackMsg = self._get_balances()
         if isinstance(ackMsg, dict):
-            self.balances[str(ackMsg['currency'].upper())] = float(ackMsg['marginBalance']/(10**8))
-            self.available[str(ackMsg['currency'].upper())] = float(ackMsg['availableMargin']/(10**8))
+            self.balances[str(ackMsg['currency'].upper())] = self.bitmex.Xbt_to_XBT(ackMsg['marginBalance'])
+            self.available[str(ackMsg['currency'].upper())] = self.bitmex.Xbt_to_XBT(ackMsg['availableMargin'])
         else:
             intAckMsg = self.handleUnknownMsg(ackMsg)
             if intAckMsg in ['INT_ERR_0','INT_ERR_1']:
@@ -224,37 +401,48 @@ class ExchangeInterface:
             return e
             # sleep(settings.API_ERROR_INTERVAL)
 
+    def _order_store(self):
+        """The streamed order store, once it has received its partial."""
+        store = self.bitmex.order_store
+        return store if store is not None and store.live else None
+
     def _active_orders(self):
+        store = self._order_store()
+        if store is not None:
+            return store.open_orders(self.bitmex.client.symbol)
         return self.bitmex.active_orders()
     #
 
     def cancel_all_orders(self):
-        # In certain cases, a WS update might not make it through before we call this.
-        # For that reason, we grab via HTTP to ensure we grab them all.
-        orders = self.bitmex.active_orders()
-
-        if len(orders):
-            self.bitmex.cancel([order['orderID'] for order in orders])
-
-        sleep(API_REST_INTERVAL)
+        # One DELETE order/all, so orders the WS has not told us about yet are cancelled too. Its acks
+        # update the order store, so there is nothing to wait for.
+        return self.bitmex.cancel_all(self.bitmex.client.symbol)
 
     def _get_balances(self):
+        positions = self.bitmex.positions
+        if positions is not None and positions.live:
+            return positions.balances()
         return self.bitmex.balances()
 
-    def place_order(self,side, symbol, quantity, ordertpye, price=None, stopPx=None):
+    def place_order(self, side, symbol, quantity, ordertpye, price=None, stopPx=None, clOrdID=None, trace=None):
         if side == 'sell':
-            return self.bitmex.sell(symbol, quantity, ordertpye, price=None, stopPx=None)
+            return self.bitmex.sell(symbol, quantity, ordertpye, price=price, stopPx=stopPx, clOrdID=clOrdID,
+                                    trace=trace)
         elif side == 'buy':
-            return self.bitmex.buy(symbol, quantity, ordertpye, price=None, stopPx=None)
-
-
-o = Order('bitmex', 'XBT', 'USD', 'Limit', 'buy', 100, 15200)
-
-ex = ExchangeInterface()
-print(ex.getActiveOrders())
-print(ex.getBalances())
-print(ex.bitmex.ticker('XBTUSD'))
-print(ex.bitmex.order_book('XBTUSD'))
-print(ex.bitmex.instrument("XBTUSD"))
-print(ex.bitmex.today('XBTUSD'))
-print(ex.bitmex.recent_trades('XBTUSD'))
\ No newline at end of file
+            return self.bitmex.buy(symbol, quantity, ordertpye, price=price, stopPx=stopPx, clOrdID=clOrdID,
+                                   trace=trace)
+
+
+if __name__ == '__main__':
+    # python bitmex_om.py [base_url], e.g. the url printed by python -m bitmex.simulator
+    o = Order('bitmex', 'XBT', 'USD', 'Limit', 'buy', 100, 15200)
+
+    ex = ExchangeInterface(*sys.argv[1:2])
+    print(ex.start())
+    print(ex.getActiveOrders())
+    print(ex.getBalances())
+    print(ex.bitmex.ticker('XBTUSD'))
+    print(ex.bitmex.order_book('XBTUSD'))
+    print(ex.bitmex.instrument("XBTUSD"))
+    print(ex.bitmex.today('XBTUSD'))
+    print(ex.bitmex.recent_trades('XBTUSD'))
\ No newline at end of file
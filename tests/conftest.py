@@ -0,0 +1,22 @@
+from __future__ import absolute_import
+
+import pytest
+
+from bitmex.simulator import Simulator
+
+
+class Account:
+    apiKey = 'key'
+    apiSecret = 'secret'
+
+
+@pytest.fixture
+def account():
+    return Account()
+
+
+@pytest.fixture
+def sim():
+    """A local exchange whose rate limit stays out of the way unless a test lowers it."""
+    with Simulator(accounts={Account.apiKey: Account.apiSecret}, rate_limit=100000) as sim:
+        yield sim
@@ -0,0 +1,100 @@
+from __future__ import absolute_import
+
+import asyncio
+
+import pytest
+
+from bitmex.async_bitmex import AsyncTradeClient
+from bitmex.auth import AuthenticationError
+from bitmex.bitmex import THROTTLE_CANCEL_ALL, TradeClient
+from bitmex.ratelimit import RateLimiter
+from bitmex.retry import RetryError, RetryPolicy
+
+
+def run(sim, account, test, **kwargs):
+    """Run `test(client)` on an AsyncTradeClient pointed at `sim`."""
+    async def main():
+        kwargs.setdefault('ratelimiter', RateLimiter(limit=100000))
+        async with AsyncTradeClient(account, base_url=sim.base_url, **kwargs) as client:
+            client.public_ratelimiter = RateLimiter(limit=100000)
+            return await test(client)
+    return asyncio.run(main())
+
+
+def test_place_amend_cancel(sim, account):
+    async def test(client):
+        ack = await client.buy('XBTUSD', 10, 'Limit', price=9000)
+        assert ack['ordStatus'] == 'New'
+        assert ack['clOrdID']
+        amended = await client.amend_bulk_orders([{'orderID': ack['orderID'], 'price': 9001}])
+        assert amended[0]['price'] == 9001
+        assert [order['orderID'] for order in await client.active_orders('XBTUSD')] == [ack['orderID']]
+        canceled = await client.cancel(ack['orderID'])
+        assert canceled[0]['ordStatus'] == 'Canceled'
+        return ack
+
+    run(sim, account, test)
+    assert sim.engine.open_orders(account.apiKey) == []
+
+
+def test_concurrent_orders_share_the_pool(sim, account):
+    async def test(client):
+        return await asyncio.gather(*[client.sell('XBTUSD', 1, 'Limit', price=11000 + i) for i in range(20)])
+
+    acks = run(sim, account, test, pool_size=4)
+    assert [ack['ordStatus'] for ack in acks] == ['New'] * 20
+    assert len(sim.engine.open_orders(account.apiKey, 'XBTUSD')) == 20
+
+
+def test_market_data_and_account(sim, account):
+    async def test(client):
+        ticker = await client.ticker('XBTUSD')
+        book = await client.order_book('XBTUSD', depth=5)
+        await client.buy('XBTUSD', 100, 'Market')
+        return ticker, book, await client.position(), await client.balances()
+
+    ticker, book, positions, balances = run(sim, account, test)
+    assert ticker['buy'] < ticker['sell']
+    assert len([level for level in book if level['side'] == 'Buy']) == 5
+    assert positions[0]['currentQty'] == 100
+    assert balances['currency'] == 'XBt'
+
+
+def test_server_errors_are_retried_then_raised(sim, account):
+    sim.faults[503] = 1.0
+
+    async def test(client):
+        with pytest.raises(RetryError):
+            await client.active_orders('XBTUSD')
+
+    run(sim, account, test, retry_policy=RetryPolicy(max_retries=2, base=0.001))
+    assert sim.responses[503] == 3
+
+
+def test_wrong_secret_raises(sim, account):
+    account.apiSecret = 'wrong'
+
+    async def test(client):
+        with pytest.raises(AuthenticationError):
+            await client.buy('XBTUSD', 10, 'Limit', price=9000)
+
+    run(sim, account, test)
+    assert sim.responses == {200: 1, 401: 1}
+
+
+def test_throttle_cancels_resting_orders_first(sim, account):
+    # Two requests per 2s, the second spent elsewhere: the query after the order is answered 429.
+    # on_throttle's cancel goes out at once, is answered 429 as well, and is retried before the query.
+    sim.rate_limit, sim.rate_period = 2, 2
+    other = TradeClient(account, ratelimiter=RateLimiter(limit=100), base_url=sim.base_url)
+
+    async def test(client):
+        client.round_orders = False
+        await client.buy('XBTUSD', 10, 'Limit', price=9000)
+        other.balances()
+        return await client.active_orders('XBTUSD')
+
+    assert run(sim, account, test, on_throttle=THROTTLE_CANCEL_ALL,
+               ratelimiter=RateLimiter(limit=2, period=2, reserve=(0, 0, 0))) == []
+    assert sim.engine.open_orders(account.apiKey) == []
+    assert sim.responses == {200: 4, 429: 2}
@@ -0,0 +1,56 @@
+from __future__ import absolute_import
+
+import gc
+
+import requests
+
+from bitmex.auth import APIKeyAuthWithExpires, Signer, compact_json, generate_signature
+
+SECRET = 'chNOOS4KvNXR_Xq4k4c9qsfoKWvnDecLATCRlcBwyKDYnWgO'
+URL = 'https://www.bitmex.com/api/v1/order?symbol=XBTUSD&count=10'
+
+
+def test_signer_matches_generate_signature():
+    body = compact_json({'symbol': 'XBTUSD', 'orderQty': 1, 'price': 395.01})
+    signer = Signer.for_secret(SECRET)
+
+    for verb, url, data in (('GET', URL, b''), ('POST', 'https://www.bitmex.com/api/v1/order', body),
+                            ('DELETE', '/api/v1/order/all', b'')):
+        expected = generate_signature(SECRET, verb, url, 1518064236, data)
+        assert signer.sign(verb, url, 1518064236, data) == expected
+        # Again, from the cached prefix.
+        assert signer.sign(verb, url, 1518064236, data) == expected
+
+
+def test_documented_signature():
+    # The example from https://www.bitmex.com/app/apiKeysUsage
+    signature = generate_signature('chNOOS4KvNXR_Xq4k4c9qsfoKWvnDecLATCRlcBwyKDYnWgO', 'GET',
+                                   '/api/v1/instrument', 1518064236, '')
+    assert signature == 'c7682d435d0cfe87c16098df34ef2eb5a549d4c5a3c2b1f0f77b8af73423bf00'
+
+
+def test_signers_are_shared_per_secret():
+    assert Signer.for_secret(SECRET) is Signer.for_secret(SECRET)
+    assert Signer.for_secret(SECRET) is not Signer.for_secret(SECRET + 'x')
+
+
+def test_signer_registry_keeps_no_secret_and_drops_unused_signers():
+    gc.collect()
+    before = len(Signer._signers)
+    signer = Signer.for_secret(SECRET + 'y')
+    assert len(Signer._signers) == before + 1
+    assert SECRET + 'y' not in Signer._signers
+
+    del signer
+    gc.collect()
+    assert len(Signer._signers) == before
+
+
+def test_auth_signs_what_is_sent():
+    body = compact_json({'symbol': 'XBTUSD', 'orderQty': 1})
+    request = requests.Request('POST', 'https://www.bitmex.com/api/v1/order', data=body,
+                               auth=APIKeyAuthWithExpires('key', SECRET)).prepare()
+
+    assert request.headers['api-key'] == 'key'
+    assert request.headers['api-signature'] == generate_signature(
+        SECRET, 'POST', request.url, request.headers['api-expires'], body)
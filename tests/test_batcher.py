@@ -0,0 +1,76 @@
+from __future__ import absolute_import
+
+import pytest
+
+from bitmex.batcher import OrderBatcher
+from bitmex.bitmex import TradeClient
+from bitmex.orderstore import OrderStore
+from bitmex.ratelimit import RateLimiter
+
+
+def order(qty, price):
+    return {'symbol': 'XBTUSD', 'side': 'Buy', 'orderQty': qty, 'price': price, 'ordType': 'Limit'}
+
+
+@pytest.fixture
+def batcher(sim, account):
+    client = TradeClient(account, ratelimiter=RateLimiter(limit=100000), base_url=sim.base_url)
+    batcher = OrderBatcher(client, window=0.05)
+    yield batcher
+    batcher.close()
+
+
+def test_order_below_the_lot_size_fails_alone(batcher):
+    good = batcher.submit(order(10, 9000.2))
+    bad = batcher.submit(order(0.4, 9000))
+    other = batcher.submit(order(20, 8999))
+
+    with pytest.raises(ValueError):
+        bad.result(5)
+    acks = [good.result(5), other.result(5)]
+    assert [(ack['ordStatus'], ack['orderQty'], ack['price']) for ack in acks] == [('New', 10, 9000.0),
+                                                                                   ('New', 20, 8999.0)]
+    assert batcher.requests == 1
+
+
+def test_cancelled_submission_is_withdrawn(batcher):
+    withdrawn = batcher.submit(order(10, 9000))
+    kept = batcher.submit(order(10, 8999))
+    assert withdrawn.cancel()
+
+    assert kept.result(5)['ordStatus'] == 'New'
+    assert withdrawn.cancelled()
+    assert batcher.thread.is_alive()
+
+
+def test_cancel_of_a_list_resolves_with_its_acks(batcher):
+    acks = [batcher.submit(order(10, 9000 - i)).result(5) for i in range(3)]
+
+    listed = batcher.cancel([acks[0]['orderID'], acks[1]['orderID']])
+    single = batcher.cancel(acks[2]['orderID'])
+
+    assert [ack['orderID'] for ack in listed.result(5)] == [acks[0]['orderID'], acks[1]['orderID']]
+    assert single.result(5)['orderID'] == acks[2]['orderID']
+    assert all(ack['ordStatus'] == 'Canceled' for ack in listed.result() + [single.result()])
+
+
+def test_merged_amend_survives_its_first_caller_cancelling(batcher):
+    ack = batcher.submit(order(10, 9000)).result(5)
+
+    first = batcher.amend({'orderID': ack['orderID'], 'price': 8990})
+    second = batcher.amend({'orderID': ack['orderID'], 'price': 8980})
+    assert first.cancel()
+
+    assert second.result(5)['price'] == 8980
+    assert first.cancelled() and batcher.merged == 1
+
+
+def test_cancel_drops_amends_by_either_key(batcher):
+    ack = batcher.submit(dict(order(10, 9000), clOrdID='mine-1')).result(5)
+
+    by_clordid = batcher.amend({'origClOrdID': 'mine-1', 'price': 8990})
+    batcher.client.order_store = OrderStore()
+    batcher.client.order_store.update(ack)
+    batcher.cancel(ack['orderID']).result(5)
+
+    assert by_clordid.cancelled() and batcher.dropped == 1
@@ -0,0 +1,112 @@
+from __future__ import absolute_import
+
+import time
+
+from bitmex import codec
+from bitmex.bitmex import THROTTLE_CANCEL_ALL, THROTTLE_DEAD_MAN, Client, TradeClient
+from bitmex.ratelimit import RateLimiter
+
+
+class OneFault:
+    """Stands in for the simulator's fault dice: only the first request rolls a fault."""
+
+    def __init__(self):
+        self.rolls = 0
+
+    def random(self):
+        self.rolls += 1
+        return 0.0 if self.rolls == 1 else 1.0
+
+
+def throttled_once(sim):
+    """The next request is answered 429 (Retry-After 1), every later one goes through."""
+    sim.faults[429] = 1.0
+    sim.random = OneFault()
+
+
+def test_retry_after_429_is_signed_after_the_wait(sim, account):
+    # One request per 6s: the 429 parks the retry in the limiter longer than a signature lives (5s).
+    sim.rate_limit, sim.rate_period = 1, 6
+    other = TradeClient(account, ratelimiter=RateLimiter(limit=100), base_url=sim.base_url)
+    other._curl_bitmex_private('user/margin', private=True)
+    client = TradeClient(account, ratelimiter=RateLimiter(limit=1, period=6, reserve=(0, 0, 0)),
+                         base_url=sim.base_url)
+    client.round_orders = False
+
+    ack = client.buy('XBTUSD', 1, 'Limit', price=9000)
+
+    assert ack['ordStatus'] == 'New'
+    assert sim.responses == {200: 2, 429: 1}
+
+
+def test_large_arrays_are_decoded_by_the_selected_codec(sim, account, monkeypatch):
+    trades = sim.engine.trades['XBTUSD']
+    for i in range(1000):
+        trades.append({'timestamp': '2020-01-01T00:00:00.%03dZ' % i, 'symbol': 'XBTUSD', 'side': 'Buy', 'size': i + 1,
+                       'price': 9000.0, 'tickDirection': 'ZeroPlusTick',
+                       'trdMatchID': '00000000-0000-0000-0000-%012x' % i})
+    decoded = []
+    loads = codec.loads
+    monkeypatch.setattr(codec, 'loads', lambda body: decoded.append(len(body)) or loads(body))
+    client = TradeClient(account, ratelimiter=RateLimiter(limit=100000), base_url=sim.base_url)
+
+    assert client.recent_trades('XBTUSD', count=1000) == list(trades)[-1000:]
+    # The 180KB page, read whole; the simulator decodes the small request body with it too.
+    assert max(decoded) > 1 << 16
+    # The pooled connection serves the next request.
+    assert client.recent_trades('XBTUSD', count=5) == list(trades)[:5]
+    assert client.client.transport.last_timing().connect == 0
+
+
+def test_throttle_cancels_resting_orders_at_once(sim, account):
+    client = TradeClient(account, ratelimiter=RateLimiter(limit=100000), base_url=sim.base_url,
+                         on_throttle=THROTTLE_CANCEL_ALL)
+    client.round_orders = False
+    client.buy('XBTUSD', 10, 'Limit', price=9000)
+    throttled_once(sim)
+
+    # The cancel goes out while the query that hit the 429 waits for the budget.
+    assert client.active_orders('XBTUSD') == []
+    assert sim.engine.open_orders(account.apiKey) == []
+    assert sim.responses == {200: 3, 429: 1}
+
+
+def test_throttle_arms_the_dead_man_at_once_and_disarms_it(sim, account, monkeypatch):
+    armed = []
+    cancel_all_after = sim.engine.cancel_all_after
+    monkeypatch.setattr(sim.engine, 'cancel_all_after',
+                        lambda name, timeout: armed.append((time.monotonic(), timeout)) or cancel_all_after(name, timeout))
+    client = TradeClient(account, ratelimiter=RateLimiter(limit=100000), base_url=sim.base_url,
+                         on_throttle=THROTTLE_DEAD_MAN)
+    client.round_orders = False
+    ack = client.buy('XBTUSD', 10, 'Limit', price=9000)
+    throttled_once(sim)
+
+    started = time.monotonic()
+    assert [order['orderID'] for order in client.active_orders('XBTUSD')] == [ack['orderID']]
+    # Armed well before the 429 lifted, and disarmed by the first request to succeed after it.
+    client._reactions.submit(lambda: None).result()
+    assert [timeout for _, timeout in armed] == [60000, 0]
+    assert armed[0][0] - started < 0.5
+    assert sim.engine.account(account.apiKey).cancel_at is None
+    assert len(sim.engine.open_orders(account.apiKey)) == 1
+
+
+def test_public_client_answers_from_its_own_instrument_cache(sim):
+    client = Client(base_url=sim.base_url)
+    client.public_ratelimiter = RateLimiter(limit=100)
+
+    symbols = client.symbols()
+    ticker = client.ticker('XBTUSD')
+
+    assert 'XBTUSD' in symbols
+    assert ticker['buy'] <= ticker['mid'] <= ticker['sell']
+    assert client.instruments.loads == 1
+    assert sim.responses == {200: 1}
+
+
+def test_trade_client_shares_its_instrument_cache(sim, account):
+    client = TradeClient(account, ratelimiter=RateLimiter(limit=100), base_url=sim.base_url)
+
+    assert client.client.instruments is client.instruments
+    assert client.instruments.fetch == client._active_instruments
@@ -0,0 +1,50 @@
+from __future__ import absolute_import
+
+import pytest
+
+from bitmex import codec
+
+PAYLOAD = [{'symbol': 'XBTUSD', 'price': 10000.5, 'text': 'café "q" \\ /', 'execInst': None, 'size': 10}]
+
+
+@pytest.fixture(autouse=True)
+def restore_codec():
+    yield
+    codec.CODECS.pop('test', None)
+    codec.use()
+
+
+@pytest.mark.parametrize('name', sorted(codec.CODECS))
+def test_every_available_codec_round_trips_bytes(name):
+    codec.use(name)
+    raw = codec.dumps(PAYLOAD)
+    assert isinstance(raw, bytes)
+    assert raw.startswith(b'[{"symbol":"XBTUSD","price":10000.5,')
+    assert codec.loads(raw) == PAYLOAD
+
+
+def test_default_is_the_first_installed_preference():
+    assert codec.use() == next(c for c in codec.PREFERENCE if c in codec.CODECS)
+
+
+def test_falls_back_to_the_standard_library_when_nothing_faster_is_installed(monkeypatch):
+    monkeypatch.setattr(codec, 'CODECS', {'json': codec.CODECS['json']})
+    assert codec.use() == 'json'
+    assert codec.dumps({'a': [1, 2]}) == b'{"a":[1,2]}'
+    assert codec.loads(b'{"a":[1,2]}') == {'a': [1, 2]}
+
+
+def test_unknown_codec_is_refused_and_keeps_the_current_one():
+    current = codec.name
+    with pytest.raises(ValueError):
+        codec.use('nope')
+    assert codec.name == current
+
+
+def test_registered_codec_can_be_selected():
+    calls = []
+    codec.register('test', lambda raw: calls.append(raw) or 1, lambda obj: b'1')
+    assert codec.use('test') == 'test'
+    assert codec.dumps({}) == b'1'
+    assert codec.loads(b'1') == 1
+    assert calls == [b'1']
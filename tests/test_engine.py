@@ -0,0 +1,71 @@
+from __future__ import absolute_import
+
+import asyncio
+import time
+
+from bitmex.bitmex import TradeClient
+from bitmex.engine import AsyncExecutionEngine
+from bitmex.ratelimit import RateLimiter
+from bitmex.simulator import Simulator
+
+
+class Account:
+    def __init__(self, apiKey, apiSecret):
+        self.apiKey = apiKey
+        self.apiSecret = apiSecret
+
+
+ACCOUNTS = {'mm1': Account('key1', 'secret1'), 'mm2': Account('key2', 'secret2')}
+
+
+def run(test, **kwargs):
+    """Run `test(engine, sim)` on an AsyncExecutionEngine over two accounts of a fresh simulator."""
+    with Simulator(accounts=dict((acc.apiKey, acc.apiSecret) for acc in ACCOUNTS.values()), rate_limit=100000) as sim:
+        async def main():
+            engine = AsyncExecutionEngine(ACCOUNTS, base_url=sim.base_url, **kwargs)
+            async with engine:
+                for client in engine.clients.values():
+                    client.ratelimiter = RateLimiter(limit=100000)
+                    client.public_ratelimiter = RateLimiter(limit=100000)
+                return await test(engine, sim)
+        return asyncio.run(main())
+
+
+def test_each_account_keeps_its_own_order_store():
+    async def test(engine, sim):
+        acks = await asyncio.gather(engine.place('mm1', 'XBTUSD', 'Buy', 10, 9000),
+                                    engine.place('mm2', 'XBTUSD', 'Sell', 10, 11000))
+        stores = [engine.clients[name].order_store for name in ('mm1', 'mm2')]
+        assert [store.get(ack['orderID']).ordStatus for store, ack in zip(stores, acks)] == ['New', 'New']
+        assert acks[1]['orderID'] not in stores[0] and acks[0]['orderID'] not in stores[1]
+        # Acks alone never make a store live: reads still go to REST.
+        assert engine.order_store('mm1') is None
+        await engine.cancel('mm1', acks[0]['orderID'])
+        assert stores[0].status(acks[0]['orderID']) == 'Canceled'
+        assert await engine.active_orders('mm1') == []
+        assert [o['orderID'] for o in await engine.active_orders('mm2')] == [acks[1]['orderID']]
+
+    run(test)
+
+
+def test_websockets_make_the_stores_live_and_reconcile_repairs_them():
+    async def test(engine, sim):
+        await engine.connect_websockets(reconcile=0)
+        assert engine.order_store('mm1') is not None and engine.order_store('mm2') is not None
+        ack = await engine.place('mm1', 'XBTUSD', 'Buy', 10, 9000)
+        assert [o['orderID'] for o in await engine.active_orders('mm1')] == [ack['orderID']]
+        assert await engine.active_orders('mm2') == []
+
+        # Cancelled while the stream is down: only reconciliation can tell the store.
+        store = engine.order_store('mm1')
+        engine.websockets['mm1'].exit()
+        deadline = time.time() + 5
+        while engine.order_store('mm1') is not None and time.time() < deadline:
+            await asyncio.sleep(0.01)
+        assert engine.order_store('mm1') is None
+        TradeClient(ACCOUNTS['mm1'], base_url=sim.base_url).cancel(ack['orderID'])
+        assert store.status(ack['orderID']) == 'New'
+        assert await engine.reconcile('mm1') == 1
+        assert store.status(ack['orderID']) == 'Canceled'
+
+    run(test)
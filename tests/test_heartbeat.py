@@ -0,0 +1,86 @@
+from __future__ import absolute_import
+
+import threading
+import time
+
+from bitmex.auth import AuthenticationError
+from bitmex.bitmex import TradeClient
+from bitmex.heartbeat import EXPIRING, MISSED, DeadMansSwitch
+from bitmex.ratelimit import RateLimiter
+
+
+class WrongSecret:
+    apiKey = 'key'
+    apiSecret = 'wrong'
+
+
+def switch(sim, account, **kwargs):
+    client = TradeClient(account, ratelimiter=RateLimiter(limit=100000), base_url=sim.base_url)
+    degraded = []
+    heartbeat = DeadMansSwitch(client, on_degraded=lambda s, reason, latency: degraded.append(reason), **kwargs)
+    return heartbeat, degraded
+
+
+def test_renewal_arms_the_exchange(sim, account):
+    heartbeat, degraded = switch(sim, account, timeout=60, interval=15)
+
+    assert heartbeat.beat()
+    assert heartbeat.renewals == 1 and degraded == []
+    assert 59 < heartbeat.remaining() <= 60
+
+
+def test_rejected_renewal_is_missed(sim):
+    heartbeat, degraded = switch(sim, WrongSecret(), timeout=60, interval=15)
+
+    assert not heartbeat.beat()
+    assert (heartbeat.renewals, heartbeat.missed) == (0, 1)
+    assert isinstance(heartbeat.last_error, AuthenticationError)
+    assert degraded == [MISSED]
+
+
+def test_throttled_renewal_warns_instead_of_waiting(sim, account):
+    heartbeat, degraded = switch(sim, account, timeout=2, interval=1, request_timeout=0.5)
+    assert heartbeat.beat()
+    # A 429 holds the account's budget longer than the switch lives.
+    heartbeat.client.ratelimiter.block_until(time.time() + 60)
+
+    started = time.monotonic()
+    assert not heartbeat.beat()
+    assert time.monotonic() - started < 0.5
+    assert degraded == [MISSED]
+
+    time.sleep(1.1)
+    assert not heartbeat.beat()
+    assert degraded == [MISSED, MISSED, EXPIRING]
+    assert heartbeat.remaining() > 0
+
+
+def test_restart_runs_one_loop_and_stop_still_disarms(sim, account):
+    heartbeat, degraded = switch(sim, account, timeout=2, interval=0.05)
+    in_beat, release = threading.Event(), threading.Event()
+    beat = heartbeat.beat
+
+    def held_beat():
+        # Hold the second renewal, so stop() and start() land while it is in flight.
+        if heartbeat.renewals == 1 and not release.is_set():
+            in_beat.set()
+            release.wait(5)
+        return beat()
+    heartbeat.beat = held_beat
+    heartbeat.start()
+    assert in_beat.wait(5)
+
+    heartbeat.stop()
+    heartbeat.start()
+    release.set()
+    time.sleep(0.3)
+
+    assert [t.name for t in threading.enumerate()].count('DeadMansSwitch') == 1
+    # The old thread's disarm went out before the new thread's first renewal.
+    assert sim.engine.accounts[account.apiKey].cancel_at is not None
+    heartbeat.stop(wait=5)
+    assert not heartbeat.running()
+    assert sim.engine.accounts[account.apiKey].cancel_at is None
+    renewals = heartbeat.renewals
+    time.sleep(0.2)
+    assert heartbeat.renewals == renewals
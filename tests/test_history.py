@@ -0,0 +1,96 @@
+from __future__ import absolute_import
+
+import numpy as np
+
+from bitmex.bitmex import TradeClient
+from bitmex.history import TRADE_SCHEMA, ColumnStore, HistoryDownloader, iso, to_columns, to_ms, uuid_bytes
+from bitmex.ratelimit import RateLimiter
+
+START = to_ms('2020-01-01T00:00:00.000Z')
+HOUR = 3600 * 1000
+
+
+def fixture_trades():
+    """Three hours of trades, with bursts sharing a millisecond on and around the half-hour window edges."""
+    stamps = [START + i * 37000 for i in range(300)]
+    for edge in range(START + HOUR // 2, START + 3 * HOUR, HOUR // 2):
+        stamps += [edge - 1] * 3 + [edge] * 4
+    trades = []
+    for i, stamp in enumerate(sorted(stamps)):
+        trades.append({'timestamp': iso(stamp), 'symbol': 'XBTUSD', 'side': 'Buy' if i % 2 else 'Sell',
+                       'size': 10 + i, 'price': 9000.0 + i % 7, 'tickDirection': 'ZeroPlusTick',
+                       'trdMatchID': '%08x-0000-0000-0000-%012x' % (i, i)})
+    return trades
+
+
+def stored_ids(store):
+    return [bytes(v).ljust(16, b'\0') for v in store.column('trdMatchID')]
+
+
+def expected_ids(trades, start, end):
+    return [uuid_bytes(t['trdMatchID']) for t in trades if start <= to_ms(t['timestamp']) < end]
+
+
+class PagedStub:
+    """recent_trades over a fixture list; pages repeat the last row of the page before, and windows
+    reach `spill` ms past their endTime."""
+
+    def __init__(self, trades, spill=0):
+        self.trades = trades
+        self.spill = spill
+        self.calls = 0
+
+    def recent_trades(self, symbol, count=None, start=None, startTime=None, endTime=None):
+        self.calls += 1
+        lo, hi = to_ms(startTime), to_ms(endTime) + self.spill
+        rows = [t for t in self.trades if lo <= to_ms(t['timestamp']) <= hi]
+        first = max(0, start - 1)
+        return rows[first:first + count]
+
+
+def test_windows_and_pages_against_the_simulator(sim, account, tmp_path):
+    trades = fixture_trades()
+    sim.engine.trades['XBTUSD'].extend(trades)
+    client = TradeClient(account, ratelimiter=RateLimiter(limit=100000), base_url=sim.base_url)
+    store = ColumnStore(str(tmp_path), TRADE_SCHEMA)
+    start, end = START + HOUR // 4, START + 5 * HOUR // 2
+    requests = sim.requests
+
+    added = HistoryDownloader(client, workers=3, window=1800, page=25).trades('XBTUSD', iso(start), iso(end), store)
+
+    assert added == len(store) == len(expected_ids(trades, start, end))
+    assert stored_ids(store) == expected_ids(trades, start, end)
+    assert np.all(np.diff(store.column('timestamp')) >= 0)
+    # Five windows, each more than one page.
+    assert sim.requests - requests > 5
+
+
+def test_overlapping_windows_and_pages_are_stored_once(tmp_path):
+    trades = fixture_trades()
+    stub = PagedStub(trades, spill=60000)
+    store = ColumnStore(str(tmp_path), TRADE_SCHEMA)
+
+    HistoryDownloader(stub, workers=2, window=1800, page=10).trades('XBTUSD', START, START + 3 * HOUR, store)
+
+    assert stored_ids(store) == expected_ids(trades, START, START + 3 * HOUR + 60000)
+    assert stub.calls > 6
+
+
+def test_resume_from_an_existing_store(tmp_path):
+    trades = fixture_trades()
+    end = START + 3 * HOUR
+    ids = expected_ids(trades, START, end)
+    # A previous run stopped inside the burst just before the first window edge.
+    cut = [i for i, t in enumerate(trades) if to_ms(t['timestamp']) == START + HOUR // 2 - 1][1]
+    path = str(tmp_path)
+    ColumnStore(path, TRADE_SCHEMA).append(to_columns(trades[:cut + 1], TRADE_SCHEMA))
+
+    stub = PagedStub(trades)
+    store = ColumnStore(path, TRADE_SCHEMA)
+    assert len(store) == cut + 1
+    added = HistoryDownloader(stub, window=1800, page=50).trades('XBTUSD', START, end, store)
+
+    assert added == len(ids) - cut - 1
+    assert stored_ids(store) == ids
+    # Only the remainder was fetched, from the last stored millisecond on.
+    assert stub.calls < len(ids) // 50 + 6
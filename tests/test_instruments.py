@@ -0,0 +1,99 @@
+from __future__ import absolute_import
+
+import threading
+import time
+
+import pytest
+
+from bitmex.instruments import InstrumentCache, round_order, round_price, round_quantity
+
+XBTUSD = {'symbol': 'XBTUSD', 'tickSize': 0.5, 'lotSize': 100}
+ETHUSD = {'symbol': 'ETHUSD', 'tickSize': 0.05, 'lotSize': 1}
+
+
+class Fetch:
+    """instrument/active, counting the calls; `gate` holds them until set, `error` fails them."""
+
+    def __init__(self):
+        self.calls = 0
+        self.gate = threading.Event()
+        self.gate.set()
+        self.error = None
+
+    def __call__(self):
+        self.calls += 1
+        self.gate.wait(5)
+        if self.error is not None:
+            raise self.error
+        return [dict(XBTUSD), dict(ETHUSD)]
+
+
+def wait_for(condition):
+    deadline = time.time() + 5
+    while not condition() and time.time() < deadline:
+        time.sleep(0.005)
+    assert condition()
+
+
+def test_prices_never_round_more_aggressive():
+    assert round_price(XBTUSD, 9000.7, 'Buy') == 9000.5
+    assert round_price(XBTUSD, 9000.2, 'Sell') == 9000.5
+    assert round_price(XBTUSD, 9000.5, 'Buy') == 9000.5
+    assert round_price(ETHUSD, 200.07) == 200.05
+    assert round_price(ETHUSD, 200.08) == 200.1
+
+
+def test_quantities_round_towards_zero():
+    assert round_quantity(XBTUSD, 250) == 200
+    assert round_quantity(XBTUSD, -250) == -200
+    assert round_order(XBTUSD, {'orderQty': -150, 'price': 9000.2}) == {'orderQty': -100, 'price': 9000.5}
+    with pytest.raises(ValueError):
+        round_order(XBTUSD, {'orderQty': 50, 'price': 9000.0})
+
+
+def test_amends_round_by_the_side_given():
+    assert round_order(XBTUSD, {'orderQty': 250, 'price': 9000.7}, amend=True) == {'orderQty': 200, 'price': 9000.5}
+    assert round_order(XBTUSD, {'price': 9000.2}, side='Sell', amend=True) == {'price': 9000.5}
+
+
+def test_reads_reload_once_the_ttl_runs_out():
+    fetch = Fetch()
+    cache = InstrumentCache(fetch, ttl=0.05)
+
+    assert cache.get('XBTUSD')['tickSize'] == 0.5
+    assert cache.symbols() == ['XBTUSD', 'ETHUSD']
+    assert fetch.calls == 1
+    time.sleep(0.06)
+    assert cache.get('ETHUSD')['tickSize'] == 0.05
+    assert fetch.calls == 2 and cache.loads == 2
+
+
+def test_orders_round_against_a_stale_cache_while_it_reloads():
+    fetch = Fetch()
+    cache = InstrumentCache(fetch, ttl=0.05)
+    cache.get('XBTUSD')
+    time.sleep(0.06)
+    fetch.gate.clear()
+
+    # Served at once from the stale entries; one background reload for both orders.
+    assert cache.round_order({'symbol': 'XBTUSD', 'orderQty': 150, 'price': 9000.7})['price'] == 9000.5
+    assert cache.round_order({'symbol': 'XBTUSD', 'orderQty': 150, 'price': 9000.7})['orderQty'] == 100
+    assert cache.reloading and fetch.calls == 2
+    fetch.gate.set()
+    wait_for(lambda: not cache.reloading)
+    assert cache.loads == 2 and not cache.stale()
+
+
+def test_a_failed_background_reload_keeps_the_stale_entries():
+    fetch = Fetch()
+    cache = InstrumentCache(fetch, ttl=0.05)
+    cache.get('XBTUSD')
+    time.sleep(0.06)
+    fetch.error = IOError('instrument/active is down')
+
+    assert cache.round_order({'symbol': 'XBTUSD', 'orderQty': 100, 'price': 9000.7})['price'] == 9000.5
+    wait_for(lambda: cache.errors == 1)
+    # Not tried again straight away.
+    wait_for(lambda: not cache.reloading)
+    assert cache.round_order({'symbol': 'XBTUSD', 'orderQty': 100, 'price': 9000.2})['price'] == 9000.0
+    assert fetch.calls == 2 and cache.last_error is fetch.error
@@ -0,0 +1,60 @@
+from __future__ import absolute_import
+
+import os
+import signal
+import subprocess
+import sys
+
+from bitmex.bitmex import TradeClient
+from bitmex.ratelimit import RateLimiter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Places, amends and cancels until killed, printing a line per round trip.
+CHILD = '''
+import sys
+from bitmex.bitmex import TradeClient
+from bitmex.ratelimit import RateLimiter
+
+class Account:
+    apiKey = 'key'
+    apiSecret = 'secret'
+
+client = TradeClient(Account(), ratelimiter=RateLimiter(limit=1000000), base_url=sys.argv[1])
+client.open_journal(sys.argv[2])
+i = 0
+while True:
+    ack = client.buy('XBTUSD', 10, 'Limit', price=9000 - i % 50)
+    if i % 3 == 0:
+        client.cancel(ack['orderID'])
+    elif i % 7 == 0:
+        client.amend_bulk_orders([{'orderID': ack['orderID'], 'price': 8000}])
+    i += 1
+    print(i, flush=True)
+'''
+
+
+def test_journal_recovers_open_orders_after_sigkill(sim, account, tmp_path):
+    path = str(tmp_path / 'journal')
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get('PYTHONPATH')])))
+    child = subprocess.Popen([sys.executable, '-c', CHILD, sim.base_url, path], stdout=subprocess.PIPE, env=env)
+    try:
+        # Kill it mid-flight, once it has been through creates, amends and cancels.
+        for _ in range(40):
+            if not child.stdout.readline():
+                break
+    finally:
+        child.send_signal(signal.SIGKILL)
+        child.wait()
+        child.stdout.close()
+    assert child.returncode == -signal.SIGKILL
+
+    client = TradeClient(account, ratelimiter=RateLimiter(limit=1000000), base_url=sim.base_url)
+    recovery = client.open_journal(path)
+    try:
+        assert recovery.records > 0
+        recovered = sorted(order['orderID'] for order in client.order_store.open_orders('XBTUSD'))
+        exchange = sorted(order['orderID'] for order in sim.engine.open_orders(account.apiKey, 'XBTUSD'))
+        assert recovered and recovered == exchange
+    finally:
+        client.close_journal()
@@ -0,0 +1,103 @@
+from __future__ import absolute_import
+
+import random
+import socket
+
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+
+from bitmex.bitmex import TradeClient
+from bitmex.metrics import Histogram, Metrics, PrometheusExporter, StatsdSink
+from bitmex.ratelimit import RateLimiter
+
+
+def test_small_values_are_exact():
+    h = Histogram()
+    for value in range(1, 101):
+        h.record(value)
+
+    assert [h.percentile(q) for q in (1, 50, 90, 100)] == [1, 50, 90, 100]
+    assert (h.count, h.min, h.max, h.mean()) == (100, 1, 100, 50.5)
+
+
+def test_percentiles_are_within_the_precision():
+    rng = random.Random(7)
+    values = sorted(int(rng.lognormvariate(13, 1.5)) for _ in range(20000))
+    h = Histogram()
+    for value in values:
+        h.record(value)
+
+    for q in (50, 90, 99, 99.9):
+        exact = values[int(round(q / 100.0 * len(values))) - 1]
+        assert exact <= h.percentile(q) <= exact * (1 + 2.0 ** -6)
+    assert h.percentile(100) == values[-1]
+
+
+def test_out_of_range_values_are_clamped():
+    h = Histogram(max_bits=20)
+    h.record(-5)
+    h.record(1 << 30)
+
+    assert (h.min, h.max) == (0, 1 << 30)
+    assert h.percentile(100) == 1 << 30
+    h.reset()
+    assert h.count == 0 and h.percentile(50) is None
+
+
+def test_snapshot_reports_seconds_per_series():
+    metrics = Metrics()
+    for ms in (1, 2, 3, 4):
+        metrics.timing('request', ms * 1000000, verb='GET', endpoint='order')
+    metrics.incr('errors', endpoint='order', kind='timeout')
+    metrics.incr('errors', 2, endpoint='order', kind='timeout')
+
+    snapshot = metrics.snapshot()
+    request = snapshot['request{endpoint=order,verb=GET}']
+    assert request['count'] == 4
+    assert abs(request['p50'] - 0.002) < 0.002 * 0.02
+    assert request['max'] == 0.004
+    assert snapshot['errors{endpoint=order,kind=timeout}'] == 3
+    assert metrics.counter('errors', kind='timeout', endpoint='order') == 3
+
+
+def test_prometheus_and_statsd():
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(('127.0.0.1', 0))
+    receiver.settimeout(1)
+    metrics = Metrics(sinks=[StatsdSink(port=receiver.getsockname()[1])])
+
+    metrics.timing('request', 1500000, endpoint='order/bulk')
+    metrics.incr('responses', endpoint='order', status=200)
+
+    assert receiver.recv(512) == b'bitmex.request.order_bulk:1.500|ms'
+    assert receiver.recv(512) == b'bitmex.responses.order.200:1|c'
+    text = PrometheusExporter(metrics).render()
+    assert '# TYPE bitmex_request_seconds summary' in text
+    assert 'bitmex_request_seconds_count{endpoint="order/bulk"} 1' in text
+    assert 'bitmex_responses_total{endpoint="order",status="200"} 1' in text
+
+
+def test_exporter_serves_on_loopback_by_default():
+    metrics = Metrics()
+    metrics.incr('responses', endpoint='order', status=200)
+    exporter = PrometheusExporter(metrics)
+    port = exporter.serve(port=0)
+    try:
+        assert exporter.server.server_address[0] == '127.0.0.1'
+        body = urlopen('http://127.0.0.1:%d/metrics' % port, timeout=5).read().decode('utf8')
+        assert 'bitmex_responses_total{endpoint="order",status="200"} 1' in body
+    finally:
+        exporter.stop()
+
+
+def test_client_reports_requests(sim, account):
+    metrics = Metrics()
+    client = TradeClient(account, ratelimiter=RateLimiter(limit=100), base_url=sim.base_url, metrics=metrics)
+
+    client.balances()
+
+    assert metrics.histogram('request', endpoint='user/margin', verb='GET').count == 1
+    assert metrics.counter('responses', endpoint='user/margin', status=200) == 1
+    assert metrics.histogram('sign').count == 1
@@ -0,0 +1,76 @@
+from __future__ import absolute_import
+
+import pytest
+
+from bitmex import codec
+from bitmex.order import CLORDID_MAX_LEN, ClOrdIDGenerator, OrderState, base36, decode_ack
+
+ACK = {'orderID': 'a1', 'clOrdID': 'mm-x-1', 'symbol': 'XBTUSD', 'side': 'Buy', 'ordStatus': 'PartiallyFilled',
+       'orderQty': 100, 'cumQty': 40, 'leavesQty': 60, 'price': 9000.5, 'avgPx': 9000.5, 'account': 1,
+       'text': 'Submitted via API.'}
+
+
+def test_decode_ack_keeps_the_ack_fields():
+    state = decode_ack(ACK)
+
+    assert (state.orderID, state.ordStatus, state.cumQty, state.leavesQty, state.price) == \
+        ('a1', 'PartiallyFilled', 40, 60, 9000.5)
+    # Only ACK_FIELDS are decoded; the rest is dropped.
+    assert state.clOrdID is None and state.text is None
+    assert state.is_open()
+
+
+def test_decode_ack_from_raw_json_and_bulk():
+    assert decode_ack(codec.dumps(ACK)).orderID == 'a1'
+    assert decode_ack(codec.dumps([ACK, dict(ACK, orderID='a2')])).orderID == 'a1'
+    assert decode_ack([]) is None
+    assert decode_ack({'error': {'message': 'Invalid ordStatus', 'name': 'HTTPError'}}) is None
+
+
+def test_decode_ack_into_an_existing_state():
+    state = OrderState(orderID='a1', clOrdID='mm-x-1', ordStatus='New', orderQty=100, leavesQty=100)
+
+    assert decode_ack(dict(ACK, ordStatus='Filled', cumQty=100, leavesQty=0), into=state) is state
+    assert state.clOrdID == 'mm-x-1'
+    assert (state.ordStatus, state.leavesQty) == ('Filled', 0)
+    assert not state.is_open()
+
+
+def test_order_state_reads_like_an_ack():
+    state = OrderState().merge(ACK)
+
+    assert state['symbol'] == 'XBTUSD'
+    assert state.get('stopPx', 0) == 0
+    assert 'price' in state and 'stopPx' not in state
+    assert state.to_dict()['text'] == 'Submitted via API.'
+    assert 'account' not in state.to_dict()
+    with pytest.raises(KeyError):
+        state['account']
+    with pytest.raises(AttributeError):
+        state.account = 1
+
+
+def test_merge_copies_only_the_fields_present():
+    state = OrderState(orderID='a1', price=9000, orderQty=100)
+
+    state.merge({'orderID': 'a1', 'price': 9001, 'cumQty': 10}, fields=('price', 'cumQty', 'orderQty'))
+
+    assert (state.price, state.cumQty, state.orderQty) == (9001, 10, 100)
+
+
+def test_clordids_are_reproducible_per_session():
+    ids = ClOrdIDGenerator(session='s1')
+    again = ClOrdIDGenerator(session='s1')
+
+    first = [ids() for _ in range(40)]
+    assert first == [again() for _ in range(40)]
+    assert first[0] == 'mm-s1-1' and first[35] == 'mm-s1-10'
+    assert len(set(first)) == 40
+    assert ids.owns(first[0]) and not ids.owns('mm-s2-1') and not ids.owns(None)
+    assert base36(36 ** 2) == '100'
+
+
+def test_clordid_prefix_leaves_room_for_the_counter():
+    with pytest.raises(ValueError):
+        ClOrdIDGenerator(prefix='p' * CLORDID_MAX_LEN)
+    assert len(ClOrdIDGenerator()()) <= CLORDID_MAX_LEN
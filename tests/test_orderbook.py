@@ -0,0 +1,87 @@
+from __future__ import absolute_import
+
+from bitmex.orderbook import OrderBook
+
+ROWS = [{'symbol': 'XBTUSD', 'id': 1, 'side': 'Sell', 'price': 9002.0, 'size': 300},
+        {'symbol': 'XBTUSD', 'id': 2, 'side': 'Sell', 'price': 9001.0, 'size': 200},
+        {'symbol': 'XBTUSD', 'id': 3, 'side': 'Sell', 'price': 9000.5, 'size': 100},
+        {'symbol': 'XBTUSD', 'id': 4, 'side': 'Buy', 'price': 9000.0, 'size': 400},
+        {'symbol': 'XBTUSD', 'id': 5, 'side': 'Buy', 'price': 8999.5, 'size': 500}]
+
+
+def book():
+    return OrderBook.from_list('XBTUSD', ROWS)
+
+
+def test_to_list_matches_the_rest_layout():
+    # Sells by descending price, then buys by descending price.
+    assert book().to_list() == ROWS
+    assert book().to_list(depth=1) == [ROWS[2], ROWS[3]]
+
+
+def test_updates_and_deletes_by_level_id():
+    b = book()
+    b.apply('update', [{'symbol': 'XBTUSD', 'id': 3, 'side': 'Sell', 'size': 150}])
+    b.apply('insert', [{'symbol': 'XBTUSD', 'id': 6, 'side': 'Buy', 'price': 9000.25, 'size': 50}])
+    b.apply('delete', [{'symbol': 'XBTUSD', 'id': 1, 'side': 'Sell'}])
+
+    assert b.best_ask() == (9000.5, 150)
+    assert b.best_bid() == (9000.25, 50)
+    assert [row['id'] for row in b.to_list()] == [2, 3, 6, 4, 5]
+    assert len(b) == 5
+
+    b.apply('partial', ROWS[3:])
+    assert b.best_ask() is None and b.mid() is None
+    assert len(b) == 2
+
+
+def test_a_level_that_moves_sides_leaves_the_old_one():
+    b = book()
+    b.insert(3, 'Buy', 9000.25, 100)
+
+    assert [row['id'] for row in b.to_list()] == [1, 2, 3, 4, 5]
+    assert b.best_ask() == (9001.0, 200)
+    assert b.best_bid() == (9000.25, 100)
+    b.delete(3, 'Sell')
+    assert b.best_bid() == (9000.0, 400)
+
+
+def test_an_overwritten_level_is_forgotten():
+    b = book()
+    # A new id at an occupied price takes the level over; deleting the old id must not remove it.
+    b.insert(7, 'Sell', 9001.0, 250)
+    b.delete(2, 'Sell')
+
+    assert b.asks.prices.tolist() == [9000.5, 9001.0, 9002.0]
+    assert b.asks.ids.tolist() == [3, 7, 1]
+
+
+def test_depth_vwap_and_imbalance():
+    b = book()
+
+    assert b.mid() == 9000.25
+    assert b.depth('Sell', 9001.0) == 300
+    assert b.depth('Buy', 9000.0) == 400
+    assert b.depth('Buy', 9001.0) == 0
+    assert b.vwap('Buy', 100) == 9000.5
+    assert b.vwap('Buy', 250) == (100 * 9000.5 + 150 * 9001.0) / 250
+    assert b.vwap('Sell', 900) == (400 * 9000.0 + 500 * 8999.5) / 900
+    # Too thin: more than the side holds.
+    assert b.vwap('Sell', 901) is None
+    assert b.vwap('Buy', 0) is None
+    assert b.imbalance() == (900 - 600) / 1500.0
+    assert b.imbalance(levels=1) == (400 - 100) / 500.0
+    assert OrderBook('XBTUSD').imbalance() == 0.0
+
+
+def test_sides_grow_past_their_capacity():
+    b = OrderBook('XBTUSD', capacity=2)
+    for i in range(100):
+        b.insert(i, 'Buy', 9000.0 - i, i + 1)
+        b.insert(1000 + i, 'Sell', 9001.0 + i, i + 1)
+
+    assert len(b) == 200
+    assert b.best_bid() == (9000.0, 1)
+    assert b.best_ask() == (9001.0, 1)
+    assert b.bids.volume() == 5050
+    assert b.bids.prices.tolist() == sorted(b.bids.prices.tolist(), reverse=True)
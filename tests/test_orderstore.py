@@ -0,0 +1,87 @@
+from __future__ import absolute_import
+
+from bitmex import codec
+from bitmex.journal import ACK, ORDER, Journal
+from bitmex.orderstore import OrderStore
+from bitmex.ws import BitMEXWebsocket
+
+ORDER_ROW = {'orderID': 'o1', 'clOrdID': 'c1', 'symbol': 'XBTUSD', 'side': 'Buy', 'ordType': 'Limit',
+             'orderQty': 10, 'price': 9000, 'ordStatus': 'New', 'cumQty': 0, 'leavesQty': 10,
+             'workingIndicator': True, 'timestamp': '2020-01-01T00:00:00.000Z'}
+
+# Frames as the private streams send them: the partial, a new order, a partial fill, then the fill.
+FRAMES = [
+    {'table': 'order', 'action': 'partial', 'data': []},
+    {'table': 'execution', 'action': 'partial', 'data': []},
+    {'table': 'order', 'action': 'insert', 'data': [ORDER_ROW]},
+    {'table': 'execution', 'action': 'insert', 'data': [dict(ORDER_ROW, execID='e1', execType='Trade',
+                                                             ordStatus='PartiallyFilled', cumQty=4, leavesQty=6,
+                                                             timestamp='2020-01-01T00:00:01.000Z')]},
+    {'table': 'order', 'action': 'update', 'data': [{'orderID': 'o1', 'ordStatus': 'PartiallyFilled', 'cumQty': 4,
+                                                      'leavesQty': 6, 'timestamp': '2020-01-01T00:00:01.000Z'}]},
+    {'table': 'execution', 'action': 'insert', 'data': [dict(ORDER_ROW, execID='e2', execType='Trade',
+                                                             ordStatus='Filled', cumQty=10, leavesQty=0,
+                                                             timestamp='2020-01-01T00:00:02.000Z')]},
+    {'table': 'order', 'action': 'update', 'data': [{'orderID': 'o1', 'ordStatus': 'Filled', 'cumQty': 10,
+                                                      'leavesQty': 0, 'workingIndicator': False,
+                                                      'timestamp': '2020-01-01T00:00:02.000Z'}]},
+]
+
+
+def replay(frames):
+    ws = BitMEXWebsocket()
+    store = OrderStore()
+    store.attach(ws)
+    for frame in frames:
+        ws.on_message(codec.dumps(frame))
+    return ws, store
+
+
+def test_replayed_streams_fill_the_store():
+    ws, store = replay(FRAMES[:5])
+    assert store.live
+    assert [(o['orderID'], o['ordStatus'], o['leavesQty']) for o in store.open_orders('XBTUSD')] == \
+        [('o1', 'PartiallyFilled', 6)]
+    assert store.by_clordid('c1').cumQty == 4
+    assert len(store.executions) == 1
+
+    ws.on_message(codec.dumps(FRAMES[5]))
+    assert store.status('o1') == 'Filled'
+    assert store.open_orders() == []
+
+
+def test_stale_ack_does_not_reopen_a_filled_order():
+    ws, store = replay(FRAMES)
+    store.update(ORDER_ROW)
+
+    assert store.status('o1') == 'Filled'
+    assert store.get('o1').leavesQty == 0
+    assert store.open_orders() == []
+
+
+def test_stale_ack_does_not_undo_a_partial_fill():
+    ws, store = replay(FRAMES[:5])
+    store.update(dict(ORDER_ROW, timestamp='2020-01-01T00:00:01.000Z'))
+
+    assert (store.status('o1'), store.get('o1').cumQty, store.get('o1').leavesQty) == ('PartiallyFilled', 4, 6)
+
+
+def test_store_is_not_live_after_a_disconnect():
+    ws, store = replay(FRAMES[:3])
+    ws._on_close()
+    assert not store.live
+
+    ws.on_message(codec.dumps(FRAMES[0]))
+    assert store.live
+
+
+def test_recovery_ignores_a_stale_ack(tmp_path):
+    journal = Journal(str(tmp_path))
+    journal.append(ORDER, dict(ORDER_ROW, ordStatus='Filled', cumQty=10, leavesQty=0,
+                               timestamp='2020-01-01T00:00:02.000Z'))
+    journal.append(ACK, ORDER_ROW)
+    recovery = journal.recover()
+    journal.close()
+
+    assert recovery.store.status('o1') == 'Filled'
+    assert recovery.store.open_orders() == []
@@ -0,0 +1,136 @@
+from __future__ import absolute_import
+
+import pytest
+
+from bitmex.instruments import InstrumentCache
+from bitmex.positions import MID, PositionEngine
+from bitmex.ws import BitMEXWebsocket
+
+
+def engine(capacity=16):
+    instruments = InstrumentCache()
+    instruments.load([
+        {'symbol': 'XBTUSD', 'multiplier': -100000000, 'isInverse': True, 'initMargin': 0.01},
+        {'symbol': 'ETHUSDT', 'multiplier': 100, 'isInverse': False, 'initMargin': 0.05},
+    ])
+    return PositionEngine(instruments, capacity=capacity)
+
+
+def test_inverse_fills_realise_against_the_entry():
+    positions = engine()
+    positions.fill('XBTUSD', 1000, 10000.0)
+    positions.set_mark('XBTUSD', 11000.0)
+
+    position = positions.position('XBTUSD')
+    assert position['avgEntryPrice'] == pytest.approx(10000.0)
+    assert position['unrealisedPnl'] == pytest.approx(1000 * 1e8 / 10000 - 1000 * 1e8 / 11000)
+    assert positions.delta('XBTUSD') == pytest.approx(1000 / 11000.0)
+    assert position['margin'] == pytest.approx(1000 * 1e8 / 11000 / 100)
+
+    realised = positions.fill('XBTUSD', -400, 12000.0, comm=500)
+
+    assert realised == pytest.approx(400 * 1e8 / 10000 - 400 * 1e8 / 12000)
+    position = positions.position('XBTUSD')
+    assert position['currentQty'] == 600
+    assert position['avgEntryPrice'] == pytest.approx(10000.0)
+    assert position['realisedPnl'] == pytest.approx(realised)
+    assert positions.balances()['walletBalance'] == pytest.approx(realised - 500)
+
+
+def test_a_fill_through_zero_opens_the_other_side_at_its_price():
+    positions = engine()
+    positions.fill('XBTUSD', 600, 10000.0)
+
+    assert positions.fill('XBTUSD', -1000, 12500.0) == pytest.approx(600 * 1e8 / 10000 - 600 * 1e8 / 12500)
+    position = positions.position('XBTUSD')
+    assert position['currentQty'] == -400
+    assert position['avgEntryPrice'] == pytest.approx(12500.0)
+
+    positions.fill('XBTUSD', 400, 12000.0)
+    assert positions.position('XBTUSD')['currentQty'] == 0
+    assert positions.position('XBTUSD')['avgEntryPrice'] is None
+    assert positions.snapshot()['cost'][0] == 0
+
+
+def test_linear_pnl_and_one_pass_revalue():
+    positions = engine()
+    positions.set_marks({'XBTUSD': 10000.0, 'ETHUSDT': 2000.0})
+    positions.fill('ETHUSDT', 10, 2000.0)
+    positions.fill('XBTUSD', -1000, 10000.0)
+    single = positions.snapshot()
+
+    # A fill revalues its own symbol only; a full pass must agree with it.
+    positions.set_marks({})
+    for name in ('notional', 'unrealised', 'margin'):
+        assert positions.snapshot()[name] == pytest.approx(single[name])
+
+    positions.set_marks({'XBTUSD': 9000.0, 'ETHUSDT': 2100.0})
+    assert positions.position('ETHUSDT')['unrealisedPnl'] == pytest.approx(10 * 100 * 100)
+    assert positions.position('XBTUSD')['unrealisedPnl'] == pytest.approx(1000 * 1e8 / 9000 - 1000 * 1e8 / 10000)
+    balances = positions.balances()
+    assert balances['unrealisedPnl'] == pytest.approx(sum(p['unrealisedPnl'] for p in positions.positions()))
+    assert balances['availableMargin'] == pytest.approx(balances['marginBalance'] - balances['initMargin'])
+
+
+def test_arrays_grow_past_their_capacity():
+    positions = PositionEngine(capacity=2)
+    for i, symbol in enumerate(('A', 'B', 'C', 'D', 'E')):
+        positions.fill(symbol, i + 1, 100.0)
+        positions.set_leverage(symbol, 2)
+
+    assert [p['currentQty'] for p in positions.positions()] == [1, 2, 3, 4, 5]
+    assert list(positions.snapshot()['leverage']) == [2] * 5
+    assert positions.position('F') is None and positions.delta('F') == 0.0
+
+
+def test_load_seeds_from_rest_rows():
+    positions = engine()
+    positions.load([{'symbol': 'XBTUSD', 'currentQty': -500, 'avgEntryPrice': 10000.0, 'markPrice': 10000.0,
+                     'realisedPnl': 1234, 'leverage': 10}],
+                   {'walletBalance': 5000000})
+
+    position = positions.position('XBTUSD')
+    assert (position['currentQty'], position['avgEntryPrice'], position['realisedPnl']) == (-500, 10000.0, 1234)
+    assert position['unrealisedPnl'] == pytest.approx(0)
+    assert position['margin'] == pytest.approx(500 * 1e8 / 10000 / 10)
+    assert positions.balances()['walletBalance'] == 5000000
+    assert positions.live
+
+
+def test_follows_the_websocket():
+    positions = engine()
+    ws = BitMEXWebsocket()
+    positions.attach(ws)
+
+    def message(table, action, data):
+        ws.apply({'table': table, 'action': action, 'data': data})
+    message('position', 'partial', [{'symbol': 'XBTUSD', 'currentQty': 100, 'avgEntryPrice': 10000.0}])
+    message('margin', 'partial', [{'walletBalance': 1000000}])
+    message('execution', 'partial', [{'symbol': 'XBTUSD', 'execType': 'Trade', 'side': 'Buy', 'lastQty': 999,
+                                      'lastPx': 1.0}])
+    message('execution', 'insert', [{'symbol': 'XBTUSD', 'execType': 'Trade', 'side': 'Buy', 'lastQty': 100,
+                                     'lastPx': 10000.0, 'execComm': 75},
+                                    {'symbol': 'XBTUSD', 'execType': 'Funding', 'execComm': 25}])
+    message('instrument', 'update', [{'symbol': 'XBTUSD', 'markPrice': 10000.0}])
+
+    position = positions.position('XBTUSD')
+    assert position['currentQty'] == 200
+    assert position['execComm'] == 100
+    assert positions.balances()['walletBalance'] == 1000000 - 100
+    assert positions.live
+
+    ws._on_close()
+    assert not positions.live
+
+
+def test_marks_from_the_book_mid():
+    positions = engine()
+    ws = BitMEXWebsocket()
+    positions.attach(ws, marks=MID)
+    positions.fill('XBTUSD', 1000, 10000.0)
+
+    ws.apply({'table': 'orderBookL2_25', 'action': 'partial', 'data': [
+        {'symbol': 'XBTUSD', 'id': 1, 'side': 'Sell', 'price': 10001.0, 'size': 10},
+        {'symbol': 'XBTUSD', 'id': 2, 'side': 'Buy', 'price': 9999.0, 'size': 10}]})
+
+    assert positions.position('XBTUSD')['markPrice'] == 10000.0
@@ -0,0 +1,114 @@
+from __future__ import absolute_import
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+from bitmex.ratelimit import CANCEL, ORDER, QUERY, RateLimiter, priority_for
+
+
+def test_priorities():
+    assert priority_for('DELETE', 'order') == CANCEL
+    assert priority_for('POST', 'order/cancelAllAfter') == CANCEL
+    assert priority_for('POST', 'order/bulk') == ORDER
+    assert priority_for('PUT', 'order') == ORDER
+    assert priority_for('GET', 'order') == QUERY
+
+
+def test_reserves_keep_the_last_tokens_for_cancels():
+    limiter = RateLimiter(limit=3, period=60, reserve=(0, 1, 2))
+
+    assert limiter.try_acquire(QUERY) == 0
+    assert limiter.try_acquire(QUERY) > 0
+    assert limiter.try_acquire(ORDER) == 0
+    assert limiter.try_acquire(ORDER) > 0
+    assert limiter.try_acquire(CANCEL) == 0
+    assert limiter.acquired == [1, 1, 1]
+
+
+def test_queued_cancels_go_before_queries():
+    limiter = RateLimiter(limit=1, period=0.2, reserve=(0, 0, 0))
+    limiter.acquire(QUERY)
+    order = []
+
+    def take(priority):
+        limiter.acquire(priority)
+        order.append(priority)
+    query = threading.Thread(target=take, args=(QUERY,))
+    query.start()
+    time.sleep(0.02)
+    cancel = threading.Thread(target=take, args=(CANCEL,))
+    cancel.start()
+    query.join(5)
+    cancel.join(5)
+
+    assert order == [CANCEL, QUERY]
+    assert limiter.delayed == [1, 0, 1]
+
+
+def test_timeout_fails_at_once_instead_of_waiting():
+    limiter = RateLimiter(limit=1, period=60, reserve=(0, 0, 0))
+    limiter.acquire()
+
+    started = time.monotonic()
+    with pytest.raises(Exception, match='Rate limit'):
+        limiter.acquire(QUERY, timeout=0.5)
+    assert time.monotonic() - started < 0.1
+
+
+def test_throttle_blocks_every_priority_until_reset():
+    limiter = RateLimiter(limit=100)
+
+    reset = limiter.throttle({'Retry-After': '0.2'})
+    assert reset > time.time()
+    assert limiter.try_acquire(CANCEL) > 0
+    assert limiter.snapshot()['throttled'] == 1
+    waited = limiter.acquire(CANCEL)
+    assert 0.1 < waited < 1.0
+    # take() is for the reaction to a 429 itself: it never waits.
+    limiter.throttle({'Retry-After': '60'})
+    limiter.take(CANCEL)
+    assert limiter.budget() < 0
+
+
+def test_headers_resync_the_bucket():
+    limiter = RateLimiter(limit=60)
+
+    limiter.update({'X-RateLimit-Limit': '120', 'X-RateLimit-Remaining': '10',
+                    'X-RateLimit-Reset': str(time.time() + 60)})
+    assert limiter.limit == 120 and limiter.remaining == 10
+    assert limiter.budget() <= 10.01
+
+    limiter.update({'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': str(time.time() + 30)})
+    assert limiter.snapshot()['blocked_for'] > 29
+
+
+def test_async_waiters_queue_like_threads():
+    limiter = RateLimiter(limit=1, period=0.2, reserve=(0, 0, 0))
+    limiter.acquire(QUERY)
+
+    async def main():
+        order = []
+
+        async def take(priority):
+            await limiter.acquire_async(priority)
+            order.append(priority)
+        query = asyncio.ensure_future(take(QUERY))
+        await asyncio.sleep(0.02)
+        await asyncio.gather(query, take(CANCEL))
+        return order
+
+    assert asyncio.run(main()) == [CANCEL, QUERY]
+
+
+def test_async_timeout_fails_at_once_and_leaves_no_waiter():
+    limiter = RateLimiter(limit=1, period=60, reserve=(0, 0, 0))
+    limiter.acquire()
+
+    started = time.monotonic()
+    with pytest.raises(Exception, match='Rate limit'):
+        asyncio.run(limiter.acquire_async(QUERY, timeout=0.5))
+    assert time.monotonic() - started < 0.1
+    assert limiter.waiting == [0, 0, 0]
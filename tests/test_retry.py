@@ -0,0 +1,64 @@
+from __future__ import absolute_import
+
+import time
+
+import pytest
+
+from bitmex.retry import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, RetryPolicy, match_duplicates
+
+
+def test_only_requests_safe_to_repeat_are_retried():
+    policy = RetryPolicy(max_retries=3)
+
+    assert policy.begin('GET').max_retries == 3
+    assert policy.begin('POST', {'timeout': 60000}, path='order/cancelAllAfter').max_retries == 3
+    assert policy.begin('POST', {'orders': [{'clOrdID': 'a'}, {'clOrdID': 'b'}]}).max_retries == 3
+    assert policy.begin('POST', {'orders': [{'clOrdID': 'a'}, {'orderQty': 1}]}).max_retries == 0
+    # An amend naming its order by origClOrdID would be applied twice if it landed the first time.
+    assert policy.begin('PUT', {'origClOrdID': 'a', 'price': 9001}).max_retries == 0
+    assert policy.begin('PUT', {'origClOrdID': 'a', 'clOrdID': 'a2', 'price': 9001}).max_retries == 3
+
+
+def test_backoff_gives_up_at_the_deadline_but_a_429_waits():
+    state = RetryPolicy(max_retries=5, base=10, cap=10, deadline=0.5).begin('GET')
+
+    assert state.next_delay(wait=60) == 60
+    state.deadline = time.monotonic() - 1
+    assert state.next_delay(wait=2) == 2
+    assert state.next_delay() is None
+
+
+def test_retries_run_out():
+    state = RetryPolicy(max_retries=2, base=0.01, cap=0.01).begin('GET')
+
+    assert 0 <= state.next_delay() <= 0.01
+    assert 0 <= state.next_delay() <= 0.01
+    assert state.next_delay() is None
+
+
+def test_breaker_opens_then_lets_one_probe_through():
+    breaker = CircuitBreaker(threshold=2, cooldown=0.05)
+    breaker.failure()
+    assert breaker.allow() and breaker.state == CLOSED
+    breaker.failure()
+
+    assert breaker.state == OPEN and not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.allow() and breaker.state == HALF_OPEN
+    assert not breaker.allow()
+    breaker.failure()
+    assert breaker.state == OPEN and breaker.trips == 2
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.success()
+    assert breaker.state == CLOSED and breaker.allow()
+
+
+def test_duplicates_are_matched_to_what_was_sent():
+    found = [{'clOrdID': 'a', 'orderQty': 10, 'side': 'Sell', 'price': 9000.0, 'symbol': 'XBTUSD'}]
+
+    assert match_duplicates({'clOrdID': 'a', 'orderQty': -10, 'price': 9000.0, 'symbol': 'XBTUSD'}, found) == found[0]
+    # An amend that leaves the quantity alone.
+    assert match_duplicates({'orders': [{'origClOrdID': 'o', 'clOrdID': 'a', 'price': 9000.0}]}, found) == found
+    with pytest.raises(Exception):
+        match_duplicates({'clOrdID': 'a', 'orderQty': 10, 'price': 9000.0}, found)
@@ -0,0 +1,71 @@
+from __future__ import absolute_import
+
+import pytest
+
+from bitmex.risk import RiskError, RiskGate
+
+
+def row(status, leaves, **fields):
+    row = {'orderID': 'o1', 'clOrdID': 'c1', 'symbol': 'XBTUSD', 'side': 'Buy', 'orderQty': 10,
+           'ordStatus': status, 'leavesQty': leaves}
+    row.update(fields)
+    return row
+
+
+def test_ack_after_stream_close_does_not_book_again():
+    gate = RiskGate(max_open_orders=1)
+    gate.check('XBTUSD', 10, 9000, 'c1')
+    gate.on_order('update', [row('Filled', 0)])
+    gate.on_ack(row('New', 10))
+
+    assert gate.open_orders('XBTUSD') == (0, 0.0, 0.0)
+    gate.check('XBTUSD', 10, 9000, 'c2')
+    with pytest.raises(RiskError):
+        gate.check('XBTUSD', 10, 9000, 'c3')
+
+
+def test_ack_after_stream_close_of_a_foreign_order_is_ignored():
+    gate = RiskGate()
+    gate.on_order('update', [row('Canceled', 0, orderID='o2', clOrdID='')])
+    gate.on_ack(row('New', 10, orderID='o2', clOrdID=''))
+
+    assert gate.open_orders('XBTUSD') == (0, 0.0, 0.0)
+
+
+def test_open_foreign_orders_are_booked():
+    gate = RiskGate()
+    gate.on_order('partial', [row('New', 10, orderID='o2', clOrdID='')])
+
+    assert gate.open_orders('XBTUSD') == (1, 10.0, 0.0)
+
+
+def test_closed_keys_are_bounded(monkeypatch):
+    monkeypatch.setattr('bitmex.risk.REMEMBER_CLOSED', 4)
+    gate = RiskGate()
+    for i in range(3):
+        gate.on_order('update', [row('Canceled', 0, orderID='o%d' % i, clOrdID='c%d' % i)])
+
+    assert gate.closed == {'o1', 'c1', 'o2', 'c2'}
+    assert list(gate.closing) == ['o1', 'c1', 'o2', 'c2']
+
+
+def test_amends_of_a_partly_filled_order_count_only_what_rests():
+    gate = RiskGate(max_order_qty=60, max_position=100)
+    gate.check('XBTUSD', 60, 9000, 'c1')
+    gate.on_order('update', [row('PartiallyFilled', 20, orderQty=60, cumQty=40)])
+    gate.check('XBTUSD', 40, 9000, 'c2')
+
+    # orderQty 100 of which 40 are filled: 60 rest, 40 more than before, and the book reaches 100.
+    gate.check_amend({'orderID': 'o1', 'orderQty': 100})
+    with pytest.raises(RiskError) as e:
+        gate.check_amend({'orderID': 'o1', 'orderQty': 101})
+    assert e.value.check == 'max_order_qty'
+    gate.check_amend({'orderID': 'o1', 'leavesQty': 60})
+    with pytest.raises(RiskError) as e:
+        gate.check_amend({'orderID': 'o1', 'leavesQty': 61})
+    assert e.value.check == 'max_order_qty'
+    gate.set_limits(max_order_qty=None, max_position=80)
+    gate.check_amend({'orderID': 'o1', 'orderQty': 80})
+    with pytest.raises(RiskError) as e:
+        gate.check_amend({'orderID': 'o1', 'orderQty': 81})
+    assert e.value.check == 'max_position'
@@ -0,0 +1,174 @@
+from __future__ import absolute_import
+
+import pytest
+
+from bitmex.simulator import MatchingEngine, SimError
+
+
+def engine(**kwargs):
+    return MatchingEngine(liquidity=False, **kwargs)
+
+
+def sell(e, account, qty, price, **params):
+    return e.place(account, dict({'symbol': 'XBTUSD', 'side': 'Sell', 'orderQty': qty, 'price': price}, **params))
+
+
+def buy(e, account, qty, price=None, **params):
+    params = dict({'symbol': 'XBTUSD', 'side': 'Buy', 'orderQty': qty}, **params)
+    if price is not None:
+        params['price'] = price
+    return e.place(account, params)
+
+
+def status(e, order):
+    o = e.orders[order['orderID']]
+    return o.ordStatus, o.cumQty, o.leavesQty
+
+
+def test_price_then_time_priority():
+    e = engine()
+    first = sell(e, 'maker', 10, 10001)
+    second = sell(e, 'maker', 10, 10001)
+    better = sell(e, 'maker', 10, 10000.5)
+
+    taker = buy(e, 'taker', 25)
+
+    assert taker['ordStatus'] == 'Filled'
+    assert taker['avgPx'] == (10 * 10000.5 + 15 * 10001) / 25
+    assert status(e, better) == ('Filled', 10, 0)
+    assert status(e, first) == ('Filled', 10, 0)
+    assert status(e, second) == ('PartiallyFilled', 5, 5)
+    assert e.l2('XBTUSD') == [dict(e._level('XBTUSD', 'Sell', 10001), size=5)]
+    assert [(t['size'], t['price']) for t in e.recent_trades('XBTUSD')] == [(10, 10000.5), (10, 10001), (5, 10001)]
+    assert e.positions('taker')[0]['currentQty'] == 25
+
+
+def test_a_partly_filled_limit_rests_the_rest():
+    e = engine()
+    sell(e, 'maker', 10, 10001)
+
+    ack = buy(e, 'taker', 15, 10001.5)
+
+    assert (ack['ordStatus'], ack['cumQty'], ack['leavesQty']) == ('PartiallyFilled', 10, 5)
+    assert e.instrument('XBTUSD')[0]['bidPrice'] == 10001.5
+    # A market order with nothing left to take is cancelled, not rested.
+    market = buy(e, 'taker', 5)
+    assert market['ordStatus'] == 'Canceled'
+
+
+def test_stops_trigger_on_the_last_price():
+    e = engine()
+    sell(e, 'maker', 10, 10002)
+    sell(e, 'maker', 10, 10010)
+    stop = buy(e, 'taker', 5, stopPx=10002)
+
+    assert e.orders[stop['orderID']].triggered == ''
+    assert not stop['workingIndicator']
+    buy(e, 'other', 1, 10002)
+
+    assert status(e, stop) == ('Filled', 5, 0)
+    assert e.orders[stop['orderID']].avgPx == 10002
+
+
+def test_post_only_never_takes():
+    e = engine()
+    sell(e, 'maker', 10, 10001)
+
+    crossing = buy(e, 'taker', 5, 10001, execInst='ParticipateDoNotInitiate')
+    resting = buy(e, 'taker', 5, 10000, execInst='ParticipateDoNotInitiate')
+
+    assert crossing['ordStatus'] == 'Canceled'
+    assert resting['ordStatus'] == 'New'
+    assert e.recent_trades('XBTUSD') == []
+
+
+def test_reduce_only_may_not_open_or_grow_a_position():
+    e = engine()
+    with pytest.raises(SimError):
+        sell(e, 'taker', 5, 10000, execInst='ReduceOnly')
+    sell(e, 'maker', 10, 10001)
+    buy(e, 'taker', 10)
+    with pytest.raises(SimError):
+        buy(e, 'taker', 1, 9000, execInst='ReduceOnly')
+    with pytest.raises(SimError):
+        sell(e, 'taker', 11, 11000, execInst='ReduceOnly')
+
+    assert sell(e, 'taker', 10, 11000, execInst='ReduceOnly')['ordStatus'] == 'New'
+
+
+def test_a_bulk_place_is_rejected_as_a_whole():
+    e = engine()
+    orders = [{'symbol': 'XBTUSD', 'side': 'Buy', 'orderQty': 10, 'price': 9000, 'clOrdID': 'a'},
+              {'symbol': 'XBTUSD', 'side': 'Buy', 'orderQty': 10, 'price': 9000.3, 'clOrdID': 'b'}]
+
+    with pytest.raises(SimError, match='tickSize'):
+        e.place_bulk('taker', orders)
+    with pytest.raises(SimError, match='Duplicate'):
+        e.place_bulk('taker', [orders[0], dict(orders[0], price=8999)])
+    assert e.open_orders('taker') == [] and e.clOrdIDs == {}
+
+    orders[1]['price'] = 9000.5
+    assert [ack['clOrdID'] for ack in e.place_bulk('taker', orders)] == ['a', 'b']
+
+
+def test_a_bulk_place_checks_its_margin_together():
+    # 1 XBT at 100x covers 1,000,000 contracts at 10000.
+    e = engine()
+    order = {'symbol': 'XBTUSD', 'side': 'Buy', 'orderQty': 600000, 'price': 10000}
+
+    with pytest.raises(SimError, match='insufficient'):
+        e.place_bulk('taker', [order, order])
+    assert e.open_orders('taker') == []
+
+
+def test_a_bulk_amend_is_rejected_as_a_whole():
+    e = engine()
+    first = buy(e, 'taker', 10, 9000)
+    second = buy(e, 'taker', 10, 9001)
+
+    with pytest.raises(SimError):
+        e.amend_bulk('taker', [{'orderID': first['orderID'], 'price': 8999},
+                               {'orderID': second['orderID'], 'price': 8999.3}])
+    assert e.orders[first['orderID']].price == 9000
+
+    e.amend_bulk('taker', [{'orderID': first['orderID'], 'orderQty': 20},
+                           {'orderID': second['orderID'], 'leavesQty': 5}])
+    assert status(e, first) == ('New', 0, 20)
+    assert status(e, second) == ('New', 0, 5)
+
+
+def test_amending_a_partly_filled_order_keeps_its_fills():
+    e = engine()
+    sell(e, 'maker', 4, 9000)
+    order = buy(e, 'taker', 10, 9000)
+
+    e.amend('taker', {'orderID': order['orderID'], 'orderQty': 6})
+
+    assert status(e, order) == ('PartiallyFilled', 4, 2)
+    with pytest.raises(SimError):
+        e.amend('taker', {'orderID': order['orderID'], 'orderQty': 4})
+
+
+def test_cancels_report_each_id():
+    e = engine()
+    open_order = buy(e, 'taker', 10, 9000, clOrdID='x')
+    sell(e, 'maker', 10, 9500)
+    filled = buy(e, 'taker', 10, 9500)
+
+    results = e.cancel('taker', orderIDs=[filled['orderID'], 'missing'], clOrdIDs='x')
+
+    assert results[0]['error'].endswith('Filled')
+    assert results[1] == {'orderID': 'missing', 'error': 'Not Found'}
+    assert results[2]['ordStatus'] == 'Canceled'
+    assert status(e, open_order) == ('Canceled', 0, 0)
+
+
+def test_cancel_all_after_fires_once_due():
+    e = engine()
+    buy(e, 'taker', 10, 9000)
+    e.cancel_all_after('taker', 60000)
+
+    e.expire()
+    assert len(e.open_orders('taker')) == 1
+    e.expire(now=e.accounts['taker'].cancel_at)
+    assert e.open_orders('taker') == []
@@ -0,0 +1,117 @@
+from __future__ import absolute_import
+
+import asyncio
+import threading
+
+import pytest
+
+from bitmex.singleflight import AsyncSingleFlight, SingleFlight, request_key
+
+
+def run_threads(n, target):
+    threads = [threading.Thread(target=target) for _ in range(n)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+
+def test_concurrent_callers_share_one_call():
+    flight = SingleFlight()
+    release = threading.Event()
+    calls = []
+    results = []
+
+    def fetch():
+        calls.append(1)
+        release.wait(5)
+        return {'orders': []}
+
+    def caller():
+        results.append(flight.do(request_key('GET', 'order', {'count': 500}), fetch))
+
+    threading.Timer(0.1, release.set).start()
+    run_threads(5, caller)
+
+    assert len(calls) == 1 and flight.requests == 1 and flight.shared == 4
+    assert all(result is results[0] for result in results)
+    # Finished without a ttl: the next read sends its own.
+    flight.do(request_key('GET', 'order', {'count': 500}), fetch)
+    assert len(calls) == 2
+
+
+def test_a_failure_is_raised_in_every_caller():
+    flight = SingleFlight()
+    release = threading.Event()
+    errors = []
+
+    def fetch():
+        release.wait(5)
+        raise IOError('down')
+
+    def caller():
+        try:
+            flight.do('key', fetch)
+        except IOError as e:
+            errors.append(e)
+
+    threading.Timer(0.1, release.set).start()
+    run_threads(3, caller)
+
+    assert len(errors) == 3 and flight.requests == 1
+    # Failures are never kept, even with a ttl.
+    assert flight.calls == {}
+
+
+def test_ttl_keeps_results_until_a_write_invalidates_them():
+    flight = SingleFlight(ttl=60)
+    calls = []
+
+    assert flight.do('key', lambda: calls.append(1) or len(calls)) == 1
+    assert flight.do('key', lambda: calls.append(1) or len(calls)) == 1
+    flight.invalidate()
+    assert flight.do('key', lambda: calls.append(1) or len(calls)) == 2
+
+
+def test_request_keys_ignore_dict_order():
+    assert request_key('GET', 'order', {'a': 1, 'b': 2}) == request_key('GET', 'order', {'b': 2, 'a': 1})
+    assert request_key('GET', 'order', private=True) != request_key('GET', 'order', private=False)
+
+
+def test_async_leader_cancelled_does_not_fail_the_others():
+    async def main():
+        flight = AsyncSingleFlight()
+        calls = []
+
+        async def fetch():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return [1, 2, 3]
+
+        leader = asyncio.ensure_future(flight.do('key', fetch))
+        await asyncio.sleep(0)
+        followers = [asyncio.ensure_future(flight.do('key', fetch)) for _ in range(3)]
+        await asyncio.sleep(0)
+        leader.cancel()
+        results = await asyncio.gather(*followers)
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return calls, results, flight
+
+    calls, results, flight = asyncio.run(main())
+    assert calls == [1] and results == [[1, 2, 3]] * 3
+    assert (flight.requests, flight.shared) == (1, 3)
+
+
+def test_async_failure_is_shared():
+    async def main():
+        flight = AsyncSingleFlight()
+
+        async def fetch():
+            await asyncio.sleep(0.01)
+            raise IOError('down')
+
+        return await asyncio.gather(*[flight.do('key', fetch) for _ in range(3)], return_exceptions=True)
+
+    errors = asyncio.run(main())
+    assert [type(e) for e in errors] == [IOError] * 3 and errors[0] is errors[1]
@@ -0,0 +1,96 @@
+from __future__ import absolute_import
+
+import os
+
+from bitmex.tickstore import RECORD, TickRecorder, TickReplay, ReplayWebsocket
+from bitmex.ws import BitMEXWebsocket
+
+BOOK = [{'symbol': 'XBTUSD', 'id': 1, 'side': 'Sell', 'price': 9001.0, 'size': 200},
+        {'symbol': 'XBTUSD', 'id': 2, 'side': 'Sell', 'price': 9000.5, 'size': 100},
+        {'symbol': 'XBTUSD', 'id': 3, 'side': 'Buy', 'price': 9000.0, 'size': 300}]
+TRADE = {'timestamp': '2026-10-16T12:00:00.123Z', 'symbol': 'XBTUSD', 'side': 'Buy', 'size': 50, 'price': 9000.5,
+         'tickDirection': 'PlusTick', 'trdMatchID': '2c9e3d8a-7b2e-4e3f-9a0c-0d3c5e2b6f11', 'grossValue': 555550,
+         'homeNotional': 0.0055555, 'foreignNotional': 50}
+MESSAGES = [
+    ('orderBookL2_25', 'partial', BOOK),
+    ('trade', 'partial', []),
+    ('instrument', 'partial', [{'symbol': 'XBTUSD', 'lastPrice': 9000.5, 'tickSize': 0.5, 'lotSize': 100,
+                                'state': 'Open'}]),
+    ('orderBookL2_25', 'update', [{'symbol': 'XBTUSD', 'id': 2, 'side': 'Sell', 'size': 50}]),
+    ('trade', 'insert', [TRADE]),
+    ('orderBookL2_25', 'delete', [{'symbol': 'XBTUSD', 'id': 1, 'side': 'Sell'}]),
+    ('instrument', 'update', [{'symbol': 'XBTUSD', 'lastPrice': 9001.0}]),
+]
+
+
+def live(messages):
+    ws = BitMEXWebsocket()
+    ws.symbols = ['XBTUSD']
+    for table, action, data in messages:
+        ws.apply({'table': table, 'action': action, 'data': data})
+    return ws
+
+
+def record(path, messages, batch=4096):
+    recorder = TickRecorder(path, batch=batch)
+    ws = live([])
+    recorder.attach(ws)
+    for table, action, data in messages:
+        ws.apply({'table': table, 'action': action, 'data': data})
+    recorder.close()
+    return recorder
+
+
+def test_replay_rebuilds_the_live_tables(tmp_path):
+    path = str(tmp_path / 'ticks')
+    record(path, MESSAGES, batch=2)
+    expected = live(MESSAGES)
+
+    ws = ReplayWebsocket(TickReplay(path))
+    ws.connect()
+    ws.thread.join(5)
+
+    assert ws.order_book('XBTUSD') == expected.order_book('XBTUSD')
+    assert ws.recent_trades('XBTUSD') == [TRADE]
+    assert ws.instrument('XBTUSD')['lastPrice'] == 9001.0
+    assert ws.instrument('XBTUSD')['tickSize'] == 0.5
+    assert ws.has_book('XBTUSD') and ws.has_trades('XBTUSD')
+
+
+def test_messages_keep_their_boundaries(tmp_path):
+    path = str(tmp_path / 'ticks')
+    recorder = TickRecorder(path)
+    # Two updates in one nanosecond are still two messages.
+    recorder.on_book('update', BOOK[:1], ts=1)
+    recorder.on_book('update', BOOK[1:], ts=1)
+    recorder.on_trade('partial', [], ts=2)
+    recorder.close()
+
+    messages = list(TickReplay(path).messages())
+
+    assert [(ts, action, symbol, len(rows)) for ts, _, action, symbol, rows in messages] == \
+        [(1, 2, 'XBTUSD', 1), (1, 2, 'XBTUSD', 2), (2, 0, None, 0)]
+
+
+def test_recording_appends_and_drops_a_torn_record(tmp_path):
+    path = str(tmp_path / 'ticks')
+    record(path, MESSAGES[:1])
+    with open(os.path.join(path, 'ticks.bin'), 'ab') as f:
+        f.write(b'\0' * (RECORD.itemsize // 2))
+
+    recorder = record(path, MESSAGES[3:4])
+
+    assert len(recorder) == 4
+    assert len(TickReplay(path)) == 4
+    assert TickReplay(path).symbols == ['XBTUSD']
+
+
+def test_replay_feeds_book_listeners_rows(tmp_path):
+    path = str(tmp_path / 'ticks')
+    record(path, MESSAGES)
+    ws = ReplayWebsocket(TickReplay(path))
+    seen = []
+    ws.add_listener('orderBookL2_25', lambda action, data: seen.append((action, len(data))))
+
+    assert TickReplay(path).play(ws) == len(MESSAGES)
+    assert seen == [('partial', 3), ('update', 1), ('delete', 1)]
@@ -0,0 +1,79 @@
+from __future__ import absolute_import
+
+import pytest
+
+from bitmex import codec, tracing
+from bitmex.bitmex import TradeClient
+from bitmex.ratelimit import RateLimiter
+from bitmex.tracing import ACKED, BOOK, BUILT, RECEIVED, SENT, SIGNED, STRATEGY, Tracer
+from bitmex.ws import BitMEXWebsocket
+
+
+def test_stamps_land_in_the_trace_and_the_ring():
+    tracer = Tracer(size=8)
+    trace = tracer.begin()
+    trace.stamp(SENT, trace.stamps[RECEIVED] + 3000)
+    trace.stamp(ACKED, trace.stamps[RECEIVED] + 10000)
+
+    assert trace.elapsed() == 10000
+    assert trace.elapsed(SENT, ACKED) == 7000
+    assert trace.elapsed(BOOK, ACKED) is None
+    records = tracer.records()
+    assert records['stage'].tolist() == [RECEIVED, SENT, ACKED]
+    assert set(records['trace'].tolist()) == {trace.id}
+
+
+def test_the_ring_keeps_the_latest_stamps():
+    tracer = Tracer(size=4)
+    traces = [tracer.begin() for _ in range(6)]
+
+    assert tracer.records()['trace'].tolist() == [t.id for t in traces[2:]]
+    with pytest.raises(ValueError):
+        Tracer(size=6)
+
+
+def test_summary_per_stage_pair(tmp_path):
+    tracer = Tracer()
+    for i in range(100):
+        trace = tracer.begin()
+        start = trace.stamps[RECEIVED]
+        trace.stamp(BUILT, start + 1000)
+        trace.stamp(ACKED, start + 1000 + 1000 * (i + 1))
+    path = str(tmp_path / 'trace.npy')
+    tracer.dump(path)
+
+    summary = tracing.summary(tracing.load(path))
+
+    assert summary['received->built']['count'] == 100
+    assert summary['received->built']['p50'] == 1.0
+    assert summary['built->acked']['max'] == 100.0
+    assert summary['received->acked']['p50'] == pytest.approx(51.5)
+    assert tracing.main([path]) == 0
+
+
+def test_websocket_frames_start_traces_for_the_listeners():
+    tracer = Tracer()
+    ws = BitMEXWebsocket(tracer=tracer)
+    seen = []
+    ws.add_listener('trade', lambda action, data: seen.append(ws.trace))
+
+    ws.on_message(codec.dumps({'table': 'trade', 'action': 'partial', 'data': []}))
+
+    trace = seen[0]
+    assert all(trace.stamps[stage] for stage in (RECEIVED, BOOK, STRATEGY))
+    assert ws.trace is None
+    assert BitMEXWebsocket().trace is None
+
+
+def test_orders_are_stamped_through_the_request_path(sim, account):
+    client = TradeClient(account, ratelimiter=RateLimiter(limit=100), base_url=sim.base_url)
+    client.round_orders = False
+    trace = Tracer().begin()
+
+    client.buy('XBTUSD', 1, 'Limit', price=9000, trace=trace)
+
+    signed, sent, acked = (trace.stamps[stage] for stage in (SIGNED, SENT, ACKED))
+    assert trace.stamps[RECEIVED] <= signed <= sent <= acked
+    tracing.stamp(None, BUILT)
+    tracing.stamp([trace], BUILT)
+    assert trace.stamps[BUILT] > acked
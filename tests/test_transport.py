@@ -0,0 +1,64 @@
+from __future__ import absolute_import
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from bitmex.bitmex import TradeClient
+from bitmex.ratelimit import RateLimiter
+from bitmex.simulator import Simulator
+from bitmex.transport import Transport
+
+# Self-signed certificate and key for localhost and 127.0.0.1, for tests only.
+CERT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'localhost.pem')
+
+
+@pytest.fixture
+def tls_sim(account):
+    with Simulator(accounts={account.apiKey: account.apiSecret}, rate_limit=100000, certfile=CERT) as sim:
+        yield sim
+
+
+def tls_client(sim, account, **kwargs):
+    transport = Transport(verify=CERT, **kwargs)
+    return TradeClient(account, ratelimiter=RateLimiter(limit=100000), base_url=sim.base_url, transport=transport)
+
+
+def connections(client):
+    """Connections opened so far by the client's pools."""
+    pools = client.client.transport.adapter.poolmanager.pools
+    return sum(pools[key].num_connections for key in pools.keys())
+
+
+def test_timings_split_connect_tls_and_ttfb(tls_sim, account):
+    client = tls_client(tls_sim, account)
+    assert tls_sim.base_url.startswith('https://')
+
+    client.ticker('XBTUSD')
+    first = client.client.transport.last_timing()
+    assert first.connect > 0 and first.tls > 0
+    assert 0 < first.ttfb <= first.total
+
+    client.order_book('XBTUSD')
+    second = client.client.transport.last_timing()
+    assert second.connect == 0 and second.tls == 0
+    assert 0 < second.ttfb <= second.total
+    assert connections(client) == 1
+
+
+def test_preconnected_pool_is_reused(tls_sim, account):
+    client = tls_client(tls_sim, account, pool_maxsize=3)
+
+    warmup = client.client.transport.preconnect(client.client.base_url + 'instrument/active', 3)
+    assert len(warmup) == 3 and all(timing.tls > 0 for timing in warmup)
+    assert connections(client) == 3
+
+    timings = client.client.transport.timings
+    before = len(timings)
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        # Distinct queries, so none of them joins another in flight.
+        list(executor.map(lambda depth: client.order_book('XBTUSD', depth), range(1, 10)))
+    assert len(timings) == before + 9
+    assert all(timing.connect == 0 and timing.tls == 0 for timing in list(timings)[before:])
+    assert connections(client) == 3
@@ -0,0 +1,126 @@
+from __future__ import absolute_import
+
+import time
+
+from bitmex import codec
+from bitmex.bitmex import TradeClient
+from bitmex.ratelimit import RateLimiter
+from bitmex.ws import BitMEXWebsocket
+
+# Recorded orderBookL2_25, trade and instrument frames of one symbol.
+FRAMES = [
+    {'table': 'orderBookL2_25', 'action': 'partial', 'keys': ['symbol', 'id', 'side'], 'data': [
+        {'symbol': 'XBTUSD', 'id': 8799100000, 'side': 'Sell', 'size': 300, 'price': 9000.0},
+        {'symbol': 'XBTUSD', 'id': 8799100050, 'side': 'Sell', 'size': 200, 'price': 8999.5},
+        {'symbol': 'XBTUSD', 'id': 8799100100, 'side': 'Buy', 'size': 100, 'price': 8999.0},
+        {'symbol': 'XBTUSD', 'id': 8799100150, 'side': 'Buy', 'size': 400, 'price': 8998.5}]},
+    {'table': 'trade', 'action': 'partial', 'keys': [], 'data': [
+        {'timestamp': '2020-01-01T00:00:00.000Z', 'symbol': 'XBTUSD', 'side': 'Buy', 'size': 5,
+         'price': 8999.5, 'tickDirection': 'PlusTick', 'trdMatchID': 't1'}]},
+    {'table': 'instrument', 'action': 'partial', 'keys': ['symbol'], 'data': [
+        {'symbol': 'XBTUSD', 'lastPrice': 8999.5, 'markPrice': 8999.2, 'tickSize': 0.5}]},
+    {'table': 'orderBookL2_25', 'action': 'insert', 'data': [
+        {'symbol': 'XBTUSD', 'id': 8799100080, 'side': 'Sell', 'size': 50, 'price': 8999.2}]},
+    {'table': 'orderBookL2_25', 'action': 'update', 'data': [
+        {'symbol': 'XBTUSD', 'id': 8799100100, 'side': 'Buy', 'size': 150}]},
+    {'table': 'orderBookL2_25', 'action': 'delete', 'data': [
+        {'symbol': 'XBTUSD', 'id': 8799100000, 'side': 'Sell'}]},
+    {'table': 'trade', 'action': 'insert', 'data': [
+        {'timestamp': '2020-01-01T00:00:01.000Z', 'symbol': 'XBTUSD', 'side': 'Sell', 'size': 7,
+         'price': 8999.0, 'tickDirection': 'MinusTick', 'trdMatchID': 't2'}]},
+    {'table': 'instrument', 'action': 'update', 'data': [
+        {'symbol': 'XBTUSD', 'lastPrice': 8999.0, 'markPrice': 8999.1}]},
+]
+
+
+def wait(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def levels(ws):
+    return [(row['side'], row['price'], row['size']) for row in ws.order_book('XBTUSD')]
+
+
+def test_recorded_frames_build_the_tables():
+    ws = BitMEXWebsocket()
+    ws.symbols = ['XBTUSD']
+    seen = []
+    ws.add_listener('orderBookL2_25', lambda action, data: seen.append(action))
+    for frame in FRAMES[:3]:
+        ws.on_message(codec.dumps(frame))
+    assert ws.has_book('XBTUSD') and ws.has_trades('XBTUSD') and ws.has_instrument('XBTUSD')
+    assert levels(ws) == [('Sell', 9000.0, 300), ('Sell', 8999.5, 200), ('Buy', 8999.0, 100), ('Buy', 8998.5, 400)]
+
+    for frame in FRAMES[3:]:
+        ws.on_message(codec.dumps(frame))
+    assert levels(ws) == [('Sell', 8999.5, 200), ('Sell', 8999.2, 50), ('Buy', 8999.0, 150), ('Buy', 8998.5, 400)]
+    assert [trade['trdMatchID'] for trade in ws.recent_trades('XBTUSD')] == ['t1', 't2']
+    assert ws.instrument('XBTUSD') == {'symbol': 'XBTUSD', 'lastPrice': 8999.0, 'markPrice': 8999.1,
+                                       'tickSize': 0.5}
+    assert seen == ['partial', 'insert', 'update', 'delete']
+
+
+def test_empty_partials_clear_the_subscribed_symbols():
+    ws = BitMEXWebsocket()
+    ws.symbols = ['XBTUSD']
+    for frame in FRAMES:
+        ws.on_message(codec.dumps(frame))
+    ws.on_message(codec.dumps({'table': 'orderBookL2_25', 'action': 'partial', 'data': []}))
+    ws.on_message(codec.dumps({'table': 'trade', 'action': 'partial', 'data': []}))
+    assert ws.live_order_book('XBTUSD') == []
+    assert ws.live_trades('XBTUSD') == []
+
+
+def test_error_frame_is_kept():
+    ws = BitMEXWebsocket()
+    ws.on_message(codec.dumps({'status': 401, 'error': 'Not authenticated'}))
+    assert ws.error == 'Not authenticated'
+
+
+def test_drop_falls_back_to_rest_and_reconnects(sim, account):
+    client = TradeClient(account, ratelimiter=RateLimiter(limit=100000), base_url=sim.base_url)
+    ws = client.connect_websocket('XBTUSD')
+    try:
+        assert ws.has_book('XBTUSD') and ws.is_connected()
+        served = sim.requests
+        client.order_book('XBTUSD')
+        assert sim.requests == served
+
+        drops = []
+        ws.add_disconnect_listener(lambda: drops.append(1))
+        sim.drop_websockets()
+        assert wait(lambda: not ws.has_book('XBTUSD'))
+        assert ws.live_order_book('XBTUSD') is None and ws.live_trades('XBTUSD') is None
+        assert not ws.partials
+        # With the book gone the client asks REST, not the frozen copy.
+        assert client.order_book('XBTUSD') == sim.engine.l2('XBTUSD', 25)
+        assert sim.requests > served
+
+        assert wait(lambda: ws.has_book('XBTUSD'))
+        assert ws.reconnects == 1 and ws.is_connected()
+        client.buy('XBTUSD', 30000, 'Market')
+        assert wait(lambda: ws.order_book('XBTUSD') == sim.engine.l2('XBTUSD', 25))
+        # Heard once, though both the websocket's on_close and the end of run_forever report it.
+        assert drops == [1]
+    finally:
+        client.close_websocket()
+
+
+def test_exit_reports_the_drop_once_and_stops_serving():
+    ws = BitMEXWebsocket()
+    drops = []
+    ws.add_disconnect_listener(lambda: drops.append(1))
+    for frame in FRAMES[:3]:
+        ws.on_message(codec.dumps(frame))
+    assert ws.live_order_book('XBTUSD') == ws.order_book('XBTUSD')
+    assert ws.live_instrument('XBTUSD')['markPrice'] == 8999.2
+
+    ws.exit()
+    ws._on_close()
+
+    assert drops == [1]
+    assert ws.live_order_book('XBTUSD') is None and ws.live_book('XBTUSD') is None
+    assert ws.live_instrument('XBTUSD') is None